@@ -0,0 +1,20 @@
+# Generated by Django 5.2.7 on 2026-10-19 12:37
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actions', '0003_initial'),
+        ('files', '0005_related_media'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='mediaaction',
+            index=models.Index(fields=['action', 'action_date', 'media'], name='actions_med_action_a926e6_idx'),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2.7 on 2026-10-19 12:37
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actions', '0005_watch_rate_limits'),
+        ('files', '0005_related_media'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MediaActionDaily',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('action', models.CharField(choices=[('like', 'Like'), ('dislike', 'Dislike'), ('watch', 'Watch'), ('report', 'Report')], max_length=20)),
+                ('count', models.PositiveIntegerField(default=0)),
+                ('unique_viewers', models.PositiveIntegerField(default=0)),
+                ('media', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='dailyactions', to='files.media')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['action', 'day', 'media'], name='actions_med_action_0d740e_idx')],
+                'constraints': [models.UniqueConstraint(fields=('media', 'day', 'action'), name='unique_media_day_action')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 12:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('actions', '0006_media_action_daily'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mediaactiondaily',
+            name='viewers_sketch',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+    ]
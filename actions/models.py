@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 
 from files.models import Media
 from users.models import User
@@ -31,7 +32,8 @@ class MediaAction(models.Model):
     media = models.ForeignKey(
         Media, on_delete=models.CASCADE, related_name="mediaactions"
     )
-    action_date = models.DateTimeField(auto_now_add=True)
+    # not auto_now_add, buffered actions are stored with the time of their request
+    action_date = models.DateTimeField(default=timezone.now, editable=False)
     remote_ip = models.CharField(max_length=40, blank=True, null=True)
 
     def save(self, *args, **kwargs):
@@ -44,4 +46,37 @@ class MediaAction(models.Model):
         indexes = [
             models.Index(fields=["user", "action", "-action_date"]),
             models.Index(fields=["session_key", "action"]),
+            # grouped counts of recent actions, eg get_list_of_popular_media
+            models.Index(fields=["action", "action_date", "media"]),
+            # recent anonymous views per IP, when actions are stored in batches
+            models.Index(fields=["media", "remote_ip", "action_date"]),
+        ]
+
+
+class MediaActionDaily(models.Model):
+    """Daily counts of the actions on a media, rolled up from MediaAction"""
+
+    media = models.ForeignKey(
+        Media, on_delete=models.CASCADE, related_name="dailyactions"
+    )
+    day = models.DateField()
+    action = models.CharField(max_length=20, choices=USER_MEDIA_ACTIONS)
+    count = models.PositiveIntegerField(default=0)
+    # distinct users and anonymous sessions, approximate for watches with
+    # a sketch
+    unique_viewers = models.PositiveIntegerField(default=0)
+    # HyperLogLog sketch of the viewers of watches, see files.unique_viewers
+    viewers_sketch = models.BinaryField(blank=True, null=True, editable=False)
+
+    def __str__(self):
+        return f"{self.action} {self.day}"
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["media", "day", "action"], name="unique_media_day_action"
+            ),
+        ]
+        indexes = [
+            models.Index(fields=["action", "day", "media"]),
         ]
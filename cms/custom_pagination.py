@@ -1,7 +1,15 @@
-from rest_framework.pagination import PageNumberPagination
+import base64
+import json
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, PageNumberPagination
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
 from collections import OrderedDict  # requires Python 2.7 or later
+from django.core.exceptions import FieldDoesNotExist, ValidationError
 from django.core.paginator import Paginator
+from django.db.models import F, Q
 from django.utils.functional import cached_property
 
 
@@ -27,3 +35,187 @@ class FastPaginationWithoutCount(PageNumberPagination):
                 ]
             )
         )
+
+
+class KeysetPagination(BasePagination):
+    """
+    Keyset (cursor) pagination.
+
+    Instead of an OFFSET, a page continues from the sort key of the last row
+    seen, so page 200 of an infinite scroll costs the same as page 1.
+    `ordering` must end with a unique field (eg id) so that the position is
+    unambiguous. Cursors are opaque to clients.
+
+    Requests that carry a `page` parameter are served by page-number
+    pagination, so existing clients keep working. The total count is
+    computed on the first page, with `count_function` when given, and
+    carried in the cursors, so every page returns it without a COUNT.
+    """
+
+    page_size = api_settings.PAGE_SIZE
+    cursor_query_param = "cursor"
+    page_query_param = "page"
+    page_number_class = PageNumberPagination
+    invalid_cursor_message = "Invalid cursor"
+
+    def __init__(self, ordering=("-add_date", "-id"), count_function=None):
+        # (field, descending, nulls_last) - NULLs always sort after values
+        # when paging forward, so that position filters are database agnostic
+        self.ordering = [
+            (field.lstrip("-"), field.startswith("-"), True) for field in ordering
+        ]
+        self.count_function = count_function
+        self.page_number_paginator = None
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        if self.page_query_param in request.query_params:
+            self.page_number_paginator = self.page_number_class()
+            return self.page_number_paginator.paginate_queryset(
+                queryset, request, view=view
+            )
+
+        self.base_url = request.build_absolute_uri()
+        position, reverse, self.count = None, False, None
+        encoded = request.query_params.get(self.cursor_query_param)
+        if encoded:
+            position, reverse, self.count = self.decode_cursor(encoded, queryset)
+        else:
+            self.count = self.get_count(queryset)
+
+        ordering = self.ordering
+        if reverse:
+            ordering = [
+                (field, not descending, not nulls_last)
+                for field, descending, nulls_last in ordering
+            ]
+        queryset = queryset.order_by(*self.get_order_by(ordering))
+        if position is not None:
+            nullable = [
+                self.get_field(queryset, field).null for field, _, _ in ordering
+            ]
+            queryset = queryset.filter(
+                self.get_position_filter(ordering, position, nullable)
+            )
+
+        results = list(queryset[: self.page_size + 1])
+        has_more = len(results) > self.page_size
+        results = results[: self.page_size]
+        if reverse:
+            results.reverse()
+            self.has_next, self.has_previous = True, has_more
+        else:
+            self.has_next, self.has_previous = has_more, position is not None
+        self.page = results
+        return results
+
+    def get_paginated_response(self, data):
+        if self.page_number_paginator:
+            return self.page_number_paginator.get_paginated_response(data)
+
+        ret = OrderedDict()
+        ret["count"] = self.count
+        ret["next"] = self.get_next_link()
+        ret["previous"] = self.get_previous_link()
+        ret["results"] = data
+        return Response(ret)
+
+    def get_count(self, queryset):
+        if self.count_function:
+            return self.count_function(queryset)
+        return queryset.count()
+
+    def get_next_link(self):
+        if not (self.has_next and self.page):
+            return None
+        return self.get_link(self.page[-1], reverse=False)
+
+    def get_previous_link(self):
+        if not (self.has_previous and self.page):
+            return None
+        return self.get_link(self.page[0], reverse=True)
+
+    def get_link(self, obj, reverse):
+        if isinstance(obj, dict):
+            # .values() rows
+            position = [obj[field] for field, _, _ in self.ordering]
+        else:
+            position = [getattr(obj, field) for field, _, _ in self.ordering]
+        return replace_query_param(
+            self.base_url,
+            self.cursor_query_param,
+            self.encode_cursor(position, reverse),
+        )
+
+    def get_order_by(self, ordering):
+        order_by = []
+        for field, descending, nulls_last in ordering:
+            nulls = {"nulls_last": True} if nulls_last else {"nulls_first": True}
+            if descending:
+                order_by.append(F(field).desc(**nulls))
+            else:
+                order_by.append(F(field).asc(**nulls))
+        return order_by
+
+    def get_position_filter(self, ordering, position, nullable):
+        # rows after (f1, f2, ... fn) are those with f1 after v1, or f1 equal
+        # to v1 and (f2, ... fn) after (v2, ... vn)
+        condition = None
+        for (field, descending, nulls_last), value, null in reversed(
+            list(zip(ordering, position, nullable))
+        ):
+            if value is None:
+                after = Q(pk__in=[]) if nulls_last else Q(**{f"{field}__isnull": False})
+                equal = Q(**{f"{field}__isnull": True})
+            else:
+                lookup = "lt" if descending else "gt"
+                after = Q(**{f"{field}__{lookup}": value})
+                if null and nulls_last:
+                    after |= Q(**{f"{field}__isnull": True})
+                equal = Q(**{field: value})
+            if condition is not None:
+                after |= equal & condition
+            condition = after
+        return condition
+
+    def encode_cursor(self, position, reverse):
+        data = {
+            "p": [
+                value.isoformat() if hasattr(value, "isoformat") else value
+                for value in position
+            ],
+            "r": int(reverse),
+            "c": self.count,
+        }
+        data = json.dumps(data, separators=(",", ":"))
+        return base64.urlsafe_b64encode(data.encode("utf-8")).decode("ascii")
+
+    def decode_cursor(self, encoded, queryset):
+        try:
+            data = json.loads(base64.urlsafe_b64decode(encoded.encode("ascii")))
+            values = data["p"]
+            if len(values) != len(self.ordering):
+                raise ValueError
+            position = [
+                None if value is None else self.get_field(queryset, field).to_python(value)
+                for (field, _, _), value in zip(self.ordering, values)
+            ]
+            count = data.get("c")
+            if count is not None and not isinstance(count, int):
+                raise ValueError
+            return position, bool(data.get("r")), count
+        except (
+            TypeError,
+            ValueError,
+            KeyError,
+            ValidationError,
+            FieldDoesNotExist,
+        ):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_field(self, queryset, field):
+        if field in queryset.query.annotations:
+            return queryset.query.annotations[field].output_field
+        if field == "pk":
+            return queryset.model._meta.pk
+        return queryset.model._meta.get_field(field)
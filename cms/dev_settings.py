@@ -47,6 +47,7 @@ MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
     "whitenoise.middleware.WhiteNoiseMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
+    "cms.middleware.ViewerIdMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
@@ -166,6 +167,11 @@ CACHES = {
 
 SESSION_ENGINE = "django.contrib.sessions.backends.cache"
 SESSION_CACHE_ALIAS = "default"
+
+# anonymous viewers are identified by a signed cookie for actions and
+# history, sessions are only created when they hold state (eg login)
+VIEWER_ID_COOKIE_NAME = "viewer_id"
+VIEWER_ID_COOKIE_AGE = 365 * 24 * 60 * 60  # 1 year in seconds
 USE_I18N = True
 USE_L10N = True
 USE_TZ = True
@@ -241,10 +247,19 @@ MP4HLS = "mp4hls"
 
 ALLOW_ANONYMOUS_ACTIONS = ["report", "like", "dislike", "watch"]  # need be a list
 MASK_IPS_FOR_ACTIONS = True
+# no beat in development to drain buffered actions, save them directly
+BUFFER_USER_ACTIONS = False
+# no beat in development either to release encodes, publish them directly
+FAIR_SHARE_ENCODING = False
+FAIR_SHARE_SLOTS = 8
+FAIR_SHARE_WEIGHTS = {"advancedUser": 2, "is_editor": 3, "is_manager": 3}
 # how many seconds a process in running state without reporting progress is
 # considered as stale...unfortunately v9 seems to not include time
 # some times so raising this high
 RUNNING_STATE_STALE = 60 * 60 * 2
+# how many seconds remote encoding workers (manage.py encode_agent) hold an
+# encoding without reporting progress, before another worker can lease it
+REMOTE_ENCODING_LEASE = 60 * 5
 
 # how many times an item need be reported
 # to get to private state automatically
@@ -273,8 +288,36 @@ CHUNKIZE_VIDEO_DURATION = 60 * 5
 # aparently this has to be smaller than VIDEO_CHUNKIZE_DURATION
 VIDEO_CHUNKS_DURATION = 60 * 4
 
+# encode MP4 chunks as fragmented MP4 (CMAF style fragments, moov atom
+# first), and concatenate them into a fragmented MP4 too. Concatenation is
+# then a single sequential write, instead of a second faststart pass that
+# rewrites the whole rendition to move its moov atom to the front
+FRAGMENTED_MP4_CHUNKS = False
+
+# fast local volume (tmpfs or NVMe) for encode intermediates: two-pass logs,
+# outputs before they are moved into storage, and chunks with SCRATCH_CHUNKS.
+# Encodes reserve the space they expect to write, and wait SCRATCH_DELAY
+# seconds while less than that is free, keeping SCRATCH_MIN_FREE bytes free
+SCRATCH_DIRECTORY = TEMP_DIRECTORY
+SCRATCH_MIN_FREE = 1024 * 1024 * 1024
+SCRATCH_DELAY = 60
+# write chunks to SCRATCH_DIRECTORY instead of next to the original. Only
+# when the worker that cuts the chunks of a video encodes them all: other
+# hosts and remote encode agents can't read them there
+SCRATCH_CHUNKS = False
+
 # always get these two, even if upscaling
 MINIMUM_RESOLUTIONS_TO_ENCODE = [240, 360]
+# no beat in development to encode deferred renditions, encode all at once
+LAZY_ENCODING = False
+LAZY_ENCODING_RESOLUTION = 1080
+LAZY_ENCODING_BACKLOG = 50
+LAZY_ENCODING_VIEWS = 0
+LAZY_ENCODING_IDLE_HOURS = (1, 7)
+
+# re-encode campaigns (manage.py reencode_campaign) wait while more than
+# this many other encodings are pending, so that they don't hold back uploads
+REENCODE_CAMPAIGN_MAX_BACKLOG = 10
 
 # NOTIFICATIONS
 USERS_NOTIFICATIONS = {
@@ -305,8 +348,24 @@ CHUNKS_DONE_PARAM_NAME = "done"
 FILE_STORAGE = "django.core.files.storage.DefaultStorage"
 
 
-# valid options: content, author
+# valid options: content, author, calculated
+# calculated serves related media precomputed daily by task
+# update_related_media, out of shared taxonomy and co-watches
 RELATED_MEDIA_STRATEGY = "content"
+# number of related media stored per media, for calculated
+RELATED_MEDIA_CALCULATED_COUNT = 50
+# days of watch history used for co-watches, for calculated
+RELATED_MEDIA_WATCH_DAYS = 90
+
+# hours of watches that make the trending media listing
+TRENDING_MEDIA_HOURS = 24
+
+# days raw watch rows are kept, once task rollup_media_actions has counted
+# them into daily rollups. Anonymous watches, and watches of logged in
+# users, which are also their history. None keeps them forever. Run the
+# backfill_action_rollups command before setting these
+WATCH_ACTIONS_RETENTION_DAYS = None
+WATCH_HISTORY_RETENTION_DAYS = None
 
 # These are passed on every request
 LOAD_FROM_CDN = True  # if set to False will not fetch external content
@@ -406,6 +465,16 @@ PYSUBS_COMMAND = "pysubs2"
 WHISPER_CPP_COMMAND = "/home/cinemata/whisper.cpp/build/bin/main"
 WHISPER_CPP_MODEL = "/home/cinemata/whisper.cpp/models/ggml-large-v3.bin"
 
+# media longer than WHISPER_SEGMENTED_DURATION seconds (0 to never) are
+# transcribed in windows of about WHISPER_SEGMENT_SECONDS, cut at silences,
+# by concurrent whisper.cpp processes of WHISPER_SEGMENT_THREADS threads.
+# WHISPER_SEGMENT_PROCESSES of them, or as many as the cores of the host
+# hold with 0; mind the concurrency of the whisper_tasks worker
+WHISPER_SEGMENTED_DURATION = 30 * 60
+WHISPER_SEGMENT_SECONDS = 5 * 60
+WHISPER_SEGMENT_THREADS = 4
+WHISPER_SEGMENT_PROCESSES = 0
+
 DJANGO_ADMIN_URL = "adminx/"
 ALLOWED_MEDIA_UPLOAD_TYPES = ['video']
 
@@ -172,4 +172,26 @@ class MaintenanceTimingMiddleware(MiddlewareMixin):
             try:
                 os.remove(lock_file)
             except OSError:
-                pass
\ No newline at end of file
+                pass
+
+
+class ViewerIdMiddleware(MiddlewareMixin):
+    """
+    Set the signed viewer id cookie of anonymous viewers, when a view gave
+    them a new one (see files.methods.get_anonymous_viewer_id).
+    """
+
+    def process_response(self, request, response):
+        viewer_id = getattr(request, 'new_viewer_id', None)
+        if viewer_id:
+            response.set_signed_cookie(
+                settings.VIEWER_ID_COOKIE_NAME,
+                viewer_id,
+                salt=settings.VIEWER_ID_COOKIE_NAME,
+                max_age=settings.VIEWER_ID_COOKIE_AGE,
+                domain=settings.SESSION_COOKIE_DOMAIN,
+                secure=settings.SESSION_COOKIE_SECURE,
+                httponly=True,
+                samesite=settings.SESSION_COOKIE_SAMESITE,
+            )
+        return response
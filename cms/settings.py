@@ -107,6 +107,7 @@ MIDDLEWARE = [
     "corsheaders.middleware.CorsMiddleware",
     "django.middleware.security.SecurityMiddleware",
     "django.contrib.sessions.middleware.SessionMiddleware",
+    "cms.middleware.ViewerIdMiddleware",
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
@@ -234,6 +235,11 @@ SITE_ID = 1
 SESSION_COOKIE_AGE = 28800  # 8 hours in seconds
 CSRF_COOKIE_AGE = None  # Make CSRF token session-based
 
+# anonymous viewers are identified by a signed cookie for actions and
+# history, sessions are only created when they hold state (eg login)
+VIEWER_ID_COOKIE_NAME = "viewer_id"
+VIEWER_ID_COOKIE_AGE = 365 * 24 * 60 * 60  # 1 year in seconds
+
 STATIC_URL = "/static/"  #  where js/css files are stored on the filesystem
 MEDIA_ROOT = BASE_DIR + "/media_files/"  #  where uploaded + encoded media are stored
 MEDIA_URL = "/media/"  #  URL where static files are served from the server
@@ -292,6 +298,38 @@ CELERY_BEAT_SCHEDULE = {
         "task": "cleanup_orphaned_uploads",
         "schedule": crontab(hour="2", minute="0"),
     },
+    # daily rollups of user actions, and retention of raw watches
+    "rollup_media_actions": {
+        "task": "rollup_media_actions",
+        "schedule": crontab(hour="0", minute="30"),
+    },
+    # only does work when BUFFER_USER_ACTIONS is enabled
+    "drain_user_actions": {
+        "task": "drain_user_actions",
+        # every 10 seconds
+        "schedule": 10,
+    },
+    # only does work when LAZY_ENCODING is enabled
+    "backfill_deferred_encodes": {
+        "task": "backfill_deferred_encodes",
+        "schedule": crontab(minute="*/15"),
+    },
+    # only does work while re-encode campaigns are running
+    "advance_reencode_campaigns": {
+        "task": "advance_reencode_campaigns",
+        "schedule": 60,
+    },
+    # only does work when FAIR_SHARE_ENCODING is enabled
+    "dispatch_encodes": {
+        "task": "dispatch_encodes",
+        # every 10 seconds
+        "schedule": 10,
+    },
+    # only does work when RELATED_MEDIA_STRATEGY is calculated
+    "update_related_media": {
+        "task": "update_related_media",
+        "schedule": crontab(hour="3", minute="30"),
+    },
     #     "schedule": timedelta(seconds=5),
     #     "args": (16, 16)
 }
@@ -306,6 +344,22 @@ TIME_TO_ACTION_ANONYMOUS = 10 * 60
 # Allows classrooms/offices (30+ students) while blocking automated spam/bots
 MAX_ANONYMOUS_VIEWS_PER_5SEC = 30
 
+# watches, likes and dislikes are appended to a Redis list at request time
+# and stored in batches by task drain_user_actions, run every 10 seconds by
+# beat. Needs the django-redis cache
+BUFFER_USER_ACTIONS = True
+USER_ACTIONS_BATCH_SIZE = 1000
+
+# encodes wait in a queue per uploader and are released to Celery in turns,
+# while fewer than FAIR_SHARE_SLOTS released encodes are pending or running,
+# so that bulk uploads don't hold back everyone else. Set slots a bit above
+# the encode_media concurrency of the workers. Needs the django-redis cache
+FAIR_SHARE_ENCODING = False
+FAIR_SHARE_SLOTS = 8
+# turns per release of uploaders with these user flags, the highest that
+# applies, 1 for everyone else
+FAIR_SHARE_WEIGHTS = {"advancedUser": 2, "is_editor": 3, "is_manager": 3}
+
 # django-allauth settings
 ACCOUNT_SESSION_REMEMBER = True
 ACCOUNT_LOGIN_METHODS = {"username", "email"}
@@ -384,6 +438,9 @@ MASK_IPS_FOR_ACTIONS = True
 # considered as stale...unfortunately v9 seems to not include time
 # some times so raising this high
 RUNNING_STATE_STALE = 60 * 60 * 2
+# how many seconds remote encoding workers (manage.py encode_agent) hold an
+# encoding without reporting progress, before another worker can lease it
+REMOTE_ENCODING_LEASE = 60 * 5
 
 # how many times an item need be reported
 # to get to private state automatically
@@ -415,6 +472,13 @@ RESTRICTED_PERMISSION_CACHE_TIMEOUT = 60  # 1 minute
 PERMISSION_CACHE_KEY_PREFIX = "cinemata_media_permission"
 PERMISSION_CACHE_VERSION = 1
 
+# Search result cache settings
+# Results are keyed on the normalized search parameters and a global catalog
+# generation that is bumped whenever listable media change
+ENABLE_SEARCH_CACHE = True
+# Cache timeout for search results (in seconds)
+SEARCH_CACHE_TIMEOUT = 300  # 5 minutes
+
 MAX_MEDIA_PER_PLAYLIST = 70
 FRIENDLY_TOKEN_LEN = 9
 
@@ -424,9 +488,42 @@ CHUNKIZE_VIDEO_DURATION = 60 * 5
 # aparently this has to be smaller than VIDEO_CHUNKIZE_DURATION
 VIDEO_CHUNKS_DURATION = 60 * 4
 
+# encode MP4 chunks as fragmented MP4 (CMAF style fragments, moov atom
+# first), and concatenate them into a fragmented MP4 too. Concatenation is
+# then a single sequential write, instead of a second faststart pass that
+# rewrites the whole rendition to move its moov atom to the front
+FRAGMENTED_MP4_CHUNKS = False
+
+# fast local volume (tmpfs or NVMe) for encode intermediates: two-pass logs,
+# outputs before they are moved into storage, and chunks with SCRATCH_CHUNKS.
+# Encodes reserve the space they expect to write, and wait SCRATCH_DELAY
+# seconds while less than that is free, keeping SCRATCH_MIN_FREE bytes free
+SCRATCH_DIRECTORY = TEMP_DIRECTORY
+SCRATCH_MIN_FREE = 1024 * 1024 * 1024
+SCRATCH_DELAY = 60
+# write chunks to SCRATCH_DIRECTORY instead of next to the original. Only
+# when the worker that cuts the chunks of a video encodes them all: other
+# hosts and remote encode agents can't read them there
+SCRATCH_CHUNKS = False
+
 # always get these two, even if upscaling
 MINIMUM_RESOLUTIONS_TO_ENCODE = [240, 360]
 
+# renditions of LAZY_ENCODING_RESOLUTION and above are deferred while more
+# than LAZY_ENCODING_BACKLOG encodings are pending, and with
+# LAZY_ENCODING_VIEWS also until media have that many views. Task
+# backfill_deferred_encodes encodes them later, the media with enough views
+# any time and the rest in LAZY_ENCODING_IDLE_HOURS (from, to, local time)
+LAZY_ENCODING = False
+LAZY_ENCODING_RESOLUTION = 1080
+LAZY_ENCODING_BACKLOG = 50
+LAZY_ENCODING_VIEWS = 0
+LAZY_ENCODING_IDLE_HOURS = (1, 7)
+
+# re-encode campaigns (manage.py reencode_campaign) wait while more than
+# this many other encodings are pending, so that they don't hold back uploads
+REENCODE_CAMPAIGN_MAX_BACKLOG = 10
+
 # NOTIFICATIONS
 USERS_NOTIFICATIONS = {
     "MEDIA_ADDED": True,
@@ -458,8 +555,30 @@ CHUNKS_DONE_PARAM_NAME = "done"
 FILE_STORAGE = "django.core.files.storage.DefaultStorage"
 
 
-# valid options: content, author
+# valid options: content, author, calculated
+# calculated serves related media precomputed daily by task
+# update_related_media, out of shared taxonomy and co-watches
 RELATED_MEDIA_STRATEGY = "content"
+# number of related media stored per media, for calculated
+RELATED_MEDIA_CALCULATED_COUNT = 50
+# days of watch history used for co-watches, for calculated
+RELATED_MEDIA_WATCH_DAYS = 90
+
+# hours of watches that make the trending media listing
+TRENDING_MEDIA_HOURS = 24
+
+# days raw watch rows are kept, once task rollup_media_actions has counted
+# them into daily rollups. Anonymous watches, and watches of logged in
+# users, which are also their history. None keeps them forever. Run the
+# backfill_action_rollups command before setting these
+WATCH_ACTIONS_RETENTION_DAYS = None
+WATCH_HISTORY_RETENTION_DAYS = None
+# hourly and daily buckets of the watch and like counters kept in Redis,
+# windows up to MEDIA_COUNTER_HOURS are counted in hourly buckets
+MEDIA_COUNTER_HOURS = 48
+MEDIA_COUNTER_DAYS = 190
+# seconds the merged counters of a window are kept for paging through them
+MEDIA_COUNTER_UNION_TTL = 60
 
 # These are passed on every request
 LOAD_FROM_CDN = True  # if set to False will not fetch external content
@@ -603,6 +722,16 @@ MAINTENANCE_MODE_IGNORE_URLS = (
 ALLOWED_HOSTS.append(FRONTEND_HOST.replace("http://", "").replace("https://", ""))
 WHISPER_SIZE = "base"
 
+# media longer than WHISPER_SEGMENTED_DURATION seconds (0 to never) are
+# transcribed in windows of about WHISPER_SEGMENT_SECONDS, cut at silences,
+# by concurrent whisper.cpp processes of WHISPER_SEGMENT_THREADS threads.
+# WHISPER_SEGMENT_PROCESSES of them, or as many as the cores of the host
+# hold with 0; mind the concurrency of the whisper_tasks worker
+WHISPER_SEGMENTED_DURATION = 30 * 60
+WHISPER_SEGMENT_SECONDS = 5 * 60
+WHISPER_SEGMENT_THREADS = 4
+WHISPER_SEGMENT_PROCESSES = 0
+
 
 ALLOWED_MEDIA_UPLOAD_TYPES = ["video"]
 
@@ -0,0 +1,343 @@
+"""
+Buffered ingestion of user actions on media.
+
+Views append watches, likes and dislikes to a Redis list instead of
+enqueueing a save_user_action task per request. Task drain_user_actions
+pops them in batches and applies them with a fixed number of queries per
+batch. It applies the rules of pre_save_action in memory: one like or
+dislike per viewer, re-watches only after the media duration, and the
+anonymous views per IP rate limit. Then it bulk creates the MediaAction
+rows and runs one views/likes/dislikes UPDATE per media, and adds the
+viewers to the unique viewers sketches.
+
+A batch is stored in one transaction. A batch that fails goes back to the
+head of the buffer, to be tried again by the next drain, and to a
+dead-letter list after MAX_ATTEMPTS tries.
+
+Without django-redis, or with BUFFER_USER_ACTIONS off, actions go through
+save_user_action as before.
+
+Functions:
+    - buffer_user_action: Record an action, buffered when possible
+    - pop_buffered_actions: Atomically take a batch off the buffer
+    - apply_user_actions: Validate and store a batch of actions
+    - requeue_failed_actions: Put back a batch that failed
+
+Cache Key Patterns:
+    - user_actions:buffer
+    - user_actions:dead
+"""
+
+import json
+import logging
+from collections import Counter, defaultdict, deque
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import Any, Dict, List
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .cache_utils import CACHE_KEY_PREFIX
+from .counters import get_redis, incr_media_counter
+from .rate_limits import check_watch
+from .unique_viewers import add_viewers, get_viewer_id
+
+logger = logging.getLogger(__name__)
+
+# actions that only change counters and history, others (eg report) have
+# side effects that should not wait for a batch
+BUFFERED_ACTIONS = ("watch", "like", "dislike")
+BUFFER_KEY = f"{CACHE_KEY_PREFIX}:user_actions:buffer"
+# batches that failed MAX_ATTEMPTS times, kept for inspection
+DEAD_LETTER_KEY = f"{CACHE_KEY_PREFIX}:user_actions:dead"
+MAX_ATTEMPTS = 3
+
+# Media field incremented per accepted action
+COUNTER_FIELDS = {"watch": "views", "like": "likes", "dislike": "dislikes"}
+
+
+def buffer_user_action(user_or_session: Dict[str, Any], friendly_token: str, action: str = "watch", extra_info=None, media=None) -> bool:
+    """
+    Record a user action, appended to the Redis buffer when possible,
+    through task save_user_action otherwise.
+
+    Args:
+        user_or_session: As returned by get_user_or_session
+        friendly_token: Media friendly token
+        action: MediaAction action
+        extra_info: Optional extra info of the action
+        media: Optional Media, lets watches within the cooldown or over the
+            rate limit be dropped before they are buffered
+
+    Returns:
+        bool: True if the action was buffered
+    """
+    from .tasks import save_user_action
+
+    client = get_redis() if settings.BUFFER_USER_ACTIONS else None
+    checked = False
+    if client is not None and action in BUFFERED_ACTIONS:
+        if action == "watch" and media is not None:
+            allowed = check_watch(
+                media,
+                user_or_session.get("user_id"),
+                user_or_session.get("user_session"),
+                user_or_session.get("remote_ip_addr"),
+            )
+            if allowed is False:
+                return False
+            # the check started the cooldown, the fallback must not check again
+            checked = bool(allowed)
+        entry = {
+            "user_id": user_or_session.get("user_id"),
+            "session_key": user_or_session.get("user_session"),
+            "remote_ip": user_or_session.get("remote_ip_addr"),
+            "friendly_token": friendly_token,
+            "action": action,
+            "extra_info": extra_info,
+            "ts": timezone.now().timestamp(),
+        }
+        try:
+            client.rpush(BUFFER_KEY, json.dumps(entry))
+            return True
+        except Exception as e:
+            logger.warning(f"Buffering user action failed, saving it directly: {e}")
+
+    save_user_action.delay(
+        user_or_session,
+        friendly_token=friendly_token,
+        action=action,
+        extra_info=extra_info,
+        checked=checked,
+    )
+    return False
+
+
+def pop_buffered_actions(limit: int) -> List[Dict[str, Any]]:
+    """
+    Take up to limit of the oldest buffered actions off the buffer.
+
+    Returns:
+        list: Action entries, oldest first
+    """
+    client = get_redis()
+    if client is None:
+        return []
+    pipe = client.pipeline()
+    pipe.lrange(BUFFER_KEY, 0, limit - 1)
+    pipe.ltrim(BUFFER_KEY, limit, -1)
+    entries = []
+    for raw in pipe.execute()[0]:
+        try:
+            entries.append(json.loads(raw))
+        except ValueError:
+            logger.warning(f"Dropping malformed buffered action {raw!r}")
+    return entries
+
+
+def requeue_failed_actions(entries: List[Dict[str, Any]]) -> int:
+    """
+    Put back a batch of actions that failed to apply, at the head of the
+    buffer, or in the dead-letter list once tried MAX_ATTEMPTS times.
+
+    Returns:
+        int: Number of entries moved to the dead-letter list
+    """
+    client = get_redis()
+    if client is None or not entries:
+        return 0
+    retry, dead = [], []
+    for entry in entries:
+        entry = dict(entry, attempts=entry.get("attempts", 0) + 1)
+        (dead if entry["attempts"] >= MAX_ATTEMPTS else retry).append(json.dumps(entry))
+    pipe = client.pipeline()
+    if retry:
+        # oldest first, as they were popped
+        pipe.lpush(BUFFER_KEY, *reversed(retry))
+    if dead:
+        pipe.rpush(DEAD_LETTER_KEY, *dead)
+    pipe.execute()
+    return len(dead)
+
+
+def apply_user_actions(entries: List[Dict[str, Any]]) -> int:
+    """
+    Validate a batch of buffered actions like pre_save_action would, store
+    the accepted ones and update the media counters.
+
+    Args:
+        entries: Action entries, as produced by buffer_user_action
+
+    Returns:
+        int: Number of accepted actions
+    """
+    from actions.models import MediaAction
+    from users.models import User
+
+    from .models import Media
+
+    # copies, the entries stay as buffered in case the batch fails
+    entries = sorted(
+        (dict(e) for e in entries if e.get("action") in BUFFERED_ACTIONS),
+        key=lambda e: e["ts"],
+    )
+    if not entries:
+        return 0
+
+    # friendly token -> (id, duration)
+    media = {
+        friendly_token: (media_id, duration)
+        for friendly_token, media_id, duration in Media.objects.filter(
+            friendly_token__in={e["friendly_token"] for e in entries}
+        ).values_list("friendly_token", "id", "duration")
+    }
+    user_ids = set(
+        User.objects.filter(
+            id__in={e["user_id"] for e in entries if e.get("user_id")}
+        ).values_list("id", flat=True)
+    )
+
+    def viewer(entry):
+        # logged in users are identified by id, anonymous ones by session
+        if entry.get("user_id"):
+            return ("user", entry["user_id"])
+        return ("session", entry["session_key"])
+
+    valid = []
+    for entry in entries:
+        m = media.get(entry["friendly_token"])
+        if not m or (entry.get("user_id") and entry["user_id"] not in user_ids):
+            continue
+        if not entry.get("user_id") and not entry.get("session_key"):
+            continue
+        entry["media_id"], entry["duration"] = m
+        entry["date"] = datetime.fromtimestamp(entry["ts"], tz=dt_timezone.utc)
+        valid.append(entry)
+    if not valid:
+        return 0
+
+    # previous actions of the viewers of this batch on these media
+    media_ids = {e["media_id"] for e in valid}
+    viewers = Q(user_id__in={e["user_id"] for e in valid if e.get("user_id")}) | Q(
+        user=None, session_key__in={e["session_key"] for e in valid if not e.get("user_id")}
+    )
+    previous = defaultdict(list)  # (viewer, media id, action) -> [(date, id)]
+    for action_id, user_id, session_key, media_id, action, action_date in (
+        MediaAction.objects.filter(viewers, media_id__in=media_ids, action__in=BUFFERED_ACTIONS)
+        .values_list("id", "user_id", "session_key", "media_id", "action", "action_date")
+        .iterator()
+    ):
+        key = ("user", user_id) if user_id else ("session", session_key)
+        previous[(key, media_id, action)].append((action_date, action_id))
+    last_done = {key: max(rows)[0] for key, rows in previous.items()}
+
+    # recent anonymous watches per media and IP, for the rate limit
+    window = timedelta(seconds=5)
+    max_per_window = getattr(settings, 'MAX_ANONYMOUS_VIEWS_PER_5SEC', 30)
+    recent = defaultdict(deque)
+    for media_id, remote_ip, action_date in (
+        MediaAction.objects.filter(
+            media_id__in=media_ids,
+            action="watch",
+            user=None,
+            remote_ip__in={e["remote_ip"] for e in valid if not e.get("user_id")},
+            action_date__gte=valid[0]["date"] - window,
+        )
+        .order_by("action_date")
+        .values_list("media_id", "remote_ip", "action_date")
+    ):
+        recent[(media_id, remote_ip)].append(action_date)
+
+    accepted = []
+    for entry in valid:
+        media_id = entry["media_id"]
+        key = (viewer(entry), media_id, entry["action"])
+        last = last_done.get(key)
+        if last is not None:
+            # re-watch once the media has been watched through, see pre_save_action
+            if not (
+                entry["action"] == "watch"
+                and entry["duration"]
+                and (entry["date"] - last).total_seconds() > entry["duration"]
+            ):
+                continue
+        elif not entry.get("user_id") and entry["action"] == "watch":
+            watches = recent[(media_id, entry["remote_ip"])]
+            while watches and watches[0] < entry["date"] - window:
+                watches.popleft()
+            if len(watches) >= max_per_window:
+                logger.warning(
+                    f"Rate limit: IP {entry['remote_ip']} exceeded {max_per_window} views/5sec "
+                    f"for media {entry['friendly_token']}"
+                )
+                continue
+        if entry["action"] == "watch" and not entry.get("user_id"):
+            recent[(media_id, entry["remote_ip"])].append(entry["date"])
+        last_done[key] = entry["date"]
+        accepted.append(entry)
+    if not accepted:
+        return 0
+
+    # history keeps the latest watch of a viewer only
+    watched = {(viewer(e), e["media_id"]) for e in accepted if e["action"] == "watch"}
+    replaced = [
+        action_id
+        for (key, media_id, action), rows in previous.items()
+        if action == "watch" and (key, media_id) in watched
+        for _, action_id in rows
+    ]
+    latest_watch = {}
+    for entry in accepted:
+        if entry["action"] == "watch":
+            latest_watch[(viewer(entry), entry["media_id"])] = entry
+    stored = [
+        entry
+        for entry in accepted
+        if entry["action"] != "watch" or latest_watch[(viewer(entry), entry["media_id"])] is entry
+    ]
+    increments = defaultdict(Counter)
+    for entry in accepted:
+        increments[entry["media_id"]][entry["action"]] += 1
+
+    with transaction.atomic():
+        if replaced:
+            MediaAction.objects.filter(id__in=replaced).delete()
+        # action_date is the time of the request
+        MediaAction.objects.bulk_create(
+            [
+                MediaAction(
+                    user_id=entry.get("user_id"),
+                    session_key=entry.get("session_key"),
+                    media_id=entry["media_id"],
+                    action=entry["action"],
+                    extra_info=entry.get("extra_info"),
+                    remote_ip=entry.get("remote_ip"),
+                    action_date=entry["date"],
+                )
+                for entry in stored
+            ],
+            batch_size=500,
+        )
+        # one UPDATE per media
+        for media_id, counts in increments.items():
+            Media.objects.filter(id=media_id).update(
+                **{COUNTER_FIELDS[action]: F(COUNTER_FIELDS[action]) + n for action, n in counts.items()}
+            )
+
+    # the time-bucketed counters and sketches, once stored
+    for media_id, counts in increments.items():
+        for action, n in counts.items():
+            incr_media_counter(action, media_id, amount=n)
+    add_viewers(
+        (
+            entry["media_id"],
+            get_viewer_id(entry.get("user_id"), entry.get("session_key"), entry.get("remote_ip")),
+            entry["date"],
+        )
+        for entry in accepted
+        if entry["action"] == "watch"
+    )
+
+    return len(accepted)
@@ -0,0 +1,306 @@
+"""
+Daily rollups and retention of user actions on media.
+
+MediaAction keeps a row per action, forever. Task rollup_media_actions
+counts every day's actions per media into MediaActionDaily (count and
+unique viewers per media, day and action). It then deletes raw watch rows
+older than the retention settings:
+
+- WATCH_ACTIONS_RETENTION_DAYS applies to watches of anonymous sessions;
+- WATCH_HISTORY_RETENTION_DAYS applies to watches of logged in users,
+  which are also their watch history.
+
+Both default to None, keep forever. Run the backfill_action_rollups
+command before enabling them, so that older days are rolled up before
+their rows go. Likes, dislikes and reports are always kept, they enforce
+one action per viewer.
+
+Watch rollups also keep the day's unique viewers sketch, see
+unique_viewers. Rollups back popularity over whole days and creator
+statistics.
+
+Functions:
+    - rollup_day: Roll up the actions of a day
+    - rollup_pending_days: Roll up the days since the last rollup
+    - apply_retention: Delete raw watch rows past retention
+    - get_top_media: Media with most actions since a day, from rollups
+    - get_user_stats: Daily action counts on a user's media
+    - stats_window_start: First day of a statistics window
+"""
+
+import logging
+from collections import defaultdict
+from datetime import date, datetime, time, timedelta
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Max, Min, Q, Sum
+from django.utils import timezone
+
+from .unique_viewers import get_day_sketches
+
+logger = logging.getLogger(__name__)
+
+# rows deleted per query when applying retention
+RETENTION_BATCH_SIZE = 5000
+# days rolled up at most by a single run of rollup_pending_days
+MAX_PENDING_DAYS = 31
+
+
+def day_bounds(day: date):
+    """Start and end of a day, in the current time zone"""
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    return start, start + timedelta(days=1)
+
+
+def get_retention_cutoff() -> Optional[date]:
+    """First day whose raw watch rows are all kept, None if all are kept"""
+    days = [
+        d
+        for d in (settings.WATCH_ACTIONS_RETENTION_DAYS, settings.WATCH_HISTORY_RETENTION_DAYS)
+        if d
+    ]
+    if not days:
+        return None
+    # the shorter retention removes rows of the days before it
+    return timezone.localdate() - timedelta(days=min(days))
+
+
+def rollup_day(day: date) -> int:
+    """
+    Count the actions of a day into MediaActionDaily, replacing any
+    previous rollup of that day.
+
+    Days with raw rows removed by retention are not rolled up again, as
+    that would lose counts.
+
+    Returns:
+        int: Number of rollup rows written, -1 if the day was skipped
+    """
+    from actions.models import MediaAction, MediaActionDaily
+
+    from .models import Media
+
+    cutoff = get_retention_cutoff()
+    if cutoff and day < cutoff:
+        logger.info(f"not rolling up {day}, its raw actions are past retention")
+        return -1
+
+    start, end = day_bounds(day)
+    rows = (
+        MediaAction.objects.filter(action_date__gte=start, action_date__lt=end)
+        .values_list("media_id", "action")
+        .annotate(
+            count=Count("id"),
+            users=Count("user", distinct=True),
+            sessions=Count("session_key", distinct=True, filter=Q(user=None)),
+        )
+        .order_by()
+    )
+    rollups = {
+        (media_id, action): MediaActionDaily(
+            media_id=media_id,
+            day=day,
+            action=action,
+            count=count,
+            unique_viewers=users + sessions,
+        )
+        for media_id, action, count, users, sessions in rows
+    }
+
+    # unique viewers sketches of the day's watches, from Redis or kept from
+    # a previous rollup once they expired there. They also hold the viewers
+    # whose watch row was replaced by a later watch
+    sketches = {
+        media_id: (bytes(sketch), unique_viewers)
+        for media_id, sketch, unique_viewers in MediaActionDaily.objects.filter(
+            day=day, action="watch", viewers_sketch__isnull=False
+        ).values_list("media_id", "viewers_sketch", "unique_viewers")
+    }
+    sketches.update(get_day_sketches(day))
+    unrolled = set(sketches) - {media_id for media_id, _ in rollups}
+    if unrolled:
+        unrolled &= set(Media.objects.filter(id__in=unrolled).values_list("id", flat=True))
+    for media_id, (sketch, unique_viewers) in sketches.items():
+        if media_id in unrolled:
+            rollups[(media_id, "watch")] = MediaActionDaily(
+                media_id=media_id, day=day, action="watch", count=0
+            )
+        rollup = rollups.get((media_id, "watch"))
+        if rollup is not None:
+            rollup.viewers_sketch = sketch
+            rollup.unique_viewers = unique_viewers
+
+    with transaction.atomic():
+        MediaActionDaily.objects.filter(day=day).delete()
+        MediaActionDaily.objects.bulk_create(rollups.values(), batch_size=1000)
+    return len(rollups)
+
+
+def rollup_pending_days() -> List[date]:
+    """
+    Roll up the complete days after the last rolled up one, at most
+    MAX_PENDING_DAYS, from the first of them with actions. Rolled up days
+    are not rebuilt, nor days whose raw rows may be past retention.
+
+    Returns:
+        list: Days rolled up
+    """
+    from actions.models import MediaAction, MediaActionDaily
+
+    yesterday = timezone.localdate() - timedelta(days=1)
+    last = MediaActionDaily.objects.aggregate(last=Max("day"))["last"]
+    first_pending = last + timedelta(days=1) if last else None
+    cutoff = get_retention_cutoff()
+    if cutoff and (first_pending is None or first_pending < cutoff):
+        first_pending = cutoff
+    # days without actions have nothing to roll up
+    actions = MediaAction.objects.all()
+    if first_pending:
+        actions = actions.filter(action_date__gte=day_bounds(first_pending)[0])
+    first = actions.aggregate(first=Min("action_date"))["first"]
+    if first is None:
+        return []
+    first_pending = timezone.localtime(first).date()
+    days = []
+    day = first_pending
+    while day <= min(yesterday, first_pending + timedelta(days=MAX_PENDING_DAYS - 1)):
+        if rollup_day(day) >= 0:
+            days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+def apply_retention() -> int:
+    """
+    Delete raw watch rows older than the retention settings, in batches.
+
+    Returns:
+        int: Number of rows deleted
+    """
+    from actions.models import MediaAction
+
+    deleted = 0
+    for days, viewers in (
+        (settings.WATCH_ACTIONS_RETENTION_DAYS, Q(user=None)),
+        (settings.WATCH_HISTORY_RETENTION_DAYS, Q(user__isnull=False)),
+    ):
+        if not days:
+            continue
+        start, _ = day_bounds(timezone.localdate() - timedelta(days=days))
+        expired = MediaAction.objects.filter(viewers, action="watch", action_date__lt=start)
+        while True:
+            ids = list(expired.values_list("id", flat=True)[:RETENTION_BATCH_SIZE])
+            if not ids:
+                break
+            deleted += MediaAction.objects.filter(id__in=ids).delete()[0]
+    return deleted
+
+
+def has_unrolled_actions(days: List[date]) -> bool:
+    """Whether any of these days has raw actions, so it lacks its rollups"""
+    from actions.models import MediaAction
+
+    if not days:
+        return False
+    ranges = Q()
+    for day in days:
+        start, end = day_bounds(day)
+        ranges |= Q(action_date__gte=start, action_date__lt=end)
+    return MediaAction.objects.filter(ranges).exists()
+
+
+def get_top_media(action: str, since: datetime, limit: int) -> Optional[List[int]]:
+    """
+    Ids of the listable media with most actions since the day of a date,
+    most first. Whole days are read from the rollups, today is counted in
+    MediaAction.
+
+    Returns:
+        list or None: Media ids, or None if rollups don't cover every day
+        since the day of since
+    """
+    from actions.models import MediaAction, MediaActionDaily
+
+    first = timezone.localtime(since).date()
+    today = timezone.localdate()
+    if not MediaActionDaily.objects.filter(action=action, day__lte=first).exists():
+        return None
+    # days without rollups are only fine without actions
+    rolled = set(
+        MediaActionDaily.objects.filter(day__gte=first, day__lt=today)
+        .values_list("day", flat=True)
+        .distinct()
+    )
+    missing = [
+        first + timedelta(days=i)
+        for i in range((today - first).days)
+        if first + timedelta(days=i) not in rolled
+    ]
+    if has_unrolled_actions(missing):
+        return None
+
+    listable = dict(
+        media__state="public", media__is_reviewed=True, media__encoding_status="success"
+    )
+    rollups = MediaActionDaily.objects.filter(action=action, day__gte=first, **listable)
+    totals = dict(
+        rollups.values_list("media_id")
+        .annotate(total=Sum("count"))
+        .order_by("-total", "media_id")[:limit]
+    )
+    todays = dict(
+        MediaAction.objects.filter(
+            action=action, action_date__gte=day_bounds(today)[0], **listable
+        )
+        .values_list("media_id")
+        .annotate(count=Count("id"))
+        .order_by()
+    )
+    # media with actions today may pass those of the top rolled totals
+    others = set(todays) - set(totals)
+    if others:
+        totals.update(
+            rollups.filter(media_id__in=others)
+            .values_list("media_id")
+            .annotate(total=Sum("count"))
+            .order_by()
+        )
+    for media_id, count in todays.items():
+        totals[media_id] = totals.get(media_id, 0) + count
+    return sorted(totals, key=lambda media_id: (-totals[media_id], media_id))[:limit]
+
+
+def stats_window_start(days: int) -> date:
+    """First day of a statistics window of the last days days, today included"""
+    return timezone.localdate() - timedelta(days=days - 1)
+
+
+def get_user_stats(user, since: date) -> Dict:
+    """
+    Action counts on the media of a user, per day and in total, from the
+    rollups of the days since a date.
+
+    Returns:
+        dict: totals, {action: count}, and daily, ordered by day,
+        [{day, actions: {action: {count, unique_viewers}}}]. Viewers are
+        unique per media and day
+    """
+    from actions.models import MediaActionDaily
+
+    rows = (
+        MediaActionDaily.objects.filter(media__user=user, day__gte=since)
+        .values_list("day", "action")
+        .annotate(count=Sum("count"), unique_viewers=Sum("unique_viewers"))
+        .order_by("day", "action")
+    )
+    totals = defaultdict(int)
+    daily = {}
+    for day, action, count, unique_viewers in rows:
+        totals[action] += count
+        daily.setdefault(day, {"day": day, "actions": {}})["actions"][action] = {
+            "count": count,
+            "unique_viewers": unique_viewers,
+        }
+    return {"totals": dict(totals), "daily": list(daily.values())}
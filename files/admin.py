@@ -21,6 +21,7 @@ from .models import (
     Page,
     Rating,
     RatingCategory,
+    ReencodeCampaign,
     Subtitle,
     Tag,
     Topic,
@@ -319,6 +320,14 @@ class TranscriptionRequestAdmin(admin.ModelAdmin):
     )
 
 
+class ReencodeCampaignAdmin(admin.ModelAdmin):
+    list_display = ["name", "status", "concurrency", "queued", "last_media_id", "add_date"]
+    list_filter = ["status"]
+    list_editable = ["status", "concurrency"]
+    # campaigns are started by manage.py reencode_campaign
+    readonly_fields = ["filters", "profiles", "last_media_id", "queued"]
+
+
 @admin.register(TinyMCEMedia)
 class TinyMCEMediaAdmin(admin.ModelAdmin):
     list_display = ["original_filename", "file_type", "uploaded_at", "user"]
@@ -346,3 +355,4 @@ admin.site.register(IndexPageFeatured, IndexPageFeaturedAdmin)
 admin.site.register(MediaLanguage, MediaLanguageAdmin)
 admin.site.register(HomepagePopup, HomepagePopupAdmin)
 admin.site.register(TranscriptionRequest, TranscriptionRequestAdmin)
+admin.site.register(ReencodeCampaign, ReencodeCampaignAdmin)
@@ -4,7 +4,9 @@ import locale
 import logging
 import re
 import time
-from subprocess import PIPE, Popen
+from subprocess import PIPE
+
+from . import processes
 
 logger = logging.getLogger(__name__)
 
@@ -22,13 +24,15 @@ console_encoding = locale.getdefaultlocale()[1] or "UTF-8"
 class FFmpegBackend(object):
     name = "FFmpeg"
 
-    def __init__(self):
+    def __init__(self, encoding_id=None):
         self.process = None
+        self.encoding_id = encoding_id
 
     def _spawn(self, cmd):
         try:
-            return Popen(
+            return processes.TrackedPopen(
                 cmd,
+                encoding_id=self.encoding_id,
                 shell=False,
                 stdin=PIPE,
                 stdout=PIPE,
@@ -45,33 +49,22 @@ class FFmpegBackend(object):
         return ret
 
     def terminate_process(self):
-        """Gracefully terminate the FFmpeg subprocess."""
+        """Terminate the FFmpeg subprocess and its group, killing it if needed."""
         if self.process is None:
             return
 
         try:
-            # First try graceful termination
             if self.process.poll() is None:  # Check if still running
-                logger.info("Terminating FFmpeg process gracefully")
-                self.process.terminate()
-                
-                # Wait up to 5 seconds for graceful shutdown
-                try:
-                    self.process.wait(timeout=5)
-                    logger.info("FFmpeg process terminated gracefully")
-                except:
-                    # Force kill if still alive
-                    logger.warning("FFmpeg process did not terminate gracefully, force killing")
-                    self.process.kill()
-                    self.process.wait(timeout=2)
-                
-                # Close file descriptors
-                if self.process.stdin:
-                    self.process.stdin.close()
-                if self.process.stdout:
-                    self.process.stdout.close()
-                if self.process.stderr:
-                    self.process.stderr.close()
+                logger.info("Terminating FFmpeg process")
+                processes.stop_process(self.process)
+
+            # Close file descriptors
+            if self.process.stdin:
+                self.process.stdin.close()
+            if self.process.stdout:
+                self.process.stdout.close()
+            if self.process.stderr:
+                self.process.stderr.close()
         except Exception as e:
             logger.error(f"Error terminating FFmpeg process: {e}")
         finally:
@@ -1,22 +1,29 @@
 """
-Cache utilities for media permission management.
+Cache utilities for media permission management and listing caches.
 
-This module provides utilities for managing Redis cache related to media permissions.
-It's designed to be imported by both models.py and secure_media_views.py to avoid
-circular import issues.
+This module provides utilities for managing Redis cache related to media permissions
+and to cached media listings (search results). It's designed to be imported by
+models.py, views.py and secure_media_views.py to avoid circular import issues.
 
 Functions:
     - clear_media_permission_cache: Clear permission cache for specific media
     - clear_user_permission_cache: Clear permission cache for specific user
     - get_permission_cache_key: Generate cache keys for permissions
     - invalidate_media_cache_patterns: Clear cache using patterns (if available)
+    - get_catalog_generation / bump_catalog_generation: Global listing invalidation
+    - get_search_cache_key / get_cached_search / set_cached_search: Search result cache
+    - get_cached_listing_count: Listing counts cached per catalog generation
 
 Cache Key Patterns:
     - media_permission:{user_id}:{media_uid}[:{additional_data_hash}]
     - elevated_access:{user_id}:{media_uid}
+    - catalog_generation
+    - search:{generation}:{params_hash}
+    - listing_count:{generation}:{query_hash}
 """
 
 import hashlib
+import json
 import logging
 import time
 from typing import Optional, Dict, Any, Union
@@ -38,6 +45,14 @@ PERMISSION_KEY_TEMPLATE = f"{CACHE_KEY_PREFIX}:media_permission:{{user_id}}:{{me
 ELEVATED_ACCESS_KEY_TEMPLATE = f"{CACHE_KEY_PREFIX}:elevated_access:{{user_id}}:{{media_uid}}"
 RESTRICTED_KEY_TEMPLATE = f"{CACHE_KEY_PREFIX}:media_permission:{{user_id}}:{{media_uid}}:{{data_hash}}"
 
+# Listing caches are keyed on a global catalog generation, so they never need
+# per-key deletion: bumping the generation makes every older entry unreachable
+# and it simply expires.
+SEARCH_CACHE_TIMEOUT = getattr(settings, 'SEARCH_CACHE_TIMEOUT', 300)  # Default: 5 minutes
+CATALOG_GENERATION_KEY = f"{CACHE_KEY_PREFIX}:catalog_generation"
+SEARCH_KEY_TEMPLATE = f"{CACHE_KEY_PREFIX}:search:{{generation}}:{{params_hash}}"
+COUNT_KEY_TEMPLATE = f"{CACHE_KEY_PREFIX}:listing_count:{{generation}}:{{query_hash}}"
+
 
 def get_permission_cache_key(user_id: Union[int, str], media_uid: str, additional_data: Optional[str] = None) -> str:
     """
@@ -367,3 +382,145 @@ def health_check() -> Dict[str, Any]:
             "latency_ms": round(latency, 2),
             "timestamp": time.time()
         }
+
+
+def get_catalog_generation() -> int:
+    """
+    Get the current catalog generation.
+
+    The generation is a global counter that is bumped whenever listable media
+    change. Listing caches include it in their keys.
+
+    Returns:
+        int: Current generation (0 if the cache is unavailable)
+    """
+    try:
+        generation = cache.get(CATALOG_GENERATION_KEY, version=CACHE_VERSION)
+        if generation is None:
+            # seed with a timestamp so a lost counter never restarts at a
+            # generation that older cached entries may still use.
+            # add() won't overwrite a value set concurrently by another process
+            cache.add(CATALOG_GENERATION_KEY, int(time.time()), None, version=CACHE_VERSION)
+            generation = cache.get(CATALOG_GENERATION_KEY, 0, version=CACHE_VERSION)
+        return int(generation)
+    except Exception as e:
+        logger.warning(f"Failed to get catalog generation: {e}")
+        return 0
+
+
+def bump_catalog_generation() -> bool:
+    """
+    Bump the catalog generation, invalidating all listing caches at once.
+
+    Returns:
+        bool: True if the generation was bumped, False otherwise
+    """
+    try:
+        try:
+            cache.incr(CATALOG_GENERATION_KEY, version=CACHE_VERSION)
+        except ValueError:
+            # key does not exist yet (or was evicted)
+            cache.set(CATALOG_GENERATION_KEY, int(time.time()), None, version=CACHE_VERSION)
+        logger.debug("Bumped catalog generation")
+        return True
+    except Exception as e:
+        logger.warning(f"Failed to bump catalog generation: {e}")
+        return False
+
+
+def get_search_cache_key(params: Dict[str, Any], generation: Optional[int] = None) -> str:
+    """
+    Generate a cache key for a normalized set of search parameters.
+
+    Args:
+        params: Normalized search parameters (must be JSON serializable)
+        generation: Catalog generation (current generation if None)
+
+    Returns:
+        str: Cache key for the search results
+    """
+    if generation is None:
+        generation = get_catalog_generation()
+    serialized = json.dumps(params, sort_keys=True, separators=(',', ':'))
+    params_hash = hashlib.sha256(serialized.encode('utf-8')).hexdigest()[:24]
+    return SEARCH_KEY_TEMPLATE.format(generation=generation, params_hash=params_hash)
+
+
+def get_cached_search(cache_key: str) -> Optional[Any]:
+    """
+    Get cached search results.
+
+    Args:
+        cache_key: The cache key to look up
+
+    Returns:
+        Cached response data, or None if not found/error
+    """
+    try:
+        return cache.get(cache_key, version=CACHE_VERSION)
+    except Exception as e:
+        logger.warning(f"Cache get failed for key {cache_key}: {e}")
+        return None
+
+
+def set_cached_search(cache_key: str, data: Any, timeout: Optional[int] = None) -> bool:
+    """
+    Cache search results.
+
+    Args:
+        cache_key: The cache key to set
+        data: Response data to cache
+        timeout: Cache timeout in seconds (uses default if None)
+
+    Returns:
+        bool: True if cache was set successfully, False otherwise
+    """
+    if timeout is None:
+        timeout = SEARCH_CACHE_TIMEOUT
+
+    try:
+        cache.set(cache_key, data, timeout, version=CACHE_VERSION)
+        return True
+    except Exception as e:
+        logger.warning(f"Cache set failed for key {cache_key}: {e}")
+        return False
+
+
+def get_cached_listing_count(queryset, timeout: Optional[int] = None) -> int:
+    """
+    Get the row count of a listing queryset, cached per catalog generation.
+
+    Listing counts only change when listable media change, so the COUNT is
+    run at most once per generation for each distinct query.
+
+    Args:
+        queryset: Media queryset to count
+        timeout: Cache timeout in seconds (uses default if None)
+
+    Returns:
+        int: Number of rows in the queryset
+    """
+    if timeout is None:
+        timeout = SEARCH_CACHE_TIMEOUT
+
+    try:
+        sql = str(queryset.order_by().query)
+    except Exception:
+        # eg EmptyResultSet, nothing worth caching
+        return queryset.count()
+
+    query_hash = hashlib.sha256(sql.encode('utf-8')).hexdigest()[:24]
+    cache_key = COUNT_KEY_TEMPLATE.format(generation=get_catalog_generation(), query_hash=query_hash)
+    try:
+        count = cache.get(cache_key, version=CACHE_VERSION)
+        if count is not None:
+            return count
+    except Exception as e:
+        logger.warning(f"Cache get failed for key {cache_key}: {e}")
+
+    count = queryset.count()
+    try:
+        cache.set(cache_key, count, timeout, version=CACHE_VERSION)
+    except Exception as e:
+        logger.warning(f"Cache set failed for key {cache_key}: {e}")
+    return count
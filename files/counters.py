@@ -0,0 +1,209 @@
+"""
+Time-bucketed action counters of media, in Redis.
+
+Every accepted watch and like increments the media's score in an hourly and
+a daily sorted set. Buckets expire on their own, so the counters only ever
+hold the retention period. Counts over a window are merged on read from the
+buckets that cover it, which costs O(buckets) whatever the size of the
+MediaAction table. The merged ranking of a window is kept for
+MEDIA_COUNTER_UNION_TTL seconds, so that its pages are read from one merge.
+
+The counters need the default cache to be django-redis. Without it, or
+while they don't cover a window yet (eg right after deployment), readers
+get None and callers count MediaAction instead.
+
+Functions:
+    - incr_media_counter: Count an action of a media
+    - get_top_media: Media with most actions since a date
+    - get_media_count: Actions of a media since a date
+
+Cache Key Patterns:
+    - media_counter:{action}:h:{YYYYMMDDHH}
+    - media_counter:{action}:d:{YYYYMMDD}
+    - media_counter:{action}:since
+    - media_counter:union:{action}:{granularity}:{first bucket}-{last bucket}
+"""
+
+import logging
+import math
+from datetime import datetime, timedelta, timezone as dt_timezone
+from typing import List, Optional
+
+from django.conf import settings
+from django.utils import timezone
+
+from .cache_utils import CACHE_KEY_PREFIX
+
+logger = logging.getLogger(__name__)
+
+COUNTED_ACTIONS = ("watch", "like")
+
+# hourly buckets serve windows up to this long, daily buckets longer ones
+HOURLY_BUCKETS = getattr(settings, 'MEDIA_COUNTER_HOURS', 48)
+DAILY_BUCKETS = getattr(settings, 'MEDIA_COUNTER_DAYS', 190)
+# seconds a merged window is kept, pages of a listing read the same merge
+UNION_TTL = getattr(settings, 'MEDIA_COUNTER_UNION_TTL', 60)
+
+BUCKET_KEY_TEMPLATE = f"{CACHE_KEY_PREFIX}:media_counter:{{action}}:{{granularity}}:{{bucket}}"
+SINCE_KEY_TEMPLATE = f"{CACHE_KEY_PREFIX}:media_counter:{{action}}:since"
+UNION_KEY_TEMPLATE = f"{CACHE_KEY_PREFIX}:media_counter:union:{{action}}:{{window}}"
+
+GRANULARITIES = {
+    # granularity: (bucket length, buckets kept, bucket format)
+    "h": (timedelta(hours=1), HOURLY_BUCKETS, "%Y%m%d%H"),
+    "d": (timedelta(days=1), DAILY_BUCKETS, "%Y%m%d"),
+}
+
+
+def get_redis():
+    """
+    Raw Redis client of the default cache.
+
+    Returns:
+        Redis client, or None if the default cache is not django-redis
+    """
+    try:
+        from django_redis import get_redis_connection
+
+        return get_redis_connection("default")
+    except Exception:
+        return None
+
+
+def get_bucket_key(action: str, granularity: str, moment: datetime) -> str:
+    bucket_format = GRANULARITIES[granularity][2]
+    return BUCKET_KEY_TEMPLATE.format(
+        action=action,
+        granularity=granularity,
+        bucket=moment.astimezone(dt_timezone.utc).strftime(bucket_format),
+    )
+
+
+def get_window_keys(action: str, since: datetime, now: Optional[datetime] = None) -> List[str]:
+    """
+    Keys of the buckets covering since..now, hourly ones if they are enough.
+    The oldest bucket is included whole, so counts may include up to one
+    bucket length of actions older than since.
+    """
+    now = now or timezone.now()
+    window = max(now - since, timedelta(0))
+    hour, hours_kept, _ = GRANULARITIES["h"]
+    granularity = "h" if window <= hour * (hours_kept - 1) else "d"
+    length, kept, _ = GRANULARITIES[granularity]
+    buckets = min(math.ceil(window / length), kept - 1) + 1
+    return [get_bucket_key(action, granularity, now - length * i) for i in range(buckets)]
+
+
+def get_union_key(action: str, window_keys: List[str]) -> str:
+    """Key of the merged buckets of a window, named after its first and last bucket"""
+    granularity, last = window_keys[0].rsplit(":", 2)[1:]
+    first = window_keys[-1].rsplit(":", 1)[1]
+    return UNION_KEY_TEMPLATE.format(action=action, window=f"{granularity}:{first}-{last}")
+
+
+def covers(client, action: str, since: datetime) -> bool:
+    """Whether the counters of action hold every action since a date"""
+    started = client.get(SINCE_KEY_TEMPLATE.format(action=action))
+    if started is None:
+        return False
+    if since < timezone.now() - GRANULARITIES["d"][0] * (DAILY_BUCKETS - 1):
+        # older than the buckets kept
+        return False
+    return float(started) <= since.timestamp()
+
+
+def incr_media_counter(action: str, media_id: int, now: Optional[datetime] = None, amount: int = 1) -> bool:
+    """
+    Count an action of a media in its hourly and daily buckets.
+
+    Args:
+        action: MediaAction action, only COUNTED_ACTIONS are counted
+        media_id: Media id
+        now: Time of the action, defaults to now
+        amount: Number of actions
+
+    Returns:
+        bool: True if the action was counted
+    """
+    if action not in COUNTED_ACTIONS:
+        return False
+    client = get_redis()
+    if client is None:
+        return False
+    now = now or timezone.now()
+    try:
+        pipe = client.pipeline(transaction=False)
+        for granularity, (length, kept, _) in GRANULARITIES.items():
+            key = get_bucket_key(action, granularity, now)
+            pipe.zincrby(key, amount, media_id)
+            # kept whole buckets, plus the current one
+            pipe.expire(key, int((length * (kept + 1)).total_seconds()))
+        pipe.set(SINCE_KEY_TEMPLATE.format(action=action), now.timestamp(), nx=True)
+        pipe.execute()
+        return True
+    except Exception as e:
+        logger.warning(f"Media counter increment failed for {action} of {media_id}: {e}")
+        return False
+
+
+def get_top_media(
+    action: str, since: datetime, limit: int, offset: int = 0
+) -> Optional[List[int]]:
+    """
+    Ids of the media with most actions since a date, most first.
+
+    Args:
+        action: One of COUNTED_ACTIONS
+        since: Start of the window
+        limit: Maximum number of media returned
+        offset: Number of top media skipped
+
+    Returns:
+        list or None: Media ids, or None if the counters can't tell, eg
+        without Redis or when counting started after since
+    """
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        if not covers(client, action, since):
+            return None
+        window_keys = get_window_keys(action, since)
+        union_key = get_union_key(action, window_keys)
+        pipe = client.pipeline(transaction=False)
+        pipe.exists(union_key)
+        pipe.zrevrange(union_key, offset, offset + limit - 1)
+        merged, top = pipe.execute()
+        if not merged:
+            # concurrent merges of a window store the same union
+            pipe = client.pipeline()
+            pipe.zunionstore(union_key, window_keys)
+            pipe.expire(union_key, UNION_TTL)
+            pipe.zrevrange(union_key, offset, offset + limit - 1)
+            top = pipe.execute()[2]
+        return [int(media_id) for media_id in top]
+    except Exception as e:
+        logger.warning(f"Media counter read failed for {action}: {e}")
+        return None
+
+
+def get_media_count(action: str, media_id: int, since: datetime) -> Optional[int]:
+    """
+    Number of actions of a media since a date.
+
+    Returns:
+        int or None: Count, or None if the counters can't tell
+    """
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        if not covers(client, action, since):
+            return None
+        pipe = client.pipeline(transaction=False)
+        for key in get_window_keys(action, since):
+            pipe.zscore(key, media_id)
+        return int(sum(score or 0 for score in pipe.execute()))
+    except Exception as e:
+        logger.warning(f"Media counter read failed for {action} of {media_id}: {e}")
+        return None
@@ -0,0 +1,328 @@
+"""
+Remote encoding worker, that pulls encodings from a CinemataCMS server.
+
+Runs as python manage.py encode_agent on machines that share neither the
+media filesystem nor the Celery broker with the server, with the token of
+an admin user. In a loop, the agent:
+
+1. leases the oldest pending encoding (POST /api/v1/encodings/lease);
+2. downloads its source, or chunk, resuming with HTTP Range and checking
+   its md5sum; sources are kept for the other profiles of the media;
+3. runs the ffmpeg commands of the encoding, with its own files in place of
+   the server's paths and placeholders;
+4. reports progress every PROGRESS_INTERVAL seconds, which renews the
+   lease, and gives up the encoding if the server leased it to another
+   worker meanwhile;
+5. uploads the output in ranges of UPLOAD_CHUNK bytes, resuming from what
+   the server has;
+6. sets the encoding to success, or fail, with its telemetry.
+
+The server side is files/remote_encoding.py and EncodingDetail.
+
+Classes:
+    - EncodeAgent: The worker loop
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import time
+from typing import Any, Dict, Optional, Tuple
+from urllib.parse import urljoin
+
+import requests
+
+from .backends import FFmpegBackend, VideoEncodingError
+from .encode_telemetry import get_encode_settings
+from .helpers import calculate_seconds
+from .remote_encoding import TEMP_FILE, TEMP_PASS_FILE
+
+logger = logging.getLogger(__name__)
+
+# seconds between progress reports
+PROGRESS_INTERVAL = 10
+# under DATA_UPLOAD_MAX_MEMORY_SIZE, the server reads a range in memory
+UPLOAD_CHUNK = 2 * 1024 * 1024
+DOWNLOAD_BLOCK = 1024 * 1024
+# attempts of a download or upload, with exponential backoff
+RETRIES = 5
+# sources kept for the next encodings
+KEEP_SOURCES = 2
+
+
+class LeaseLost(Exception):
+    """The server leased the encoding to another worker"""
+
+
+def file_md5sum(path: str) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(DOWNLOAD_BLOCK), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class EncodeAgent(object):
+    def __init__(
+        self,
+        server: str,
+        token: str,
+        name: Optional[str] = None,
+        work_dir: Optional[str] = None,
+        ffmpeg: str = "ffmpeg",
+        timeout: int = 60,
+    ):
+        self.server = server.rstrip("/") + "/"
+        self.name = name or socket.gethostname()
+        self.work_dir = work_dir or os.path.join(tempfile.gettempdir(), "encode_agent")
+        self.ffmpeg = ffmpeg
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Token {token}"
+        os.makedirs(os.path.join(self.work_dir, "sources"), exist_ok=True)
+
+    def url(self, path: str) -> str:
+        return urljoin(self.server, path.lstrip("/"))
+
+    def encoding_url(self, encoding_id: int) -> str:
+        return self.url(f"api/v1/media/encoding/{encoding_id}")
+
+    def retry(self, attempt: int, error: Exception) -> None:
+        if attempt + 1 >= RETRIES:
+            raise error
+        logger.warning(f"{error}, retrying")
+        time.sleep(2**attempt)
+
+    def lease(self) -> Optional[Dict[str, Any]]:
+        """The start info of a leased encoding, None if there is no work"""
+        r = self.session.post(
+            self.url("api/v1/encodings/lease"), json={"worker": self.name}, timeout=self.timeout
+        )
+        if r.status_code == 204:
+            return None
+        r.raise_for_status()
+        return r.json()
+
+    def update(self, encoding_id: int, **fields) -> None:
+        """Update fields of the encoding, renewing the lease"""
+        fields.update({"action": "update_fields", "worker": self.name})
+        r = self.session.post(self.encoding_url(encoding_id), json=fields, timeout=self.timeout)
+        if r.status_code == 409:
+            raise LeaseLost(f"encoding {encoding_id} was leased to another worker")
+        r.raise_for_status()
+
+    def download(self, job: Dict[str, Any]) -> str:
+        """
+        Download the source of an encoding, resuming a partial download
+        with Range, and check its md5sum.
+
+        Returns:
+            str: path of the source
+        """
+        md5sum = job.get("original_media_md5sum") or ""
+        extension = os.path.splitext(job["original_media_path"])[1]
+        name = md5sum or f"encoding-{job['encoding_id']}"
+        path = os.path.join(self.work_dir, "sources", name + extension)
+        if os.path.exists(path):
+            os.utime(path)
+            return path
+        self.prune_sources()
+
+        part = path + ".part"
+        for attempt in range(RETRIES):
+            have = os.path.getsize(part) if os.path.exists(part) else 0
+            headers = {"Range": f"bytes={have}-"} if have else {}
+            try:
+                with self.session.get(
+                    self.url(job["source_url"]), headers=headers, stream=True, timeout=self.timeout
+                ) as r:
+                    # the whole file is there already
+                    if r.status_code == 416 and have:
+                        break
+                    r.raise_for_status()
+                    # servers without Range support send it all again
+                    with open(part, "ab" if r.status_code == 206 else "wb") as f:
+                        for block in r.iter_content(DOWNLOAD_BLOCK):
+                            f.write(block)
+                break
+            except requests.RequestException as e:
+                self.retry(attempt, e)
+
+        if md5sum and file_md5sum(part) != md5sum:
+            os.remove(part)
+            raise VideoEncodingError(f"md5sum of {job['source_url']} does not match")
+        os.replace(part, path)
+        return path
+
+    def prune_sources(self) -> None:
+        sources_dir = os.path.join(self.work_dir, "sources")
+        sources = sorted(
+            (os.path.join(sources_dir, f) for f in os.listdir(sources_dir)),
+            key=os.path.getmtime,
+            reverse=True,
+        )
+        for path in [s for s in sources if not s.endswith(".part")][KEEP_SOURCES - 1:]:
+            os.remove(path)
+
+    def local_command(self, cmd, job, source: str, output: str, pass_file: str):
+        """A command of the server, with the files and ffmpeg of this worker"""
+        ret = [self.ffmpeg]
+        for arg in cmd[1:]:
+            arg = str(arg)
+            if arg == job["original_media_path"]:
+                arg = source
+            ret.append(arg.replace(TEMP_PASS_FILE, pass_file).replace(TEMP_FILE, output))
+        return ret
+
+    def encode(self, job: Dict[str, Any], source: str, temp_dir: str) -> Tuple[str, Dict[str, Any]]:
+        """
+        Run the ffmpeg commands of an encoding, reporting progress.
+
+        Returns:
+            (str, dict): path of the output, and telemetry of the encode
+        """
+        encoding_id = job["encoding_id"]
+        output = os.path.join(temp_dir, f"output.{job['profile_extension']}")
+        pass_file = os.path.join(temp_dir, "pass")
+        commands = [
+            self.local_command(cmd, job, source, output, pass_file) for cmd in job["ffmpeg_commands"]
+        ]
+        duration = job.get("duration") or 0
+        telemetry = dict(get_encode_settings(job["ffmpeg_commands"]), cpu_time=0.0, max_rss=0)
+
+        start = last_report = time.time()
+        encoded = 0.0
+        logs = ""
+        for cmd in commands:
+            backend = FFmpegBackend()
+            try:
+                for logs in backend.encode(cmd):
+                    # the time= of ffmpeg's stats as HH:MM:SS.ms, then its output
+                    seconds = calculate_seconds(f"time={logs}") if isinstance(logs, str) else None
+                    if seconds:
+                        encoded = max(encoded, float(seconds))
+                    if time.time() - last_report >= PROGRESS_INTERVAL:
+                        last_report = time.time()
+                        progress = min(int(encoded * 100 / duration), 99) if duration else 0
+                        self.update(encoding_id, progress=progress)
+            except BaseException:
+                # lease lost, or the server unreachable
+                backend.terminate_process()
+                raise
+            rusage = getattr(backend.process, "rusage", None)
+            if rusage is not None:
+                telemetry["cpu_time"] += rusage.ru_utime + rusage.ru_stime
+                telemetry["max_rss"] = max(telemetry["max_rss"], rusage.ru_maxrss)
+
+        if not os.path.exists(output) or not os.path.getsize(output):
+            raise VideoEncodingError(f"No output from FFmpeg.\n{logs}")
+        wall_time = time.time() - start
+        size = os.path.getsize(output)
+        telemetry.update(
+            {
+                "wall_time": wall_time,
+                "output_size": size,
+                "speed": encoded / wall_time if wall_time else 0,
+                "bitrate": int(size * 8 / 1000 / encoded) if encoded else 0,
+                "logs": logs,
+            }
+        )
+        return output, telemetry
+
+    def upload(self, encoding_id: int, path: str) -> None:
+        """Upload the output in ranges, from what the server has already"""
+        url = self.encoding_url(encoding_id)
+        params = {"worker": self.name}
+        total = os.path.getsize(path)
+        md5sum = file_md5sum(path)
+        r = self.session.get(url, params=params, timeout=self.timeout)
+        r.raise_for_status()
+        offset = r.json()["uploaded"]
+        if offset > total:
+            offset = 0
+
+        failures = 0
+        with open(path, "rb") as f:
+            while offset < total:
+                f.seek(offset)
+                data = f.read(UPLOAD_CHUNK)
+                end = offset + len(data) - 1
+                headers = {
+                    "Content-Range": f"bytes {offset}-{end}/{total}",
+                    "Content-Type": "application/octet-stream",
+                }
+                if end + 1 == total:
+                    headers["X-Md5sum"] = md5sum
+                try:
+                    r = self.session.put(
+                        url, params=params, data=data, headers=headers, timeout=self.timeout
+                    )
+                    if r.status_code == 409:
+                        ret = r.json()
+                        if "uploaded" not in ret:
+                            raise LeaseLost(f"encoding {encoding_id} was leased to another worker")
+                        # out of sync, or the checksum failed and it starts over
+                        offset = ret["uploaded"]
+                        raise requests.RequestException(f"upload of {encoding_id} resumes at {offset}")
+                    r.raise_for_status()
+                    offset = r.json()["uploaded"]
+                except requests.RequestException as e:
+                    self.retry(failures, e)
+                    failures += 1
+
+    def run_once(self) -> bool:
+        """
+        Lease and encode one encoding.
+
+        Returns:
+            bool: False if there was no work
+        """
+        job = self.lease()
+        if job is None:
+            return False
+        encoding_id = job["encoding_id"]
+        logger.info(f"Leased encoding {encoding_id}")
+        start = time.time()
+        temp_dir = tempfile.mkdtemp(dir=self.work_dir)
+        try:
+            source = self.download(job)
+            output, telemetry = self.encode(job, source, temp_dir)
+            self.upload(encoding_id, output)
+            self.update(
+                encoding_id,
+                status="success",
+                progress=100,
+                total_run_time=int(time.time() - start),
+                **telemetry,
+            )
+            logger.info(f"Encoded encoding {encoding_id}")
+        except LeaseLost as e:
+            logger.warning(str(e))
+        except VideoEncodingError as e:
+            logger.error(f"Encoding {encoding_id} failed: {e.message}")
+            try:
+                self.update(encoding_id, status="fail", logs=str(e.message)[-1000:])
+            except LeaseLost:
+                pass
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+        return True
+
+    def run(self, poll: int = 30, once: bool = False) -> None:
+        """
+        Encode until stopped, waiting poll seconds when there's no work.
+        Encodings left by errors are leased again when their lease expires.
+        """
+        while True:
+            try:
+                worked = self.run_once()
+            except Exception as e:
+                logger.exception(f"Remote encoding failed: {e}")
+                worked = False
+            if once:
+                return
+            if not worked:
+                time.sleep(poll)
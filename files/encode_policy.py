@@ -0,0 +1,105 @@
+"""
+Which renditions of a video are encoded at upload, and which later.
+
+Every upload used to be encoded in every active profile at once, high
+resolutions included, that few viewers watch and that take most of the
+encoding time. With LAZY_ENCODING, profiles of LAZY_ENCODING_RESOLUTION and
+above are deferred:
+
+- while more than LAZY_ENCODING_BACKLOG encodings are pending, so uploads
+  at peak hours get their MINIMUM_RESOLUTIONS_TO_ENCODE ladder and lower
+  renditions sooner;
+- and, with LAZY_ENCODING_VIEWS set, also until the media has that many
+  views.
+
+Deferred renditions are encodings a media doesn't have. Task
+backfill_deferred_encodes encodes them later without growing the backlog
+past LAZY_ENCODING_BACKLOG: those of media with enough views any time,
+the others in LAZY_ENCODING_IDLE_HOURS. check_missing_profiles follows the
+same policy.
+
+Functions:
+    - get_backlog: Number of pending encodings
+    - is_deferrable: Whether a profile is ever deferred
+    - is_deferred: Whether a media waits for a profile
+    - get_encodable_filter: Media that may be encoded in a profile now
+    - split_profiles: Profiles a media is encoded in now, and deferred ones
+    - is_idle_hour: Whether deferred renditions of any media are encoded
+"""
+
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+
+
+def get_backlog() -> int:
+    from .models import Encoding
+
+    return Encoding.objects.filter(status="pending").count()
+
+
+def is_deferrable(profile) -> bool:
+    return bool(
+        settings.LAZY_ENCODING
+        and profile.extension != "gif"
+        and profile.resolution
+        and profile.resolution >= settings.LAZY_ENCODING_RESOLUTION
+        and profile.resolution not in settings.MINIMUM_RESOLUTIONS_TO_ENCODE
+    )
+
+
+def is_deferred(profile, views: int, backlog: int) -> bool:
+    """Whether encoding a media with views in a profile waits"""
+    if not is_deferrable(profile):
+        return False
+    if backlog > settings.LAZY_ENCODING_BACKLOG:
+        return True
+    return bool(settings.LAZY_ENCODING_VIEWS) and views < settings.LAZY_ENCODING_VIEWS
+
+
+def get_encodable_filter(profile, backlog: int) -> Optional[Q]:
+    """
+    Media that may be encoded in a profile now, like is_deferred.
+
+    Returns:
+        Q: a filter of Media, empty for all of them, or None for none
+    """
+    if not is_deferrable(profile):
+        return Q()
+    if backlog > settings.LAZY_ENCODING_BACKLOG:
+        return None
+    if settings.LAZY_ENCODING_VIEWS:
+        return Q(views__gte=settings.LAZY_ENCODING_VIEWS)
+    return Q()
+
+
+def split_profiles(media, profiles, backlog: Optional[int] = None) -> Tuple[List, List]:
+    """
+    Profiles to encode a media in now, and deferred ones.
+
+    Returns:
+        (list, list): profiles now, deferred profiles
+    """
+    profiles = list(profiles)
+    if not any(is_deferrable(profile) for profile in profiles):
+        return profiles, []
+    if backlog is None:
+        backlog = get_backlog()
+    now, deferred = [], []
+    for profile in profiles:
+        if is_deferred(profile, media.views, backlog):
+            deferred.append(profile)
+        else:
+            now.append(profile)
+    return now, deferred
+
+
+def is_idle_hour() -> bool:
+    start, end = settings.LAZY_ENCODING_IDLE_HOURS
+    hour = timezone.localtime().hour
+    if start <= end:
+        return start <= hour < end
+    # over midnight
+    return hour >= start or hour < end
@@ -0,0 +1,138 @@
+"""
+Performance telemetry of encodes, and throughput reports.
+
+encode_media records on each Encoding:
+    - wall_time: seconds ffmpeg ran, over all passes
+    - cpu_time and max_rss: from the process registry (files/processes.py)
+    - speed: seconds of output encoded per second of wall time
+    - output_size and bitrate: of the output file, in bytes and kbit/s
+    - preset, crf and pass_mode: encoder settings of the ffmpeg commands
+    - queue_wait: seconds from publishing the task to its start
+
+Publishing an encode_media task stamps its message with the time, in the
+PUBLISHED_HEADER header, which workers read as a request attribute.
+
+Functions:
+    - get_encode_settings: Preset, CRF and pass mode of ffmpeg commands
+    - get_queue_wait: Seconds a task waited in the queue
+    - get_throughput: Aggregates of the encodes of a window, grouped
+"""
+
+import time
+from typing import Any, Dict, Iterable, List, Optional
+
+from celery.signals import before_task_publish
+from django.db.models import Avg, Count, F, Max, Q, Sum
+
+PUBLISHED_HEADER = "published_at"
+
+# report groups -> Encoding fields
+GROUPS = {
+    "profile": "profile__name",
+    "resolution": "profile__resolution",
+    "codec": "profile__codec",
+    "worker": "worker",
+    "preset": "preset",
+    "pass_mode": "pass_mode",
+}
+
+
+def get_encode_settings(commands) -> Dict[str, Any]:
+    """
+    Preset, CRF and pass mode of the ffmpeg commands of an encode, as made
+    by produce_ffmpeg_commands. The preset of VP9 is its -speed.
+    """
+    cmd = [str(arg) for arg in commands[-1]]
+
+    def value(flag):
+        return cmd[cmd.index(flag) + 1] if flag in cmd[:-1] else None
+
+    preset = value("-preset")
+    if preset is None and value("-speed") is not None:
+        preset = f"speed={value('-speed')}"
+    crf = value("-crf")
+    if len(commands) > 1:
+        pass_mode = "twopass"
+    else:
+        pass_mode = "crf" if crf else "onepass"
+    return {
+        "preset": preset or "",
+        "crf": int(crf) if crf else None,
+        "pass_mode": pass_mode,
+    }
+
+
+def get_queue_wait(request, started: float) -> Optional[float]:
+    """Seconds a task waited in its queue, None if its message has no stamp"""
+    published = getattr(request, PUBLISHED_HEADER, None)
+    if not published:
+        return None
+    return max(started - float(published), 0)
+
+
+def get_throughput(
+    since, until=None, group_by: Iterable[str] = ("profile",)
+) -> List[Dict[str, Any]]:
+    """
+    Aggregates of the encodes added in a window that ran ffmpeg, grouped by
+    GROUPS keys, most wall time first.
+
+    Per group: encodes, failed, wall_hours, cpu_hours, encoded_hours (of
+    output), speed (encoded per wall second), cores (CPU per wall second),
+    cpu_per_encoded_second, output_bytes, avg_bitrate (kbit/s, of
+    successful encodes), avg_queue_wait (seconds) and max_rss (KB).
+    """
+    from .models import Encoding
+
+    fields = [GROUPS[group] for group in group_by]
+    encodes = Encoding.objects.filter(add_date__gte=since, wall_time__gt=0)
+    if until is not None:
+        encodes = encodes.filter(add_date__lt=until)
+    rows = (
+        encodes.values(*fields)
+        .annotate(
+            n_encodes=Count("id"),
+            n_failed=Count("id", filter=Q(status="fail")),
+            sum_wall=Sum("wall_time"),
+            sum_cpu=Sum("cpu_time"),
+            sum_encoded=Sum(F("speed") * F("wall_time")),
+            sum_output=Sum("output_size"),
+            avg_bitrate=Avg("bitrate", filter=Q(status="success")),
+            avg_queue_wait=Avg("queue_wait"),
+            peak_rss=Max("max_rss"),
+        )
+        .order_by("-sum_wall", *fields)
+    )
+
+    ret = []
+    for row in rows:
+        wall, cpu, encoded = row["sum_wall"], row["sum_cpu"] or 0, row["sum_encoded"] or 0
+        item = {group: row[field] for group, field in zip(group_by, fields)}
+        item.update(
+            {
+                "encodes": row["n_encodes"],
+                "failed": row["n_failed"],
+                "wall_hours": round(wall / 3600, 3),
+                "cpu_hours": round(cpu / 3600, 3),
+                "encoded_hours": round(encoded / 3600, 3),
+                "speed": round(encoded / wall, 3),
+                "cores": round(cpu / wall, 2),
+                "cpu_per_encoded_second": round(cpu / encoded, 3) if encoded else None,
+                "output_bytes": row["sum_output"] or 0,
+                "avg_bitrate": round(row["avg_bitrate"]) if row["avg_bitrate"] else None,
+                "avg_queue_wait": (
+                    round(row["avg_queue_wait"], 1) if row["avg_queue_wait"] is not None else None
+                ),
+                "max_rss": row["peak_rss"],
+            }
+        )
+        ret.append(item)
+    return ret
+
+
+@before_task_publish.connect
+def stamp_published(sender=None, headers=None, **kwargs):
+    # sender is the task name, headers of the message are sent as modified.
+    # Encodes released by fair_share.dispatch carry the time they were queued
+    if sender == "encode_media" and headers is not None:
+        headers.setdefault(PUBLISHED_HEADER, time.time())
@@ -0,0 +1,376 @@
+"""
+Set-based reconciliation of media and encoding states.
+
+The periodic checks (tasks check_media_states, check_running_states,
+check_pending_states and check_missing_profiles) used to load every media
+or encoding in Python, with a few queries per row. Here each check finds
+the rows that need fixing with aggregate or anti-join queries, walks them
+by id in batches of BATCH_SIZE, and fixes a batch with a fixed number of
+queries. Each returns the number of rows it fixed.
+
+Functions:
+    - annotate_mp4_status: Encoding status of media, as a query annotation
+    - fix_media_states: Set encoding_status from the mp4 encodings
+    - resume_chunked_encodes: Encode again only the chunks an encode lacks
+    - requeue_stale_running: Re-encode encodings stuck running
+    - requeue_lost_pending: Re-encode pending encodings no worker has
+    - encode_missing_profiles: Encode the profiles videos lack
+    - backfill_deferred_profiles: Encode renditions the policy deferred
+"""
+
+import json
+import os
+from collections import defaultdict
+from datetime import timedelta
+from typing import Iterable, Set, Tuple
+
+from django.conf import settings
+from django.db.models import Case, CharField, Count, Exists, F, OuterRef, Q, Value, When
+from django.utils import timezone
+
+from . import encode_policy, helpers
+
+BATCH_SIZE = 1000
+
+
+def annotate_mp4_status(media):
+    """
+    Annotate media with mp4_status, their encoding status from their final
+    mp4 encodings, like Media.set_encoding_status does
+    """
+    mp4 = Q(encodings__profile__extension="mp4", encodings__chunk=False)
+    return media.annotate(
+        mp4_count=Count("encodings", filter=mp4),
+        mp4_success=Count("encodings", filter=mp4 & Q(encodings__status="success")),
+        mp4_running=Count("encodings", filter=mp4 & Q(encodings__status="running")),
+    ).annotate(
+        mp4_status=Case(
+            When(mp4_count=0, then=Value("pending")),
+            When(mp4_success__gt=0, then=Value("success")),
+            When(mp4_running__gt=0, then=Value("running")),
+            default=Value("fail"),
+            output_field=CharField(),
+        )
+    )
+
+
+def fix_media_states(batch_size: int = BATCH_SIZE) -> int:
+    """
+    Set the encoding status of media not in success from their mp4
+    encodings, where it differs.
+
+    Media that become success are saved one by one, as listings and counts
+    depend on it. Other changes are one UPDATE per status and batch.
+
+    Returns:
+        int: Number of media whose status changed
+    """
+    from .models import Media
+
+    wrong = annotate_mp4_status(
+        Media.objects.filter(encoding_status__in=["running", "fail", "pending"])
+    ).exclude(encoding_status=F("mp4_status"))
+    fixed = 0
+    last_id = 0
+    while True:
+        rows = list(
+            wrong.filter(id__gt=last_id).order_by("id").values_list("id", "mp4_status")[:batch_size]
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        by_status = defaultdict(list)
+        for media_id, mp4_status in rows:
+            by_status[mp4_status].append(media_id)
+        for mp4_status, ids in by_status.items():
+            if mp4_status == "success":
+                for media in Media.objects.filter(id__in=ids):
+                    media.encoding_status = "success"
+                    media.save(update_fields=["encoding_status"])
+            else:
+                Media.objects.filter(id__in=ids).update(encoding_status=mp4_status)
+        fixed += len(rows)
+    return fixed
+
+
+def resume_chunked_encodes(rows: Iterable[Tuple[int, int, int]]) -> Set[int]:
+    """
+    Encode again the chunks of the given chunk encodings, keeping the
+    chunks their encode has already.
+
+    A chunked encode is the chunk encodings of a media and profile with the
+    same chunks_info, the segments chunkize_media cut and their md5sums.
+    Each chunk is saved as it's encoded and they are merged once all are
+    there, so an encode that lost a worker only needs its chunks that are
+    not encoded, pending or running: the given ones, failed ones, and
+    segments without an encoding. Their encodings are reused, to keep one
+    per segment.
+
+    Encodes with segments missing from disk can't be resumed. Their
+    chunks, and their remaining segments, are deleted.
+
+    Args:
+        rows: (encoding id, media id, profile id), of any encodings
+
+    Returns:
+        set: Ids of the encodings resumed
+    """
+    from .models import Encoding
+    from .tasks import encode_chunk
+
+    chunks = Encoding.objects.filter(
+        id__in=[encoding_id for encoding_id, _, _ in rows], chunk=True
+    ).select_related("media", "profile")
+    encodes = defaultdict(list)
+    for encoding in chunks:
+        encodes[(encoding.media_id, encoding.profile_id, encoding.chunks_info)].append(encoding)
+
+    resumed = set()
+    for (media_id, profile_id, chunks_info), restart in encodes.items():
+        try:
+            segments = json.loads(chunks_info)
+        except ValueError:
+            segments = {}
+        encodings = Encoding.objects.filter(
+            media_id=media_id, profile_id=profile_id, chunk=True, chunks_info=chunks_info
+        )
+        if not segments or not all(os.path.exists(segment) for segment in segments):
+            encodings.exclude(id__in=[encoding.id for encoding in restart]).delete()
+            for segment in segments:
+                helpers.rm_file(segment)
+            continue
+
+        restart_ids = [encoding.id for encoding in restart]
+        restart += list(encodings.filter(status="fail").exclude(id__in=restart_ids))
+        restart_ids = [encoding.id for encoding in restart]
+        encoded = Q(status="success") & ~Q(media_file="")
+        keep = set(
+            encodings.exclude(id__in=restart_ids)
+            .filter(encoded | Q(status__in=["pending", "running"]))
+            .values_list("chunk_file_path", flat=True)
+        )
+        by_segment = {encoding.chunk_file_path: encoding for encoding in restart}
+        media, profile = restart[0].media, restart[0].profile
+        for segment, md5sum in segments.items():
+            if segment in keep:
+                continue
+            encoding = by_segment.pop(segment, None)
+            if encoding is None:
+                encoding = Encoding(
+                    media=media,
+                    profile=profile,
+                    chunk=True,
+                    chunk_file_path=segment,
+                    chunks_info=chunks_info,
+                    md5sum=md5sum,
+                )
+            encoding.status = "pending"
+            encoding.progress = 0
+            encoding.lease_expires = None
+            encoding.save()
+            # encode_media drops the other encodings of the segment
+            encode_chunk(encoding, force=True)
+            resumed.add(encoding.id)
+        # duplicates of segments another encoding has
+        Encoding.objects.filter(id__in=[encoding.id for encoding in by_segment.values()]).delete()
+        resumed.update(encoding.id for encoding in by_segment.values())
+    return resumed
+
+
+def requeue_encodings(rows: Iterable[Tuple[int, int, int]], force: bool) -> int:
+    """
+    Delete encodings and encode their profiles again, one encode call per
+    media. Chunked encodes are resumed instead, see resume_chunked_encodes.
+
+    Args:
+        rows: (encoding id, media id, profile id)
+        force: Passed to Media.encode
+
+    Returns:
+        int: Number of encodings requeued
+    """
+    from .models import EncodeProfile, Encoding, Media
+
+    rows = list(rows)
+    if not rows:
+        return 0
+    requeued = len(rows)
+    resumed = resume_chunked_encodes(rows)
+    rows = [row for row in rows if row[0] not in resumed]
+    profiles_of = defaultdict(list)
+    for _, media_id, profile_id in rows:
+        profiles_of[media_id].append(profile_id)
+    Encoding.objects.filter(id__in=[encoding_id for encoding_id, _, _ in rows]).delete()
+    media = Media.objects.in_bulk(list(profiles_of))
+    profiles = EncodeProfile.objects.in_bulk({p for ids in profiles_of.values() for p in ids})
+    for media_id, profile_ids in profiles_of.items():
+        if media_id in media:
+            media[media_id].encode(profiles=[profiles[p] for p in profile_ids], force=force)
+    return requeued
+
+
+def requeue_stale_running(batch_size: int = BATCH_SIZE) -> int:
+    """
+    Re-encode the encodings running without an update for longer than
+    RUNNING_STATE_STALE seconds.
+
+    Returns:
+        int: Number of encodings requeued
+    """
+    from .models import Encoding
+
+    stale = Encoding.objects.filter(
+        status="running",
+        update_date__lt=timezone.now() - timedelta(seconds=settings.RUNNING_STATE_STALE),
+    )
+    fixed = 0
+    last_id = 0
+    while True:
+        rows = list(
+            stale.filter(id__gt=last_id)
+            .order_by("id")
+            .values_list("id", "media_id", "profile_id")[:batch_size]
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        fixed += requeue_encodings(rows, force=True)
+    return fixed
+
+
+def requeue_lost_pending(batch_size: int = BATCH_SIZE) -> int:
+    """
+    Re-encode the pending encodings that are in no worker's active,
+    reserved or scheduled tasks, and not waiting in the fair-share queues.
+
+    Returns:
+        int: Number of encodings requeued
+    """
+    from .fair_share import get_queued_encodings
+    from .methods import list_tasks
+    from .models import Encoding
+
+    pending = Encoding.objects.filter(status="pending")
+    if not pending.exists():
+        return 0
+    queued = get_queued_encodings()
+    tasks = list_tasks()
+    task_ids = set(tasks["task_ids"])
+    media_profile_pairs = set(tasks["media_profile_pairs"])
+
+    fixed = 0
+    last_id = 0
+    while True:
+        rows = list(
+            pending.filter(id__gt=last_id)
+            .order_by("id")
+            .values_list("id", "media_id", "profile_id", "task_id", "media__friendly_token")[
+                :batch_size
+            ]
+        )
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        lost = [
+            (encoding_id, media_id, profile_id)
+            for encoding_id, media_id, profile_id, task_id, friendly_token in rows
+            # tasks of encodings without task id are known by media and profile
+            if not (task_id and task_id in task_ids)
+            and (friendly_token, profile_id) not in media_profile_pairs
+            and encoding_id not in queued
+        ]
+        fixed += requeue_encodings(lost, force=False)
+    return fixed
+
+
+def get_missing_profile_media(profile):
+    """
+    Videos without an encoding of a profile, by anti-join. Profiles above
+    the video height are skipped, like Media.encode does, unless in
+    MINIMUM_RESOLUTIONS_TO_ENCODE.
+    """
+    from .models import Encoding, Media
+
+    videos = Media.objects.filter(media_type="video")
+    if (
+        profile.extension != "gif"
+        and profile.resolution
+        and profile.resolution not in settings.MINIMUM_RESOLUTIONS_TO_ENCODE
+    ):
+        videos = videos.filter(
+            Q(video_height__gte=profile.resolution)
+            | Q(video_height=0)
+            | Q(video_height__isnull=True)
+        )
+    return videos.filter(~Exists(Encoding.objects.filter(media=OuterRef("pk"), profile=profile)))
+
+
+def encode_missing_profiles(batch_size: int = BATCH_SIZE) -> int:
+    """
+    Encode the profiles that videos have no encoding of, inactive ones
+    too like the check always did, except those deferred by the encoding
+    policy, see files/encode_policy.py.
+
+    Returns:
+        int: Number of media sent to encode
+    """
+    from .models import EncodeProfile, Media
+
+    backlog = encode_policy.get_backlog()
+    missing = defaultdict(list)
+    for profile in EncodeProfile.objects.all():
+        encodable = encode_policy.get_encodable_filter(profile, backlog)
+        if encodable is None:
+            continue
+        videos = get_missing_profile_media(profile).filter(encodable)
+        for media_id in videos.values_list("id", flat=True).iterator():
+            missing[media_id].append(profile)
+
+    media_ids = sorted(missing)
+    for start in range(0, len(media_ids), batch_size):
+        batch = media_ids[start:start + batch_size]
+        for media in Media.objects.filter(id__in=batch):
+            # with force=False encode_media won't delete existing profiles
+            # if they appear on the meanwhile (eg on a big queue)
+            media.encode(profiles=missing[media.id], force=False)
+    return len(media_ids)
+
+
+def backfill_deferred_profiles() -> int:
+    """
+    Encode renditions deferred by the encoding policy, most viewed media
+    first, up to LAZY_ENCODING_BACKLOG pending encodings. Only media with
+    LAZY_ENCODING_VIEWS views, out of LAZY_ENCODING_IDLE_HOURS.
+
+    Returns:
+        int: Number of renditions sent to encode
+    """
+    from .models import EncodeProfile, Media
+
+    if not settings.LAZY_ENCODING:
+        return 0
+    capacity = settings.LAZY_ENCODING_BACKLOG - encode_policy.get_backlog()
+    if capacity <= 0:
+        return 0
+    idle = encode_policy.is_idle_hour()
+    candidates = []
+    for profile in EncodeProfile.objects.filter(active=True):
+        if not encode_policy.is_deferrable(profile):
+            continue
+        videos = get_missing_profile_media(profile)
+        if not idle:
+            if not settings.LAZY_ENCODING_VIEWS:
+                continue
+            videos = videos.filter(views__gte=settings.LAZY_ENCODING_VIEWS)
+        for media_id, views in videos.order_by("-views", "id").values_list("id", "views")[
+            :capacity
+        ]:
+            candidates.append((-views, media_id, profile))
+
+    candidates.sort(key=lambda c: c[:2])
+    missing = defaultdict(list)
+    for _, media_id, profile in candidates[:capacity]:
+        missing[media_id].append(profile)
+    for media in Media.objects.filter(id__in=list(missing)):
+        media.encode(profiles=missing[media.id], force=False)
+    return sum(len(profiles) for profiles in missing.values())
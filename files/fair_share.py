@@ -0,0 +1,312 @@
+"""
+Fair-share scheduling of encodes across uploaders.
+
+encode_media tasks used to be published straight to the long_tasks queue
+in upload order, so a distributor uploading 40 films, or the chunks of one
+feature, held back everyone else's encodes for hours. With
+FAIR_SHARE_ENCODING, encodes wait in a queue per uploader in Redis, and
+dispatch releases them to Celery while fewer than FAIR_SHARE_SLOTS released
+encodes are pending or running. The broker queue stays short, so the next
+encode of any uploader starts soon.
+
+Uploaders take turns in proportion to their weight, the highest of
+FAIR_SHARE_WEIGHTS their user flags match, by stride scheduling: every
+uploader with queued encodes has a pass, the one with the lowest pass is
+released next and its pass grows by 1 / weight. Uploaders that start
+queueing join at the pass of the last release, so idle time earns no
+credit.
+
+dispatch runs when encodes are queued and when encode_media finishes, and
+every 10 seconds with task dispatch_encodes. Without django-redis, or with
+FAIR_SHARE_ENCODING off, encodes are published at once as before.
+
+Functions:
+    - get_weight: Weight of an uploader
+    - publish_encode: Queue an encode_media task of a media
+    - dispatch: Release queued encodes to Celery
+    - get_queue_stats: Queued and released encodes per uploader
+    - get_queued_encodings: Ids of the encodings queued or released
+
+Cache Key Patterns:
+    - fair_share:users
+    - fair_share:queue:{user_id}
+    - fair_share:released
+    - fair_share:pass
+"""
+
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional, Set
+
+from celery.signals import task_postrun
+from django.conf import settings
+from django.core.cache import cache
+from redis.exceptions import WatchError
+
+from .cache_utils import CACHE_KEY_PREFIX
+from .counters import get_redis
+from .encode_telemetry import PUBLISHED_HEADER
+
+logger = logging.getLogger(__name__)
+
+# uploaders with queued encodes, scored by pass
+USERS_KEY = f"{CACHE_KEY_PREFIX}:fair_share:users"
+QUEUE_KEY_TEMPLATE = f"{CACHE_KEY_PREFIX}:fair_share:queue:{{user_id}}"
+# released encodes as {user_id}:{encoding_id}, scored by release time
+RELEASED_KEY = f"{CACHE_KEY_PREFIX}:fair_share:released"
+# pass of the last release
+PASS_KEY = f"{CACHE_KEY_PREFIX}:fair_share:pass"
+LOCK_KEY = "fair_share_dispatch_lock"
+LOCK_TIMEOUT = 60
+
+
+def get_fair_share_redis():
+    return get_redis() if settings.FAIR_SHARE_ENCODING else None
+
+
+def get_weight(user) -> float:
+    """Highest weight of FAIR_SHARE_WEIGHTS the flags of a user match, or 1"""
+    weights = [
+        weight
+        for flag, weight in settings.FAIR_SHARE_WEIGHTS.items()
+        if getattr(user, flag, False)
+    ]
+    return float(max(weights + [1]))
+
+
+def publish_encode(
+    media,
+    args: List[Any],
+    kwargs: Dict[str, Any],
+    priority: Optional[int] = None,
+    countdown: Optional[int] = None,
+) -> bool:
+    """
+    Queue an encode_media task of a media, in the queue of its uploader.
+    An encode published again, eg waiting for scratch space, gives back
+    its slot until released again.
+
+    Args:
+        countdown: Seconds the task waits once published
+
+    Returns:
+        bool: False if the task was published at once
+    """
+    from .tasks import encode_media
+
+    client = get_fair_share_redis()
+    if client is not None:
+        item = {
+            "args": args,
+            "kwargs": kwargs,
+            "priority": priority,
+            "countdown": countdown,
+            "weight": get_weight(media.user),
+            "queued": time.time(),
+        }
+        try:
+            current_pass = float(client.get(PASS_KEY) or 0)
+            pipe = client.pipeline(transaction=False)
+            pipe.rpush(QUEUE_KEY_TEMPLATE.format(user_id=media.user_id), json.dumps(item))
+            # uploaders already queueing keep their pass
+            pipe.zadd(USERS_KEY, {media.user_id: current_pass}, nx=True)
+            pipe.zrem(RELEASED_KEY, f"{media.user_id}:{args[2]}")
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Could not queue encode of {media.friendly_token}: {e}")
+        else:
+            release_encodes()
+            return True
+    encode_media.apply_async(args=args, kwargs=kwargs, priority=priority, countdown=countdown)
+    return False
+
+
+def get_released(client) -> List[str]:
+    """Released encodes still pending or running, dropping the others"""
+    from .models import Encoding
+
+    released = {}
+    for member in client.zrange(RELEASED_KEY, 0, -1):
+        member = member.decode() if isinstance(member, bytes) else member
+        released[member] = int(member.split(":")[1])
+    if not released:
+        return []
+    live = set(
+        Encoding.objects.filter(
+            id__in=list(released.values()), status__in=["pending", "running"]
+        ).values_list("id", flat=True)
+    )
+    done = [member for member, encoding_id in released.items() if encoding_id not in live]
+    if done:
+        client.zrem(RELEASED_KEY, *done)
+    return [member for member, encoding_id in released.items() if encoding_id in live]
+
+
+def drop_if_empty(client, user_id: str) -> None:
+    """Remove an uploader from the turns, unless an encode was just queued"""
+    queue_key = QUEUE_KEY_TEMPLATE.format(user_id=user_id)
+    with client.pipeline() as pipe:
+        try:
+            pipe.watch(queue_key)
+            if pipe.llen(queue_key) == 0:
+                pipe.multi()
+                pipe.zrem(USERS_KEY, user_id)
+                pipe.execute()
+        except WatchError:
+            pass
+
+
+def dispatch() -> int:
+    """
+    Release queued encodes to Celery, the uploader with the lowest pass
+    first, until FAIR_SHARE_SLOTS released encodes are pending or running.
+    Only one dispatch runs at a time, others return at once.
+
+    Returns:
+        int: Number of encodes released
+    """
+    from .tasks import encode_media
+
+    client = get_fair_share_redis()
+    if client is None:
+        return 0
+    # a single dispatcher, that takes turns in order
+    if not cache.add(LOCK_KEY, True, timeout=LOCK_TIMEOUT):
+        return 0
+    released = 0
+    try:
+        free = settings.FAIR_SHARE_SLOTS - len(get_released(client))
+        while released < free:
+            turn = client.zrange(USERS_KEY, 0, 0, withscores=True)
+            if not turn:
+                break
+            user_id, user_pass = turn[0]
+            user_id = user_id.decode() if isinstance(user_id, bytes) else user_id
+            queue_key = QUEUE_KEY_TEMPLATE.format(user_id=user_id)
+            raw = client.lpop(queue_key)
+            if raw is None:
+                drop_if_empty(client, user_id)
+                continue
+            item = json.loads(raw)
+            try:
+                encode_media.apply_async(
+                    args=item["args"],
+                    kwargs=item["kwargs"],
+                    priority=item["priority"],
+                    countdown=item.get("countdown"),
+                    # the queue wait of the encode starts in its virtual queue
+                    headers={PUBLISHED_HEADER: item["queued"]},
+                )
+            except Exception as e:
+                client.lpush(queue_key, raw)
+                logger.warning(f"Could not release encode: {e}")
+                break
+            encoding_id = item["args"][2]
+            pipe = client.pipeline(transaction=False)
+            pipe.zadd(USERS_KEY, {user_id: user_pass + 1 / item["weight"]}, xx=True)
+            pipe.set(PASS_KEY, user_pass)
+            pipe.zadd(RELEASED_KEY, {f"{user_id}:{encoding_id}": time.time()})
+            pipe.execute()
+            released += 1
+    finally:
+        cache.delete(LOCK_KEY)
+    return released
+
+
+def get_queue_stats() -> Dict[str, Any]:
+    """
+    Queued and released encodes per uploader, with their weight, their
+    share of the turns among uploaders with queued encodes, and the wait
+    of their oldest queued encode in seconds.
+    """
+    from users.models import User
+
+    client = get_fair_share_redis()
+    ret = {
+        "enabled": client is not None,
+        "slots": settings.FAIR_SHARE_SLOTS,
+        "released": 0,
+        "queued": 0,
+        "users": [],
+    }
+    if client is None:
+        return ret
+
+    now = time.time()
+    stats = {}
+    for user_id, user_pass in client.zrange(USERS_KEY, 0, -1, withscores=True):
+        user_id = int(user_id)
+        queue_key = QUEUE_KEY_TEMPLATE.format(user_id=user_id)
+        first = client.lindex(queue_key, 0)
+        stats[user_id] = {
+            "queued": client.llen(queue_key),
+            "released": 0,
+            "pass": round(user_pass, 3),
+            "weight": json.loads(first)["weight"] if first else 1.0,
+            "oldest_wait": round(now - json.loads(first)["queued"], 1) if first else None,
+        }
+    released = get_released(client)
+    for member in released:
+        user_id = int(member.split(":")[0])
+        stats.setdefault(
+            user_id,
+            {"queued": 0, "released": 0, "pass": None, "weight": None, "oldest_wait": None},
+        )
+        stats[user_id]["released"] += 1
+
+    users = User.objects.in_bulk(list(stats))
+    total_weight = sum(s["weight"] for s in stats.values() if s["queued"])
+    for user_id, user_stats in stats.items():
+        user = users.get(user_id)
+        if user_stats["weight"] is None:
+            user_stats["weight"] = get_weight(user) if user else 1.0
+        user_stats["share"] = (
+            round(user_stats["weight"] / total_weight, 3) if user_stats["queued"] else 0
+        )
+        user_stats["username"] = user.username if user else None
+        user_stats["user_id"] = user_id
+    ret["users"] = sorted(
+        stats.values(), key=lambda s: (-s["share"], -s["released"], s["user_id"])
+    )
+    ret["released"] = len(released)
+    ret["queued"] = sum(s["queued"] for s in stats.values())
+    return ret
+
+
+def get_queued_encodings(released: bool = True) -> Set[int]:
+    """
+    Ids of the encodings with an encode queued here, and with released
+    the ones released and not finished. No worker knows of queued encodes
+    yet, they are not lost, and they wait for their turn.
+    """
+    client = get_fair_share_redis()
+    if client is None:
+        return set()
+    encoding_ids = set()
+    try:
+        for user_id in client.zrange(USERS_KEY, 0, -1):
+            user_id = user_id.decode() if isinstance(user_id, bytes) else user_id
+            for raw in client.lrange(QUEUE_KEY_TEMPLATE.format(user_id=user_id), 0, -1):
+                encoding_ids.add(int(json.loads(raw)["args"][2]))
+        for member in client.zrange(RELEASED_KEY, 0, -1) if released else []:
+            member = member.decode() if isinstance(member, bytes) else member
+            encoding_ids.add(int(member.split(":")[1]))
+    except Exception as e:
+        logger.warning(f"Could not read the queued encodes: {e}")
+    return encoding_ids
+
+
+def release_encodes() -> None:
+    # dispatch_encodes releases them later, if this fails
+    try:
+        dispatch()
+    except Exception as e:
+        logger.warning(f"Could not release encodes: {e}")
+
+
+@task_postrun.connect
+def dispatch_after_encode(sender=None, **kwargs):
+    # a finished encode frees a slot
+    if sender is not None and sender.name == "encode_media":
+        release_encodes()
@@ -12,6 +12,9 @@ from fractions import Fraction
 
 import filetype
 from django.conf import settings
+from django.core.files import File
+
+from . import processes
 
 CHARS = "abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789"
 
@@ -37,6 +40,10 @@ X26x_PRESET_BIG_HEIGHT = "faster"
 # VP9_SPEED = 1  # between 0 and 4, lower is slower
 VP9_SPEED = 2
 
+# fragmented MP4, with the moov atom ahead of the fragments, written in a
+# single pass: no faststart rewrite to move the moov atom to the front
+FRAGMENTED_MP4_FLAGS = "+frag_keyframe+empty_moov+default_base_moof"
+
 
 VIDEO_CRFS = {
     "h264_baseline": 23,
@@ -210,19 +217,23 @@ def mask_ip(ip_address):
     return hashlib.md5(ip_address.encode("utf-8")).hexdigest()
 
 
-def run_command(cmd, cwd=None):
+def run_command(cmd, cwd=None, encoding_id=None):
     """
     Run a command directly
+
+    ffmpeg, whisper.cpp and mp4hls, and commands of an encoding, are tracked
+    in the process registry
     """
     if isinstance(cmd, str):
         cmd = cmd.split()
     ret = {}
-    if cwd:
-        process = subprocess.Popen(
-            cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, cwd=cwd
-        )
-    else:
-        process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    process = processes.popen(
+        cmd,
+        encoding_id=encoding_id,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        cwd=cwd or None,
+    )
     stdout, stderr = process.communicate()
     # TODO: catch unicodedecodeerrors here...
     if process.returncode == 0:
@@ -684,12 +695,57 @@ def get_base_ffmpeg_command(
         cmd.extend(["-an", "-f", "null", "/dev/null"])
     elif pass_number == 2:
         if output_file.endswith("mp4") and chunk:
-            cmd.extend(["-movflags", "+faststart"])
+            cmd.extend(["-movflags", get_mp4_movflags()])
         cmd.extend([output_file])
 
     return cmd
 
 
+def get_mp4_movflags():
+    """movflags of chunks and of the renditions concatenated from them"""
+    if settings.FRAGMENTED_MP4_CHUNKS:
+        return FRAGMENTED_MP4_FLAGS
+    return "+faststart"
+
+
+def get_concat_ffmpeg_command(seg_file, output_file):
+    """Concatenate the encoded chunks listed in seg_file, without re-encoding
+
+    Arguments:
+        seg_file {str} -- concat demuxer list of the chunk files
+        output_file {str} -- output file name
+    """
+
+    cmd = [
+        settings.FFMPEG_COMMAND,
+        "-y",
+        "-f",
+        "concat",
+        "-safe",
+        "0",
+        "-i",
+        seg_file,
+        "-c",
+        "copy",
+        "-pix_fmt",
+        "yuv420p",
+    ]
+    if output_file.endswith("mp4"):
+        cmd.extend(["-movflags", get_mp4_movflags()])
+    cmd.extend([output_file])
+    return cmd
+
+
+class MovableFile(File):
+    """
+    A File that storage moves into place instead of copying, like uploads
+    saved to a temporary file. For outputs written to TEMP_DIRECTORY.
+    """
+
+    def temporary_file_path(self):
+        return self.name
+
+
 def produce_ffmpeg_commands(
     media_file, media_info, resolution, codec, output_filename, pass_file, chunk=False
 ):
@@ -0,0 +1,93 @@
+"""
+Django Management Command: backfill_action_rollups
+
+Popularity and creator statistics read the daily rollups of user actions
+(MediaActionDaily). Task rollup_media_actions keeps them up to date, but
+only rolls up the days since its last run. This command rolls up older
+days from the raw MediaAction rows, one day per query.
+
+Run it before enabling WATCH_ACTIONS_RETENTION_DAYS or
+WATCH_HISTORY_RETENTION_DAYS: days past retention can't be rolled up
+anymore and are skipped.
+
+Usage Examples:
+    # Roll up every day since the first action, until yesterday
+    python manage.py backfill_action_rollups
+
+    # Roll up a range of days
+    python manage.py backfill_action_rollups --since 2025-01-01 --until 2025-06-30
+
+    # Only days that have no rollup yet
+    python manage.py backfill_action_rollups --missing
+"""
+
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Min
+from django.utils import timezone
+
+from actions.models import MediaAction, MediaActionDaily
+from files.action_rollups import rollup_day
+
+
+class Command(BaseCommand):
+    help = 'Roll up the daily action counts of past days'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--since',
+            type=date.fromisoformat,
+            help='First day to roll up, YYYY-MM-DD (default: day of the first action)',
+        )
+        parser.add_argument(
+            '--until',
+            type=date.fromisoformat,
+            help='Last day to roll up, YYYY-MM-DD (default: yesterday)',
+        )
+        parser.add_argument(
+            '--missing',
+            action='store_true',
+            help='Skip days that already have rollups',
+        )
+
+    def handle(self, *args, **options):
+        since = options['since']
+        if since is None:
+            first = MediaAction.objects.aggregate(first=Min('action_date'))['first']
+            if first is None:
+                self.stdout.write('No actions to roll up')
+                return
+            since = timezone.localtime(first).date()
+        until = options['until'] or timezone.localdate() - timedelta(days=1)
+        if until >= timezone.localdate():
+            raise CommandError('Only complete days can be rolled up, until must be before today')
+
+        done = set()
+        if options['missing']:
+            done = set(
+                MediaActionDaily.objects.filter(day__gte=since, day__lte=until)
+                .values_list('day', flat=True)
+                .distinct()
+            )
+
+        rolled = skipped = rows = 0
+        day = since
+        while day <= until:
+            if day not in done:
+                written = rollup_day(day)
+                if written < 0:
+                    skipped += 1
+                else:
+                    rolled += 1
+                    rows += written
+                if (rolled + skipped) % 30 == 0:
+                    self.stdout.write(f'{day}: {rolled} days rolled up')
+            day += timedelta(days=1)
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Rolled up {rolled} days into {rows} rows '
+                f'({skipped} skipped, past retention)'
+            )
+        )
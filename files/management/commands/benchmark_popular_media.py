@@ -0,0 +1,177 @@
+"""
+Django Management Command: benchmark_popular_media
+
+Measures how the run time of the popular media calculation
+(get_list_of_popular_media) scales with the size of the catalog and of the
+MediaAction table. For every combination of sizes it fills the database
+with synthetic media and actions, times the previous per-media counting and
+the current grouped aggregates, and prints run time and query count.
+
+All data is created inside a transaction that is rolled back, so nothing
+is left behind, but the command is write heavy: run it against a
+development copy of the database, not production.
+
+Usage Examples:
+    # Default grid
+    python manage.py benchmark_popular_media
+
+    # Custom grid
+    python manage.py benchmark_popular_media --media 1000 10000 --actions 100000 1000000
+"""
+
+import random
+import time
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from actions.models import MediaAction
+from files.helpers import produce_friendly_token
+from files.models import Media
+from files.methods import count_top_media
+
+
+class Rollback(Exception):
+    pass
+
+
+def legacy_popular_media(period_x, period_y):
+    """The previous calculation: two counts per listable media"""
+    valid_media_x = {}
+    valid_media_y = {}
+    media_x = Media.objects.filter(
+        state="public", is_reviewed=True, encoding_status="success"
+    ).values("friendly_token")
+    for media in media_x:
+        ft = media["friendly_token"]
+        num = MediaAction.objects.filter(
+            action_date__gte=period_x, action="watch", media__friendly_token=ft
+        ).count()
+        if num:
+            valid_media_x[ft] = num
+        num = MediaAction.objects.filter(
+            action_date__gte=period_y, action="like", media__friendly_token=ft
+        ).count()
+        if num:
+            valid_media_y[ft] = num
+    x = sorted(valid_media_x.items(), key=lambda kv: kv[1], reverse=True)[:25]
+    y = sorted(valid_media_y.items(), key=lambda kv: kv[1], reverse=True)[:25]
+    return {a[0] for a in x} | {a[0] for a in y}
+
+
+def aggregate_popular_media(period_x, period_y):
+    return set(count_top_media("watch", period_x, 25)) | set(
+        count_top_media("like", period_y, 25)
+    )
+
+
+class Command(BaseCommand):
+    help = 'Benchmark the popular media calculation against catalog and action table size'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--media',
+            type=int,
+            nargs='+',
+            default=[100, 1000, 5000],
+            help='Catalog sizes to benchmark (default: 100 1000 5000)',
+        )
+        parser.add_argument(
+            '--actions',
+            type=int,
+            nargs='+',
+            default=[10000, 100000],
+            help='MediaAction table sizes to benchmark (default: 10000 100000)',
+        )
+        parser.add_argument(
+            '--skip-legacy',
+            action='store_true',
+            help='Only time the grouped aggregates, the legacy loop is slow on large grids',
+        )
+
+    def handle(self, *args, **options):
+        self.stdout.write(
+            f"{'media':>8} {'actions':>10} {'legacy s':>10} {'queries':>8} "
+            f"{'aggregate s':>12} {'queries':>8}"
+        )
+        for media_count in options['media']:
+            for action_count in options['actions']:
+                try:
+                    with transaction.atomic():
+                        self.benchmark(media_count, action_count, options['skip_legacy'])
+                        raise Rollback
+                except Rollback:
+                    pass
+
+    def benchmark(self, media_count, action_count, skip_legacy):
+        self.populate(media_count, action_count)
+        now = timezone.now()
+        period_x = now - timedelta(days=7)
+        period_y = now - timedelta(days=30 * 6)
+
+        legacy = ('-', '-')
+        if not skip_legacy:
+            seconds, queries = self.measure(legacy_popular_media, period_x, period_y)
+            legacy = (f'{seconds:.3f}', queries)
+        seconds, queries = self.measure(aggregate_popular_media, period_x, period_y)
+
+        self.stdout.write(
+            f'{media_count:>8} {action_count:>10} {legacy[0]:>10} {legacy[1]:>8} '
+            f'{seconds:>12.3f} {queries:>8}'
+        )
+
+    def measure(self, function, *args):
+        with CaptureQueriesContext(connection) as context:
+            start = time.perf_counter()
+            function(*args)
+            seconds = time.perf_counter() - start
+        return seconds, len(context.captured_queries)
+
+    def populate(self, media_count, action_count):
+        user = get_user_model().objects.create(
+            username=f'benchmark-{produce_friendly_token()}', email='benchmark@example.com'
+        )
+        # bulk_create skips Media.save, so no encoding is triggered
+        media = Media.objects.bulk_create(
+            [
+                Media(
+                    title=f'benchmark {i}',
+                    user=user,
+                    friendly_token=produce_friendly_token(),
+                    state='public',
+                    is_reviewed=True,
+                    encoding_status='success',
+                )
+                for i in range(media_count)
+            ],
+            batch_size=1000,
+        )
+        now = timezone.now()
+        # actions spread over a year, skewed towards a few popular media
+        weights = [1 / (rank + 1) for rank in range(media_count)]
+        actions = []
+        for item in random.choices(media, weights, k=action_count):
+            actions.append(
+                MediaAction(
+                    user=user,
+                    media=item,
+                    action=random.choice(['watch', 'watch', 'watch', 'like']),
+                )
+            )
+            if len(actions) == 5000:
+                self.create_actions(actions, now)
+                actions = []
+        self.create_actions(actions, now)
+        with connection.cursor() as cursor:
+            cursor.execute(f'ANALYZE {MediaAction._meta.db_table}')
+
+    def create_actions(self, actions, now):
+        actions = MediaAction.objects.bulk_create(actions)
+        # action_date is auto_now_add, spread it afterwards
+        for action in actions:
+            action.action_date = now - timedelta(seconds=random.randint(0, 365 * 24 * 3600))
+        MediaAction.objects.bulk_update(actions, ['action_date'], batch_size=1000)
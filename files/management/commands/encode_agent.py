@@ -0,0 +1,59 @@
+"""
+Django Management Command: encode_agent
+
+Remote encoding worker. Leases pending encodings from a CinemataCMS server
+over its API, encodes them with the local ffmpeg and uploads the results,
+see files/encode_agent.py. The machine running it needs ffmpeg and network
+access to the server, but neither the media filesystem nor the broker.
+
+The token is the API token of an admin user, from --token or the
+ENCODE_AGENT_TOKEN environment variable.
+
+Usage Examples:
+    # Encode until stopped
+    ENCODE_AGENT_TOKEN=... python manage.py encode_agent --server https://cinemata.org
+
+    # Encode one encoding, if there is one, then exit
+    python manage.py encode_agent --server http://localhost:8000 --token ... --once
+"""
+
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from files.encode_agent import EncodeAgent
+
+
+class Command(BaseCommand):
+    help = 'Lease and encode encodings of a remote server'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--server', required=True, help='Base URL of the server')
+        parser.add_argument(
+            '--token',
+            default=os.environ.get('ENCODE_AGENT_TOKEN', ''),
+            help='API token of an admin user (default: $ENCODE_AGENT_TOKEN)',
+        )
+        parser.add_argument('--name', help='Worker name (default: hostname)')
+        parser.add_argument('--work-dir', help='Directory for sources and outputs')
+        parser.add_argument('--ffmpeg', default='ffmpeg', help='Path of ffmpeg (default: ffmpeg)')
+        parser.add_argument(
+            '--poll',
+            type=int,
+            default=30,
+            help='Seconds to wait when there is no work (default: 30)',
+        )
+        parser.add_argument('--once', action='store_true', help='Encode at most one encoding')
+
+    def handle(self, *args, **options):
+        if not options['token']:
+            raise CommandError('An API token is required, with --token or ENCODE_AGENT_TOKEN')
+        agent = EncodeAgent(
+            options['server'],
+            options['token'],
+            name=options['name'],
+            work_dir=options['work_dir'],
+            ffmpeg=options['ffmpeg'],
+        )
+        self.stdout.write(f'Encoding for {options["server"]} as {agent.name}')
+        agent.run(poll=options['poll'], once=options['once'])
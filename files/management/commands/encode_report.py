@@ -0,0 +1,97 @@
+"""
+Django Management Command: encode_report
+
+Encoding throughput over a window, from the telemetry encode_media records
+on each Encoding: wall and CPU hours, hours of output encoded, realtime
+speed, cores used, output size and bitrate, and queue wait. Groups can be
+profile, resolution, codec, worker, preset and pass_mode.
+
+The same report is served to admins by /api/v1/encode_stats.
+
+Usage Examples:
+    # Last 7 days, per profile
+    python manage.py encode_report
+
+    # Last 30 days, per worker and codec
+    python manage.py encode_report --days 30 --by worker,codec
+
+    # As JSON
+    python manage.py encode_report --json
+"""
+
+import json
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from files.encode_telemetry import GROUPS, get_throughput
+
+COLUMNS = (
+    'encodes',
+    'failed',
+    'wall_hours',
+    'cpu_hours',
+    'encoded_hours',
+    'speed',
+    'cores',
+    'output_bytes',
+    'avg_bitrate',
+    'avg_queue_wait',
+)
+
+
+class Command(BaseCommand):
+    help = 'Report encoding throughput, grouped by profile, resolution, codec or worker'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days',
+            type=int,
+            default=7,
+            help='Length of the window, in days (default: 7)',
+        )
+        parser.add_argument(
+            '--by',
+            default='profile',
+            help=f'Comma separated groups, of {", ".join(GROUPS)} (default: profile)',
+        )
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            help='Output JSON',
+        )
+
+    def handle(self, *args, **options):
+        group_by = [g for g in options['by'].split(',') if g]
+        unknown = [g for g in group_by if g not in GROUPS]
+        if not group_by or unknown:
+            raise CommandError(f'Unknown groups {", ".join(unknown)}, use {", ".join(GROUPS)}')
+        if options['days'] < 1:
+            raise CommandError('days must be at least 1')
+
+        since = timezone.now() - timedelta(days=options['days'])
+        rows = get_throughput(since, group_by=group_by)
+        if options['json']:
+            self.stdout.write(json.dumps(rows, indent=2, default=str))
+            return
+        if not rows:
+            self.stdout.write(f'No encodes since {since:%Y-%m-%d %H:%M}')
+            return
+
+        header = [*group_by, *COLUMNS]
+        table = [header] + [
+            ['-' if row[c] is None else str(row[c]) for c in header] for row in rows
+        ]
+        widths = [max(len(line[i]) for line in table) for i in range(len(header))]
+        for line in table:
+            self.stdout.write('  '.join(cell.ljust(width) for cell, width in zip(line, widths)))
+
+        wall = sum(row['wall_hours'] for row in rows)
+        cpu = sum(row['cpu_hours'] for row in rows)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'{sum(row["encodes"] for row in rows)} encodes since '
+                f'{since:%Y-%m-%d %H:%M}: {wall:.1f} wall hours, {cpu:.1f} CPU hours'
+            )
+        )
@@ -0,0 +1,184 @@
+"""
+Django Management Command: reencode_campaign
+
+Re-encode the catalog, or part of it, after a change to profiles, bitrates
+or presets, without starving new uploads. A campaign sends its media to
+encode a few at a time, `--concurrency` of them, and waits while more than
+REENCODE_CAMPAIGN_MAX_BACKLOG other encodings are pending. Task
+advance_reencode_campaigns advances running campaigns every minute; they
+can be paused and resumed here or in the admin.
+
+Actions:
+    start NAME      Create a campaign, or estimate its cost with --dry-run
+    pause NAME      Stop sending media to encode
+    resume NAME     Continue from the last media sent to encode
+    status [NAME]   Progress of a campaign, or of all of them
+    advance         Advance running campaigns now
+
+Usage Examples:
+    # Cost of re-encoding videos of 2023 in h264-1080, from the telemetry
+    python manage.py reencode_campaign start x264-preset-2024 \\
+        --profile h264-1080 --since 2023-01-01 --until 2024-01-01 --dry-run
+
+    # Start it, four media at a time
+    python manage.py reencode_campaign start x264-preset-2024 \\
+        --profile h264-1080 --since 2023-01-01 --until 2024-01-01 --concurrency 4
+
+    # Progress
+    python manage.py reencode_campaign status x264-preset-2024
+"""
+
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Max
+
+from files.models import Media, ReencodeCampaign
+from files.reencode_campaigns import (
+    advance_campaigns,
+    estimate,
+    get_campaign_media,
+    get_filters,
+    get_progress,
+    list_profiles,
+)
+
+ACTIONS = ('start', 'pause', 'resume', 'status', 'advance')
+
+
+class Command(BaseCommand):
+    help = 'Start, pause, resume and follow throttled re-encode campaigns'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=ACTIONS)
+        parser.add_argument('name', nargs='?', help='Name of the campaign')
+        parser.add_argument(
+            '--profile',
+            action='append',
+            default=[],
+            help='Encode profile to re-encode in, repeatable (default: all active ones)',
+        )
+        parser.add_argument('--since', help='Media added from this date')
+        parser.add_argument('--until', help='Media added before this date')
+        parser.add_argument('--min-height', type=int, help='Minimum video height')
+        parser.add_argument('--max-height', type=int, help='Maximum video height')
+        parser.add_argument('--state', help='Media state, public, private or unlisted')
+        parser.add_argument('--user', help='Username of the uploader')
+        parser.add_argument(
+            '--with-profile',
+            help='Only media with a successful encoding in this profile',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=2,
+            help='Media with encodes in flight at a time (default: 2)',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Print the estimated cost of the campaign, without starting it',
+        )
+        parser.add_argument(
+            '--json',
+            action='store_true',
+            help='Output JSON',
+        )
+
+    def handle(self, *args, **options):
+        action = options['action']
+        if action == 'advance':
+            sent = advance_campaigns()
+            self.stdout.write(self.style.SUCCESS(f'Sent {sent} media to encode'))
+            return
+        if action == 'status':
+            self.status(options)
+            return
+        if not options['name']:
+            raise CommandError(f'{action} needs the name of a campaign')
+        if action == 'start':
+            self.start(options)
+            return
+
+        campaign = self.get_campaign(options['name'])
+        if campaign.status == 'done':
+            raise CommandError(f'Campaign {campaign.name} is done')
+        campaign.status = 'paused' if action == 'pause' else 'running'
+        campaign.save(update_fields=['status', 'update_date'])
+        self.stdout.write(self.style.SUCCESS(f'Campaign {campaign.name} is {campaign.status}'))
+
+    def get_campaign(self, name):
+        try:
+            return ReencodeCampaign.objects.get(name=name)
+        except ReencodeCampaign.DoesNotExist:
+            raise CommandError(f'No campaign named {name}')
+
+    def start(self, options):
+        name = options['name']
+        if options['concurrency'] < 1:
+            raise CommandError('concurrency must be at least 1')
+        if ReencodeCampaign.objects.filter(name=name).exists():
+            raise CommandError(f'Campaign {name} exists already')
+        try:
+            profiles = list_profiles(options['profile'])
+            filters = get_filters(options)
+        except ValueError as e:
+            raise CommandError(str(e))
+        if not profiles:
+            raise CommandError('No profiles to re-encode in')
+        # later uploads are encoded with the new settings already
+        filters['max_id'] = Media.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+
+        cost = estimate(filters, profiles)
+        if options['json']:
+            self.stdout.write(json.dumps(cost, indent=2))
+        else:
+            self.write_estimate(cost)
+        if options['dry_run']:
+            return
+
+        campaign = ReencodeCampaign.objects.create(
+            name=name, filters=filters, concurrency=options['concurrency']
+        )
+        campaign.profiles.set(profiles)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Started campaign {name} of {get_campaign_media(filters).count()} media'
+            )
+        )
+
+    def write_estimate(self, cost):
+        self.stdout.write(f'{cost["media"]} media')
+        for row in cost['profiles']:
+            hours = (
+                f'{row["encode_hours"]} encode hours, {row["cpu_hours"]} CPU hours'
+                if row['encode_hours'] is not None
+                else 'no telemetry'
+            )
+            self.stdout.write(
+                f'  {row["profile"]}: {row["renditions"]} renditions, '
+                f'{row["video_hours"]} hours of video, {hours}'
+            )
+        self.stdout.write(
+            f'Total: {int(cost.get("renditions", 0))} renditions, '
+            f'{cost.get("encode_hours", 0)} encode hours, {cost.get("cpu_hours", 0)} CPU hours'
+        )
+
+    def status(self, options):
+        if options['name']:
+            campaigns = [self.get_campaign(options['name'])]
+        else:
+            campaigns = ReencodeCampaign.objects.order_by('-add_date')
+        rows = [get_progress(campaign) for campaign in campaigns]
+        if options['json']:
+            self.stdout.write(json.dumps(rows, indent=2))
+            return
+        if not rows:
+            self.stdout.write('No campaigns')
+            return
+        for row in rows:
+            self.stdout.write(
+                f'{row["name"]} ({row["status"]}, {", ".join(row["profiles"])}): '
+                f'{row["queued"]}/{row["total"]} media sent to encode ({row["percent"]}%), '
+                f'{row["in_flight"]} in flight, {row["failed"]} failed'
+            )
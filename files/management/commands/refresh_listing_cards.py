@@ -0,0 +1,66 @@
+"""
+Django Management Command: refresh_listing_cards
+
+Listing endpoints serve media items from the denormalised Media.listing_card
+(urls, thumbnails and author info). Cards are refreshed automatically when a
+media, its preview encoding or its author change, and missing cards are built
+lazily on first listing. This command (re)builds them in bulk.
+
+Usage Examples:
+    # Build cards for media that don't have one yet
+    python manage.py refresh_listing_cards
+
+    # Rebuild all cards, eg after changing MEDIA_URL
+    python manage.py refresh_listing_cards --all
+
+    # Rebuild cards of a single user's media
+    python manage.py refresh_listing_cards --all --user username
+"""
+
+from django.core.management.base import BaseCommand
+
+from files.models import Media
+
+
+class Command(BaseCommand):
+    help = 'Build or rebuild the listing cards of media'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Rebuild all cards, not only missing ones',
+        )
+        parser.add_argument(
+            '--user',
+            type=str,
+            help='Only media of this username',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of media loaded per query (default: 500)',
+        )
+
+    def handle(self, *args, **options):
+        qs = Media.objects.all()
+        if not options['all']:
+            qs = qs.filter(listing_card={})
+        if options['user']:
+            qs = qs.filter(user__username=options['user'])
+
+        ids = list(qs.order_by('id').values_list('id', flat=True))
+        batch_size = options['batch_size']
+        refreshed = failed = 0
+        for start in range(0, len(ids), batch_size):
+            batch = Media.objects.filter(id__in=ids[start:start + batch_size]).select_related('user')
+            for media in batch:
+                if media.update_listing_card():
+                    refreshed += 1
+                else:
+                    failed += 1
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Refreshed {refreshed} listing cards ({failed} failed)')
+        )
@@ -1,23 +1,79 @@
+import heapq
 import itertools
 import logging
+import math
 import random
+import uuid
+from collections import Counter, defaultdict
 from datetime import datetime, timedelta
 
 from django.conf import settings
 from django.core.cache import cache
 from django.core.mail import EmailMessage, send_mail
-from django.db.models import Q
+from django.db.models import Count, Q
 from django.utils import timezone
 
 from cms import celery_app
 
-from . import models
+from . import action_rollups, counters, models, rate_limits, task_registry
 from .helpers import mask_ip
 
 logger = logging.getLogger(__name__)
 
 
 def list_tasks():
+    """
+    Active, reserved and scheduled tasks, with the media, profile and
+    progress of encodes, from the task registry when there is one.
+    """
+    registered = task_registry.get_registered_tasks()
+    if registered is None:
+        return inspect_tasks()
+
+    ret = {}
+    task_ids = []
+    media_profile_pairs = []
+    encoding_ids = {
+        task["encoding_id"]
+        for tasks in registered.values()
+        for task in tasks
+        if task.get("encoding_id")
+    }
+    encodings = {
+        encoding_id: (progress, title, profile_name)
+        for encoding_id, progress, title, profile_name in models.Encoding.objects.filter(
+            id__in=encoding_ids
+        ).values_list("id", "progress", "media__title", "profile__name")
+    }
+    for state, tasks in registered.items():
+        ret[state] = {"tasks": []}
+        for task in tasks:
+            task_dict = {
+                "worker": task.get("worker"),
+                "task_id": task["task_id"],
+                "args": task.get("args"),
+                "name": task.get("name"),
+                "time_start": task.get("time_start"),
+            }
+            task_ids.append(task["task_id"])
+            if task.get("friendly_token"):
+                media_profile_pairs.append((task["friendly_token"], task["profile_id"]))
+            encoding = encodings.get(task.get("encoding_id"))
+            if encoding:
+                progress, title, profile_name = encoding
+                task_dict["info"] = {
+                    "profile name": profile_name,
+                    "media title": title,
+                    "encoding progress": progress,
+                }
+            ret[state]["tasks"].append(task_dict)
+    ret["task_ids"] = task_ids
+    ret["media_profile_pairs"] = media_profile_pairs
+    return ret
+
+
+def inspect_tasks():
+    # asks the workers, without a task registry
     i = celery_app.control.inspect([])
     ret = {}
     temp = {}
@@ -75,14 +131,53 @@ def list_tasks():
     return ret
 
 
+def get_anonymous_viewer_id(request, create=True):
+    """
+    Identifier of an anonymous viewer, from the signed viewer id cookie.
+
+    New viewers get a random id, set as a cookie by
+    cms.middleware.ViewerIdMiddleware, instead of a session that would be
+    written to the cache on their first visit. The session key is never
+    used as the id, it would outlive the session in the cookie. Viewers
+    with a session have their history moved to their new id instead.
+    """
+    # attributes go on the HttpRequest, under a REST framework Request
+    request = getattr(request, "_request", request)
+    viewer_id = getattr(request, "viewer_id", None)
+    if viewer_id:
+        return viewer_id
+    viewer_id = request.get_signed_cookie(
+        settings.VIEWER_ID_COOKIE_NAME, default=None, salt=settings.VIEWER_ID_COOKIE_NAME
+    )
+    if not viewer_id:
+        session_key = request.session.session_key
+        if not create:
+            # the history of the session, until the viewer gets an id
+            return session_key
+        viewer_id = uuid.uuid4().hex
+        if session_key:
+            carry_over_session_history(session_key, viewer_id)
+        request.new_viewer_id = viewer_id
+    request.viewer_id = viewer_id
+    return viewer_id
+
+
+def carry_over_session_history(session_key, viewer_id):
+    """Move the anonymous actions of a session to a new viewer id"""
+    from actions.models import MediaAction
+
+    MediaAction.objects.filter(user=None, session_key=session_key).update(
+        session_key=viewer_id
+    )
+
+
 def get_user_or_session(request):
     ret = {}
     if request.user.is_authenticated:
         ret["user_id"] = request.user.id
     else:
-        if not request.session.session_key:
-            request.session.save()
-        ret["user_session"] = request.session.session_key
+        # the anonymous viewer id, kept under the key of session keys
+        ret["user_session"] = get_anonymous_viewer_id(request)
     if settings.MASK_IPS_FOR_ACTIONS:
         ret["remote_ip_addr"] = mask_ip(request.META.get("REMOTE_ADDR"))
     else:
@@ -94,6 +189,14 @@ def pre_save_action(media, user, session_key, action, remote_ip):
     # PERFORM THRESHOLD CHECKS
     from actions.models import MediaAction
 
+    if action == "watch":
+        # answered by Redis cooldowns and rate limits, when available
+        allowed = rate_limits.check_watch(
+            media, user.id if user else None, session_key, remote_ip
+        )
+        if allowed is not None:
+            return allowed
+
     if user:
         query = MediaAction.objects.filter(media=media, action=action, user=user)
     else:
@@ -253,26 +356,133 @@ The Cinemata Curatorial Team
         return True
 
 
-def show_recommended_media(request, limit=100):
+def set_thumbnail_media(objects):
+    """
+    Load, in a single query, the media whose thumbnail listed objects (eg
+    categories, playlists) show. Objects need a thumbnail_media_id annotation
+    """
+    objects = list(objects)
+    media = models.Media.objects.in_bulk(
+        [obj.thumbnail_media_id for obj in objects if obj.thumbnail_media_id]
+    )
+    for obj in objects:
+        obj.thumbnail_media = media.get(obj.thumbnail_media_id)
+    return objects
+
+
+def show_recommended_media(request, limit=100, values=None):
+    # values: return .values() rows with these fields instead of models
     basic_query = Q(state="public", is_reviewed=True, encoding_status="success")
     pmi = cache.get("popular_media_ids")
     # produced by task get_list_of_popular_media
     if pmi:
-        media = list(
-            models.Media.objects.filter(friendly_token__in=pmi)
-            .filter(basic_query)
-            .prefetch_related("user")[:limit]
+        media = models.Media.objects.filter(friendly_token__in=pmi).filter(
+            basic_query
         )
     else:
-        media = list(
-            models.Media.objects.filter(basic_query)
-            .order_by("-views", "-likes")
-            .prefetch_related("user")[:limit]
+        # most watched of the last week, if the action counters know them
+        top = get_listable_top_media(
+            "watch", timezone.now() - timedelta(days=7), limit
         )
+        if top:
+            media = models.Media.objects.filter(id__in=top).filter(basic_query)
+        else:
+            media = models.Media.objects.filter(basic_query).order_by(
+                "-views", "-likes"
+            )
+    if values:
+        media = media.values(*values)
+    else:
+        media = media.prefetch_related("user")
+    media = list(media[:limit])
     random.shuffle(media)
     return media
 
 
+def show_trending_media(request, limit=100, values=None):
+    # most watched media of the last TRENDING_MEDIA_HOURS, most first
+    # values: return .values() rows with these fields instead of models
+    since = timezone.now() - timedelta(hours=settings.TRENDING_MEDIA_HOURS)
+    top = get_top_media("watch", since, limit)
+    media = models.Media.objects.filter(
+        id__in=top, state="public", is_reviewed=True, encoding_status="success"
+    )
+    if values:
+        media = media.values(*values)
+    else:
+        media = media.prefetch_related("user")
+    positions = {media_id: position for position, media_id in enumerate(top)}
+    return sorted(media, key=lambda m: positions[m["id"] if values else m.id])[:limit]
+
+
+def count_top_media(action, since, limit):
+    """
+    Ids of the listable media with the most actions of a type since a
+    date, most first, as a single grouped count over MediaAction
+    """
+    from actions.models import MediaAction
+
+    top = (
+        MediaAction.objects.filter(
+            action=action,
+            action_date__gte=since,
+            media__state="public",
+            media__is_reviewed=True,
+            media__encoding_status="success",
+        )
+        .values_list("media_id")
+        .annotate(num=Count("id"))
+        .order_by("-num", "media_id")[:limit]
+    )
+    return [media_id for media_id, num in top]
+
+
+# media ids read from the action counters per listable one wanted
+TOP_MEDIA_OVERFETCH = 4
+
+
+def get_listable_top_media(action, since, limit):
+    """
+    Ids of the listable media with the most actions of a type since a
+    date, most first, from the action counters. The counters know nothing
+    of listability, so they are read in pages of TOP_MEDIA_OVERFETCH times
+    limit until limit listable media are found or they run out. None if
+    the counters can't tell
+    """
+    page = limit * TOP_MEDIA_OVERFETCH
+    top = []
+    offset = 0
+    while len(top) < limit:
+        ids = counters.get_top_media(action, since, page, offset=offset)
+        if ids is None:
+            return top if offset else None
+        listable = set(
+            models.Media.objects.filter(
+                id__in=ids, state="public", is_reviewed=True, encoding_status="success"
+            ).values_list("id", flat=True)
+        )
+        top.extend(media_id for media_id in ids if media_id in listable)
+        if len(ids) < page:
+            break
+        offset += page
+    return top[:limit]
+
+
+def get_top_media(action, since, limit):
+    """
+    Ids of the listable media with the most actions of a type since a
+    date, most first. Read from the action counters when they cover the
+    period, from the daily rollups for periods of a day or more, counted in
+    MediaAction otherwise
+    """
+    top = get_listable_top_media(action, since, limit)
+    if top is None and timezone.now() - since >= timedelta(days=1):
+        top = action_rollups.get_top_media(action, since, limit)
+    if top is None:
+        top = count_top_media(action, since, limit)
+    return top
+
+
 def show_related_media(media, request=None, limit=100):
     # TODO: this will be a setting that can also be tuned by the user
     # by default show videos of same author.
@@ -316,7 +526,8 @@ def show_related_media_content(media, request, limit):
     # TODO: Make this mess more readable, and add TAGS support - aka related tags rather than random media
     extra_limit = max(limit - media.user.media_count, 10)
     if len(m) < limit:
-        category = media.category.first()
+        # category may be prefetched, eg on media detail
+        category = next(iter(media.category.all()), None)
         if category:
             q_category = Q(
                 state="public",
@@ -387,7 +598,182 @@ def show_related_media_author(media, request, limit):
 
 
 def show_related_media_calculated(media, request, limit):
-    return []
+    # related media ids are precomputed by task update_related_media
+    ids = media.related_media_ids[:limit]
+    if not ids:
+        # not calculated yet, eg new media
+        return show_related_media_content(media, request, limit)
+    related = models.Media.objects.filter(
+        id__in=ids, state="public", is_reviewed=True, encoding_status="success"
+    ).select_related("user")
+    positions = {media_id: position for position, media_id in enumerate(ids)}
+    return sorted(related, key=lambda m: positions[m.id])
+
+
+# weights of the signals shared by two media, for calculate_related_media
+RELATED_MEDIA_WEIGHTS = {
+    "tags": 3,
+    "topics": 2,
+    "category": 2,
+    "language": 0.5,
+    "country": 0.5,
+    "watch": 4,
+}
+# signals that only add to the score of candidates, they are shared by too
+# many media to find candidates with
+RELATED_MEDIA_SCORE_ONLY = {"language", "country"}
+# same for categories, topics and tags used by more media than this
+RELATED_MEDIA_MAX_GROUP = 2000
+# most recent media per viewer considered for co-watches
+RELATED_MEDIA_WATCHES_PER_VIEWER = 20
+# candidates scored per media at most, taken from the rarest shared groups
+RELATED_MEDIA_MAX_CANDIDATES = 300
+# media whose related media are calculated and stored at a time
+RELATED_MEDIA_BATCH_SIZE = 500
+
+
+def calculate_related_media(media_ids=None):
+    """
+    Calculate the related media of listable media, for the "calculated"
+    RELATED_MEDIA_STRATEGY, and store them as id arrays on
+    Media.related_media_ids.
+
+    Media are scored on the categories, topics, tags, language and country
+    they share, each weighted by how rare the shared value is, and on how
+    often they were watched by the same viewer. The best
+    RELATED_MEDIA_CALCULATED_COUNT are kept, and popular media of the same
+    author fill the rest. Only RELATED_MEDIA_MAX_CANDIDATES candidates are
+    scored per media, and the results are stored in batches.
+
+    media_ids: only calculate the related media of these media
+    Returns the number of media updated
+    """
+    from actions.models import MediaAction
+
+    count = settings.RELATED_MEDIA_CALCULATED_COUNT
+    listable = models.Media.objects.filter(
+        state="public", is_reviewed=True, encoding_status="success"
+    )
+
+    features = defaultdict(set)  # media id -> {(signal, value)}
+    group_sizes = Counter()  # (signal, value) -> number of media
+    # (signal, value) -> [media id], for the groups candidates are found in:
+    # categories, topics and tags of up to RELATED_MEDIA_MAX_GROUP media
+    members = defaultdict(list)
+    authors = {}
+    views = {}
+    for media_id, user_id, language, country, media_views in listable.values_list(
+        "id", "user_id", "media_language", "media_country", "views"
+    ):
+        authors[media_id] = user_id
+        views[media_id] = media_views
+        for signal, value in (("language", language), ("country", country)):
+            if value:
+                features[media_id].add((signal, value))
+                group_sizes[(signal, value)] += 1
+    for signal, value_field in (
+        ("category", "category_id"),
+        ("topics", "topic_id"),
+        ("tags", "tag_id"),
+    ):
+        through = getattr(models.Media, signal).through
+        for media_id, value in (
+            through.objects.filter(media__in=listable)
+            .values_list("media_id", value_field)
+            .iterator()
+        ):
+            features[media_id].add((signal, value))
+            group_sizes[(signal, value)] += 1
+            members[(signal, value)].append(media_id)
+    for feature in [f for f, size in group_sizes.items() if size > RELATED_MEDIA_MAX_GROUP]:
+        members.pop(feature, None)
+
+    total = max(len(authors), 1)
+    feature_weights = {
+        feature: RELATED_MEDIA_WEIGHTS[feature[0]] * math.log(1 + total / size)
+        for feature, size in group_sizes.items()
+    }
+
+    # media watched by the same user or session, recent history only
+    since = timezone.now() - timedelta(days=settings.RELATED_MEDIA_WATCH_DAYS)
+    watched = defaultdict(list)
+    for user_id, session_key, media_id in (
+        MediaAction.objects.filter(
+            action="watch", action_date__gte=since, media__in=listable
+        )
+        .order_by("-action_date")
+        .values_list("user_id", "session_key", "media_id")
+        .iterator()
+    ):
+        viewer = user_id or session_key
+        if (
+            viewer
+            and media_id not in watched[viewer]
+            and len(watched[viewer]) < RELATED_MEDIA_WATCHES_PER_VIEWER
+        ):
+            watched[viewer].append(media_id)
+    cowatches = defaultdict(Counter)
+    for media in watched.values():
+        for a, b in itertools.permutations(media, 2):
+            cowatches[a][b] += 1
+    del watched
+
+    author_media = defaultdict(list)
+    for media_id in sorted(authors, key=lambda m: -views[m]):
+        author_media[authors[media_id]].append(media_id)
+
+    if media_ids is None:
+        targets = list(authors)
+    else:
+        targets = [media_id for media_id in media_ids if media_id in authors]
+
+    def related_of(media_id):
+        scores = Counter()
+        own = features[media_id]
+        candidates = set()
+        for other, watches in cowatches[media_id].most_common(count * 2):
+            candidates.add(other)
+            scores[other] += RELATED_MEDIA_WEIGHTS["watch"] * math.log1p(watches)
+        # the rarest groups weigh the most, their media are taken first
+        shared = (
+            other
+            for feature in sorted(
+                (f for f in own if f in members),
+                key=lambda f: group_sizes[f],
+            )
+            for other in members[feature]
+            if other != media_id
+        )
+        for other in shared:
+            if len(candidates) >= RELATED_MEDIA_MAX_CANDIDATES:
+                break
+            candidates.add(other)
+        for other in candidates:
+            for feature in own & features[other]:
+                scores[other] += feature_weights[feature]
+
+        related = heapq.nlargest(
+            count, candidates, key=lambda other: (scores[other], views[other])
+        )
+        if len(related) < count:
+            chosen = set(related)
+            chosen.add(media_id)
+            for other in author_media[authors[media_id]]:
+                if other not in chosen:
+                    related.append(other)
+                    if len(related) == count:
+                        break
+        return related
+
+    for start in range(0, len(targets), RELATED_MEDIA_BATCH_SIZE):
+        models.Media.objects.bulk_update(
+            [
+                models.Media(id=media_id, related_media_ids=related_of(media_id))
+                for media_id in targets[start : start + RELATED_MEDIA_BATCH_SIZE]
+            ],
+            ["related_media_ids"],
+        )
+    return len(targets)
 
 
 def update_user_ratings(user, media, user_ratings):
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 12:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='listing_card',
+            field=models.JSONField(blank=True, default=dict, editable=False),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 12:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0004_hls_manifest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='media',
+            name='related_media_ids',
+            field=models.JSONField(blank=True, default=list, editable=False),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.7 on 2026-10-19 12:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0005_related_media'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encoding',
+            name='cpu_time',
+            field=models.FloatField(default=0, help_text='CPU seconds of its processes'),
+        ),
+        migrations.AddField(
+            model_name='encoding',
+            name='max_rss',
+            field=models.PositiveIntegerField(default=0, help_text='peak RSS of its processes, in KB'),
+        ),
+    ]
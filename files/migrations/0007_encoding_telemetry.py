@@ -0,0 +1,53 @@
+# Generated by Django 5.2.7 on 2026-10-19 12:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0006_encoding_process_usage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encoding',
+            name='bitrate',
+            field=models.PositiveIntegerField(default=0, help_text='output bitrate, in kbit/s'),
+        ),
+        migrations.AddField(
+            model_name='encoding',
+            name='crf',
+            field=models.PositiveSmallIntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='encoding',
+            name='output_size',
+            field=models.BigIntegerField(default=0, help_text='output size, in bytes'),
+        ),
+        migrations.AddField(
+            model_name='encoding',
+            name='pass_mode',
+            field=models.CharField(blank=True, max_length=10),
+        ),
+        migrations.AddField(
+            model_name='encoding',
+            name='preset',
+            field=models.CharField(blank=True, max_length=20),
+        ),
+        migrations.AddField(
+            model_name='encoding',
+            name='queue_wait',
+            field=models.FloatField(blank=True, help_text='seconds from publishing to start', null=True),
+        ),
+        migrations.AddField(
+            model_name='encoding',
+            name='speed',
+            field=models.FloatField(default=0, help_text='seconds encoded per second of wall time'),
+        ),
+        migrations.AddField(
+            model_name='encoding',
+            name='wall_time',
+            field=models.FloatField(default=0, help_text='seconds ffmpeg ran'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.7 on 2026-10-19 12:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0007_encoding_telemetry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='encoding',
+            name='lease_expires',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='lease of a remote worker', null=True),
+        ),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.7 on 2026-10-19 12:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('files', '0008_encoding_lease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ReencodeCampaign',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100, unique=True)),
+                ('filters', models.JSONField(blank=True, default=dict, help_text='filters of the media')),
+                ('concurrency', models.PositiveSmallIntegerField(default=2, help_text='media re-encoded at the same time')),
+                ('status', models.CharField(choices=[('running', 'Running'), ('paused', 'Paused'), ('done', 'Done')], db_index=True, default='running', max_length=10)),
+                ('last_media_id', models.PositiveIntegerField(default=0, help_text='media are sent to encode in id order, up to this one')),
+                ('queued', models.PositiveIntegerField(default=0, help_text='media sent to encode')),
+                ('add_date', models.DateTimeField(auto_now_add=True)),
+                ('update_date', models.DateTimeField(auto_now=True)),
+                ('profiles', models.ManyToManyField(to='files.encodeprofile')),
+            ],
+        ),
+    ]
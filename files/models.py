@@ -40,9 +40,23 @@ from .methods import (
     is_media_allowed_type,
 )
 from .stop_words import STOP_WORDS
-from .cache_utils import clear_media_permission_cache
+from .cache_utils import bump_catalog_generation, clear_media_permission_cache
 
 logger = logging.getLogger(__name__)
+
+# Media fields that the listing card depends on. edit_date versions the urls
+LISTING_CARD_FIELDS = {
+    "user",
+    "friendly_token",
+    "edit_date",
+    "media_country",
+    "thumbnail",
+    "uploaded_thumbnail",
+    "preview_file_path",
+}
+# Media fields that decide which listings a media is in, or that the cards show
+LISTING_CACHE_FIELDS = LISTING_CARD_FIELDS | {"state", "is_reviewed", "encoding_status", "featured"}
+
 RE_TIMECODE = re.compile(r"(\d+:\d+:\d+.\d+)")
 # the final state of a media, and also encoded medias
 MEDIA_ENCODING_STATUS = (
@@ -272,6 +286,9 @@ class Media(models.Model):
     size = models.CharField(max_length=20, blank=True, null=True)
     # set this here, so we don't perform extra query for it on media listing
     preview_file_path = models.CharField(max_length=501, blank=True)
+    # denormalised urls and author info of listing items, served straight
+    # from .values() by listing endpoints. See update_listing_card
+    listing_card = models.JSONField(default=dict, blank=True, editable=False)
     password = models.CharField(
         max_length=100, blank=True, help_text="when video is in restricted state"
     )
@@ -288,6 +305,12 @@ class Media(models.Model):
         help_text="In case existing URLs of media exist, for use in migrations",
     )
     hls_file = models.CharField(max_length=1000, blank=True)
+    # paths of the HLS master, variant and iframe playlists, read once when
+    # the media is packaged. See read_hls_manifest
+    hls_manifest = models.JSONField(default=dict, blank=True, editable=False)
+    # ids of related media, best first, for RELATED_MEDIA_STRATEGY
+    # "calculated". See calculate_related_media
+    related_media_ids = models.JSONField(default=list, blank=True, editable=False)
     # keep track if media file has changed
     company = models.CharField(
         "Production Company", max_length=300, blank=True, null=True
@@ -370,6 +393,15 @@ class Media(models.Model):
             self.state = helpers.get_default_state(user=self.user)
             self.license = License.objects.filter(id=10).first()
         super(Media, self).save(*args, **kwargs)
+        update_fields = kwargs.get("update_fields")
+        if update_fields is None or LISTING_CARD_FIELDS.intersection(update_fields):
+            self.update_listing_card()
+        # Invalidate listing caches if media is or was listed publicly, and
+        # the save may have changed what the listings show
+        if (self.state == "public" or self.__original_state == "public") and (
+            update_fields is None or LISTING_CACHE_FIELDS.intersection(update_fields)
+        ):
+            self._invalidate_listing_cache()
         # Invalidate permission cache if state or password changed
         if self.pk and (
             self.state != self.__original_state
@@ -481,6 +513,69 @@ class Media(models.Model):
                 f"Failed to invalidate permission cache for media {self.uid}: {e}"
             )
 
+    def get_listing_card(self):
+        """
+        Values of listing items that are expensive to compute on every
+        request: urls, thumbnails and author info
+        """
+        card = {
+            "url": self.get_absolute_url(),
+            "api_url": self.get_absolute_url(api=True),
+            "thumbnail_url": self.thumbnail_url,
+            "preview_url": self.preview_url,
+            "media_country_info": self.media_country_info,
+        }
+        card.update(Media.get_author_card(self.user))
+        return card
+
+    @staticmethod
+    def get_author_card(user):
+        return {
+            "author_name": user.name,
+            "author_profile": user.get_absolute_url(),
+            "author_thumbnail": helpers.url_from_path(user.logo.path),
+        }
+
+    def update_listing_card(self):
+        """
+        Refresh the listing card of this media. Called on save, since urls
+        are versioned on edit_date
+        """
+        self.__dict__.pop("media_version", None)
+        try:
+            card = self.get_listing_card()
+        except Exception as e:
+            logger.warning(
+                f"Failed to build listing card for media {self.friendly_token}: {e}"
+            )
+            return False
+        Media.objects.filter(pk=self.pk).update(listing_card=card)
+        self.listing_card = card
+        return True
+
+    @classmethod
+    def update_author_listing_cards(cls, user):
+        """
+        Refresh the author part of the listing cards of all media of a user,
+        without rebuilding the cards
+        """
+        author_card = cls.get_author_card(user)
+        media = []
+        for pk, card in cls.objects.filter(user=user).values_list("id", "listing_card"):
+            if card and any(card.get(k) != v for k, v in author_card.items()):
+                card.update(author_card)
+                media.append(cls(id=pk, listing_card=card))
+        cls.objects.bulk_update(media, ["listing_card"], batch_size=500)
+        return len(media)
+
+    def _invalidate_listing_cache(self):
+        """
+        Invalidate cached listings (search results) that may include this media.
+        Listing caches are keyed on a global catalog generation, so bumping it
+        is enough; stale entries are never read again and simply expire.
+        """
+        bump_catalog_generation()
+
     def media_init(self):
         # new media file uploaded. Check if media type,
         # video duration, thumbnail etc. Re-encode
@@ -610,21 +705,32 @@ class Media(models.Model):
         return True
 
     def encode(self, profiles=[], force=True, chunkize=True):
+        from . import encode_policy, fair_share, tasks
+
         if not profiles:
-            profiles = EncodeProfile.objects.filter(active=True)
+            # high resolutions may wait, see files/encode_policy.py
+            profiles, deferred = encode_policy.split_profiles(
+                self, EncodeProfile.objects.filter(active=True)
+            )
+            if deferred:
+                logger.info(
+                    "deferred encoding {0} to {1}".format(
+                        self.friendly_token, [p.name for p in deferred]
+                    )
+                )
         profiles = list(profiles)
-        from . import tasks
 
         if self.duration > settings.CHUNKIZE_VIDEO_DURATION and chunkize:
-            for profile in profiles:
+            for profile in list(profiles):
                 if profile.extension == "gif":
                     profiles.remove(profile)
                     encoding = Encoding(media=self, profile=profile)
                     encoding.save()
                     enc_url = settings.SSL_FRONTEND_HOST + encoding.get_absolute_url()
-                    tasks.encode_media.apply_async(
-                        args=[self.friendly_token, profile.id, encoding.id, enc_url],
-                        kwargs={"force": force},
+                    fair_share.publish_encode(
+                        self,
+                        [self.friendly_token, profile.id, encoding.id, enc_url],
+                        {"force": force},
                         priority=0,
                     )
             profiles = [p.id for p in profiles]
@@ -646,9 +752,10 @@ class Media(models.Model):
                     priority = 9
                 else:
                     priority = 0
-                tasks.encode_media.apply_async(
-                    args=[self.friendly_token, profile.id, encoding.id, enc_url],
-                    kwargs={"force": force},
+                fair_share.publish_encode(
+                    self,
+                    [self.friendly_token, profile.id, encoding.id, enc_url],
+                    {"force": force},
                     priority=priority,
                 )
         return True
@@ -705,8 +812,9 @@ class Media(models.Model):
             return ret
         for key in ENCODE_RESOLUTIONS_KEYS:
             ret[key] = {}
-        for encoding in self.encodings.select_related("profile").filter(chunk=False):
-            if encoding.profile.extension == "gif":
+        encodings = self.get_encodings()
+        for encoding in encodings:
+            if encoding.chunk or encoding.profile.extension == "gif":
                 continue
             enc = self.get_encoding_info(encoding, full=full)
             resolution = encoding.profile.resolution
@@ -716,7 +824,7 @@ class Media(models.Model):
         # they are finished. Thus, produce the info for these
         if full:
             extra = []
-            for encoding in self.encodings.select_related("profile").filter(chunk=True):
+            for encoding in [encoding for encoding in encodings if encoding.chunk]:
                 resolution = encoding.profile.resolution
                 if not ret[resolution].get(encoding.profile.codec):
                     extra.append(encoding.profile.codec)
@@ -731,6 +839,15 @@ class Media(models.Model):
                 # TODO; status/logs/errors
         return ret
 
+    def get_encodings(self):
+        """
+        Encodings of the media with their profiles, from the prefetch cache
+        when the caller prefetched them (eg media detail)
+        """
+        if "encodings" in getattr(self, "_prefetched_objects_cache", {}):
+            return list(self.encodings.all())
+        return list(self.encodings.select_related("profile"))
+
     def get_encoding_info(self, encoding, full=False):
         ep = {}
         ep["title"] = encoding.profile.name
@@ -884,7 +1001,12 @@ class Media(models.Model):
             return helpers.build_versioned_url(base_url, self.media_version)
         # get preview_file out of the encodings, since some times preview_file_path
         # is empty but there is the gif encoding!
-        preview_media = self.encodings.filter(profile__extension="gif").first()
+        if "encodings" in getattr(self, "_prefetched_objects_cache", {}):
+            preview_media = next(
+                (e for e in self.get_encodings() if e.profile.extension == "gif"), None
+            )
+        else:
+            preview_media = self.encodings.filter(profile__extension="gif").first()
         if preview_media and preview_media.media_file:
             base_url = helpers.url_from_path(preview_media.media_file.path)
             return helpers.build_versioned_url(base_url, self.media_version)
@@ -892,41 +1014,49 @@ class Media(models.Model):
 
     @property
     def hls_info(self):
+        if not self.hls_file:
+            return {}
+        manifest = self.hls_manifest
+        if not manifest:
+            # media packaged before manifests were stored
+            manifest = self.update_hls_manifest()
+        return {
+            key: helpers.build_versioned_url(
+                helpers.url_from_path(path), self.media_version
+            )
+            for key, path in manifest.items()
+        }
+
+    def read_hls_manifest(self):
+        """
+        Parse the HLS master playlist from disk, returning the paths of the
+        master file and of the existing iframe and variant playlists
+        """
         res = {}
-        if self.hls_file:
-            if os.path.exists(self.hls_file):
-                hls_file = self.hls_file
-                p = os.path.dirname(hls_file)
-                m3u8_obj = m3u8.load(hls_file)
-                if os.path.exists(hls_file):
-                    base_url = helpers.url_from_path(hls_file)
-                    res["master_file"] = helpers.build_versioned_url(
-                        base_url, self.media_version
-                    )
-                    for iframe_playlist in m3u8_obj.iframe_playlists:
-                        uri = os.path.join(p, iframe_playlist.uri)
-                        if os.path.exists(uri):
-                            resolution = iframe_playlist.iframe_stream_info.resolution[
-                                1
-                            ]
-                            base_url = helpers.url_from_path(uri)
-                            res["{}_iframe".format(resolution)] = (
-                                helpers.build_versioned_url(
-                                    base_url, self.media_version
-                                )
-                            )
-                    for playlist in m3u8_obj.playlists:
-                        uri = os.path.join(p, playlist.uri)
-                        if os.path.exists(uri):
-                            resolution = playlist.stream_info.resolution[1]
-                            base_url = helpers.url_from_path(uri)
-                            res["{}_playlist".format(resolution)] = (
-                                helpers.build_versioned_url(
-                                    base_url, self.media_version
-                                )
-                            )
+        if self.hls_file and os.path.exists(self.hls_file):
+            hls_file = self.hls_file
+            p = os.path.dirname(hls_file)
+            m3u8_obj = m3u8.load(hls_file)
+            res["master_file"] = hls_file
+            for iframe_playlist in m3u8_obj.iframe_playlists:
+                uri = os.path.join(p, iframe_playlist.uri)
+                if os.path.exists(uri):
+                    resolution = iframe_playlist.iframe_stream_info.resolution[1]
+                    res["{}_iframe".format(resolution)] = uri
+            for playlist in m3u8_obj.playlists:
+                uri = os.path.join(p, playlist.uri)
+                if os.path.exists(uri):
+                    resolution = playlist.stream_info.resolution[1]
+                    res["{}_playlist".format(resolution)] = uri
         return res
 
+    def update_hls_manifest(self):
+        self.hls_manifest = self.read_hls_manifest()
+        if self.hls_manifest:
+            # not through save(), this does not change the media
+            Media.objects.filter(pk=self.pk).update(hls_manifest=self.hls_manifest)
+        return self.hls_manifest
+
     @property
     def author_name(self):
         return self.user.name
@@ -966,7 +1096,10 @@ class Media(models.Model):
         if not settings.ALLOW_RATINGS:
             return []
         for category in self.category.all():
-            ratings = RatingCategory.objects.filter(category=category, enabled=True)
+            # ratingcategory_set may be prefetched, filter in python
+            ratings = [
+                rating for rating in category.ratingcategory_set.all() if rating.enabled
+            ]
             if ratings:
                 ratings_info = []
                 for rating in ratings:
@@ -1059,11 +1192,15 @@ class Category(models.Model):
             return helpers.url_from_path(self.thumbnail.path)
         if self.listings_thumbnail:
             return self.listings_thumbnail
-        media = (
-            Media.objects.filter(category=self, state="public")
-            .order_by("-views")
-            .first()
-        )
+        if hasattr(self, "thumbnail_media"):
+            # loaded by listings, see methods.set_thumbnail_media
+            media = self.thumbnail_media
+        else:
+            media = (
+                Media.objects.filter(category=self, state="public")
+                .order_by("-views")
+                .first()
+            )
         if media:
             return media.thumbnail_url
 
@@ -1291,6 +1428,21 @@ class Encoding(models.Model):
     chunk_file_path = models.CharField(max_length=400, blank=True)
     chunks_info = models.TextField(blank=True)
     md5sum = models.CharField(max_length=50, blank=True, null=True)
+    cpu_time = models.FloatField(default=0, help_text="CPU seconds of its processes")
+    max_rss = models.PositiveIntegerField(default=0, help_text="peak RSS of its processes, in KB")
+    wall_time = models.FloatField(default=0, help_text="seconds ffmpeg ran")
+    speed = models.FloatField(default=0, help_text="seconds encoded per second of wall time")
+    bitrate = models.PositiveIntegerField(default=0, help_text="output bitrate, in kbit/s")
+    output_size = models.BigIntegerField(default=0, help_text="output size, in bytes")
+    preset = models.CharField(max_length=20, blank=True)
+    crf = models.PositiveSmallIntegerField(blank=True, null=True)
+    pass_mode = models.CharField(max_length=10, blank=True)
+    queue_wait = models.FloatField(
+        blank=True, null=True, help_text="seconds from publishing to start"
+    )
+    lease_expires = models.DateTimeField(
+        blank=True, null=True, db_index=True, help_text="lease of a remote worker"
+    )
 
     @property
     def media_encoding_url(self):
@@ -1484,6 +1636,8 @@ class Playlist(models.Model):
 
     @property
     def media_count(self):
+        if hasattr(self, "annotated_media_count"):
+            return self.annotated_media_count
         return self.media.count()
 
     def get_absolute_url(self, api=False):
@@ -1534,6 +1688,11 @@ class Playlist(models.Model):
 
     @property
     def thumbnail_url(self):
+        if hasattr(self, "thumbnail_media"):
+            # loaded by listings, see methods.set_thumbnail_media
+            if self.thumbnail_media:
+                return self.thumbnail_media.thumbnail_url
+            return None
         pm = self.playlistmedia_set.first()
         if pm:
             # return helpers.url_from_path(pm.media.thumbnail.path)
@@ -1689,6 +1848,38 @@ class TranscriptionRequest(models.Model):
     translate_to_english = models.BooleanField(default=False)
 
 
+class ReencodeCampaign(models.Model):
+    """
+    Re-encode of the media a filter matches, in some profiles, a few media
+    at a time. See files/reencode_campaigns.py
+    """
+
+    STATUS_CHOICES = (
+        ("running", "Running"),
+        ("paused", "Paused"),
+        ("done", "Done"),
+    )
+
+    name = models.CharField(max_length=100, unique=True)
+    profiles = models.ManyToManyField(EncodeProfile)
+    filters = models.JSONField(default=dict, blank=True, help_text="filters of the media")
+    concurrency = models.PositiveSmallIntegerField(
+        default=2, help_text="media re-encoded at the same time"
+    )
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default="running", db_index=True
+    )
+    last_media_id = models.PositiveIntegerField(
+        default=0, help_text="media are sent to encode in id order, up to this one"
+    )
+    queued = models.PositiveIntegerField(default=0, help_text="media sent to encode")
+    add_date = models.DateTimeField(auto_now_add=True)
+    update_date = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+
 class TinyMCEMedia(models.Model):
     file = models.FileField(upload_to="tinymce_media/")
     uploaded_at = models.DateTimeField(auto_now_add=True)
@@ -1801,10 +1992,15 @@ def media_file_delete(sender, instance, **kwargs):
         p = os.path.dirname(instance.hls_file)
         helpers.rm_dir(p)
     instance.user.update_user_media()
+    if instance.state == "public":
+        instance._invalidate_listing_cache()
 
 
 @receiver(m2m_changed, sender=Media.category.through)
 def media_m2m(sender, instance, **kwargs):
+    if kwargs.get("action") in ["post_add", "post_remove", "post_clear"]:
+        if getattr(instance, "state", None) == "public":
+            instance._invalidate_listing_cache()
     if instance.category.all():
         for category in instance.category.all():
             category.update_category_media()
@@ -1827,6 +2023,16 @@ def media_topics_m2m(sender, instance, action, pk_set, **kwargs):
             topics = Topic.objects.filter(media=instance)
             for topic in topics:
                 topic.update_tag_media()
+        if getattr(instance, "state", None) == "public":
+            instance._invalidate_listing_cache()
+
+
+@receiver(m2m_changed, sender=Media.tags.through)
+def media_tags_m2m(sender, instance, action, **kwargs):
+    # tag landing pages are search results, refresh them when tags change
+    if action in ["post_add", "post_remove", "post_clear"]:
+        if getattr(instance, "state", None) == "public":
+            instance._invalidate_listing_cache()
 
 
 @receiver(post_save, sender=Encoding)
@@ -1859,10 +2065,14 @@ def encoding_file_save(sender, instance, created, **kwargs):
                     complete = False
                     break
             if complete:
+                # in the order of the segments, as resumed encodes add
+                # chunk encodings later
+                orig_chunks = list(orig_chunks)
+                chunks = sorted(chunks, key=lambda c: orig_chunks.index(c.chunk_file_path))
                 # this should run only once!
                 chunks_paths = [f.media_file.path for f in chunks]
                 with tempfile.TemporaryDirectory(
-                    dir=settings.TEMP_DIRECTORY
+                    dir=settings.SCRATCH_DIRECTORY
                 ) as temp_dir:
                     seg_file = helpers.create_temp_file(suffix=".txt", dir=temp_dir)
                     tf = helpers.create_temp_file(
@@ -1871,23 +2081,7 @@ def encoding_file_save(sender, instance, created, **kwargs):
                     with open(seg_file, "w") as ff:
                         for f in chunks_paths:
                             ff.write("file {}\n".format(f))
-                    cmd = [
-                        settings.FFMPEG_COMMAND,
-                        "-y",
-                        "-f",
-                        "concat",
-                        "-safe",
-                        "0",
-                        "-i",
-                        seg_file,
-                        "-c",
-                        "copy",
-                        "-pix_fmt",
-                        "yuv420p",
-                        "-movflags",
-                        "faststart",
-                        tf,
-                    ]
+                    cmd = helpers.get_concat_ffmpeg_command(seg_file, tf)
                     stdout = helpers.run_command(cmd)
                     encoding = Encoding(
                         media=instance.media,
@@ -1904,9 +2098,12 @@ def encoding_file_save(sender, instance, created, **kwargs):
                     start_date = min([st.add_date for st in chunks])
                     end_date = max([st.update_date for st in chunks])
                     encoding.total_run_time = (end_date - start_date).seconds
+                    encoding.cpu_time = sum(st.cpu_time for st in chunks)
+                    encoding.max_rss = max(st.max_rss for st in chunks)
                     encoding.save()
                     with open(tf, "rb") as f:
-                        myfile = File(f)
+                        # moved into place, the rendition is written once
+                        myfile = helpers.MovableFile(f)
                         output_name = "{0}.{1}".format(
                             helpers.get_file_name(instance.media.media_file.path),
                             instance.profile.extension,
@@ -0,0 +1,331 @@
+"""
+Registry of the external processes (ffmpeg, whisper.cpp, mp4hls) run by
+tasks.
+
+Encoding processes used to be found with pgrep on their output file and
+killed with kill -9, which missed or hit the wrong process and left their
+children running. Here every tracked child starts in a process group of its
+own and is registered, with its pid, host, start time and encoding, while it
+runs. Cancelling an encoding signals the groups of its processes on this
+host, SIGTERM first and SIGKILL after TERM_GRACE seconds.
+
+Children are reaped with wait4, and their CPU seconds and peak RSS are
+added to their Encoding (cpu_time and max_rss) when they exit.
+
+The registry lives in Redis, so that the worker process that receives a
+revoke finds the processes of the pool process that runs the encode.
+Without django-redis, only the processes of the current process are known.
+
+Functions:
+    - popen: Start a command, tracked if it is ffmpeg, whisper.cpp or mp4hls
+    - run: Like subprocess.run, for a tracked command
+    - stop_process: Terminate the group of a process, then kill it
+    - get_processes: Registered processes of a host
+    - get_encoding_processes: Registered processes of an encoding
+    - cancel_encoding_processes: Stop the processes of an encoding
+
+Cache Key Patterns:
+    - processes:{host}
+    - processes:encoding:{encoding_id}
+"""
+
+import json
+import logging
+import os
+import signal
+import socket
+import subprocess
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+from django.conf import settings
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+
+from .cache_utils import CACHE_KEY_PREFIX
+from .counters import get_redis
+
+logger = logging.getLogger(__name__)
+
+HOST = socket.gethostname()
+# seconds between SIGTERM and SIGKILL
+TERM_GRACE = 5
+# longest a process stays registered, in case its worker died with it
+REGISTRY_TTL = 2 * 24 * 60 * 60
+
+HOST_KEY_TEMPLATE = f"{CACHE_KEY_PREFIX}:processes:{{host}}"
+ENCODING_KEY_TEMPLATE = f"{CACHE_KEY_PREFIX}:processes:encoding:{{encoding_id}}"
+
+# running tracked processes of this process, pid -> TrackedPopen
+_local: Dict[int, "TrackedPopen"] = {}
+_local_lock = threading.Lock()
+
+
+def tracked_commands():
+    return {
+        getattr(settings, name, None)
+        for name in ("FFMPEG_COMMAND", "WHISPER_CPP_COMMAND", "MP4HLS_COMMAND")
+    } - {None}
+
+
+class TrackedPopen(subprocess.Popen):
+    """
+    Popen in a process group of its own, registered while it runs.
+
+    The rusage of the child is kept on rusage when it is reaped, and added
+    to its encoding if it has one.
+    """
+
+    def __init__(self, args, encoding_id=None, label=None, **kwargs):
+        kwargs.setdefault("start_new_session", True)
+        self.encoding_id = encoding_id
+        self.label = label or os.path.basename(str(args[0]))
+        self.start_time = time.time()
+        self.rusage = None
+        self.exited = False
+        super().__init__(args, **kwargs)
+        register_process(self)
+
+    def _wait4(self, pid, flags):
+        # os.waitpid that keeps the resource usage of the child
+        ret_pid, status, rusage = os.wait4(pid, flags)
+        if ret_pid == self.pid:
+            self._exited(rusage)
+        return ret_pid, status
+
+    def _internal_poll(self, _deadstate=None, **kwargs):
+        return super()._internal_poll(_deadstate=_deadstate, _waitpid=self._wait4)
+
+    def _try_wait(self, wait_flags):
+        try:
+            return self._wait4(self.pid, wait_flags)
+        except ChildProcessError:
+            # reaped elsewhere, the status and usage are lost
+            self._exited(None)
+            return self.pid, 0
+
+    def _exited(self, rusage):
+        if self.exited:
+            return
+        self.exited = True
+        self.rusage = rusage
+        try:
+            unregister_process(self.pid, self.encoding_id)
+            if rusage is not None and self.encoding_id:
+                record_usage(self.encoding_id, rusage)
+        except Exception as e:
+            logger.warning(f"Recording the exit of {self.label} ({self.pid}) failed: {e}")
+
+
+def popen(cmd, encoding_id=None, label=None, **kwargs) -> subprocess.Popen:
+    """
+    Start cmd, as a TrackedPopen if it runs ffmpeg, whisper.cpp or mp4hls
+    or belongs to an encoding.
+    """
+    if encoding_id or cmd[0] in tracked_commands():
+        return TrackedPopen(cmd, encoding_id=encoding_id, label=label, **kwargs)
+    return subprocess.Popen(cmd, **kwargs)
+
+
+def run(cmd, encoding_id=None, label=None, **kwargs) -> subprocess.CompletedProcess:
+    """
+    subprocess.run for a tracked command, with stdout and stderr captured
+    unless given. The process group is stopped if waiting is interrupted.
+    """
+    kwargs.setdefault("stdout", subprocess.PIPE)
+    kwargs.setdefault("stderr", subprocess.PIPE)
+    with TrackedPopen(cmd, encoding_id=encoding_id, label=label, **kwargs) as process:
+        try:
+            stdout, stderr = process.communicate()
+        except BaseException:
+            stop_process(process, grace=0)
+            raise
+    return subprocess.CompletedProcess(process.args, process.returncode, stdout, stderr)
+
+
+def record_usage(encoding_id: int, rusage) -> None:
+    """Add the CPU seconds of a child to its encoding, and its peak RSS (KB)"""
+    from .models import Encoding
+
+    Encoding.objects.filter(id=encoding_id).update(
+        cpu_time=F("cpu_time") + rusage.ru_utime + rusage.ru_stime,
+        max_rss=Greatest("max_rss", Value(rusage.ru_maxrss)),
+    )
+
+
+def register_process(process: TrackedPopen) -> None:
+    with _local_lock:
+        _local[process.pid] = process
+    client = get_redis()
+    if client is None:
+        return
+    details = process_details(process)
+    host_key = HOST_KEY_TEMPLATE.format(host=HOST)
+    try:
+        pipe = client.pipeline(transaction=False)
+        pipe.hset(host_key, process.pid, json.dumps(details))
+        pipe.expire(host_key, REGISTRY_TTL)
+        if process.encoding_id:
+            encoding_key = ENCODING_KEY_TEMPLATE.format(encoding_id=process.encoding_id)
+            pipe.sadd(encoding_key, f"{HOST}:{process.pid}")
+            pipe.expire(encoding_key, REGISTRY_TTL)
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Registering {process.label} ({process.pid}) failed: {e}")
+
+
+def unregister_process(pid: int, encoding_id: Optional[int] = None, host: str = HOST) -> None:
+    if host == HOST:
+        with _local_lock:
+            _local.pop(pid, None)
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        pipe = client.pipeline(transaction=False)
+        pipe.hdel(HOST_KEY_TEMPLATE.format(host=host), pid)
+        if encoding_id:
+            pipe.srem(ENCODING_KEY_TEMPLATE.format(encoding_id=encoding_id), f"{host}:{pid}")
+        pipe.execute()
+    except Exception as e:
+        logger.warning(f"Unregistering process {pid} failed: {e}")
+
+
+def process_details(process: TrackedPopen) -> Dict[str, Any]:
+    return {
+        "pid": process.pid,
+        "pgid": process.pid,
+        "host": HOST,
+        "start_time": process.start_time,
+        "label": process.label,
+        "encoding_id": process.encoding_id,
+    }
+
+
+def get_processes(host: str = HOST) -> List[Dict[str, Any]]:
+    """Registered processes of a host, oldest first"""
+    if host == HOST:
+        with _local_lock:
+            processes = {pid: process_details(p) for pid, p in _local.items()}
+    else:
+        processes = {}
+    client = get_redis()
+    if client is not None:
+        try:
+            for raw in client.hvals(HOST_KEY_TEMPLATE.format(host=host)):
+                details = json.loads(raw)
+                processes.setdefault(details["pid"], details)
+        except Exception as e:
+            logger.warning(f"Reading the processes of {host} failed: {e}")
+    return sorted(processes.values(), key=lambda d: d["start_time"])
+
+
+def get_encoding_processes(encoding_id: int, host: str = HOST) -> List[Dict[str, Any]]:
+    """Registered processes of an encoding on a host"""
+    with _local_lock:
+        processes = {
+            pid: process_details(p) for pid, p in _local.items() if p.encoding_id == encoding_id
+        } if host == HOST else {}
+    client = get_redis()
+    if client is not None:
+        try:
+            members = client.smembers(ENCODING_KEY_TEMPLATE.format(encoding_id=encoding_id))
+            pids = []
+            for member in members:
+                member = member.decode() if isinstance(member, bytes) else member
+                member_host, pid = member.rsplit(":", 1)
+                if member_host == host:
+                    pids.append(int(pid))
+            if pids:
+                raws = client.hmget(HOST_KEY_TEMPLATE.format(host=host), pids)
+                for pid, raw in zip(pids, raws):
+                    if raw:
+                        processes.setdefault(pid, json.loads(raw))
+                    else:
+                        processes.setdefault(pid, {"pid": pid, "pgid": pid, "host": host})
+        except Exception as e:
+            logger.warning(f"Reading the processes of encoding {encoding_id} failed: {e}")
+    return list(processes.values())
+
+
+def signal_group(pgid: int, sig: int) -> bool:
+    """Send sig to a process group, returns False if it is gone"""
+    try:
+        os.killpg(pgid, sig)
+        return True
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        logger.warning(f"Not allowed to signal process group {pgid}")
+        return False
+
+
+def group_alive(pgid: int) -> bool:
+    with _local_lock:
+        process = _local.get(pgid)
+    # reap our own children, or they linger as zombies
+    if process is not None and process.poll() is not None:
+        return False
+    if not signal_group(pgid, 0):
+        return False
+    # children of other processes are zombies until those reap them
+    try:
+        with open(f"/proc/{pgid}/stat") as f:
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except (OSError, IndexError):
+        return True
+
+
+def stop_groups(pgids, grace: float = TERM_GRACE) -> None:
+    """SIGTERM process groups, and SIGKILL the ones still alive after grace"""
+    alive = {pgid for pgid in pgids if signal_group(pgid, signal.SIGTERM)}
+    deadline = time.time() + grace
+    while alive and time.time() < deadline:
+        time.sleep(0.1)
+        alive = {pgid for pgid in alive if group_alive(pgid)}
+    for pgid in alive:
+        logger.warning(f"Process group {pgid} did not terminate, killing it")
+        signal_group(pgid, signal.SIGKILL)
+        with _local_lock:
+            process = _local.get(pgid)
+        if process is not None:
+            try:
+                process.wait(timeout=2)
+            except subprocess.TimeoutExpired:
+                pass
+
+
+def stop_process(process: subprocess.Popen, grace: float = TERM_GRACE) -> None:
+    """Terminate a process and its group, killing them after grace seconds"""
+    if process.poll() is not None:
+        return
+    if isinstance(process, TrackedPopen):
+        stop_groups([process.pid], grace=grace)
+    else:
+        process.terminate()
+        try:
+            process.wait(timeout=grace)
+        except subprocess.TimeoutExpired:
+            process.kill()
+    try:
+        process.wait(timeout=2)
+    except subprocess.TimeoutExpired:
+        pass
+
+
+def cancel_encoding_processes(encoding_id: int, grace: float = TERM_GRACE) -> int:
+    """
+    Stop the registered processes of an encoding on this host.
+
+    Returns:
+        int: Number of processes signalled
+    """
+    processes = get_encoding_processes(encoding_id)
+    if not processes:
+        return 0
+    logger.info(f"Stopping {len(processes)} processes of encoding {encoding_id}")
+    stop_groups({p["pgid"] for p in processes}, grace=grace)
+    for p in processes:
+        unregister_process(p["pid"], encoding_id)
+    return len(processes)
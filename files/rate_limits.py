@@ -0,0 +1,157 @@
+"""
+Redis rate limits and cooldowns for user actions.
+
+pre_save_action used to query MediaAction on every watch: once for the
+viewer's previous watch, and once to count the recent anonymous views of
+the IP. Both checks are answered here from Redis instead, so the database
+is only hit when an action is going to be recorded. The viewer's last
+watch is then read once, as the cooldown may have been lost to a Redis
+flush or eviction.
+
+- Cooldowns are short-TTL keys per viewer and media, set when a watch is
+  accepted and expiring after the media duration.
+- Rate limits are sliding windows: a sorted set of hit timestamps per
+  media and IP, trimmed to the window on every hit.
+
+Without django-redis the checks return None and callers query the
+database as before.
+
+Functions:
+    - hit_rate_limit: Record a hit in a sliding window, tell if it's allowed
+    - start_cooldown: Start a cooldown unless one is running
+    - seconds_since_last_watch: Time since a viewer's last recorded watch
+    - check_watch: Whether a watch should be recorded
+
+Cache Key Patterns:
+    - rate_limit:{scope}:{ident}
+    - cooldown:{action}:{viewer}:{media_id}
+"""
+
+import logging
+import time
+import uuid
+from typing import Optional
+
+from django.conf import settings
+from django.utils import timezone
+
+from .cache_utils import CACHE_KEY_PREFIX
+from .counters import get_redis
+
+logger = logging.getLogger(__name__)
+
+RATE_LIMIT_KEY_TEMPLATE = f"{CACHE_KEY_PREFIX}:rate_limit:{{scope}}:{{ident}}"
+COOLDOWN_KEY_TEMPLATE = f"{CACHE_KEY_PREFIX}:cooldown:{{action}}:{{viewer}}:{{media_id}}"
+
+# window of MAX_ANONYMOUS_VIEWS_PER_5SEC
+ANONYMOUS_VIEWS_WINDOW = 5
+
+
+def hit_rate_limit(client, scope: str, ident: str, limit: int, window: float) -> bool:
+    """
+    Record a hit in the sliding window of scope and ident, if it is
+    within the limit.
+
+    Args:
+        client: Redis client
+        scope: What is limited, eg anonymous_views
+        ident: Who is limited, eg media and IP
+        limit: Hits allowed per window, this one included
+        window: Window length in seconds
+
+    Returns:
+        bool: True if the hit is within the limit
+    """
+    key = RATE_LIMIT_KEY_TEMPLATE.format(scope=scope, ident=ident)
+    now = time.time()
+    member = f"{now}:{uuid.uuid4().hex[:8]}"
+    pipe = client.pipeline()
+    pipe.zremrangebyscore(key, 0, now - window)
+    pipe.zadd(key, {member: now})
+    pipe.zcard(key)
+    pipe.expire(key, int(window) + 1)
+    if pipe.execute()[2] <= limit:
+        return True
+    # rejected hits don't count, or a client over the limit would stay over it
+    client.zrem(key, member)
+    return False
+
+
+def start_cooldown(client, action: str, viewer: str, media_id: int, seconds: int) -> bool:
+    """
+    Start a cooldown of a viewer's action on a media.
+
+    Returns:
+        bool: True if started, False if one is already running
+    """
+    key = COOLDOWN_KEY_TEMPLATE.format(action=action, viewer=viewer, media_id=media_id)
+    return bool(client.set(key, 1, nx=True, ex=max(int(seconds), 1)))
+
+
+def seconds_since_last_watch(media, user_id: Optional[int], session_key: Optional[str]) -> float:
+    """
+    Seconds since the last recorded watch of a viewer on a media.
+
+    Returns:
+        float: Seconds, infinity if the viewer has no recorded watch
+    """
+    from actions.models import MediaAction
+
+    if user_id:
+        query = MediaAction.objects.filter(user_id=user_id)
+    else:
+        query = MediaAction.objects.filter(user=None, session_key=session_key)
+    last = (
+        query.filter(media=media, action="watch")
+        .order_by("-action_date")
+        .values_list("action_date", flat=True)
+        .first()
+    )
+    if last is None:
+        return float("inf")
+    return (timezone.now() - last).total_seconds()
+
+
+def check_watch(media, user_id: Optional[int], session_key: Optional[str], remote_ip: Optional[str]) -> Optional[bool]:
+    """
+    Whether a watch of a media should be recorded, like pre_save_action:
+    viewers re-watch once the media duration has passed, and anonymous
+    views are limited to MAX_ANONYMOUS_VIEWS_PER_5SEC per media and IP.
+
+    Returns:
+        bool or None: None if Redis can't tell, eg it is not available or
+        the media has no duration
+    """
+    if not media.duration:
+        # without duration a media is only counted once per viewer, the
+        # database holds that
+        return None
+    client = get_redis()
+    if client is None:
+        return None
+    viewer = f"user:{user_id}" if user_id else f"session:{session_key}"
+    key = COOLDOWN_KEY_TEMPLATE.format(action="watch", viewer=viewer, media_id=media.id)
+    try:
+        if client.exists(key):
+            return False
+        # the cooldown may be gone with a Redis flush or eviction, the last
+        # recorded watch still holds
+        remaining = media.duration - seconds_since_last_watch(media, user_id, session_key)
+        if remaining > 0:
+            start_cooldown(client, "watch", viewer, media.id, remaining)
+            return False
+        if not user_id:
+            limit = getattr(settings, 'MAX_ANONYMOUS_VIEWS_PER_5SEC', 30)
+            if not hit_rate_limit(
+                client, "anonymous_views", f"{media.id}:{remote_ip}", limit, ANONYMOUS_VIEWS_WINDOW
+            ):
+                logger.warning(
+                    f"Rate limit: IP {remote_ip} exceeded {limit} views/5sec "
+                    f"for media {media.friendly_token}"
+                )
+                return False
+        # a concurrent request of the same viewer may have won
+        return start_cooldown(client, "watch", viewer, media.id, media.duration)
+    except Exception as e:
+        logger.warning(f"Watch rate limit check failed for media {media.id}: {e}")
+        return None
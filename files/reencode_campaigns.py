@@ -0,0 +1,246 @@
+"""
+Throttled re-encodes of the catalog, after changes to profiles, bitrates or
+presets.
+
+A campaign (ReencodeCampaign) re-encodes the videos its filters match in
+its profiles. Task advance_reencode_campaigns sends the next media to
+encode, in id order, while fewer than `concurrency` of them have encodes
+of the campaign pending or running. It waits while more than
+REENCODE_CAMPAIGN_MAX_BACKLOG other encodings are pending, so new uploads
+go first. The last media sent to encode is stored on the campaign, so a
+campaign can be paused and resumed, from the reencode_campaign command or
+the admin, and survives restarts.
+
+Filters:
+    - since, until: Media added in [since, until), as ISO dates
+    - min_height, max_height: Video height
+    - state: Media state
+    - user: Username of the uploader
+    - with_profile: Media with a successful encoding in this profile
+    - max_id: Media up to this id, the last one when the campaign was
+      created, as later uploads have the new settings already
+
+Functions:
+    - get_campaign_media: Media the filters of a campaign match
+    - estimate: Renditions, hours of video and of encoding of a campaign
+    - advance: Send the next media of a campaign to encode
+    - advance_campaigns: Advance the running campaigns
+    - get_progress: Media queued, in flight and failed of a campaign
+"""
+
+import logging
+from collections import defaultdict
+from datetime import timedelta
+from typing import Any, Dict, Iterable, List
+
+from django.conf import settings
+from django.db.models import Q, Sum
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .encode_telemetry import get_throughput
+
+logger = logging.getLogger(__name__)
+
+FILTERS = ("since", "until", "min_height", "max_height", "state", "user", "with_profile")
+# telemetry the estimates come from
+ESTIMATE_DAYS = 30
+
+
+def parse_date(value: str):
+    """An ISO date or datetime, in the current timezone if naive"""
+    moment = parse_datetime(value) or parse_datetime(f"{value}T00:00:00")
+    if moment is None:
+        raise ValueError(f"{value} is not a date")
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def get_campaign_media(filters: Dict[str, Any]):
+    """Videos the filters match, see the filters of the module"""
+    from .models import Media
+
+    media = Media.objects.filter(media_type="video")
+    if filters.get("since"):
+        media = media.filter(add_date__gte=parse_date(filters["since"]))
+    if filters.get("until"):
+        media = media.filter(add_date__lt=parse_date(filters["until"]))
+    if filters.get("min_height"):
+        media = media.filter(video_height__gte=filters["min_height"])
+    if filters.get("max_height"):
+        media = media.filter(video_height__lte=filters["max_height"])
+    if filters.get("state"):
+        media = media.filter(state=filters["state"])
+    if filters.get("user"):
+        media = media.filter(user__username=filters["user"])
+    if filters.get("max_id"):
+        media = media.filter(id__lte=filters["max_id"])
+    if filters.get("with_profile"):
+        media = media.filter(
+            encodings__profile__name=filters["with_profile"],
+            encodings__status="success",
+            encodings__chunk=False,
+        ).distinct()
+    return media
+
+
+def get_profile_media(media, profile):
+    """Media that Media.encode encodes in a profile, by their height"""
+    if profile.extension == "gif" or not profile.resolution:
+        return media
+    if profile.resolution in settings.MINIMUM_RESOLUTIONS_TO_ENCODE:
+        return media
+    return media.filter(
+        Q(video_height__gte=profile.resolution) | Q(video_height=0) | Q(video_height__isnull=True)
+    )
+
+
+def estimate(filters: Dict[str, Any], profiles: Iterable) -> Dict[str, Any]:
+    """
+    Cost of re-encoding the media the filters match in profiles, from the
+    durations of the media and the speed of the encodes of each profile
+    over the last ESTIMATE_DAYS. Hours are None for profiles without
+    telemetry.
+
+    Returns:
+        dict: media, and per profile renditions, video_hours,
+        encode_hours and cpu_hours, with their totals
+    """
+    media = get_campaign_media(filters)
+    since = timezone.now() - timedelta(days=ESTIMATE_DAYS)
+    throughput = {row["profile"]: row for row in get_throughput(since, group_by=("profile",))}
+    ret = {"media": media.count(), "profiles": []}
+    totals = defaultdict(float)
+    for profile in profiles:
+        profile_media = get_profile_media(media, profile)
+        video_seconds = profile_media.aggregate(seconds=Sum("duration"))["seconds"] or 0
+        row = {
+            "profile": profile.name,
+            "renditions": profile_media.count(),
+            "video_hours": round(video_seconds / 3600, 2),
+            "encode_hours": None,
+            "cpu_hours": None,
+        }
+        stats = throughput.get(profile.name)
+        if stats and stats["speed"]:
+            row["encode_hours"] = round(video_seconds / stats["speed"] / 3600, 2)
+            row["cpu_hours"] = round(video_seconds * stats["cpu_per_encoded_second"] / 3600, 2)
+        for key in ("renditions", "video_hours", "encode_hours", "cpu_hours"):
+            totals[key] += row[key] or 0
+        ret["profiles"].append(row)
+    ret.update({key: round(value, 2) for key, value in totals.items()})
+    return ret
+
+
+def get_campaign_encodings(campaign):
+    """Encodings of the media a campaign sent to encode, since it started"""
+    from .models import Encoding
+
+    media = get_campaign_media(campaign.filters).filter(id__lte=campaign.last_media_id)
+    return Encoding.objects.filter(
+        media__in=media.values("id"),
+        profile__in=campaign.profiles.all(),
+        add_date__gte=campaign.add_date,
+    )
+
+
+def advance(campaign) -> int:
+    """
+    Send the next media of a running campaign to encode, up to its
+    concurrency. Marks the campaign done once all its media are encoded.
+
+    Returns:
+        int: Number of media sent to encode
+    """
+    from .models import Encoding
+
+    if campaign.status != "running":
+        return 0
+    encodings = get_campaign_encodings(campaign)
+    in_flight = (
+        encodings.filter(status__in=["pending", "running"]).values("media_id").distinct().count()
+    )
+    backlog = Encoding.objects.filter(status="pending").exclude(id__in=encodings.values("id"))
+    if backlog.count() > settings.REENCODE_CAMPAIGN_MAX_BACKLOG:
+        return 0
+
+    profiles = list(campaign.profiles.all())
+    free = campaign.concurrency - in_flight
+    media = (
+        get_campaign_media(campaign.filters)
+        .filter(id__gt=campaign.last_media_id)
+        .order_by("id")[: max(free, 0)]
+    )
+    sent = 0
+    for item in media:
+        item.encode(profiles=profiles, force=True)
+        campaign.last_media_id = item.id
+        sent += 1
+
+    campaign.queued += sent
+    if not sent and not in_flight:
+        remaining = get_campaign_media(campaign.filters).filter(id__gt=campaign.last_media_id)
+        if not remaining.exists():
+            campaign.status = "done"
+            logger.info(f"Re-encode campaign {campaign.name} is done")
+    campaign.save(update_fields=["last_media_id", "queued", "status", "update_date"])
+    return sent
+
+
+def advance_campaigns() -> int:
+    """
+    Advance the running campaigns.
+
+    Returns:
+        int: Number of media sent to encode
+    """
+    from .models import ReencodeCampaign
+
+    return sum(advance(campaign) for campaign in ReencodeCampaign.objects.filter(status="running"))
+
+
+def get_progress(campaign) -> Dict[str, Any]:
+    """
+    Progress of a campaign: media it matches, sent to encode, with encodes
+    in flight and failed.
+    """
+    encodings = get_campaign_encodings(campaign)
+    in_flight = (
+        encodings.filter(status__in=["pending", "running"]).values("media_id").distinct().count()
+    )
+    failed = encodings.filter(status="fail", chunk=False).values("media_id").distinct().count()
+    total = get_campaign_media(campaign.filters).count()
+    return {
+        "name": campaign.name,
+        "status": campaign.status,
+        "profiles": [p.name for p in campaign.profiles.all()],
+        "concurrency": campaign.concurrency,
+        "total": total,
+        "queued": campaign.queued,
+        "in_flight": in_flight,
+        "failed": failed,
+        "percent": round(campaign.queued * 100 / total, 1) if total else 100.0,
+    }
+
+
+def get_filters(options: Dict[str, Any]) -> Dict[str, Any]:
+    """Campaign filters from options, checking dates"""
+    filters = {key: options[key] for key in FILTERS if options.get(key)}
+    for key in ("since", "until"):
+        if key in filters:
+            parse_date(filters[key])
+    return filters
+
+
+def list_profiles(names: List[str]):
+    """Profiles by name, all active ones without names"""
+    from .models import EncodeProfile
+
+    if not names:
+        return list(EncodeProfile.objects.filter(active=True))
+    profiles = list(EncodeProfile.objects.filter(name__in=names))
+    missing = set(names) - {p.name for p in profiles}
+    if missing:
+        raise ValueError(f"unknown profiles: {', '.join(sorted(missing))}")
+    return profiles
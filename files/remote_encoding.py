@@ -0,0 +1,238 @@
+"""
+Leases of encodings to remote encoding workers.
+
+Remote workers (the encode_agent command, see files/encode_agent.py) pull
+work over the API instead of the Celery broker, so they need neither the
+media filesystem nor Redis. A worker leases the oldest pending encoding,
+downloads its source, runs the ffmpeg commands of the encoding, reports
+progress and uploads the result in ranges.
+
+A lease lasts REMOTE_ENCODING_LEASE seconds and every progress report
+renews it. Encodings whose lease expired, because their worker died or lost
+the network, can be leased again. Reports and uploads of a worker that lost
+its lease are refused. encode_media claims its encoding with a conditional
+UPDATE too, so an encoding is never encoded both by a remote worker and a
+local one, nor by two local tasks.
+
+Functions:
+    - lease_encoding: Lease the oldest pending encoding to a worker
+    - holds_lease: Whether a worker may update an encoding
+    - is_leased: Whether encode_media should leave an encoding alone
+    - claim_encoding: Claim an encoding for encode_media, as running
+    - get_start_info: What a worker needs to encode
+    - get_upload_path: Partial upload of a worker
+    - append_upload: Add a range to a partial upload, finishing it at the end
+"""
+
+import hashlib
+import os
+import re
+from datetime import timedelta
+from typing import Any, Dict, Optional, Tuple
+
+from django.conf import settings
+from django.core.files import File
+from django.db.models import Q
+from django.utils import timezone
+
+from . import helpers
+
+LEASE_SECONDS = getattr(settings, "REMOTE_ENCODING_LEASE", 300)
+# encodings tried per lease request, when workers race for the same ones
+LEASE_CANDIDATES = 20
+
+# placeholders of the commands, replaced by files of the worker
+TEMP_FILE = "TEMP_FILE_REPLACE"
+TEMP_PASS_FILE = "TEMP_FPASS_FILE_REPLACE"
+
+
+def leasable_encodings(now, held=()):
+    """
+    Pending encodings, and running ones whose lease expired, except the
+    held ones
+    """
+    from .models import Encoding
+
+    return (
+        Encoding.objects.filter(Q(status="pending") | Q(status="running", lease_expires__lt=now))
+        .exclude(profile__extension="gif")
+        .exclude(id__in=held)
+    )
+
+
+def lease_encoding(worker: str):
+    """
+    Lease the oldest leasable encoding to a worker, as running.
+
+    Each candidate is claimed with a conditional UPDATE, so two workers
+    never get the same encoding. Encodings waiting for their turn in the
+    fair-share queues are left to dispatch, so remote workers keep to
+    FAIR_SHARE_SLOTS and the order of uploaders.
+
+    Returns:
+        Encoding or None
+    """
+    from .fair_share import get_queued_encodings
+    from .models import Encoding
+
+    now = timezone.now()
+    held = get_queued_encodings(released=False)
+    candidates = list(
+        leasable_encodings(now, held).order_by("add_date", "id").values_list("id", flat=True)[
+            :LEASE_CANDIDATES
+        ]
+    )
+    for encoding_id in candidates:
+        claimed = (
+            leasable_encodings(now, held)
+            .filter(id=encoding_id)
+            .update(
+                status="running",
+                worker=worker,
+                progress=0,
+                lease_expires=now + timedelta(seconds=LEASE_SECONDS),
+                update_date=now,
+            )
+        )
+        if claimed:
+            return Encoding.objects.select_related("media", "profile").get(id=encoding_id)
+    return None
+
+
+def holds_lease(encoding, worker: str) -> bool:
+    """A leased encoding can only be updated by its worker"""
+    return encoding.lease_expires is None or encoding.worker == worker
+
+
+def renew_lease(encoding) -> None:
+    encoding.lease_expires = timezone.now() + timedelta(seconds=LEASE_SECONDS)
+
+
+def is_leased(encoding) -> bool:
+    """
+    Whether an encoding is leased to a remote worker, or was encoded by
+    one, so that encode_media leaves it alone.
+    """
+    if encoding.lease_expires is None:
+        return False
+    return encoding.status == "success" or encoding.lease_expires > timezone.now()
+
+
+def claim_encoding(encoding_id: int) -> bool:
+    """
+    Claim a pending encoding for a local encode_media task, as running,
+    unless a remote worker leased it. Running encodings are only claimed
+    when their lease expired, finished ones never, so a task delivered
+    twice doesn't encode again.
+
+    Returns:
+        bool: True if claimed
+    """
+    from .models import Encoding
+
+    now = timezone.now()
+    unleased = Q(lease_expires__isnull=True) | Q(lease_expires__lt=now)
+    claimable = Q(status="pending") & unleased
+    claimable |= Q(status="running", lease_expires__lt=now)
+    return bool(
+        Encoding.objects.filter(claimable, id=encoding_id).update(
+            status="running", lease_expires=None
+        )
+    )
+
+
+def get_start_info(encoding) -> Optional[Dict[str, Any]]:
+    """
+    Source and ffmpeg commands of an encoding, as returned to workers.
+
+    The commands write to TEMP_FILE and TEMP_PASS_FILE, and read the source
+    from original_media_path; workers replace them with their own files.
+    source_url is relative to the server, original_media_url absolute.
+
+    Returns:
+        dict, or None if the encoding can't be encoded
+    """
+    media = encoding.media
+    profile = encoding.profile
+    if encoding.chunk:
+        source_path = encoding.chunk_file_path
+        source_md5sum = encoding.md5sum
+    else:
+        source_path = media.media_file.path
+        source_md5sum = media.md5sum
+    source_url = helpers.build_versioned_url(
+        helpers.url_from_path(source_path), media.media_version
+    )
+    ffmpeg_commands = helpers.produce_ffmpeg_commands(
+        source_path,
+        media.media_info,
+        resolution=profile.resolution,
+        codec=profile.codec,
+        output_filename=TEMP_FILE,
+        pass_file=TEMP_PASS_FILE,
+        chunk=encoding.chunk,
+    )
+    if not ffmpeg_commands:
+        return None
+    return {
+        "encoding_id": encoding.id,
+        "original_media_url": settings.SSL_FRONTEND_HOST + source_url,
+        "original_media_path": source_path,
+        "original_media_md5sum": source_md5sum,
+        "source_url": source_url,
+        "duration": media.duration,
+        "ffmpeg_commands": [[str(arg) for arg in cmd] for cmd in ffmpeg_commands],
+        "profile_extension": profile.extension,
+        "lease_expires": encoding.lease_expires,
+    }
+
+
+def get_upload_path(encoding_id: int, worker: str) -> str:
+    """Partial upload of the output of an encoding by a worker"""
+    worker = re.sub(r"[^\w.-]", "_", worker or "")
+    return os.path.join(
+        settings.TEMP_DIRECTORY, "remote_uploads", f"{encoding_id}-{worker}.part"
+    )
+
+
+def get_file_md5sum(path: str) -> str:
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def append_upload(
+    encoding, worker: str, data: bytes, start: int, total: int, md5sum: str = ""
+) -> Tuple[bool, int]:
+    """
+    Add the range of the output of an encoding that starts at start. When
+    the upload reaches total bytes, it is checked against md5sum if given,
+    and saved as the media file of the encoding.
+
+    Returns:
+        (bool, int): whether the range was taken, and the bytes uploaded
+        so far. Ranges that don't start there, or a failed checksum, are
+        refused and the worker resumes from the returned offset.
+    """
+    path = get_upload_path(encoding.id, worker)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    uploaded = os.path.getsize(path) if os.path.exists(path) else 0
+    if start != uploaded or start + len(data) > total:
+        return False, uploaded
+    with open(path, "ab") as f:
+        f.write(data)
+    uploaded += len(data)
+    if uploaded < total:
+        return True, uploaded
+
+    if md5sum and get_file_md5sum(path) != md5sum:
+        helpers.rm_file(path)
+        return False, 0
+    source = encoding.chunk_file_path if encoding.chunk else encoding.media.media_file.path
+    output_name = "{0}.{1}".format(helpers.get_file_name(source), encoding.profile.extension)
+    with open(path, "rb") as f:
+        encoding.media_file.save(content=File(f), name=output_name)
+    helpers.rm_file(path)
+    return True, uploaded
@@ -0,0 +1,258 @@
+"""
+Scratch space for encode intermediates.
+
+Encodes wrote their two-pass logs and outputs to TEMP_DIRECTORY, and
+chunks next to the original in the media directory, which is network
+storage on most deployments. Intermediates now go to SCRATCH_DIRECTORY, a
+fast local volume (tmpfs or NVMe), and an encode reserves the space it
+expects to write there before it starts. Without the space, less
+SCRATCH_MIN_FREE, the encode is delayed by SCRATCH_DELAY seconds instead
+of filling the volume and failing half way.
+
+Reservations are kept per host and volume in Redis, so the worker
+processes of a host see each other's. A reservation counts for the part of
+its expected size not written yet, since the written part is gone from the
+free space already. Reservations of processes that died are dropped.
+Without django-redis, only the reservations of the current process are
+known.
+
+With SCRATCH_CHUNKS, chunkize_media writes chunks to the scratch volume
+too. Only for hosts that encode the chunks they cut: other workers, and
+remote encode agents, can't read them there.
+
+Functions:
+    - estimate_encode_size: Bytes an encode is expected to write
+    - get_reserved: Bytes reserved and not written yet
+    - get_available: Bytes free for new reservations
+    - has_space: Whether bytes fit in the scratch volume
+    - reserve: Reserve space and a directory for an encode
+    - get_chunks_directory: Where chunkize_media writes chunks
+
+Cache Key Patterns:
+    - scratch:{host}:{directory}
+"""
+
+import json
+import logging
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+from typing import Dict, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+
+from .cache_utils import CACHE_KEY_PREFIX
+from .counters import get_redis
+from .helpers import AUDIO_BITRATES, VIDEO_BITRATES
+
+logger = logging.getLogger(__name__)
+
+HOST = socket.gethostname()
+RESERVATIONS_KEY_TEMPLATE = f"{CACHE_KEY_PREFIX}:scratch:{{host}}:{{directory}}"
+LOCK_KEY_TEMPLATE = "scratch_lock:{host}:{directory}"
+LOCK_TIMEOUT = 30
+# longest a reservation is kept, in case its worker died with it
+RESERVATION_TTL = 2 * 24 * 60 * 60
+# room for muxing overhead, and bitrates above target on CRF encodes
+SIZE_FACTOR = 1.5
+
+# reservations of this process, directory -> details
+_local: Dict[str, Dict] = {}
+_local_lock = threading.Lock()
+
+
+class ScratchFull(Exception):
+    """The scratch volume has no room for a reservation"""
+
+
+def get_scratch_directory() -> str:
+    return settings.SCRATCH_DIRECTORY
+
+
+def get_chunks_directory(default: str) -> str:
+    """Directory chunkize_media writes chunks to, default without SCRATCH_CHUNKS"""
+    if not settings.SCRATCH_CHUNKS:
+        return default
+    directory = os.path.join(get_scratch_directory(), "chunks")
+    os.makedirs(directory, exist_ok=True)
+    return directory
+
+
+def estimate_encode_size(media, profile, chunk: bool = False) -> int:
+    """
+    Bytes an encode of a media in a profile is expected to write, from the
+    target bitrates of the profile. The size of the original when there is
+    no target bitrate.
+    """
+    duration = media.duration or 0
+    if chunk:
+        duration = min(duration, settings.VIDEO_CHUNKS_DURATION)
+    # the higher of the rates for 25 and 60 fps input
+    rates = VIDEO_BITRATES.get(profile.codec, {}).values()
+    video_rate = max([fps_rates.get(profile.resolution) or 0 for fps_rates in rates] + [0])
+    if not video_rate or not duration:
+        try:
+            return os.path.getsize(media.media_file.path)
+        except (OSError, ValueError):
+            return 0
+    audio_rate = AUDIO_BITRATES.get(profile.codec, 128)
+    return int(duration * (video_rate + audio_rate) * 1000 / 8 * SIZE_FACTOR)
+
+
+def get_written(directory: str) -> int:
+    """Bytes written under a directory"""
+    written = 0
+    for root, _, files in os.walk(directory):
+        for name in files:
+            try:
+                written += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return written
+
+
+def is_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def get_reservations_key() -> str:
+    return RESERVATIONS_KEY_TEMPLATE.format(host=HOST, directory=get_scratch_directory())
+
+
+def get_reservations() -> Dict[str, Dict]:
+    """Live reservations on the scratch volume of this host, dropping the others"""
+    with _local_lock:
+        reservations = dict(_local)
+    client = get_redis()
+    if client is not None:
+        key = get_reservations_key()
+        try:
+            for directory, raw in client.hgetall(key).items():
+                directory = directory.decode() if isinstance(directory, bytes) else directory
+                reservations.setdefault(directory, json.loads(raw))
+            stale = [
+                directory
+                for directory, details in reservations.items()
+                if not is_alive(details["pid"]) or not os.path.isdir(directory)
+            ]
+            if stale:
+                client.hdel(key, *stale)
+                for directory in stale:
+                    reservations.pop(directory)
+        except Exception as e:
+            logger.warning(f"Reading the scratch reservations failed: {e}")
+    return reservations
+
+
+def get_reserved() -> int:
+    """Bytes reserved on the scratch volume and not written yet"""
+    return sum(
+        max(details["bytes"] - get_written(directory), 0)
+        for directory, details in get_reservations().items()
+    )
+
+
+def get_available() -> int:
+    """Bytes free on the scratch volume for new reservations"""
+    free = shutil.disk_usage(get_scratch_directory()).free
+    return free - get_reserved() - settings.SCRATCH_MIN_FREE
+
+
+def has_space(nbytes: int) -> bool:
+    return get_available() >= nbytes
+
+
+class Reservation:
+    """
+    Space reserved on the scratch volume, with a directory to write it in.
+    Used as a context manager, the directory and the reservation are
+    removed on exit.
+    """
+
+    def __init__(self, directory: str, nbytes: int, encoding_id: Optional[int] = None):
+        self.directory = directory
+        self.bytes = nbytes
+        self.encoding_id = encoding_id
+
+    def details(self) -> Dict:
+        return {
+            "bytes": self.bytes,
+            "pid": os.getpid(),
+            "encoding_id": self.encoding_id,
+            "time": time.time(),
+        }
+
+    def register(self) -> None:
+        with _local_lock:
+            _local[self.directory] = self.details()
+        client = get_redis()
+        if client is None:
+            return
+        key = get_reservations_key()
+        try:
+            pipe = client.pipeline(transaction=False)
+            pipe.hset(key, self.directory, json.dumps(self.details()))
+            pipe.expire(key, RESERVATION_TTL)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Registering the scratch reservation {self.directory} failed: {e}")
+
+    def release(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+        with _local_lock:
+            _local.pop(self.directory, None)
+        client = get_redis()
+        if client is None:
+            return
+        try:
+            client.hdel(get_reservations_key(), self.directory)
+        except Exception as e:
+            logger.warning(f"Releasing the scratch reservation {self.directory} failed: {e}")
+
+    def __enter__(self) -> str:
+        return self.directory
+
+    def __exit__(self, *exc_info) -> None:
+        self.release()
+
+
+def reserve(nbytes: int, encoding_id: Optional[int] = None) -> Reservation:
+    """
+    Reserve nbytes on the scratch volume, in a new directory.
+
+    Raises:
+        ScratchFull: if the volume has no room for them now
+    """
+    directory = get_scratch_directory()
+    lock_key = LOCK_KEY_TEMPLATE.format(host=HOST, directory=directory)
+    # one reservation at a time per volume, so two encodes don't take the
+    # same free space
+    for _ in range(50):
+        if cache.add(lock_key, True, timeout=LOCK_TIMEOUT):
+            break
+        time.sleep(0.1)
+    else:
+        raise ScratchFull(f"scratch space of {directory} is being reserved")
+    try:
+        # an encode larger than the volume waits until it is empty
+        nbytes = min(nbytes, shutil.disk_usage(directory).total - settings.SCRATCH_MIN_FREE)
+        available = get_available()
+        if available < nbytes:
+            raise ScratchFull(
+                f"{nbytes} bytes wanted, {max(available, 0)} bytes available in {directory}"
+            )
+        reservation = Reservation(tempfile.mkdtemp(dir=directory), nbytes, encoding_id)
+        reservation.register()
+    finally:
+        cache.delete(lock_key)
+    return reservation
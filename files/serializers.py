@@ -1,3 +1,6 @@
+from datetime import datetime
+
+from django.utils.encoding import iri_to_uri
 from rest_framework import serializers
 
 from .models import (
@@ -43,6 +46,15 @@ class MediaSerializer(serializers.ModelSerializer):
     def get_author_thumbnail(self, obj):
         return self.context["request"].build_absolute_uri(obj.author_thumbnail())
 
+    # listing card fields returned as absolute urls, see serialize_media_cards
+    card_absolute_fields = (
+        "url",
+        "api_url",
+        "thumbnail_url",
+        "author_profile",
+        "author_thumbnail",
+    )
+
     class Meta:
         model = Media
         read_only_fields = (
@@ -177,6 +189,8 @@ class MediaSearchSerializer(serializers.ModelSerializer):
     def get_url(self, obj):
         return self.context["request"].build_absolute_uri(obj.get_absolute_url())
 
+    card_absolute_fields = ("url",)
+
     class Meta:
         model = Media
         fields = (
@@ -197,6 +211,85 @@ class MediaSearchSerializer(serializers.ModelSerializer):
         )
 
 
+# fields served from Media.listing_card, see Media.get_listing_card
+MEDIA_CARD_FIELDS = (
+    "url",
+    "api_url",
+    "thumbnail_url",
+    "preview_url",
+    "media_country_info",
+    "author_name",
+    "author_profile",
+    "author_thumbnail",
+)
+
+
+def get_media_card_values(serializer_class, *extra):
+    """Fields to select with .values() for serialize_media_cards"""
+    fields = [
+        field
+        for field in dict.fromkeys(serializer_class.Meta.fields)
+        if field not in MEDIA_CARD_FIELDS and field != "user"
+    ]
+    return ["id", "listing_card", "user__username", *fields, *extra]
+
+
+def get_media_card_rows(media, serializer_class):
+    """
+    Rows for serialize_media_cards out of already loaded Media instances,
+    that need to have their user loaded too
+    """
+    fields = get_media_card_values(serializer_class)
+    return [
+        {
+            field: obj.user.username if field == "user__username" else getattr(obj, field)
+            for field in fields
+        }
+        for obj in media
+    ]
+
+
+def serialize_media_cards(rows, request, serializer_class):
+    """
+    Serialize media listing rows, selected with get_media_card_values, to
+    the same output as serializer_class but without instantiating models
+    """
+    rows = list(rows)
+    cards = {}
+    missing = [row["id"] for row in rows if not row["listing_card"]]
+    if missing:
+        # media that have not been saved since listing cards were added
+        for media in Media.objects.filter(id__in=missing).select_related("user"):
+            media.update_listing_card()
+            cards[media.id] = media.listing_card
+
+    fields = list(dict.fromkeys(serializer_class.Meta.fields))
+    absolute_fields = serializer_class.card_absolute_fields
+    base_url = request.build_absolute_uri("/")[:-1]
+    date_field = serializers.DateTimeField()
+    ret = []
+    for row in rows:
+        card = row["listing_card"] or cards.get(row["id"], {})
+        item = {}
+        for field in fields:
+            if field == "user":
+                value = row["user__username"]
+            elif field in MEDIA_CARD_FIELDS:
+                value = card.get(field)
+            else:
+                value = row[field]
+            if isinstance(value, datetime):
+                value = date_field.to_representation(value)
+            elif field in absolute_fields:
+                if value and value.startswith("/") and not value.startswith("//"):
+                    value = iri_to_uri(base_url + value)
+                else:
+                    value = request.build_absolute_uri(value)
+            item[field] = value
+        ret.append(item)
+    return ret
+
+
 class EncodeProfileSerializer(serializers.ModelSerializer):
     class Meta:
         model = EncodeProfile
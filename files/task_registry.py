@@ -0,0 +1,204 @@
+"""
+Registry of the published and running Celery tasks, in Redis.
+
+list_tasks used to ask every worker for its active, reserved and scheduled
+tasks with celery inspect, a broadcast that takes seconds on busy workers
+and sometimes times out. Instead, tasks register themselves:
+
+- when published (before_task_publish), as reserved, or scheduled when
+  they have an ETA;
+- when a worker starts them (task_prerun), as active;
+- and leave the registry when they finish or are revoked.
+
+Every queue and state has a sorted set of task ids, scored by time. The
+details of a task (name, args, worker, and the media and profile of
+encodes) are a key of their own that expires after REGISTRY_TTL, so tasks
+lost by crashed workers fall out of the registry.
+
+Without django-redis, get_registered_tasks returns None and list_tasks
+inspects the workers as before.
+
+Functions:
+    - register_task: Add or move a task to a state
+    - unregister_task: Remove a task
+    - get_registered_tasks: Tasks per state
+
+Cache Key Patterns:
+    - task_registry:queues
+    - task_registry:{queue}:{state}
+    - task_registry:task:{task_id}
+"""
+
+import json
+import logging
+import time
+from typing import Any, Dict, List, Optional
+
+from celery.signals import before_task_publish, task_postrun, task_prerun
+
+from .cache_utils import CACHE_KEY_PREFIX
+from .counters import get_redis
+
+logger = logging.getLogger(__name__)
+
+STATES = ("active", "reserved", "scheduled")
+# high volume tasks, not worth listing
+UNTRACKED_TASKS = ("save_user_action", "drain_user_actions")
+# longest a task stays registered without news, a day in the broker
+# (its visibility timeout) and a day running
+REGISTRY_TTL = 2 * 24 * 60 * 60
+
+QUEUES_KEY = f"{CACHE_KEY_PREFIX}:task_registry:queues"
+STATE_KEY_TEMPLATE = f"{CACHE_KEY_PREFIX}:task_registry:{{queue}}:{{state}}"
+TASK_KEY_TEMPLATE = f"{CACHE_KEY_PREFIX}:task_registry:task:{{task_id}}"
+
+
+def get_task_details(name: str, args) -> Dict[str, Any]:
+    """Details of a task kept in the registry, from its name and args"""
+    args = list(args or [])
+    details = {"name": name, "args": repr(tuple(args))}
+    if name == "encode_media" and len(args) >= 3:
+        details["friendly_token"], details["profile_id"], details["encoding_id"] = args[:3]
+    return details
+
+
+def register_task(task_id: str, queue: str, state: str, details: Dict[str, Any]) -> bool:
+    """
+    Add a task to a state of its queue, removing it from the others.
+
+    Returns:
+        bool: True if the task was registered
+    """
+    client = get_redis()
+    if client is None:
+        return False
+    now = time.time()
+    try:
+        pipe = client.pipeline(transaction=False)
+        pipe.sadd(QUEUES_KEY, queue)
+        for other in STATES:
+            if other != state:
+                pipe.zrem(STATE_KEY_TEMPLATE.format(queue=queue, state=other), task_id)
+        pipe.zadd(STATE_KEY_TEMPLATE.format(queue=queue, state=state), {task_id: now})
+        pipe.set(
+            TASK_KEY_TEMPLATE.format(task_id=task_id),
+            json.dumps(dict(details, queue=queue, state=state, time=now), default=str),
+            ex=REGISTRY_TTL,
+        )
+        pipe.execute()
+        return True
+    except Exception as e:
+        logger.warning(f"Registering task {task_id} failed: {e}")
+        return False
+
+
+def unregister_task(task_id: str, queue: Optional[str] = None) -> bool:
+    """
+    Remove a task from the registry.
+
+    Args:
+        task_id: Task id
+        queue: Queue of the task, looked up in its details when not given
+    """
+    client = get_redis()
+    if client is None:
+        return False
+    task_key = TASK_KEY_TEMPLATE.format(task_id=task_id)
+    try:
+        if queue is None:
+            details = client.get(task_key)
+            queue = json.loads(details)["queue"] if details else None
+        pipe = client.pipeline(transaction=False)
+        queues = [queue] if queue else client.smembers(QUEUES_KEY)
+        for q in queues:
+            q = q.decode() if isinstance(q, bytes) else q
+            for state in STATES:
+                pipe.zrem(STATE_KEY_TEMPLATE.format(queue=q, state=state), task_id)
+        pipe.delete(task_key)
+        pipe.execute()
+        return True
+    except Exception as e:
+        logger.warning(f"Unregistering task {task_id} failed: {e}")
+        return False
+
+
+def get_registered_tasks() -> Optional[Dict[str, List[Dict[str, Any]]]]:
+    """
+    Registered tasks per state, oldest first.
+
+    Returns:
+        dict or None: state -> [task details, with task_id], or None
+        without Redis
+    """
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        queues = sorted(q.decode() if isinstance(q, bytes) else q for q in client.smembers(QUEUES_KEY))
+        keys = [(queue, state) for queue in queues for state in STATES]
+        pipe = client.pipeline(transaction=False)
+        for queue, state in keys:
+            pipe.zrange(STATE_KEY_TEMPLATE.format(queue=queue, state=state), 0, -1)
+        members = [
+            [m.decode() if isinstance(m, bytes) else m for m in ids] for ids in pipe.execute()
+        ]
+        task_ids = [task_id for ids in members for task_id in ids]
+        details = (
+            client.mget([TASK_KEY_TEMPLATE.format(task_id=task_id) for task_id in task_ids])
+            if task_ids
+            else []
+        )
+    except Exception as e:
+        logger.warning(f"Reading the task registry failed: {e}")
+        return None
+
+    details = dict(zip(task_ids, details))
+    ret = {state: [] for state in STATES}
+    expired = []
+    for (queue, state), ids in zip(keys, members):
+        for task_id in ids:
+            raw = details.get(task_id)
+            if raw is None:
+                expired.append((queue, state, task_id))
+                continue
+            ret[state].append(dict(json.loads(raw), task_id=task_id))
+    if expired:
+        try:
+            pipe = client.pipeline(transaction=False)
+            for queue, state, task_id in expired:
+                pipe.zrem(STATE_KEY_TEMPLATE.format(queue=queue, state=state), task_id)
+            pipe.execute()
+        except Exception as e:
+            logger.warning(f"Removing expired tasks from the registry failed: {e}")
+    for tasks in ret.values():
+        tasks.sort(key=lambda t: t["time"])
+    return ret
+
+
+@before_task_publish.connect
+def task_published_handler(sender=None, headers=None, body=None, routing_key=None, **kwargs):
+    # sender is the task name, body (args, kwargs, embed) with message protocol 2
+    if sender in UNTRACKED_TASKS or not headers or not headers.get("id"):
+        return
+    args = body[0] if isinstance(body, (list, tuple)) and body else []
+    state = "scheduled" if headers.get("eta") else "reserved"
+    register_task(headers["id"], routing_key or "celery", state, get_task_details(sender, args))
+
+
+@task_prerun.connect
+def task_started_handler(task_id=None, task=None, args=None, **kwargs):
+    if task is None or task.name in UNTRACKED_TASKS:
+        return
+    delivery_info = getattr(task.request, "delivery_info", None) or {}
+    queue = delivery_info.get("routing_key") or getattr(task, "queue", None) or "celery"
+    details = get_task_details(task.name, args)
+    details["worker"] = task.request.hostname
+    details["time_start"] = time.time()
+    register_task(task_id, queue, "active", details)
+
+
+@task_postrun.connect
+def task_finished_handler(task_id=None, task=None, **kwargs):
+    if task is None or task.name in UNTRACKED_TASKS:
+        return
+    unregister_task(task_id)
@@ -6,7 +6,7 @@ import shutil
 import subprocess
 import tempfile
 import time
-from datetime import datetime, timedelta
+from datetime import timedelta
 
 import requests
 from celery import Task
@@ -19,14 +19,24 @@ from celery.utils.log import get_task_logger
 from django.conf import settings
 from django.core.cache import cache
 from django.core.files import File
-from django.db.models import F, Q
+from django.db.models import F
+from django.utils import timezone
 
 from actions.models import USER_MEDIA_ACTIONS, MediaAction
 from users.models import User
 
+from . import (
+    fair_share,
+    processes,
+    remote_encoding,
+    scratch,
+    task_registry,
+    whisper_segments,
+)
 from .backends import FFmpegBackend
 from .exceptions import VideoEncodingError
 from .helpers import (
+    MovableFile,
     calculate_seconds,
     create_temp_file,
     get_file_name,
@@ -37,7 +47,25 @@ from .helpers import (
     rm_file,
     run_command,
 )
-from .methods import list_tasks, notify_users, pre_save_action
+from .action_buffer import apply_user_actions, pop_buffered_actions, requeue_failed_actions
+from .action_rollups import apply_retention, rollup_pending_days
+from .counters import incr_media_counter
+from .encode_telemetry import get_encode_settings, get_queue_wait
+from .encoding_checks import (
+    backfill_deferred_profiles,
+    encode_missing_profiles,
+    fix_media_states,
+    requeue_lost_pending,
+    requeue_stale_running,
+)
+from .reencode_campaigns import advance_campaigns
+from .unique_viewers import add_viewers, get_viewer_id
+from .methods import (
+    calculate_related_media,
+    get_top_media,
+    notify_users,
+    pre_save_action,
+)
 from .models import (
     Category,
     EncodeProfile,
@@ -68,6 +96,16 @@ def chunkize_media(self, friendly_token, profiles, force=True):
     profiles = [EncodeProfile.objects.get(id=profile) for profile in profiles]
     media = Media.objects.get(friendly_token=friendly_token)
     cwd = os.path.dirname(os.path.realpath(media.media_file.path))
+    if settings.SCRATCH_CHUNKS:
+        # segments take about the size of the original
+        if not scratch.has_space(os.path.getsize(media.media_file.path)):
+            logger.info(
+                "No scratch space to chunkize {0}, retrying in {1}s".format(
+                    friendly_token, settings.SCRATCH_DELAY
+                )
+            )
+            raise self.retry(countdown=settings.SCRATCH_DELAY, max_retries=None)
+        cwd = scratch.get_chunks_directory(cwd)
     file_name = media.media_file.path.split("/")[-1]
     random_prefix = produce_friendly_token()
     file_format = "{0}_{1}".format(random_prefix, file_name)
@@ -108,8 +146,8 @@ def chunkize_media(self, friendly_token, profiles, force=True):
             encoding = Encoding(media=media, profile=profile)
             encoding.save()
             enc_url = settings.SSL_FRONTEND_HOST + encoding.get_absolute_url()
-            encode_media.delay(
-                friendly_token, profile.id, encoding.id, enc_url, force=force
+            fair_share.publish_encode(
+                media, [friendly_token, profile.id, encoding.id, enc_url], {"force": force}
             )
         return False
 
@@ -139,16 +177,7 @@ def chunkize_media(self, friendly_token, profiles, force=True):
                 md5sum=chunks_dict[chunk],
             )
             encoding.save()
-            enc_url = settings.SSL_FRONTEND_HOST + encoding.get_absolute_url()
-            if profile.resolution in settings.MINIMUM_RESOLUTIONS_TO_ENCODE:
-                priority = 0
-            else:
-                priority = 9
-            encode_media.apply_async(
-                args=[friendly_token, profile.id, encoding.id, enc_url],
-                kwargs={"force": force, "chunk": True, "chunk_file_path": chunk},
-                priority=priority,
-            )
+            encode_chunk(encoding, force=force)
 
     logger.info(
         "got {0} chunks and will encode to {1} profiles".format(
@@ -158,6 +187,21 @@ def chunkize_media(self, friendly_token, profiles, force=True):
     return True
 
 
+def encode_chunk(encoding, force=True):
+    """Send a chunk encoding to encode_media"""
+    enc_url = settings.SSL_FRONTEND_HOST + encoding.get_absolute_url()
+    if encoding.profile.resolution in settings.MINIMUM_RESOLUTIONS_TO_ENCODE:
+        priority = 0
+    else:
+        priority = 9
+    fair_share.publish_encode(
+        encoding.media,
+        [encoding.media.friendly_token, encoding.profile.id, encoding.id, enc_url],
+        {"force": force, "chunk": True, "chunk_file_path": encoding.chunk_file_path},
+        priority=priority,
+    )
+
+
 class EncodingTask(Task):
     def on_failure(self, exc, task_id, args, kwargs, einfo):
         # mainly used to run some post failure steps
@@ -166,7 +210,7 @@ class EncodingTask(Task):
             if hasattr(self, "encoding"):
                 self.encoding.status = "fail"
                 self.encoding.save(update_fields=["status"])
-                kill_ffmpeg_process(self.encoding.temp_file)
+                processes.cancel_encoding_processes(self.encoding.id)
                 if hasattr(self.encoding, "media"):
                     self.encoding.media.post_encode_actions()
         except:
@@ -196,6 +240,7 @@ def encode_media(
             friendly_token, profile_id, force
         )
     )
+    queue_wait = get_queue_wait(self.request, time.time())
     # TODO: if called as function, not as task, what is the value for this?
     if self.request.id:
         task_id = self.request.id
@@ -208,6 +253,15 @@ def encode_media(
         Encoding.objects.filter(id=encoding_id).delete()
         return False
 
+    # a deleted encoding is created again below
+    if not remote_encoding.claim_encoding(encoding_id) and Encoding.objects.filter(
+        id=encoding_id
+    ).exists():
+        logger.info(
+            "Encoding {0} is leased to a remote worker or running already".format(encoding_id)
+        )
+        return False
+
     # break logic with chunk True/False
     if chunk:
         # TODO: in case a video is chunkized and this enters here many times
@@ -259,8 +313,9 @@ def encode_media(
 
     if task_id:
         encoding.task_id = task_id
-    encoding.worker = "localhost"
+    encoding.worker = self.request.hostname or "localhost"
     encoding.retries = self.request.retries
+    encoding.queue_wait = queue_wait
     encoding.save()
 
     if profile.extension == "gif":
@@ -282,8 +337,13 @@ def encode_media(
             "gif",
             tf,
         ]
-        ret = run_command(command)
+        encode_start = time.time()
+        ret = run_command(command, encoding_id=encoding.id)
+        encoding.wall_time = time.time() - encode_start
+        # the registry added the resource usage of ffmpeg
+        encoding.refresh_from_db(fields=["cpu_time", "max_rss"])
         if os.path.exists(tf) and get_file_type(tf) == "image":
+            encoding.output_size = os.path.getsize(tf)
             with open(tf, "rb") as f:
                 myfile = File(f)
                 encoding.status = "success"
@@ -302,7 +362,27 @@ def encode_media(
         encoding.save(update_fields=["status"])
         return False
 
-    with tempfile.TemporaryDirectory(dir=settings.TEMP_DIRECTORY) as temp_dir:
+    try:
+        scratch_space = scratch.reserve(
+            scratch.estimate_encode_size(media, profile, chunk=chunk), encoding_id=encoding.id
+        )
+    except scratch.ScratchFull as e:
+        # published again rather than retried, retries are for failed encodes.
+        # Its fair-share slot is free until it is released again
+        logger.info("Encoding {0} waits for scratch space, {1}".format(encoding.id, e))
+        encoding.status = "pending"
+        encoding.save(update_fields=["status"])
+        delivery_info = self.request.delivery_info or {}
+        fair_share.publish_encode(
+            media,
+            list(self.request.args),
+            self.request.kwargs,
+            priority=delivery_info.get("priority"),
+            countdown=settings.SCRATCH_DELAY,
+        )
+        return False
+
+    with scratch_space as temp_dir:
         tf = create_temp_file(suffix=".{0}".format(profile.extension), dir=temp_dir)
         tfpass = create_temp_file(suffix=".{0}".format(profile.extension), dir=temp_dir)
         ffmpeg_commands = produce_ffmpeg_commands(
@@ -321,16 +401,23 @@ def encode_media(
 
         encoding.temp_file = tf
         encoding.commands = str(ffmpeg_commands)
+        encode_settings = get_encode_settings(ffmpeg_commands)
+        encoding.preset = encode_settings["preset"]
+        encoding.crf = encode_settings["crf"]
+        encoding.pass_mode = encode_settings["pass_mode"]
 
-        encoding.save(update_fields=["temp_file", "commands", "task_id"])
+        encoding.save(
+            update_fields=["temp_file", "commands", "task_id", "preset", "crf", "pass_mode"]
+        )
 
         # binding these, so they are available on on_failure
         self.encoding = encoding
         self.media = media
+        encode_start = time.time()
         # can be one-pass or two-pass
         for ffmpeg_command in ffmpeg_commands:
             ffmpeg_command = [str(s) for s in ffmpeg_command]
-            encoding_backend = FFmpegBackend()
+            encoding_backend = FFmpegBackend(encoding_id=encoding.id)
             try:
                 encoding_command = encoding_backend.encode(ffmpeg_command)
                 duration, n_times = 0, 0
@@ -400,10 +487,7 @@ def encode_media(
                 except AttributeError:
                     output = ""
                 if isinstance(e, SoftTimeLimitExceeded):
-                    kill_ffmpeg_process(encoding.temp_file)
-                encoding.logs = output
-                encoding.status = "fail"
-                encoding.save(update_fields=["status", "logs"])
+                    processes.cancel_encoding_processes(encoding.id)
                 raise_exception = True
                 # if this is an ffmpeg's valid error
                 # no need for the task to be re-run
@@ -411,22 +495,44 @@ def encode_media(
                 for error_msg in ERRORS_LIST:
                     if error_msg.lower() in output.lower():
                         raise_exception = False
+                encoding.logs = output
+                # a failed chunk fails the whole encode and drops the chunks
+                # encoded already, see encoding_file_save. Chunks that are
+                # run again stay pending instead, and so do encodes retried
+                # once, to be claimed again
+                if raise_exception and (chunk or self.request.retries < 1):
+                    encoding.status = "pending"
+                else:
+                    encoding.status = "fail"
+                encoding.wall_time = time.time() - encode_start
+                encoding.save(update_fields=["status", "logs", "wall_time"])
                 if raise_exception:
                     raise self.retry(exc=e, countdown=5, max_retries=1)
 
         encoding.logs = output
         encoding.progress = 100
+        encoding.wall_time = time.time() - encode_start
 
         success = False
         encoding.status = "fail"
+        # the registry added the resource usage of ffmpeg, a full save
+        # (on media_file.save) must not overwrite it
+        encoding.refresh_from_db(fields=["cpu_time", "max_rss"])
         if os.path.exists(tf) and os.path.getsize(tf) != 0:
             ret = media_file_info(tf)
             if ret.get("is_video") or ret.get("is_audio"):
                 encoding.status = "success"
                 success = True
+                encoding.output_size = os.path.getsize(tf)
+                output_duration = ret.get("video_duration") or media.duration
+                if output_duration:
+                    encoding.bitrate = int(encoding.output_size * 8 / 1000 / output_duration)
+                    if encoding.wall_time:
+                        encoding.speed = output_duration / encoding.wall_time
 
                 with open(tf, "rb") as f:
-                    myfile = File(f)
+                    # renamed into place when scratch and media share a volume
+                    myfile = MovableFile(f)
                     output_name = "{0}.{1}".format(
                         get_file_name(original_media_path), profile.extension
                     )
@@ -437,7 +543,16 @@ def encode_media(
 
         try:
             encoding.save(
-                update_fields=["status", "logs", "progress", "total_run_time"]
+                update_fields=[
+                    "status",
+                    "logs",
+                    "progress",
+                    "total_run_time",
+                    "wall_time",
+                    "speed",
+                    "bitrate",
+                    "output_size",
+                ]
             )
         # this will raise a django.db.utils.DatabaseError error when task is revoked,
         # since we delete the encoding at that stage
@@ -541,9 +656,7 @@ def whisper_transcribe(friendly_token, translate=False, notify=True):
             logger.info(f"Running ffmpeg command: {' '.join(ffmpeg_cmd)}")
 
             try:
-                ret = subprocess.run(
-                    ffmpeg_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False
-                )
+                ret = processes.run(ffmpeg_cmd)
                 logger.info(f"ffmpeg return code: {ret.returncode}")
 
                 if ret.returncode != 0:
@@ -581,55 +694,69 @@ def whisper_transcribe(friendly_token, translate=False, notify=True):
                 "-m",
                 settings.WHISPER_CPP_MODEL,
                 *whisper_cmd_conf,
-                "-f",
-                wav_file,
             ]
 
             if translate:
                 whisper_cmd.append("--translate")
 
-            whisper_cmd.extend(["--output-vtt", "--output-file", output_name])
+            if whisper_segments.is_segmented(media):
+                # long media, in windows transcribed concurrently
+                try:
+                    cues = whisper_segments.transcribe(
+                        wav_file,
+                        media.duration,
+                        whisper_cmd,
+                        output_name_with_vtt_ending,
+                        tmpdirname,
+                    )
+                    logger.info(f"Segmented transcription created {cues} cues")
+                except Exception as e:
+                    logger.error(f"Exception running segmented whisper: {str(e)}")
+                    transcription_request.delete()
+                    return False
+            else:
+                whisper_cmd.extend(
+                    ["-f", wav_file, "--output-vtt", "--output-file", output_name]
+                )
 
-            cmd_str = " ".join(whisper_cmd)
-            logger.info(f"Running whisper command: {cmd_str}")
+                cmd_str = " ".join(whisper_cmd)
+                logger.info(f"Running whisper command: {cmd_str}")
 
-            try:
-                ret = subprocess.run(
-                    whisper_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE
-                )
-                logger.info(f"Whisper return code: {ret.returncode}")
+                try:
+                    ret = processes.run(whisper_cmd)
+                    logger.info(f"Whisper return code: {ret.returncode}")
 
-                stdout = ret.stdout.decode("utf-8")
-                stderr = ret.stderr.decode("utf-8")
+                    stdout = ret.stdout.decode("utf-8")
+                    stderr = ret.stderr.decode("utf-8")
 
-                if stdout:
-                    logger.info(f"Whisper stdout: {stdout}")
+                    if stdout:
+                        logger.info(f"Whisper stdout: {stdout}")
 
-                if stderr:
-                    logger.error(f"Whisper stderr: {stderr}")
+                    if stderr:
+                        logger.error(f"Whisper stderr: {stderr}")
 
-                if ret.returncode != 0:
-                    logger.error(
-                        f"Whisper command failed with return code {ret.returncode}"
-                    )
-                    transcription_request.delete()
-                    return False
+                    if ret.returncode != 0:
+                        logger.error(
+                            f"Whisper command failed with return code {ret.returncode}"
+                        )
+                        transcription_request.delete()
+                        return False
 
-                if not os.path.exists(output_name_with_vtt_ending):
-                    logger.error(
-                        f"Output VTT file not created at: {output_name_with_vtt_ending}"
+                    if not os.path.exists(output_name_with_vtt_ending):
+                        logger.error(
+                            f"Output VTT file not created at: {output_name_with_vtt_ending}"
+                        )
+                        transcription_request.delete()
+                        return False
+
+                    logger.info(
+                        f"VTT file created successfully: {os.path.getsize(output_name_with_vtt_ending)} bytes"
                     )
+                except Exception as e:
+                    logger.error(f"Exception running whisper: {str(e)}")
                     transcription_request.delete()
                     return False
 
-                logger.info(
-                    f"VTT file created successfully: {os.path.getsize(output_name_with_vtt_ending)} bytes"
-                )
-            except Exception as e:
-                logger.error(f"Exception running whisper: {str(e)}")
-                transcription_request.delete()
-                return False
-
             # Create the subtitle entry in the database
             subtitle = None
             try:
@@ -770,7 +897,7 @@ def create_hls(friendly_token):
             f"--output-dir={output_dir}",
             *files,
         ]
-        ret = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        ret = processes.run(cmd)
         if existing_output_dir:
             cmd = ["cp", "-rT", output_dir, existing_output_dir]
             ret = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -778,9 +905,10 @@ def create_hls(friendly_token):
             output_dir = existing_output_dir
         pp = os.path.join(output_dir, "master.m3u8")
         if os.path.exists(pp):
-            if media.hls_file != pp:
-                media.hls_file = pp
-                media.save(update_fields=["hls_file"])
+            # variants may have changed even if the master path has not
+            media.hls_file = pp
+            media.hls_manifest = media.read_hls_manifest()
+            media.save(update_fields=["hls_file", "hls_manifest"])
     return True
 
 
@@ -799,108 +927,76 @@ def media_init(friendly_token):
 
 @task(name="check_running_states", queue="short_tasks")
 def check_running_states():
-    encodings = Encoding.objects.filter(status="running")
-
-    logger.info("got {0} encodings that are in state running".format(encodings.count()))
-    changed = 0
-    for encoding in encodings:
-        now = datetime.now(encoding.update_date.tzinfo)
-        if (now - encoding.update_date).seconds > settings.RUNNING_STATE_STALE:
-            media = encoding.media
-            profile = encoding.profile
-            # task_id = encoding.task_id
-            # terminate task
-            # if task_id:
-            # revoke(task_id, terminate=True)
-            encoding.delete()
-            media.encode(profiles=[profile])
-            logger.info("X" * 200, profile, encoding.media, encoding)
-            # TODO: allign with new code + chunksize...
-            changed += 1
+    # encodings running with no update for RUNNING_STATE_STALE are encoded again
+    changed = requeue_stale_running()
     if changed:
         logger.info("changed from running to pending on {0} items".format(changed))
-    return True
+    return changed
 
 
 @task(name="check_media_states", queue="short_tasks")
 def check_media_states():
     # check encoding status of not success media
-    media = Media.objects.filter(
-        Q(encoding_status="running")
-        | Q(encoding_status="fail")
-        | Q(encoding_status="pending")
-    )
-
-    logger.info("got {0} media that are not in state success".format(media.count()))
-
-    changed = 0
-    for m in media:
-        m.set_encoding_status()
-        m.save(update_fields=["encoding_status"])
-        changed += 1
+    changed = fix_media_states()
     if changed:
         logger.info("changed encoding status to {0} media items".format(changed))
-    return True
+    return changed
 
 
 @task(name="check_pending_states", queue="short_tasks")
 def check_pending_states():
     # check encoding profiles that are on state pending and not on a queue
-    encodings = Encoding.objects.filter(status="pending")
-
-    if not encodings:
-        return True
-
-    changed = 0
-    tasks = list_tasks()
-    task_ids = tasks["task_ids"]
-    media_profile_pairs = tasks["media_profile_pairs"]
-    for encoding in encodings:
-        if encoding.task_id and encoding.task_id in task_ids:
-            # encoding is in one of the active/reserved/scheduled tasks list
-            continue
-        elif (
-            encoding.media.friendly_token,
-            encoding.profile.id,
-        ) in media_profile_pairs:
-            continue
-            # encoding is in one of the reserved/scheduled tasks list.
-            # has no task_id but will be run, so need to re-enter the queue
-        else:
-            media = encoding.media
-            profile = encoding.profile
-            encoding.delete()
-            media.encode(profiles=[profile], force=False)
-            changed += 1
+    changed = requeue_lost_pending()
     if changed:
         logger.info(
             "set to the encode queue {0} encodings that were on pending state".format(
                 changed
             )
         )
-    return True
+    return changed
 
 
 @task(name="check_missing_profiles", queue="short_tasks")
 def check_missing_profiles():
     # check if video files have missing profiles. If so, add them
-    media = Media.objects.filter(media_type="video")
-    profiles = list(EncodeProfile.objects.all())
-
-    changed = 0
-
-    for m in media:
-        existing_profiles = [p.profile for p in m.encodings.all()]
-        missing_profiles = [p for p in profiles if p not in existing_profiles]
-        if missing_profiles:
-            m.encode(profiles=missing_profiles, force=False)
-            # since we call with force=False
-            # encode_media won't delete existing profiles
-            # if they appear on the meanwhile (eg on a big queue)
-            changed += 1
+    changed = encode_missing_profiles()
     if changed:
-        logger.info("set to the encode queue {0} profiles".format(changed))
-    return True
+        logger.info("set to the encode queue missing profiles of {0} media".format(changed))
+    return changed
+
+
+@task(name="backfill_deferred_encodes", queue="short_tasks")
+def backfill_deferred_encodes():
+    # encode renditions deferred by the encoding policy, while the queue is short
+    if not settings.LAZY_ENCODING:
+        return False
+    changed = backfill_deferred_profiles()
+    if changed:
+        logger.info("set to the encode queue {0} deferred renditions".format(changed))
+    return changed
+
+
+@task(name="advance_reencode_campaigns", queue="short_tasks")
+def advance_reencode_campaigns():
+    # send the next media of running re-encode campaigns to encode
+    sent = advance_campaigns()
+    if sent:
+        logger.info("sent {0} media of re-encode campaigns to encode".format(sent))
+    return sent
+
+
+@task(name="dispatch_encodes", queue="short_tasks")
+def dispatch_encodes():
+    """
+    Releases encodes waiting in the queues of their uploaders to Celery,
+    see files/fair_share.py. Runs every 10 seconds
+    """
+    if not settings.FAIR_SHARE_ENCODING:
+        return False
+    released = fair_share.dispatch()
+    if released:
+        logger.info("released {0} encodes".format(released))
+    return released
 
 
 @task(name="clear_sessions", queue="short_tasks")
@@ -919,8 +1015,10 @@ def clear_sessions():
 
 @task(name="save_user_action", queue="short_tasks")
 def save_user_action(
-    user_or_session, friendly_token=None, action="watch", extra_info=None
+    user_or_session, friendly_token=None, action="watch", extra_info=None, checked=False
 ):
+    # checked: the action was already accepted by pre_save_action's checks,
+    # eg by buffer_user_action before its buffer failed
     if action not in VALID_USER_ACTIONS:
         return False
 
@@ -942,7 +1040,7 @@ def save_user_action(
     if (not user) and (not session_key):
         return False
 
-    if not pre_save_action(
+    if not checked and not pre_save_action(
         media=media,
         user=user,
         session_key=session_key,
@@ -967,9 +1065,13 @@ def save_user_action(
         remote_ip=remote_ip,
     )
     ma.save()
+    # time-bucketed watch and like counts, for popular and trending media
+    incr_media_counter(action, media.id)
 
     if action == "watch":
         Media.objects.filter(friendly_token=media.friendly_token).update(views=F('views') + 1)
+        viewer = get_viewer_id(user.id if user else None, session_key, remote_ip)
+        add_viewers([(media.id, viewer, None)])
     elif action == "report":
         Media.objects.filter(friendly_token=media.friendly_token).update(
             reported_times=F('reported_times') + 1
@@ -993,45 +1095,96 @@ def save_user_action(
     return True
 
 
+@task(name="drain_user_actions", queue="short_tasks")
+def drain_user_actions():
+    """
+    Stores the user actions buffered by buffer_user_action, in batches of
+    USER_ACTIONS_BATCH_SIZE. Runs every 10 seconds
+    """
+    if not settings.BUFFER_USER_ACTIONS:
+        return False
+    # a single drainer, so that batches are validated in order
+    if not cache.add("drain_user_actions_lock", True, timeout=5 * 60):
+        return False
+    accepted = received = 0
+    try:
+        # at most a few batches, the next run picks up the rest
+        for _ in range(10):
+            entries = pop_buffered_actions(settings.USER_ACTIONS_BATCH_SIZE)
+            if not entries:
+                break
+            received += len(entries)
+            try:
+                accepted += apply_user_actions(entries)
+            except Exception as e:
+                dead = requeue_failed_actions(entries)
+                logger.error(
+                    "failed to save {} buffered user actions, {} moved to the dead-letter "
+                    "list: {}".format(len(entries), dead, e)
+                )
+                # tried again by the next run
+                break
+    finally:
+        cache.delete("drain_user_actions_lock")
+    if received:
+        logger.info("saved {} of {} buffered user actions".format(accepted, received))
+    return True
+
+
+@task(name="rollup_media_actions", queue="long_tasks")
+def rollup_media_actions():
+    """
+    Counts the user actions of the days since the last run into daily
+    rollups, then deletes raw watch rows past retention. Runs daily
+    """
+    days = rollup_pending_days()
+    deleted = apply_retention()
+    logger.info(
+        "rolled up actions of {} days, deleted {} expired watches".format(len(days), deleted)
+    )
+    return True
+
+
+# number of media selected by each rule of get_list_of_popular_media
+POPULAR_MEDIA_PER_RULE = 25
+
+
 @task(name="get_list_of_popular_media", queue="long_tasks")
 def get_list_of_popular_media():
     # calculate and return the top 50 popular media, based on two rules
     # X = the top 25 videos that have the most views during the last week
     # Y = the most recent 25 videos that have been liked over the last 6 months
+    # Each rule is read from the action counters, or a single grouped count
+    # over MediaAction, so cost does not grow with the catalog
+
+    now = timezone.now()
+    x = get_top_media("watch", now - timedelta(days=7), POPULAR_MEDIA_PER_RULE)
+    y = get_top_media("like", now - timedelta(days=30 * 6), POPULAR_MEDIA_PER_RULE)
 
-    valid_media_x = {}
-    valid_media_y = {}
-    basic_query = Q(state="public", is_reviewed=True, encoding_status="success")
-    media_x = Media.objects.filter(basic_query).values("friendly_token")
-
-    period_x = datetime.now() - timedelta(days=7)
-    period_y = datetime.now() - timedelta(days=30 * 6)
-
-    for media in media_x:
-        ft = media["friendly_token"]
-        num = MediaAction.objects.filter(
-            action_date__gte=period_x, action="watch", media__friendly_token=ft
-        ).count()
-        if num:
-            valid_media_x[ft] = num
-        num = MediaAction.objects.filter(
-            action_date__gte=period_y, action="like", media__friendly_token=ft
-        ).count()
-        if num:
-            valid_media_y[ft] = num
-
-    x = sorted(valid_media_x.items(), key=lambda kv: kv[1], reverse=True)[:25]
-    y = sorted(valid_media_y.items(), key=lambda kv: kv[1], reverse=True)[:25]
-
-    media_ids = [a[0] for a in x]
-    media_ids.extend([a[0] for a in y])
-    media_ids = list(set(media_ids))
+    media_ids = list(
+        Media.objects.filter(id__in=set(x) | set(y)).values_list(
+            "friendly_token", flat=True
+        )
+    )
     cache.set("popular_media_ids", media_ids, 60 * 60 * 12)
     logger.info("saved popular media ids")
 
     return media_ids
 
 
+@task(name="update_related_media", queue="long_tasks")
+def update_related_media(media_ids=None):
+    """
+    Calculates the related media served by RELATED_MEDIA_STRATEGY
+    "calculated". Runs daily
+    """
+    if settings.RELATED_MEDIA_STRATEGY != "calculated":
+        return False
+    updated = calculate_related_media(media_ids)
+    logger.info("calculated related media of {} media".format(updated))
+    return True
+
+
 @task(name="update_listings_thumbnails", queue="long_tasks")
 def update_listings_thumbnails():
     """
@@ -1198,18 +1351,19 @@ def task_sent_handler(sender=None, headers=None, body=None, **kwargs):
     # For encode_media tasks that are revoked,
     # ffmpeg command won't be stopped, since
     # it got started by a subprocess.
-    # Need to stop that process
+    # Need to stop that process, found in the process registry
     # Also, removing the Encoding object,
     # since the task that would prepare it was killed
     # Maybe add a killed state for Encoding objects
     try:
         uid = kwargs["request"].task_id
         if uid:
+            task_registry.unregister_task(uid)
             encoding = Encoding.objects.get(task_id=uid)
+            encoding_id = encoding.id
             encoding.delete()
             logger.info("deleted the Encoding object")
-            if encoding.temp_file:
-                kill_ffmpeg_process(encoding.temp_file)
+            processes.cancel_encoding_processes(encoding_id)
 
     except:
         pass
@@ -1217,25 +1371,6 @@ def task_sent_handler(sender=None, headers=None, body=None, **kwargs):
     return True
 
 
-def kill_ffmpeg_process(filepath):
-    # this is not ideal, ffmpeg pid could be linked to the Encoding object
-    try:
-        # Use pgrep to find ffmpeg processes with the filepath
-        result = subprocess.run(
-            ["pgrep", "-f", f"ffmpeg.*{filepath}"],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-        )
-        pid = result.stdout.decode("utf-8").strip()
-        if pid:
-            # Kill the process
-            subprocess.run(["kill", "-9", pid], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            return result
-    except Exception as e:
-        logger.error(f"Error killing ffmpeg process: {e}")
-    return None
-
-
 @task(name="remove_media_file", base=Task, queue="long_tasks")
 def remove_media_file(media_file=None):
     rm_file(media_file)
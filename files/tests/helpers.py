@@ -0,0 +1,30 @@
+"""
+Helpers shared by the files tests.
+"""
+from unittest.mock import patch
+
+from files import counters
+from files.models import Media
+
+
+def create_public_media(user, title, add_date=None, **kwargs):
+    """Create a listable media item without triggering file processing."""
+    with patch.object(Media, "media_init", return_value=None):
+        media = Media.objects.create(title=title, user=user, **kwargs)
+    # new media get the portal workflow default state, make it listable
+    listable = {"state": "public", "is_reviewed": True, "encoding_status": "success"}
+    if add_date is not None:
+        # add_date is set on creation
+        listable["add_date"] = add_date
+    Media.objects.filter(pk=media.pk).update(**listable)
+    media.refresh_from_db()
+    return media
+
+
+def redis_available():
+    """Whether the django-redis cache the Redis backed modules share is up."""
+    client = counters.get_redis()
+    try:
+        return client is not None and client.ping()
+    except Exception:
+        return False
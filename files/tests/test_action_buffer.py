@@ -0,0 +1,235 @@
+"""
+Tests for the buffered ingestion of user actions.
+
+Tests cover:
+1. Batches apply the rules of pre_save_action in memory
+2. A batch costs a fixed number of queries whatever its size
+3. Views and likes are incremented with one UPDATE per media
+4. Without Redis, actions are saved through save_user_action, watches
+   already checked are not checked again
+5. drain_user_actions applies the buffer in batches
+6. A batch is stored in one transaction, and put back when it fails, to
+   the dead-letter list after MAX_ATTEMPTS tries
+"""
+import json
+from datetime import timedelta
+from unittest.mock import MagicMock, patch
+
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from actions.models import MediaAction
+from files import action_buffer
+from files.action_buffer import apply_user_actions, buffer_user_action
+from files.models import Media
+from files.tasks import drain_user_actions
+from files.tests.helpers import create_public_media
+
+User = get_user_model()
+
+
+@override_settings(MAX_ANONYMOUS_VIEWS_PER_5SEC=3)
+class ApplyUserActionsTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="buffer_user", email="buffer@example.com", password="pass"
+        )
+        self.media = create_public_media(self.user, "Buffered film", duration=60)
+        self.other = create_public_media(self.user, "Other film", duration=60)
+        self.now = timezone.now()
+
+    def entry(self, media, action="watch", seconds=0, user=None, session="s1", ip="10.0.0.1"):
+        return {
+            "user_id": user.id if user else None,
+            "session_key": None if user else session,
+            "remote_ip": ip,
+            "friendly_token": media.friendly_token,
+            "action": action,
+            "extra_info": None,
+            "ts": (self.now + timedelta(seconds=seconds)).timestamp(),
+        }
+
+    def test_first_actions_are_stored(self):
+        accepted = apply_user_actions(
+            [
+                self.entry(self.media),
+                self.entry(self.media, user=self.user),
+                self.entry(self.media, action="like", user=self.user),
+                self.entry(self.other, session="s2"),
+            ]
+        )
+        self.assertEqual(accepted, 4)
+        media = Media.objects.get(pk=self.media.pk)
+        self.assertEqual(
+            (media.views, media.likes), (self.media.views + 2, self.media.likes + 1)
+        )
+        action = MediaAction.objects.get(user=self.user, media=self.media, action="watch")
+        self.assertEqual(action.action_date.timestamp(), self.now.timestamp())
+
+    def test_duplicates_are_rejected(self):
+        MediaAction.objects.create(user=self.user, media=self.media, action="like")
+        accepted = apply_user_actions(
+            [
+                self.entry(self.media, action="like", user=self.user),
+                self.entry(self.media, action="dislike", session="s1"),
+                self.entry(self.media, action="dislike", session="s1", seconds=1),
+            ]
+        )
+        self.assertEqual(accepted, 1)
+        self.assertEqual(MediaAction.objects.filter(action="dislike").count(), 1)
+
+    def test_rewatch_after_duration_replaces_history(self):
+        accepted = apply_user_actions(
+            [
+                self.entry(self.media, user=self.user),
+                # within the duration of the media
+                self.entry(self.media, user=self.user, seconds=30),
+                self.entry(self.media, user=self.user, seconds=90),
+            ]
+        )
+        self.assertEqual(accepted, 2)
+        self.assertEqual(Media.objects.get(pk=self.media.pk).views, self.media.views + 2)
+        watches = MediaAction.objects.filter(user=self.user, action="watch")
+        self.assertEqual(watches.count(), 1)
+        self.assertEqual(
+            watches.get().action_date.timestamp(), (self.now + timedelta(seconds=90)).timestamp()
+        )
+
+    def test_anonymous_views_are_rate_limited_per_ip(self):
+        entries = [self.entry(self.media, session=f"s{i}") for i in range(5)]
+        entries.append(self.entry(self.media, session="other-ip", ip="10.0.0.2"))
+        entries.append(self.entry(self.media, session="later", seconds=10))
+        self.assertEqual(apply_user_actions(entries), 5)
+
+    def test_queries_do_not_grow_with_batch(self):
+        def count(entries):
+            with CaptureQueriesContext(connection) as context:
+                apply_user_actions(entries)
+            return len(context.captured_queries)
+
+        small = count([self.entry(self.media, session="a"), self.entry(self.other, session="b")])
+        large = count(
+            [self.entry(self.media, session=f"c{i}", ip=f"10.1.0.{i}") for i in range(20)]
+            + [self.entry(self.other, session=f"d{i}", ip=f"10.2.0.{i}") for i in range(20)]
+        )
+        self.assertEqual(small, large)
+
+    def test_unknown_media_and_users_are_dropped(self):
+        entry = self.entry(self.media)
+        entry["friendly_token"] = "missing"
+        deleted = User.objects.create_user(username="gone", email="gone@example.com")
+        gone = self.entry(self.media, user=deleted)
+        deleted.delete()
+        self.assertEqual(apply_user_actions([entry, gone]), 0)
+
+    def test_failed_batch_is_rolled_back(self):
+        entries = [self.entry(self.media, user=self.user), self.entry(self.other)]
+        media_filter = Media.objects.filter
+
+        def fail_other(*args, **kwargs):
+            if kwargs.get("id") == self.other.id:
+                raise RuntimeError("database gone")
+            return media_filter(*args, **kwargs)
+
+        with patch.object(Media.objects, "filter", side_effect=fail_other):
+            with self.assertRaises(RuntimeError):
+                apply_user_actions(entries)
+        self.assertFalse(MediaAction.objects.exists())
+        self.assertEqual(Media.objects.get(pk=self.media.pk).views, self.media.views)
+        # the entries are left as buffered
+        self.assertNotIn("date", entries[0])
+
+
+class BufferUserActionTest(TestCase):
+    def test_saved_directly_without_redis(self):
+        with patch.object(action_buffer, "get_redis", return_value=None), patch(
+            "files.tasks.save_user_action.delay"
+        ) as delay:
+            buffered = buffer_user_action({"user_session": "s1"}, "token", "watch")
+        self.assertFalse(buffered)
+        delay.assert_called_once_with(
+            {"user_session": "s1"},
+            friendly_token="token",
+            action="watch",
+            extra_info=None,
+            checked=False,
+        )
+
+    def test_checked_watches_are_not_checked_again(self):
+        client = MagicMock()
+        client.rpush.side_effect = ConnectionError("redis gone")
+        with patch.object(action_buffer, "get_redis", return_value=client), patch.object(
+            action_buffer, "check_watch", return_value=True
+        ), patch("files.tasks.save_user_action.delay") as delay:
+            buffered = buffer_user_action(
+                {"user_session": "s1"}, "token", "watch", media=MagicMock()
+            )
+        self.assertFalse(buffered)
+        # the check started the cooldown, checking again would reject the watch
+        self.assertTrue(delay.call_args.kwargs["checked"])
+
+    def test_reports_are_not_buffered(self):
+        client = object()
+        with patch.object(action_buffer, "get_redis", return_value=client), patch(
+            "files.tasks.save_user_action.delay"
+        ) as delay:
+            self.assertFalse(buffer_user_action({"user_id": 1}, "token", "report"))
+        delay.assert_called_once()
+
+    def test_failed_actions_are_requeued(self):
+        client = MagicMock()
+        pipe = client.pipeline.return_value
+        first = {"action": "like", "ts": 1.0}
+        second = {"action": "watch", "ts": 2.0, "attempts": action_buffer.MAX_ATTEMPTS - 1}
+        with patch.object(action_buffer, "get_redis", return_value=client):
+            self.assertEqual(action_buffer.requeue_failed_actions([first, second]), 1)
+        pipe.lpush.assert_called_once_with(
+            action_buffer.BUFFER_KEY, json.dumps(dict(first, attempts=1))
+        )
+        pipe.rpush.assert_called_once_with(
+            action_buffer.DEAD_LETTER_KEY,
+            json.dumps(dict(second, attempts=action_buffer.MAX_ATTEMPTS)),
+        )
+
+
+class DrainUserActionsTest(TestCase):
+    def test_drains_batches_until_empty(self):
+        user = User.objects.create_user(username="drain_user", email="drain@example.com")
+        media = create_public_media(user, "Drained film")
+        entry = {
+            "user_id": user.id,
+            "session_key": None,
+            "remote_ip": "10.0.0.1",
+            "friendly_token": media.friendly_token,
+            "action": "like",
+            "ts": timezone.now().timestamp(),
+        }
+        with patch(
+            "files.tasks.pop_buffered_actions", side_effect=[[entry], []]
+        ) as pop:
+            self.assertTrue(drain_user_actions())
+        self.assertEqual(pop.call_count, 2)
+        self.assertTrue(MediaAction.objects.filter(user=user, action="like").exists())
+
+    def test_failed_batch_is_put_back(self):
+        entry = {"friendly_token": "token", "action": "like", "ts": 1.0}
+        with patch(
+            "files.tasks.pop_buffered_actions", side_effect=[[entry], [entry]]
+        ) as pop, patch(
+            "files.tasks.apply_user_actions", side_effect=RuntimeError("database gone")
+        ), patch(
+            "files.tasks.requeue_failed_actions", return_value=0
+        ) as requeue:
+            self.assertTrue(drain_user_actions())
+        # the next run tries again
+        self.assertEqual(pop.call_count, 1)
+        requeue.assert_called_once_with([entry])
+
+    @override_settings(BUFFER_USER_ACTIONS=False)
+    def test_disabled(self):
+        with patch("files.tasks.pop_buffered_actions") as pop:
+            self.assertFalse(drain_user_actions())
+        pop.assert_not_called()
@@ -0,0 +1,201 @@
+"""
+Tests for the daily rollups and retention of user actions.
+
+Tests cover:
+1. A day's actions are counted per media and action, with unique viewers
+2. Rolling up a day again replaces its rollups
+3. Retention deletes old raw watches only, and their days stay rolled up
+4. Popularity is read from rollups covering every day, with today's raw
+   actions
+5. The backfill command and the user stats endpoint
+6. Stats windows of n days end today and start n - 1 days ago, for the user
+   and the media stats
+"""
+from datetime import timedelta
+from io import StringIO
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from actions.models import MediaAction, MediaActionDaily
+from files import action_rollups
+from files.methods import get_top_media
+from files.tasks import rollup_media_actions
+from files.tests.helpers import create_public_media
+
+User = get_user_model()
+
+
+@override_settings(WATCH_ACTIONS_RETENTION_DAYS=None, WATCH_HISTORY_RETENTION_DAYS=None)
+class ActionRollupsTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="rollup_user", email="rollup@example.com", password="pass"
+        )
+        self.viewer = User.objects.create_user(
+            username="rollup_viewer", email="viewer@example.com", password="pass"
+        )
+        self.media = create_public_media(self.user, "Rolled film")
+        self.other = create_public_media(self.user, "Other film")
+        self.today = timezone.localdate()
+        self.days_ago = lambda days: self.today - timedelta(days=days)
+
+    def action(self, media, action, days, user=None, session_key=None):
+        created = MediaAction.objects.create(
+            media=media, action=action, user=user, session_key=session_key
+        )
+        start, _ = action_rollups.day_bounds(self.days_ago(days))
+        MediaAction.objects.filter(pk=created.pk).update(
+            action_date=start + timedelta(hours=12)
+        )
+        return created
+
+    def test_rollup_day(self):
+        self.action(self.media, "watch", 1, session_key="s1")
+        self.action(self.media, "watch", 1, session_key="s1")
+        self.action(self.media, "watch", 1, user=self.viewer)
+        self.action(self.media, "like", 1, user=self.viewer)
+        self.action(self.other, "watch", 2, session_key="s2")
+
+        self.assertEqual(action_rollups.rollup_day(self.days_ago(1)), 2)
+        watch = MediaActionDaily.objects.get(media=self.media, action="watch")
+        self.assertEqual((watch.count, watch.unique_viewers), (3, 2))
+        self.assertEqual(watch.day, self.days_ago(1))
+        self.assertFalse(MediaActionDaily.objects.filter(media=self.other).exists())
+
+    def test_rollup_again_replaces(self):
+        like = self.action(self.media, "like", 1, user=self.viewer)
+        self.action(self.media, "watch", 1, user=self.viewer)
+        action_rollups.rollup_day(self.days_ago(1))
+        like.delete()
+        action_rollups.rollup_day(self.days_ago(1))
+        self.assertEqual(
+            list(MediaActionDaily.objects.values_list("action", flat=True)), ["watch"]
+        )
+
+    def test_pending_days_are_rolled_up(self):
+        self.action(self.media, "watch", 3, session_key="s1")
+        self.action(self.media, "watch", 1, session_key="s1")
+        self.action(self.media, "watch", 0, session_key="s1")
+        days = action_rollups.rollup_pending_days()
+        self.assertEqual(days, [self.days_ago(3), self.days_ago(2), self.days_ago(1)])
+        # today is not complete yet
+        self.assertEqual(MediaActionDaily.objects.count(), 2)
+        # rolled up days are not rebuilt
+        self.assertEqual(action_rollups.rollup_pending_days(), [])
+
+    def test_pending_days_past_retention(self):
+        self.action(self.media, "watch", 40, session_key="s1")
+        self.action(self.media, "watch", 10, user=self.viewer)
+        with override_settings(
+            WATCH_ACTIONS_RETENTION_DAYS=30, WATCH_HISTORY_RETENTION_DAYS=365
+        ):
+            days = action_rollups.rollup_pending_days()
+        # anonymous watches of days before the shorter retention may be gone
+        self.assertEqual(days[0], self.days_ago(10))
+        self.assertFalse(MediaActionDaily.objects.filter(day=self.days_ago(40)).exists())
+
+    def test_retention(self):
+        old_anonymous = self.action(self.media, "watch", 40, session_key="s1")
+        old_history = self.action(self.media, "watch", 40, user=self.viewer)
+        old_like = self.action(self.media, "like", 40, user=self.viewer)
+        recent = self.action(self.media, "watch", 10, session_key="s2")
+        action_rollups.rollup_day(self.days_ago(40))
+
+        with override_settings(WATCH_ACTIONS_RETENTION_DAYS=30):
+            self.assertEqual(action_rollups.apply_retention(), 1)
+            # its raw rows are gone, the rollup is kept
+            self.assertEqual(action_rollups.rollup_day(self.days_ago(40)), -1)
+        remaining = set(MediaAction.objects.values_list("id", flat=True))
+        self.assertEqual(remaining, {old_history.id, old_like.id, recent.id})
+        self.assertNotIn(old_anonymous.id, remaining)
+        self.assertEqual(
+            MediaActionDaily.objects.get(action="watch", day=self.days_ago(40)).count, 2
+        )
+
+        with override_settings(WATCH_HISTORY_RETENTION_DAYS=30):
+            self.assertEqual(action_rollups.apply_retention(), 1)
+        self.assertFalse(MediaAction.objects.filter(pk=old_history.pk).exists())
+
+    def test_top_media_from_rollups(self):
+        for i in range(3):
+            self.action(self.other, "watch", 2, session_key=f"s{i}")
+        self.action(self.media, "watch", 2, session_key="s9")
+        since, _ = action_rollups.day_bounds(self.days_ago(2))
+        self.assertIsNone(action_rollups.get_top_media("watch", since, 10))
+
+        call_command("backfill_action_rollups", stdout=StringIO())
+        # raw rows don't matter anymore for rolled up days
+        MediaAction.objects.all().delete()
+        self.assertEqual(
+            action_rollups.get_top_media("watch", since, 10), [self.other.id, self.media.id]
+        )
+        self.assertEqual(get_top_media("watch", since, 10), [self.other.id, self.media.id])
+
+        # today is counted from the raw actions
+        for i in range(3):
+            self.action(self.media, "watch", 0, session_key=f"t{i}")
+        self.assertEqual(
+            action_rollups.get_top_media("watch", since, 1), [self.media.id]
+        )
+
+    def test_top_media_needs_every_day(self):
+        self.action(self.other, "watch", 3, session_key="s1")
+        self.action(self.media, "watch", 1, session_key="s2")
+        action_rollups.rollup_day(self.days_ago(3))
+        since, _ = action_rollups.day_bounds(self.days_ago(3))
+        # yesterday has actions and no rollups
+        self.assertIsNone(action_rollups.get_top_media("watch", since, 10))
+        action_rollups.rollup_day(self.days_ago(1))
+        self.assertEqual(
+            action_rollups.get_top_media("watch", since, 10), [self.media.id, self.other.id]
+        )
+
+    def test_backfill_missing_days(self):
+        self.action(self.media, "watch", 5, session_key="s1")
+        self.action(self.media, "watch", 2, session_key="s1")
+        action_rollups.rollup_day(self.days_ago(2))
+        out = StringIO()
+        call_command("backfill_action_rollups", missing=True, stdout=out)
+        self.assertIn("Rolled up 4 days into 1 rows", out.getvalue())
+        self.assertEqual(MediaActionDaily.objects.count(), 2)
+
+    def test_task(self):
+        self.action(self.media, "watch", 1, session_key="s1")
+        self.assertTrue(rollup_media_actions())
+        self.assertEqual(MediaActionDaily.objects.count(), 1)
+
+    def test_stats_window_boundary(self):
+        self.assertEqual(action_rollups.stats_window_start(1), self.today)
+        self.assertEqual(action_rollups.stats_window_start(7), self.days_ago(6))
+
+        self.action(self.media, "watch", 6, session_key="s1")
+        self.action(self.media, "watch", 7, session_key="s2")
+        action_rollups.rollup_day(self.days_ago(6))
+        action_rollups.rollup_day(self.days_ago(7))
+        self.client.force_login(self.user)
+        data = self.client.get(f"/api/v1/users/{self.user.username}/stats", {"days": 7}).json()
+        self.assertEqual(data["since"], str(self.days_ago(6)))
+        self.assertEqual(data["totals"], {"watch": 1})
+        data = self.client.get(f"/api/v1/media/{self.media.friendly_token}/stats", {"days": 7}).json()
+        self.assertEqual(data["since"], str(self.days_ago(6)))
+
+    def test_user_stats_endpoint(self):
+        self.action(self.media, "watch", 1, session_key="s1")
+        self.action(self.other, "watch", 1, session_key="s1")
+        self.action(self.media, "like", 1, user=self.viewer)
+        action_rollups.rollup_day(self.days_ago(1))
+        url = f"/api/v1/users/{self.user.username}/stats"
+
+        self.client.force_login(self.viewer)
+        self.assertEqual(self.client.get(url).status_code, 403)
+
+        self.client.force_login(self.user)
+        data = self.client.get(url, {"days": 7}).json()
+        self.assertEqual(data["totals"], {"like": 1, "watch": 2})
+        self.assertEqual(data["daily"][0]["day"], str(self.days_ago(1)))
+        self.assertEqual(
+            data["daily"][0]["actions"]["watch"], {"count": 2, "unique_viewers": 2}
+        )
@@ -0,0 +1,168 @@
+"""
+Tests for deferring high resolution encodes.
+
+Tests cover:
+1. Uploads get high resolutions unless the backlog is long, or the media
+   lacks views with LAZY_ENCODING_VIEWS; explicit profiles are encoded
+2. check_missing_profiles leaves deferred renditions alone
+3. Deferred renditions are backfilled in idle hours, most viewed first,
+   up to the backlog limit, and popular media any time
+"""
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+
+from files import encode_policy, encoding_checks
+from files.models import EncodeProfile, Encoding, Media
+
+User = get_user_model()
+
+
+@override_settings(
+    LAZY_ENCODING=True,
+    LAZY_ENCODING_RESOLUTION=1080,
+    LAZY_ENCODING_BACKLOG=2,
+    LAZY_ENCODING_VIEWS=0,
+    LAZY_ENCODING_IDLE_HOURS=(1, 7),
+    MINIMUM_RESOLUTIONS_TO_ENCODE=[240],
+    CHUNKIZE_VIDEO_DURATION=300,
+)
+class EncodePolicyTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="policy_user", email="policy@example.com", password="pass"
+        )
+        self.h240 = EncodeProfile.objects.create(
+            name="h264-240", extension="mp4", resolution=240, codec="h264"
+        )
+        self.h720 = EncodeProfile.objects.create(
+            name="h264-720", extension="mp4", resolution=720, codec="h264"
+        )
+        self.h1080 = EncodeProfile.objects.create(
+            name="h264-1080", extension="mp4", resolution=1080, codec="h264"
+        )
+        self.h2160 = EncodeProfile.objects.create(
+            name="h264-2160", extension="mp4", resolution=2160, codec="h264"
+        )
+        patcher = patch("files.fair_share.publish_encode")
+        self.publish_encode = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.video = self.create_video("Video", views=10)
+
+    def create_video(self, title, views=1):
+        with patch.object(Media, "media_init", return_value=None):
+            media = Media.objects.create(title=title, user=self.user)
+        Media.objects.filter(id=media.id).update(
+            media_type="video", video_height=2160, duration=60, views=views
+        )
+        media.refresh_from_db()
+        return media
+
+    def add_backlog(self, count):
+        other = self.create_video("Queued")
+        Encoding.objects.bulk_create(
+            [Encoding(media=other, profile=self.h240, status="pending") for _ in range(count)]
+        )
+
+    def encoded(self):
+        """(media id, profile id) of the published encodes"""
+        return sorted(
+            (Encoding.objects.get(id=c.args[1][2]).media_id, c.args[1][1])
+            for c in self.publish_encode.call_args_list
+        )
+
+    def test_upload(self):
+        self.video.encode()
+        self.assertEqual(
+            self.encoded(),
+            [(self.video.id, p.id) for p in (self.h240, self.h720, self.h1080, self.h2160)],
+        )
+
+    def test_upload_with_backlog(self):
+        self.add_backlog(3)
+        self.video.encode()
+        self.assertEqual(
+            self.encoded(), [(self.video.id, self.h240.id), (self.video.id, self.h720.id)]
+        )
+
+        # re-encoding in given profiles is not deferred
+        self.publish_encode.reset_mock()
+        self.video.encode(profiles=[self.h2160])
+        self.assertEqual(self.encoded(), [(self.video.id, self.h2160.id)])
+
+    @override_settings(LAZY_ENCODING_VIEWS=10)
+    def test_upload_by_views(self):
+        unpopular = self.create_video("Unpopular", views=9)
+        self.assertEqual(
+            encode_policy.split_profiles(unpopular, [self.h720, self.h1080]),
+            ([self.h720], [self.h1080]),
+        )
+        self.assertEqual(
+            encode_policy.split_profiles(self.video, [self.h720, self.h1080]),
+            ([self.h720, self.h1080], []),
+        )
+        # a long backlog defers them too
+        self.add_backlog(3)
+        self.assertEqual(
+            encode_policy.split_profiles(self.video, [self.h720, self.h1080]),
+            ([self.h720], [self.h1080]),
+        )
+
+    def test_missing_profiles(self):
+        self.add_backlog(3)
+        Encoding.objects.bulk_create(
+            [Encoding(media=self.video, profile=self.h240, status="success")]
+        )
+        queued = Encoding.objects.filter(status="pending").first().media_id
+        with patch.object(Media, "encode", autospec=True) as encode:
+            encoding_checks.encode_missing_profiles()
+        calls = {
+            (c.args[0].id, tuple(p.id for p in c.kwargs["profiles"])) for c in encode.call_args_list
+        }
+        # the video of the backlog lacks all but 240p too
+        self.assertEqual(calls, {(self.video.id, (self.h720.id,)), (queued, (self.h720.id,))})
+
+    def backfilled(self):
+        with patch.object(Media, "encode", autospec=True) as encode:
+            count = encoding_checks.backfill_deferred_profiles()
+        calls = sorted(
+            (c.args[0].id, sorted(p.id for p in c.kwargs["profiles"]))
+            for c in encode.call_args_list
+        )
+        return count, calls
+
+    def test_backfill(self):
+        popular = self.create_video("Popular", views=100)
+        for media in (self.video, popular):
+            Encoding.objects.bulk_create(
+                [
+                    Encoding(media=media, profile=profile, status="success")
+                    for profile in (self.h240, self.h720)
+                ]
+            )
+
+        with patch.object(encode_policy, "is_idle_hour", return_value=False):
+            self.assertEqual(self.backfilled(), (0, []))
+            with override_settings(LAZY_ENCODING_VIEWS=50):
+                self.assertEqual(
+                    self.backfilled(), (2, [(popular.id, [self.h1080.id, self.h2160.id])])
+                )
+
+        with patch.object(encode_policy, "is_idle_hour", return_value=True):
+            # two places in the backlog, for the most viewed
+            self.assertEqual(
+                self.backfilled(), (2, [(popular.id, [self.h1080.id, self.h2160.id])])
+            )
+            self.add_backlog(1)
+            self.assertEqual(self.backfilled(), (1, [(popular.id, [self.h1080.id])]))
+            self.add_backlog(1)
+            self.assertEqual(self.backfilled(), (0, []))
+
+    def test_idle_hours(self):
+        with override_settings(LAZY_ENCODING_IDLE_HOURS=(22, 6)), patch(
+            "files.encode_policy.timezone.localtime"
+        ) as localtime:
+            for hour, idle in ((23, True), (3, True), (6, False), (12, False)):
+                localtime.return_value.hour = hour
+                self.assertEqual(encode_policy.is_idle_hour(), idle)
@@ -0,0 +1,153 @@
+"""
+Tests for encode telemetry and the throughput report.
+
+Tests cover:
+1. Preset, CRF and pass mode are read from the ffmpeg commands
+2. Encode tasks are stamped when published, and their queue wait computed
+3. Throughput is aggregated per group over a window
+4. The admin endpoint and the encode_report command
+"""
+import json
+from datetime import timedelta
+from io import StringIO
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase
+from django.utils import timezone
+
+from files import encode_telemetry
+from files.helpers import produce_ffmpeg_commands
+from files.models import EncodeProfile, Encoding, Media
+
+User = get_user_model()
+
+
+def media_info(duration):
+    return json.dumps(
+        {
+            "video_frame_rate": 25,
+            "video_height": 1080,
+            "video_duration": duration,
+            "has_audio": True,
+        }
+    )
+
+
+class EncodeSettingsTest(TestCase):
+    def settings_of(self, codec, resolution, duration):
+        commands = produce_ffmpeg_commands(
+            "in.mp4", media_info(duration), resolution, codec, "out.mp4", "pass"
+        )
+        return encode_telemetry.get_encode_settings(commands)
+
+    def test_crf(self):
+        self.assertEqual(
+            self.settings_of("h264", 240, 60),
+            {"preset": "medium", "crf": 23, "pass_mode": "crf"},
+        )
+
+    def test_twopass(self):
+        ret = self.settings_of("h264", 720, 1)
+        self.assertEqual(ret["pass_mode"], "twopass")
+        self.assertIsNone(ret["crf"])
+        self.assertEqual(ret["preset"], "faster")
+
+    def test_vp9_speed(self):
+        self.assertEqual(self.settings_of("vp9", 480, 60)["preset"], "speed=2")
+
+
+class QueueWaitTest(TestCase):
+    def test_published_stamp(self):
+        headers = {"id": "t1"}
+        with patch.object(encode_telemetry.time, "time", return_value=1000.0):
+            encode_telemetry.stamp_published(sender="encode_media", headers=headers)
+        self.assertEqual(headers[encode_telemetry.PUBLISHED_HEADER], 1000.0)
+
+        other = {"id": "t2"}
+        encode_telemetry.stamp_published(sender="create_hls", headers=other)
+        self.assertNotIn(encode_telemetry.PUBLISHED_HEADER, other)
+
+        request = SimpleNamespace(**headers)
+        self.assertEqual(encode_telemetry.get_queue_wait(request, 1012.5), 12.5)
+        self.assertIsNone(encode_telemetry.get_queue_wait(SimpleNamespace(), 1012.5))
+
+
+class ThroughputTest(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(
+            username="report_admin", email="report@example.com", password="pass"
+        )
+        with patch.object(Media, "media_init", return_value=None):
+            media = Media.objects.create(title="Encoded film", user=self.admin)
+        self.h240 = EncodeProfile.objects.create(
+            name="h264-240", extension="mp4", resolution=240, codec="h264"
+        )
+        self.h720 = EncodeProfile.objects.create(
+            name="h264-720", extension="mp4", resolution=720, codec="h264"
+        )
+
+        def encoding(profile, worker, status="success", **kwargs):
+            return Encoding(media=media, profile=profile, worker=worker, status=status, **kwargs)
+
+        # without the post_save actions of encodings
+        encodings = Encoding.objects.bulk_create(
+            [
+                encoding(self.h720, "w1", wall_time=3600, cpu_time=14400, speed=2,
+                         output_size=1000, bitrate=2000, queue_wait=10),
+                encoding(self.h720, "w2", wall_time=3600, cpu_time=7200, speed=1,
+                         output_size=500, bitrate=1000, queue_wait=30),
+                encoding(self.h720, "w2", status="fail", wall_time=1800, cpu_time=1800),
+                encoding(self.h240, "w1", wall_time=360, cpu_time=360, speed=10,
+                         output_size=100, bitrate=300),
+                # not run yet, or too old
+                encoding(self.h240, "w1", status="pending"),
+                encoding(self.h240, "w1", wall_time=100, cpu_time=100, speed=1),
+            ]
+        )
+        Encoding.objects.filter(id=encodings[-1].id).update(
+            add_date=timezone.now() - timedelta(days=10)
+        )
+        self.since = timezone.now() - timedelta(days=7)
+
+    def test_by_profile(self):
+        h720, h240 = encode_telemetry.get_throughput(self.since)
+        self.assertEqual(h720["profile"], "h264-720")
+        self.assertEqual((h720["encodes"], h720["failed"]), (3, 1))
+        self.assertEqual(h720["wall_hours"], 2.5)
+        self.assertEqual(h720["cpu_hours"], 6.5)
+        self.assertEqual(h720["encoded_hours"], 3)
+        self.assertEqual(h720["speed"], 1.2)
+        self.assertEqual(h720["cores"], 2.6)
+        self.assertEqual(h720["output_bytes"], 1500)
+        # of successful encodes only
+        self.assertEqual(h720["avg_bitrate"], 1500)
+        self.assertEqual(h720["avg_queue_wait"], 20)
+        self.assertEqual((h240["profile"], h240["encodes"], h240["speed"]), ("h264-240", 1, 10))
+
+    def test_by_worker_and_resolution(self):
+        rows = encode_telemetry.get_throughput(self.since, group_by=["worker", "resolution"])
+        self.assertEqual(
+            [(r["worker"], r["resolution"], r["encodes"]) for r in rows],
+            [("w2", 720, 2), ("w1", 720, 1), ("w1", 240, 1)],
+        )
+
+    def test_api(self):
+        url = "/api/v1/encode_stats"
+        self.assertIn(self.client.get(url).status_code, (401, 403))
+        self.client.force_login(self.admin)
+        ret = self.client.get(url, {"by": "codec"}).json()
+        self.assertEqual(ret["group_by"], ["codec"])
+        self.assertEqual([(r["codec"], r["encodes"]) for r in ret["results"]], [("h264", 4)])
+        self.assertEqual(self.client.get(url, {"by": "media"}).status_code, 400)
+        self.assertEqual(self.client.get(url, {"days": "week"}).status_code, 400)
+
+    def test_command(self):
+        out = StringIO()
+        call_command("encode_report", "--by", "worker", stdout=out)
+        lines = out.getvalue().splitlines()
+        self.assertTrue(lines[0].startswith("worker"))
+        self.assertTrue(lines[1].startswith("w2"))
+        self.assertIn("4 encodes since", lines[-1])
@@ -0,0 +1,228 @@
+"""
+Tests for the set-based encoding health checks.
+
+Tests cover:
+1. Media encoding status is fixed from the mp4 encodings, in a fixed
+   number of queries
+2. Stale running encodings are encoded again, fresh ones are left alone
+3. Pending encodings are encoded again unless a worker has them, or they
+   wait in the fair-share queues
+4. Videos are encoded in the profiles they lack, inactive ones included,
+   within their height
+5. Chunked encodes are resumed with the chunks they lack, or encoded
+   again when their segments are gone
+"""
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from files import encoding_checks
+from files.models import EncodeProfile, Encoding, Media
+from files.tasks import check_media_states
+
+User = get_user_model()
+
+
+def create_video(user, title, **kwargs):
+    """Create a video without triggering file processing."""
+    with patch.object(Media, "media_init", return_value=None):
+        media = Media.objects.create(title=title, user=user, **kwargs)
+    Media.objects.filter(pk=media.pk).update(media_type="video", **kwargs)
+    media.refresh_from_db()
+    return media
+
+
+@override_settings(RUNNING_STATE_STALE=3600, MINIMUM_RESOLUTIONS_TO_ENCODE=[240])
+class EncodingChecksTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="checks_user", email="checks@example.com", password="pass"
+        )
+        self.h240 = EncodeProfile.objects.create(
+            name="h264-240", extension="mp4", resolution=240, codec="h264"
+        )
+        self.h720 = EncodeProfile.objects.create(
+            name="h264-720", extension="mp4", resolution=720, codec="h264"
+        )
+        self.webm = EncodeProfile.objects.create(
+            name="vp9-720", extension="webm", resolution=720, codec="vp9"
+        )
+        self.old = EncodeProfile.objects.create(
+            name="old", extension="mp4", resolution=480, codec="h264", active=False
+        )
+        self.video = create_video(self.user, "Video", video_height=1080)
+        self.other = create_video(self.user, "Other", video_height=1080)
+        patcher = patch.object(Media, "encode", autospec=True, return_value=True)
+        self.encode = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def encoding(self, media, profile, status, **kwargs):
+        # without the post_save actions of finished encodings
+        return Encoding.objects.bulk_create(
+            [Encoding(media=media, profile=profile, status=status, **kwargs)]
+        )[0]
+
+    def encoded(self):
+        """(media id, profile ids, force) of the Media.encode calls"""
+        return sorted(
+            (c.args[0].id, sorted(p.id for p in c.kwargs["profiles"]), c.kwargs["force"])
+            for c in self.encode.call_args_list
+        )
+
+    def test_media_states(self):
+        Media.objects.filter(id__in=[self.video.id, self.other.id]).update(
+            encoding_status="pending"
+        )
+        # webm only doesn't count, chunks neither
+        self.encoding(self.video, self.webm, "success")
+        self.encoding(self.video, self.h720, "running")
+        self.encoding(self.video, self.h240, "fail")
+        self.encoding(self.other, self.h720, "success", chunk=True)
+        third = create_video(self.user, "Third")
+        Media.objects.filter(id=third.id).update(encoding_status="running")
+        self.encoding(third, self.h240, "success")
+        fourth = create_video(self.user, "Fourth")
+        Media.objects.filter(id=fourth.id).update(encoding_status="running")
+        self.encoding(fourth, self.h240, "fail")
+
+        self.assertEqual(check_media_states(), 3)
+        statuses = dict(Media.objects.values_list("id", "encoding_status"))
+        self.assertEqual(statuses[self.video.id], "running")
+        self.assertEqual(statuses[self.other.id], "pending")
+        self.assertEqual(statuses[third.id], "success")
+        self.assertEqual(statuses[fourth.id], "fail")
+        self.assertEqual(check_media_states(), 0)
+
+    def test_media_states_queries(self):
+        for i in range(10):
+            media = create_video(self.user, f"Failed {i}")
+            Media.objects.filter(id=media.id).update(encoding_status="running")
+            self.encoding(media, self.h240, "fail")
+        # one query per batch and status, plus the empty last batch
+        with self.assertNumQueries(5):
+            self.assertEqual(encoding_checks.fix_media_states(batch_size=6), 10)
+
+    def test_stale_running(self):
+        stale = self.encoding(self.video, self.h720, "running")
+        stale_too = self.encoding(self.video, self.h240, "running")
+        fresh = self.encoding(self.other, self.h720, "running")
+        Encoding.objects.filter(id__in=[stale.id, stale_too.id]).update(
+            update_date=timezone.now() - timedelta(days=1, minutes=1)
+        )
+        self.assertEqual(encoding_checks.requeue_stale_running(batch_size=1), 2)
+        self.assertEqual(
+            self.encoded(),
+            sorted(
+                [(self.video.id, [self.h720.id], True), (self.video.id, [self.h240.id], True)]
+            ),
+        )
+        self.assertEqual(list(Encoding.objects.values_list("id", flat=True)), [fresh.id])
+
+    def test_lost_pending(self):
+        queued = self.encoding(self.video, self.h720, "pending", task_id="t1")
+        reserved = self.encoding(self.video, self.h240, "pending")
+        lost = self.encoding(self.other, self.h720, "pending", task_id="t2")
+        fair_share_queued = self.encoding(self.other, self.h240, "pending")
+        tasks = {
+            "task_ids": ["t1"],
+            "media_profile_pairs": [(self.video.friendly_token, self.h240.id)],
+        }
+        with patch("files.methods.list_tasks", return_value=tasks), patch(
+            "files.fair_share.get_queued_encodings", return_value={fair_share_queued.id}
+        ):
+            self.assertEqual(encoding_checks.requeue_lost_pending(), 1)
+        self.assertEqual(self.encoded(), [(self.other.id, [self.h720.id], False)])
+        self.assertEqual(
+            set(Encoding.objects.values_list("id", flat=True)),
+            {queued.id, reserved.id, fair_share_queued.id},
+        )
+        self.assertFalse(Encoding.objects.filter(id=lost.id).exists())
+
+    def test_missing_profiles(self):
+        for profile in (self.h240, self.h720, self.webm, self.old):
+            self.encoding(self.video, profile, "success")
+        self.encoding(self.other, self.h720, "success")
+        small = create_video(self.user, "Small", video_height=360)
+        self.assertEqual(encoding_checks.encode_missing_profiles(batch_size=1), 2)
+        self.assertEqual(
+            self.encoded(),
+            [
+                # inactive profiles too, as the check always did
+                (self.other.id, sorted([self.h240.id, self.webm.id, self.old.id]), False),
+                # profiles higher than the video are not encoded
+                (small.id, [self.h240.id], False),
+            ],
+        )
+
+    def chunked_encode(self, statuses):
+        """Chunk encodings of self.video in h720, on segments on disk"""
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir, ignore_errors=True)
+        segments = {}
+        for i in range(len(statuses)):
+            segment = os.path.join(temp_dir, "%02d_source.mkv" % i)
+            with open(segment, "wb") as f:
+                f.write(b"segment")
+            segments[segment] = "md5-%d" % i
+        chunks_info = json.dumps(segments)
+        encodings = []
+        for segment, status in zip(segments, statuses):
+            if status is None:
+                continue
+            media_file = "encoded/%s.mp4" % os.path.basename(segment) if status == "success" else ""
+            encodings.append(
+                self.encoding(
+                    self.video,
+                    self.h720,
+                    status,
+                    chunk=True,
+                    chunk_file_path=segment,
+                    chunks_info=chunks_info,
+                    media_file=media_file,
+                )
+            )
+        return list(segments), encodings
+
+    @patch("files.tasks.encode_media.apply_async")
+    def test_resume_chunked_encode(self, apply_async):
+        # the segment without encoding was lost with its worker too
+        segments, (done, queued, stale, failed) = self.chunked_encode(
+            ["success", "pending", "running", None, "fail"]
+        )
+        Encoding.objects.filter(id=stale.id).update(
+            update_date=timezone.now() - timedelta(days=1, minutes=1)
+        )
+        self.assertEqual(encoding_checks.requeue_stale_running(), 1)
+        self.assertEqual(self.encoded(), [])
+
+        chunks = Encoding.objects.filter(chunk=True)
+        self.assertEqual(chunks.count(), 5)
+        self.assertEqual(chunks.get(id=stale.id).status, "pending")
+        self.assertEqual(chunks.get(chunk_file_path=segments[3]).status, "pending")
+        self.assertEqual(chunks.get(id=done.id).status, "success")
+        self.assertEqual(chunks.get(id=queued.id).status, "pending")
+        self.assertEqual(chunks.get(id=failed.id).status, "pending")
+        self.assertEqual(
+            sorted(c.kwargs["kwargs"]["chunk_file_path"] for c in apply_async.call_args_list),
+            segments[2:],
+        )
+
+    @patch("files.tasks.encode_media.apply_async")
+    def test_chunked_encode_without_segments(self, apply_async):
+        segments, (done, stale) = self.chunked_encode(["success", "running"])
+        Encoding.objects.filter(id=stale.id).update(
+            update_date=timezone.now() - timedelta(days=1, minutes=1)
+        )
+        os.remove(segments[0])
+        self.assertEqual(encoding_checks.requeue_stale_running(), 1)
+        self.assertEqual(self.encoded(), [(self.video.id, [self.h720.id], True)])
+        apply_async.assert_not_called()
+        self.assertFalse(Encoding.objects.filter(chunk=True).exists())
+        self.assertFalse(os.path.exists(segments[1]))
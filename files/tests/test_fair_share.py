@@ -0,0 +1,197 @@
+"""
+Tests for fair-share scheduling of encodes across uploaders.
+
+Tests cover:
+1. Without Redis, or with FAIR_SHARE_ENCODING off, encodes are published
+   at once
+2. Uploaders take turns by weight, with their encodes in order
+   (needs Redis)
+3. No more than FAIR_SHARE_SLOTS released encodes are pending or running
+   (needs Redis)
+4. The admin endpoint shows queues, shares and waits (needs Redis)
+5. Queued and released encodes are known, so they are not requeued as
+   lost (needs Redis)
+6. Encodes published again give back their slot (needs Redis)
+"""
+from unittest import skipUnless
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+
+from files import fair_share
+from files.cache_utils import CACHE_KEY_PREFIX
+from files.encode_telemetry import PUBLISHED_HEADER
+from files.models import EncodeProfile, Encoding, Media
+from files.tests.helpers import redis_available
+
+User = get_user_model()
+
+
+class FairShareMixin:
+    def setUp(self):
+        self.profile = EncodeProfile.objects.create(
+            name="h264-480", extension="mp4", resolution=480, codec="h264"
+        )
+        patcher = patch("files.tasks.encode_media.apply_async")
+        self.apply_async = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create_media(self, user):
+        with patch.object(Media, "media_init", return_value=None):
+            return Media.objects.create(title=f"Film of {user.username}", user=user)
+
+    def queue(self, media, count=1):
+        """Queue encodes of a media, with pending encodings"""
+        encodings = Encoding.objects.bulk_create(
+            [Encoding(media=media, profile=self.profile) for _ in range(count)]
+        )
+        for encoding in encodings:
+            fair_share.publish_encode(
+                media, [media.friendly_token, self.profile.id, encoding.id, "url"], {"force": True}
+            )
+        return encodings
+
+    def released(self):
+        """Encoding ids of the published encode_media tasks, in order"""
+        return [c.kwargs["args"][2] for c in self.apply_async.call_args_list]
+
+
+class FairShareFallbackTest(FairShareMixin, TestCase):
+    def test_published_at_once(self):
+        user = User.objects.create_user(username="uploader", email="u@example.com", password="p")
+        media = self.create_media(user)
+        with patch.object(fair_share, "get_redis", return_value=None):
+            encodings = self.queue(media, 2)
+        with override_settings(FAIR_SHARE_ENCODING=False):
+            encodings += self.queue(media)
+        self.assertEqual(self.released(), [e.id for e in encodings])
+        with override_settings(FAIR_SHARE_ENCODING=False):
+            self.assertEqual(fair_share.dispatch(), 0)
+            self.assertFalse(fair_share.get_queue_stats()["enabled"])
+            self.assertEqual(fair_share.get_queued_encodings(), set())
+
+
+@skipUnless(redis_available(), "needs the django-redis cache")
+@override_settings(FAIR_SHARE_ENCODING=True, FAIR_SHARE_WEIGHTS={"advancedUser": 2})
+class FairShareTest(FairShareMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.redis = fair_share.get_redis()
+        self.addCleanup(self.clear_keys)
+        self.clear_keys()
+        # ids of the same length, uploaders with the same pass go in id order
+        self.distributor = User.objects.create_user(
+            id=1001, username="distributor", email="d@example.com", password="p"
+        )
+        self.trusted = User.objects.create_user(
+            id=1002, username="trusted", email="t@example.com", password="p", advancedUser=True
+        )
+        self.contributor = User.objects.create_user(
+            id=1003, username="contributor", email="c@example.com", password="p"
+        )
+
+    def clear_keys(self):
+        for key in self.redis.scan_iter(f"{CACHE_KEY_PREFIX}:fair_share:*"):
+            self.redis.delete(key)
+
+    @override_settings(FAIR_SHARE_SLOTS=0)
+    def queue_all(self):
+        bulk = self.queue(self.create_media(self.distributor), 6)
+        trusted = self.queue(self.create_media(self.trusted), 4)
+        short = self.queue(self.create_media(self.contributor))
+        return bulk, trusted, short
+
+    def test_turns_by_weight(self):
+        bulk, trusted, short = self.queue_all()
+        self.assertEqual(self.released(), [])
+
+        with override_settings(FAIR_SHARE_SLOTS=8):
+            self.assertEqual(fair_share.dispatch(), 8)
+        # twice the turns for the trusted user, the short encode early
+        self.assertEqual(
+            self.released(),
+            [
+                bulk[0].id,
+                trusted[0].id,
+                short[0].id,
+                trusted[1].id,
+                bulk[1].id,
+                trusted[2].id,
+                trusted[3].id,
+                bulk[2].id,
+            ],
+        )
+        # the wait counts from the virtual queue
+        headers = self.apply_async.call_args_list[0].kwargs["headers"]
+        self.assertIn(PUBLISHED_HEADER, headers)
+
+    @override_settings(FAIR_SHARE_SLOTS=2)
+    def test_slots(self):
+        bulk = self.queue(self.create_media(self.distributor), 4)
+        self.assertEqual(self.released(), [bulk[0].id, bulk[1].id])
+        self.assertEqual(fair_share.dispatch(), 0)
+
+        # a newcomer goes next, when a slot frees
+        short = self.queue(self.create_media(self.contributor))
+        Encoding.objects.filter(id=bulk[0].id).update(status="success")
+        self.assertEqual(fair_share.dispatch(), 1)
+        self.assertEqual(self.released()[2:], [short[0].id])
+
+        Encoding.objects.filter(id__in=[bulk[1].id, short[0].id]).delete()
+        self.assertEqual(fair_share.dispatch(), 2)
+        self.assertEqual(self.released()[3:], [bulk[2].id, bulk[3].id])
+
+    @override_settings(FAIR_SHARE_SLOTS=1)
+    def test_published_again_gives_back_the_slot(self):
+        media = self.create_media(self.distributor)
+        bulk = self.queue(media, 2)
+        self.assertEqual(self.released(), [bulk[0].id])
+        # eg waiting for scratch space, the encoding stays pending
+        fair_share.publish_encode(
+            media, [media.friendly_token, self.profile.id, bulk[0].id, "url"], {}, countdown=30
+        )
+        self.assertEqual(self.released(), [bulk[0].id, bulk[1].id])
+        Encoding.objects.filter(id=bulk[1].id).update(status="success")
+        self.assertEqual(fair_share.dispatch(), 1)
+        self.assertEqual(self.released()[2:], [bulk[0].id])
+        self.assertEqual(self.apply_async.call_args.kwargs["countdown"], 30)
+
+    def test_queued_encodings(self):
+        bulk, trusted, short = self.queue_all()
+        everything = {e.id for e in bulk + trusted + short}
+        self.assertEqual(fair_share.get_queued_encodings(), everything)
+        with override_settings(FAIR_SHARE_SLOTS=2):
+            fair_share.dispatch()
+        # released and not finished, still owned by the fair-share queues
+        self.assertEqual(fair_share.get_queued_encodings(), everything)
+        released = set(self.released())
+        self.assertEqual(len(released), 2)
+        self.assertEqual(fair_share.get_queued_encodings(released=False), everything - released)
+        Encoding.objects.filter(id=bulk[0].id).update(status="success")
+        fair_share.get_released(self.redis)
+        self.assertEqual(fair_share.get_queued_encodings(), everything - {bulk[0].id})
+
+    def test_queue_stats_endpoint(self):
+        self.queue_all()
+        with override_settings(FAIR_SHARE_SLOTS=3):
+            fair_share.dispatch()
+
+        self.client.force_login(self.distributor)
+        self.assertEqual(self.client.get("/api/v1/encode_queue").status_code, 403)
+
+        admin = User.objects.create_superuser(
+            username="queue_admin", email="a@example.com", password="p"
+        )
+        self.client.force_login(admin)
+        response = self.client.get("/api/v1/encode_queue")
+        self.assertEqual(response.status_code, 200)
+        stats = response.json()
+        self.assertEqual((stats["queued"], stats["released"]), (8, 3))
+        users = {u["username"]: u for u in stats["users"]}
+        self.assertEqual(users["trusted"]["queued"], 3)
+        self.assertEqual(users["trusted"]["share"], 0.667)
+        self.assertEqual(users["distributor"]["share"], 0.333)
+        self.assertEqual(users["contributor"]["released"], 1)
+        self.assertEqual(users["contributor"]["share"], 0)
+        self.assertGreaterEqual(users["distributor"]["oldest_wait"], 0)
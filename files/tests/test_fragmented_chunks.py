@@ -0,0 +1,76 @@
+"""
+Tests for fragmented MP4 chunks.
+
+Tests cover:
+1. MP4 chunks are encoded with faststart, or as fragmented MP4 with
+   FRAGMENTED_MP4_CHUNKS
+2. Concatenated renditions are written with the same movflags
+3. Concatenated renditions are moved into storage, not copied
+"""
+import json
+import os
+import shutil
+import tempfile
+
+from django.core.files.storage import FileSystemStorage
+from django.test import SimpleTestCase, override_settings
+
+from files import helpers
+from files.helpers import FRAGMENTED_MP4_FLAGS, produce_ffmpeg_commands
+
+
+def media_info():
+    return json.dumps(
+        {
+            "video_frame_rate": 25,
+            "video_height": 1080,
+            "video_duration": 60,
+            "has_audio": True,
+        }
+    )
+
+
+def movflags(cmd):
+    return cmd[cmd.index("-movflags") + 1] if "-movflags" in cmd else None
+
+
+class FragmentedChunksTest(SimpleTestCase):
+    def chunk_command(self, codec="h264", output="chunk.mp4", chunk=True):
+        return produce_ffmpeg_commands(
+            "in.mp4", media_info(), 720, codec, output, "pass", chunk=chunk
+        )[-1]
+
+    @override_settings(FRAGMENTED_MP4_CHUNKS=False)
+    def test_faststart_chunks(self):
+        self.assertEqual(movflags(self.chunk_command()), "+faststart")
+        concat = helpers.get_concat_ffmpeg_command("list.txt", "out.mp4")
+        self.assertEqual(movflags(concat), "+faststart")
+        self.assertEqual(concat[-1], "out.mp4")
+
+    @override_settings(FRAGMENTED_MP4_CHUNKS=True)
+    def test_fragmented_chunks(self):
+        self.assertEqual(movflags(self.chunk_command()), FRAGMENTED_MP4_FLAGS)
+        self.assertEqual(movflags(self.chunk_command(codec="h265")), FRAGMENTED_MP4_FLAGS)
+        # whole encodes and webm are left alone
+        self.assertIsNone(movflags(self.chunk_command(chunk=False)))
+        self.assertIsNone(movflags(self.chunk_command(codec="vp9", output="chunk.webm")))
+
+        self.assertEqual(
+            helpers.get_concat_ffmpeg_command("list.txt", "out.mp4")[-3:],
+            ["-movflags", FRAGMENTED_MP4_FLAGS, "out.mp4"],
+        )
+        self.assertIsNone(movflags(helpers.get_concat_ffmpeg_command("list.txt", "out.webm")))
+
+    def test_moved_into_storage(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        storage = FileSystemStorage(location=os.path.join(temp_dir, "media"))
+        output = helpers.create_temp_file(suffix=".mp4", dir=temp_dir)
+        with open(output, "wb") as f:
+            f.write(b"rendition")
+
+        with open(output, "rb") as f:
+            name = storage.save("encoded/out.mp4", helpers.MovableFile(f))
+        self.assertFalse(os.path.exists(output))
+        with storage.open(name) as f:
+            self.assertEqual(f.read(), b"rendition")
@@ -0,0 +1,82 @@
+"""
+Tests for the stored HLS manifest of media.
+
+Tests cover:
+1. The master playlist is parsed into variant and iframe playlist paths
+2. hls_info is served from the stored manifest without touching the disk
+3. Media packaged before manifests were stored get theirs on first access
+"""
+import os
+import shutil
+import tempfile
+from unittest.mock import patch
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from files.models import Media
+
+User = get_user_model()
+
+MASTER_PLAYLIST = """#EXTM3U
+#EXT-X-VERSION:4
+#EXT-X-STREAM-INF:AVERAGE-BANDWIDTH=800000,BANDWIDTH=1000000,CODECS="avc1.4d401e,mp4a.40.2",RESOLUTION=640x360
+media-1/stream.m3u8
+#EXT-X-STREAM-INF:AVERAGE-BANDWIDTH=2400000,BANDWIDTH=3000000,CODECS="avc1.4d401f,mp4a.40.2",RESOLUTION=1280x720
+media-2/stream.m3u8
+#EXT-X-I-FRAME-STREAM-INF:AVERAGE-BANDWIDTH=80000,BANDWIDTH=100000,CODECS="avc1.4d401e",RESOLUTION=640x360,URI="media-1/iframes.m3u8"
+#EXT-X-I-FRAME-STREAM-INF:AVERAGE-BANDWIDTH=240000,BANDWIDTH=300000,CODECS="avc1.4d401f",RESOLUTION=1280x720,URI="media-2/iframes.m3u8"
+"""
+
+
+class HLSManifestTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="hls_user", email="hls@example.com", password="pass"
+        )
+        with patch.object(Media, "media_init", return_value=None):
+            self.media = Media.objects.create(title="HLS film", user=self.user)
+
+        os.makedirs(settings.MEDIA_ROOT, exist_ok=True)
+        self.hls_dir = tempfile.mkdtemp(dir=settings.MEDIA_ROOT)
+        self.addCleanup(shutil.rmtree, self.hls_dir)
+        self.master = os.path.join(self.hls_dir, "master.m3u8")
+        with open(self.master, "w") as f:
+            f.write(MASTER_PLAYLIST)
+        # the 720p iframe playlist is missing, it should not be listed
+        for path in ["media-1/stream.m3u8", "media-2/stream.m3u8", "media-1/iframes.m3u8"]:
+            os.makedirs(os.path.join(self.hls_dir, os.path.dirname(path)), exist_ok=True)
+            open(os.path.join(self.hls_dir, path), "w").close()
+
+    def test_read_hls_manifest(self):
+        self.media.hls_file = self.master
+        manifest = self.media.read_hls_manifest()
+        self.assertEqual(
+            set(manifest), {"master_file", "360_iframe", "360_playlist", "720_playlist"}
+        )
+        self.assertEqual(
+            manifest["720_playlist"], os.path.join(self.hls_dir, "media-2/stream.m3u8")
+        )
+
+    def test_hls_info_does_not_touch_disk(self):
+        self.media.hls_file = self.master
+        self.media.hls_manifest = self.media.read_hls_manifest()
+        self.media.save(update_fields=["hls_file", "hls_manifest"])
+        media = Media.objects.get(pk=self.media.pk)
+
+        with patch("files.models.m3u8.load") as load, patch(
+            "files.models.os.path.exists"
+        ) as exists:
+            hls_info = media.hls_info
+        load.assert_not_called()
+        exists.assert_not_called()
+        self.assertTrue(hls_info["master_file"].endswith(f"master.m3u8?v={media.media_version}"))
+        self.assertIn("360_iframe", hls_info)
+
+    def test_missing_manifest_is_stored_on_first_access(self):
+        Media.objects.filter(pk=self.media.pk).update(hls_file=self.master)
+        media = Media.objects.get(pk=self.media.pk)
+        self.assertIn("720_playlist", media.hls_info)
+        media.refresh_from_db()
+        self.assertIn("720_playlist", media.hls_manifest)
@@ -0,0 +1,120 @@
+"""
+Tests for keyset (cursor) pagination of media listings.
+
+Tests cover:
+1. Following next links walks a listing in order, ties broken on id
+2. Previous links return the previous page
+3. Requests with a page parameter keep the page-number response
+4. Invalid cursors are rejected
+5. History is paged on the action, not on the media
+"""
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from actions.models import MediaAction
+from cms.custom_pagination import KeysetPagination
+from files.tests.helpers import create_public_media
+
+User = get_user_model()
+
+
+@patch.object(KeysetPagination, "page_size", 2)
+class KeysetPaginationTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="keyset_user", email="keyset@example.com", password="pass"
+        )
+        now = timezone.now()
+        self.media = [
+            create_public_media(self.user, "media 0", now),
+            # same add_date, ordered on id
+            create_public_media(self.user, "media 1", now - timedelta(days=1)),
+            create_public_media(self.user, "media 2", now - timedelta(days=1)),
+            create_public_media(self.user, "media 3", now - timedelta(days=2)),
+            create_public_media(self.user, "media 4", now - timedelta(days=3)),
+        ]
+        self.expected = [
+            self.media[0].friendly_token,
+            self.media[2].friendly_token,
+            self.media[1].friendly_token,
+            self.media[3].friendly_token,
+            self.media[4].friendly_token,
+        ]
+
+    def walk(self, url, params=None):
+        pages = []
+        response = self.client.get(url, params or {})
+        while True:
+            self.assertEqual(response.status_code, 200)
+            pages.append(response.json())
+            if not pages[-1]["next"]:
+                return pages
+            response = self.client.get(pages[-1]["next"])
+
+    def tokens(self, page):
+        return [item["friendly_token"] for item in page["results"]]
+
+    def test_next_links_walk_listing_in_order(self):
+        pages = self.walk("/api/v1/media", {"show": "latest"})
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(sum((self.tokens(page) for page in pages), []), self.expected)
+        # count is computed for the first page, and carried to the others
+        self.assertEqual([page["count"] for page in pages], [5, 5, 5])
+        self.assertIsNone(pages[0]["previous"])
+        self.assertIn("cursor=", pages[0]["next"])
+
+    def test_previous_link_returns_previous_page(self):
+        pages = self.walk("/api/v1/media")
+        response = self.client.get(pages[2]["previous"])
+        self.assertEqual(self.tokens(response.json()), self.tokens(pages[1]))
+        response = self.client.get(response.json()["previous"])
+        self.assertEqual(self.tokens(response.json()), self.tokens(pages[0]))
+        self.assertIsNone(response.json()["previous"])
+
+    def test_deep_pages_cost_the_same(self):
+        pages = self.walk("/api/v1/media")
+        for page in pages[:2]:
+            with CaptureQueriesContext(connection) as context:
+                self.client.get(page["next"])
+            # a single indexed range query, no COUNT and no OFFSET
+            sql = context.captured_queries[0]["sql"]
+            self.assertNotIn("COUNT", sql)
+            self.assertNotIn("OFFSET", sql)
+            self.assertIn("LIMIT 3", sql)
+
+    def test_page_number_clients_keep_working(self):
+        response = self.client.get("/api/v1/media", {"page": 1})
+        data = response.json()
+        self.assertEqual(data["count"], 5)
+        # page-number pagination keeps its own page size
+        self.assertEqual(len(data["results"]), 5)
+        self.assertIsNone(data["next"])
+
+    def test_invalid_cursor(self):
+        response = self.client.get("/api/v1/media", {"cursor": "not-a-cursor"})
+        self.assertEqual(response.status_code, 404)
+
+    def test_author_listing(self):
+        pages = self.walk("/api/v1/media", {"author": self.user.username})
+        self.assertEqual(sum((self.tokens(page) for page in pages), []), self.expected)
+
+    def test_history_paged_on_actions(self):
+        self.client.force_login(self.user)
+        for media in self.media:
+            MediaAction.objects.create(user=self.user, media=media, action="watch")
+        # watching again moves the media to the top of the history
+        MediaAction.objects.create(user=self.user, media=self.media[0], action="watch")
+
+        pages = self.walk("/api/v1/user/action/watch")
+        tokens = sum((self.tokens(page) for page in pages), [])
+        self.assertEqual(len(tokens), 6)
+        self.assertEqual(tokens[0], self.media[0].friendly_token)
+        self.assertEqual(tokens[1], self.media[4].friendly_token)
@@ -0,0 +1,70 @@
+"""
+Tests for the precomputed media listing cards.
+
+Tests cover:
+1. Listing endpoints return the same items as MediaSerializer
+2. A listing page costs a constant number of queries
+3. Cards are refreshed when the media or its author change
+4. Missing cards are built on first listing
+"""
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import RequestFactory, TestCase
+
+from files.models import Media
+from files.serializers import MediaSerializer
+from files.tests.helpers import create_public_media
+
+User = get_user_model()
+
+
+class ListingCardTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="card_user",
+            email="card@example.com",
+            password="pass",
+            name="Card User",
+        )
+        self.media = create_public_media(self.user, "Card film", media_country="PH")
+
+    def test_card_is_built_on_save(self):
+        card = self.media.listing_card
+        self.assertEqual(card["url"], self.media.get_absolute_url())
+        self.assertEqual(card["author_name"], "Card User")
+        self.assertEqual(card["media_country_info"][0]["title"], "Philippines")
+
+    def test_listing_matches_media_serializer(self):
+        response = self.client.get("/api/v1/media")
+        request = RequestFactory().get("/api/v1/media")
+        expected = MediaSerializer(self.media, context={"request": request}).data
+        self.assertEqual(response.json()["results"], [dict(expected)])
+
+    def test_listing_queries_do_not_grow_with_page_size(self):
+        for i in range(10):
+            create_public_media(self.user, f"film {i}")
+        # page query only, the count is cached per catalog generation
+        self.client.get("/api/v1/media")
+        with self.assertNumQueries(1):
+            response = self.client.get("/api/v1/media")
+        self.assertEqual(len(response.json()["results"]), 11)
+
+    def test_media_change_refreshes_card(self):
+        self.media.preview_file_path = "/nonexistent/preview.gif"
+        self.media.save(update_fields=["preview_file_path"])
+        self.media.refresh_from_db()
+        self.assertIn("preview.gif", self.media.listing_card["preview_url"])
+
+    def test_author_change_refreshes_cards(self):
+        self.user.name = "Renamed User"
+        self.user.save()
+        self.media.refresh_from_db()
+        self.assertEqual(self.media.listing_card["author_name"], "Renamed User")
+
+    def test_missing_card_is_built_on_listing(self):
+        Media.objects.filter(pk=self.media.pk).update(listing_card={})
+        response = self.client.get("/api/v1/media")
+        self.assertEqual(response.json()["results"][0]["author_name"], "Card User")
+        self.media.refresh_from_db()
+        self.assertTrue(self.media.listing_card)
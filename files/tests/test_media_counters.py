@@ -0,0 +1,182 @@
+"""
+Tests for the time-bucketed media action counters and the trending listing.
+
+Tests cover:
+1. Window bucket selection, hourly for short windows and daily for long ones
+2. Without Redis, readers fall back to counting MediaAction
+3. The trending listing orders media by recent watches, and counters are
+   paged through until enough listable media are found
+4. Counters are incremented, merged and expired in Redis, the merge of a
+   window is shared by its pages (needs Redis)
+"""
+from datetime import timedelta
+from unittest import skipIf, skipUnless
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from actions.models import MediaAction
+from files import counters
+from files.methods import get_top_media
+from files.models import Media
+from files.tasks import save_user_action
+from files.tests.helpers import create_public_media, redis_available
+
+User = get_user_model()
+
+
+class WindowKeysTest(TestCase):
+    def test_short_windows_use_hourly_buckets(self):
+        now = timezone.now()
+        keys = counters.get_window_keys("watch", now - timedelta(hours=24), now)
+        self.assertEqual(len(keys), 25)
+        self.assertIn(":watch:h:", keys[0])
+        self.assertEqual(keys[0], counters.get_bucket_key("watch", "h", now))
+
+    def test_long_windows_use_daily_buckets(self):
+        now = timezone.now()
+        keys = counters.get_window_keys("like", now - timedelta(days=7), now)
+        self.assertEqual(len(keys), 8)
+        self.assertIn(":like:d:", keys[-1])
+
+    def test_windows_are_capped_to_retention(self):
+        now = timezone.now()
+        keys = counters.get_window_keys("like", now - timedelta(days=1000), now)
+        self.assertEqual(len(keys), counters.DAILY_BUCKETS)
+
+
+@override_settings(TRENDING_MEDIA_HOURS=24)
+class TrendingMediaTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="trending_user", email="trending@example.com", password="pass"
+        )
+        self.hot = create_public_media(self.user, "Hot film")
+        self.warm = create_public_media(self.user, "Warm film")
+        self.cold = create_public_media(self.user, "Cold film")
+        for i in range(3):
+            self.watch(self.hot, f"session-{i}")
+        self.watch(self.warm, "session-0")
+        self.watch(self.cold, "session-0", hours=30)
+
+    def watch(self, media, session_key, hours=0):
+        action = MediaAction.objects.create(
+            session_key=session_key, media=media, action="watch"
+        )
+        MediaAction.objects.filter(pk=action.pk).update(
+            action_date=timezone.now() - timedelta(hours=hours)
+        )
+
+    @skipIf(redis_available(), "the cache is django-redis")
+    def test_counters_need_redis(self):
+        self.assertIsNone(
+            counters.get_top_media("watch", timezone.now() - timedelta(days=1), 10)
+        )
+        self.assertFalse(counters.incr_media_counter("watch", self.hot.id))
+
+    def test_top_media_falls_back_to_media_actions(self):
+        with patch.object(counters, "get_top_media", return_value=None):
+            top = get_top_media("watch", timezone.now() - timedelta(hours=24), 10)
+        self.assertEqual(top, [self.hot.id, self.warm.id])
+
+    def test_trending_listing(self):
+        with patch.object(counters, "get_top_media", return_value=None):
+            response = self.client.get("/api/v1/media", {"show": "trending"})
+        tokens = [item["friendly_token"] for item in response.json()["results"]]
+        self.assertEqual(tokens, [self.hot.friendly_token, self.warm.friendly_token])
+
+    def test_trending_listing_from_counters(self):
+        # counters know about a newer trend than the actions table
+        top = [self.cold.id, self.hot.id]
+        with patch.object(counters, "get_top_media", return_value=top):
+            response = self.client.get("/api/v1/media", {"show": "trending"})
+        tokens = [item["friendly_token"] for item in response.json()["results"]]
+        self.assertEqual(tokens, [self.cold.friendly_token, self.hot.friendly_token])
+
+    def test_unlistable_counted_media_are_skipped(self):
+        private = [
+            create_public_media(self.user, f"Private film {i}") for i in range(4)
+        ]
+        Media.objects.filter(id__in=[m.id for m in private]).update(state="private")
+        ranked = [m.id for m in private] + [self.warm.id, self.hot.id]
+
+        def top_media(action, since, limit, offset=0):
+            return ranked[offset:offset + limit]
+
+        with patch.object(counters, "get_top_media", side_effect=top_media) as read:
+            top = get_top_media("watch", timezone.now() - timedelta(hours=24), 1)
+        self.assertEqual(top, [self.warm.id])
+        self.assertEqual(read.call_count, 2)
+
+
+@skipUnless(redis_available(), "needs the django-redis cache")
+class RedisCountersTest(TestCase):
+    def setUp(self):
+        self.client_redis = counters.get_redis()
+        self.addCleanup(self.clear_counters)
+        self.clear_counters()
+        self.user = User.objects.create_user(
+            username="counter_user", email="counter@example.com", password="pass"
+        )
+        self.media = create_public_media(self.user, "Counted film")
+        self.other = create_public_media(self.user, "Other film")
+
+    def clear_counters(self):
+        for key in self.client_redis.scan_iter(f"{counters.CACHE_KEY_PREFIX}:media_counter:*"):
+            self.client_redis.delete(key)
+
+    def test_counts_are_merged_over_windows(self):
+        now = timezone.now()
+        started = now - timedelta(days=3)
+        counters.incr_media_counter("watch", self.media.id, now=started)
+        counters.incr_media_counter("watch", self.media.id, now=now - timedelta(hours=2))
+        counters.incr_media_counter("watch", self.other.id, now=now)
+        counters.incr_media_counter("watch", self.other.id, now=now)
+
+        since = now - timedelta(hours=3)
+        self.assertEqual(counters.get_media_count("watch", self.media.id, since), 1)
+        self.assertEqual(counters.get_top_media("watch", since, 10), [self.other.id, self.media.id])
+        self.assertEqual(counters.get_top_media("watch", since, 10, offset=1), [self.media.id])
+        self.assertEqual(
+            counters.get_media_count("watch", self.media.id, now - timedelta(days=3)), 2
+        )
+        # counting started 3 days ago, older windows are not covered
+        self.assertIsNone(counters.get_top_media("watch", now - timedelta(days=7), 10))
+
+    def test_pages_read_the_same_merge(self):
+        now = timezone.now()
+        counters.incr_media_counter("watch", self.media.id, now=now - timedelta(hours=4))
+        counters.incr_media_counter("watch", self.other.id, now=now)
+        since = now - timedelta(hours=3)
+        self.assertEqual(counters.get_top_media("watch", since, 1), [self.other.id])
+        union_key = counters.get_union_key("watch", counters.get_window_keys("watch", since))
+        self.assertLessEqual(self.client_redis.ttl(union_key), counters.UNION_TTL)
+
+        # later pages are read from the merge until it expires
+        counters.incr_media_counter("watch", self.media.id, now=now)
+        counters.incr_media_counter("watch", self.media.id, now=now)
+        self.assertEqual(counters.get_top_media("watch", since, 1, offset=1), [self.media.id])
+        self.assertEqual(counters.get_top_media("watch", since, 2), [self.other.id, self.media.id])
+        self.client_redis.delete(union_key)
+        self.assertEqual(counters.get_top_media("watch", since, 2), [self.media.id, self.other.id])
+
+    def test_buckets_expire(self):
+        counters.incr_media_counter("like", self.media.id)
+        key = counters.get_bucket_key("like", "h", timezone.now())
+        ttl = self.client_redis.ttl(key)
+        self.assertGreater(ttl, 0)
+        self.assertLessEqual(ttl, (counters.HOURLY_BUCKETS + 1) * 3600)
+
+    def test_save_user_action_counts_watches(self):
+        save_user_action(
+            {"user_session": "counted-session", "remote_ip_addr": "127.0.0.1"},
+            friendly_token=self.media.friendly_token,
+            action="watch",
+        )
+        # counting started with this watch, the current bucket holds it
+        since = timezone.now()
+        self.assertEqual(counters.get_media_count("watch", self.media.id, since), 1)
@@ -0,0 +1,121 @@
+"""
+Tests for the registry of ffmpeg, whisper.cpp and mp4hls processes.
+
+Tests cover:
+1. Tracked processes run in a group of their own and are registered while
+   they run
+2. Their CPU time and peak RSS are added to their encoding when they exit
+3. Cancelling an encoding terminates its processes, and kills the ones
+   that ignore SIGTERM
+4. The registry is shared through Redis (needs Redis)
+"""
+import os
+import signal
+import time
+from unittest import skipUnless
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from files import processes
+from files.cache_utils import CACHE_KEY_PREFIX
+from files.models import EncodeProfile, Encoding, Media
+from files.tests.helpers import redis_available
+
+User = get_user_model()
+
+
+class ProcessesTest(TestCase):
+    def setUp(self):
+        user = User.objects.create_user(
+            username="processes_user", email="processes@example.com", password="pass"
+        )
+        with patch.object(Media, "media_init", return_value=None):
+            media = Media.objects.create(title="Encoded film", user=user)
+        profile = EncodeProfile.objects.create(
+            name="h264-240", extension="mp4", resolution=240, codec="h264"
+        )
+        # without the post_save actions of encodings
+        self.encoding = Encoding.objects.bulk_create(
+            [Encoding(media=media, profile=profile, status="running")]
+        )[0]
+
+    def tearDown(self):
+        for process in list(processes._local.values()):
+            processes.stop_process(process, grace=0)
+
+    def pids(self):
+        return [p["pid"] for p in processes.get_encoding_processes(self.encoding.id)]
+
+    def test_run_records_usage(self):
+        ret = processes.run(
+            ["python", "-c", "sum(range(3000000))"], encoding_id=self.encoding.id
+        )
+        self.assertEqual(ret.returncode, 0)
+        self.assertEqual(self.pids(), [])
+        self.encoding.refresh_from_db()
+        self.assertGreater(self.encoding.cpu_time, 0)
+        self.assertGreater(self.encoding.max_rss, 0)
+
+        # CPU time adds up, peak RSS is the highest
+        max_rss = self.encoding.max_rss
+        processes.run(["true"], encoding_id=self.encoding.id)
+        encoding = Encoding.objects.get(id=self.encoding.id)
+        self.assertGreaterEqual(encoding.cpu_time, self.encoding.cpu_time)
+        self.assertEqual(encoding.max_rss, max_rss)
+
+    def test_process_group_and_registry(self):
+        process = processes.TrackedPopen(["sleep", "30"], encoding_id=self.encoding.id)
+        self.assertEqual(os.getpgid(process.pid), process.pid)
+        self.assertNotEqual(os.getpgid(process.pid), os.getpgrp())
+        self.assertEqual(self.pids(), [process.pid])
+        details = processes.get_processes()[-1]
+        self.assertEqual(details["label"], "sleep")
+        self.assertEqual(details["host"], processes.HOST)
+
+    def test_cancel(self):
+        process = processes.TrackedPopen(["sleep", "30"], encoding_id=self.encoding.id)
+        self.assertEqual(processes.cancel_encoding_processes(self.encoding.id), 1)
+        self.assertEqual(process.wait(timeout=5), -signal.SIGTERM)
+        self.assertEqual(self.pids(), [])
+        self.assertEqual(processes.cancel_encoding_processes(self.encoding.id), 0)
+        self.assertGreater(Encoding.objects.get(id=self.encoding.id).max_rss, 0)
+
+    def test_cancel_kills_after_grace(self):
+        process = processes.TrackedPopen(
+            ["sh", "-c", "trap '' TERM; sleep 30"], encoding_id=self.encoding.id
+        )
+        time.sleep(0.2)
+        processes.cancel_encoding_processes(self.encoding.id, grace=0.5)
+        self.assertEqual(process.wait(timeout=5), -signal.SIGKILL)
+
+    def test_untracked_commands(self):
+        process = processes.popen(["true"])
+        process.wait()
+        self.assertNotIsInstance(process, processes.TrackedPopen)
+        with self.settings(FFMPEG_COMMAND="true"):
+            process = processes.popen(["true"])
+            process.wait()
+        self.assertIsInstance(process, processes.TrackedPopen)
+
+
+@skipUnless(redis_available(), "needs the django-redis cache")
+class ProcessRegistryRedisTest(ProcessesTest):
+    def setUp(self):
+        super().setUp()
+        self.client_redis = processes.get_redis()
+        self.addCleanup(self.clear_keys)
+
+    def clear_keys(self):
+        for key in self.client_redis.scan_iter(f"{CACHE_KEY_PREFIX}:processes:*"):
+            self.client_redis.delete(key)
+
+    def test_cancel_from_another_process(self):
+        process = processes.TrackedPopen(["sleep", "30"], encoding_id=self.encoding.id)
+        # the worker process that gets a revoke only knows the registry
+        with patch.dict(processes._local, clear=True):
+            self.assertEqual(self.pids(), [process.pid])
+            self.assertEqual(processes.cancel_encoding_processes(self.encoding.id), 1)
+        self.assertEqual(process.wait(timeout=5), -signal.SIGTERM)
+        self.assertEqual(self.pids(), [])
@@ -0,0 +1,162 @@
+"""
+Query count contract for the public API endpoints.
+
+Every public endpoint must run a number of queries that does not depend on
+the number of items it lists or on the size of a media's taxonomy. Each test
+measures an endpoint, grows the data it serves, and measures it again. The
+media detail endpoint additionally has a fixed query budget.
+
+If one of these tests fails, an N+1 query was introduced: prefetch or
+denormalise instead of raising the budget.
+"""
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from actions.models import MediaAction
+from files.models import (
+    Category,
+    Comment,
+    Encoding,
+    EncodeProfile,
+    Language,
+    Playlist,
+    RatingCategory,
+    Subtitle,
+    Tag,
+    Topic,
+)
+from files.tests.helpers import create_public_media
+
+User = get_user_model()
+
+# queries of the media detail endpoint: media with user and license, the
+# prefetched encodings, profiles, categories, rating categories, topics,
+# tags and subtitles with languages, the media language title, and related
+# media (author, category and generic media lists, each with their users)
+MEDIA_DETAIL_QUERY_BUDGET = 15
+
+
+@override_settings(ENABLE_SEARCH_CACHE=False, ALLOW_RATINGS=True)
+class PublicEndpointQueryCountTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.counter = 0
+        self.user = User.objects.create_user(
+            username="queries_user", email="queries@example.com", password="pass"
+        )
+        self.media = create_public_media(
+            self.user, "Query film", media_language="en", media_file="original/query.mp4"
+        )
+        Language.objects.get_or_create(code="en", defaults={"title": "English"})
+        self.tag = Tag.objects.create(title="query-tag", user=self.user)
+        self.media.tags.add(self.tag)
+        self.grow()
+
+    def unique(self, prefix):
+        self.counter += 1
+        return f"{prefix}-{self.counter}"
+
+    def grow(self):
+        """Add listable items and grow the taxonomy of self.media"""
+        user = User.objects.create_user(
+            username=self.unique("user"), email=f"{self.unique('mail')}@example.com"
+        )
+        for i in range(3):
+            media = create_public_media(user, self.unique("media"), featured=True)
+            media.tags.add(self.tag)
+            MediaAction.objects.create(user=self.user, media=media, action="watch")
+            Comment.objects.create(user=user, media=self.media, text=self.unique("text"))
+        category = Category.objects.create(title=self.unique("category"))
+        RatingCategory.objects.create(title=self.unique("rating"), category=category)
+        self.media.category.add(category)
+        self.media.topics.add(Topic.objects.create(title=self.unique("topic")))
+        self.media.tags.add(Tag.objects.create(title=self.unique("tag"), user=user))
+        language = Language.objects.create(code=self.unique("code"), title=self.unique("title"))
+        Subtitle.objects.create(
+            media=self.media, language=language, user=user, subtitle_file="subtitle.vtt"
+        )
+        profile = EncodeProfile.objects.create(
+            name=self.unique("profile"),
+            extension="mp4",
+            resolution=240,
+            codec=self.unique("codec"),
+        )
+        Encoding.objects.create(
+            media=self.media, profile=profile, status="success", progress=100
+        )
+        Playlist.objects.create(title=self.unique("playlist"), user=user)
+
+    def count_queries(self, url, params=None):
+        cache.clear()
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url, params or {})
+        self.assertEqual(response.status_code, 200, url)
+        return len(context.captured_queries)
+
+    def assertConstantQueries(self, url, params=None):
+        before = self.count_queries(url, params)
+        self.grow()
+        self.grow()
+        after = self.count_queries(url, params)
+        self.assertEqual(
+            before, after, f"{url} {params or ''} query count grows with its data"
+        )
+
+    def test_media_detail_query_budget(self):
+        url = f"/api/v1/media/{self.media.friendly_token}"
+        with self.assertNumQueries(MEDIA_DETAIL_QUERY_BUDGET):
+            self.client.get(url)
+        self.assertConstantQueries(url)
+
+    def test_media_detail_prefetches_keep_order(self):
+        # languages created in reverse order of their titles
+        for title in ("zulu", "afrikaans"):
+            language = Language.objects.create(code=self.unique("code"), title=title)
+            Subtitle.objects.create(
+                media=self.media, language=language, user=self.user, subtitle_file="s.vtt"
+            )
+        data = self.client.get(f"/api/v1/media/{self.media.friendly_token}").json()
+        labels = [subtitle["label"] for subtitle in data["subtitles_info"]]
+        self.assertEqual(labels, sorted(labels))
+
+    def test_media_listings(self):
+        for params in [
+            {},
+            {"show": "latest"},
+            {"show": "featured"},
+            {"show": "recommended"},
+            {"author": self.user.username},
+            {"page": 1},
+        ]:
+            with self.subTest(params=params):
+                self.assertConstantQueries("/api/v1/media", params)
+
+    def test_search(self):
+        self.assertConstantQueries("/api/v1/search", {"t": self.tag.title})
+
+    def test_taxonomies(self):
+        for url in [
+            "/api/v1/categories",
+            "/api/v1/topics",
+            "/api/v1/tags",
+            "/api/v1/languages",
+            "/api/v1/countries",
+        ]:
+            with self.subTest(url=url):
+                self.assertConstantQueries(url)
+
+    def test_playlists(self):
+        self.assertConstantQueries("/api/v1/playlists")
+
+    def test_media_comments(self):
+        self.assertConstantQueries(f"/api/v1/media/{self.media.friendly_token}/comments")
+
+    def test_users(self):
+        self.assertConstantQueries("/api/v1/users")
+
+    def test_history(self):
+        self.client.force_login(self.user)
+        self.assertConstantQueries("/api/v1/user/action/watch")
@@ -0,0 +1,110 @@
+"""
+Tests for the Redis watch cooldowns and anonymous views rate limit.
+
+Tests cover:
+1. Without Redis, pre_save_action checks the database as before
+2. Watches in cooldown are answered from Redis without database queries
+   (needs Redis)
+3. Re-watches are rejected until the media duration has passed, also when
+   the cooldown was lost (needs Redis)
+4. Anonymous views are limited per media and IP, rejected ones don't
+   count toward the window (needs Redis)
+"""
+from datetime import timedelta
+from unittest import skipUnless
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from django.utils import timezone
+
+from actions.models import MediaAction
+from files import rate_limits
+from files.cache_utils import CACHE_KEY_PREFIX
+from files.methods import pre_save_action
+from files.tests.helpers import create_public_media, redis_available
+
+User = get_user_model()
+
+
+class WatchCheckFallbackTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="limits_user", email="limits@example.com", password="pass"
+        )
+        self.media = create_public_media(self.user, "Limited film", duration=60)
+
+    def test_falls_back_to_database_without_redis(self):
+        with patch.object(rate_limits, "get_redis", return_value=None):
+            self.assertIsNone(rate_limits.check_watch(self.media, None, "s1", "10.0.0.1"))
+            with self.assertNumQueries(2):
+                self.assertTrue(pre_save_action(self.media, None, "s1", "watch", "10.0.0.1"))
+
+    def test_media_without_duration_use_database(self):
+        self.media.duration = 0
+        self.assertIsNone(rate_limits.check_watch(self.media, self.user.id, None, "10.0.0.1"))
+
+
+@skipUnless(redis_available(), "needs the django-redis cache")
+@override_settings(MAX_ANONYMOUS_VIEWS_PER_5SEC=3)
+class RedisWatchCheckTest(TestCase):
+    def setUp(self):
+        self.client_redis = rate_limits.get_redis()
+        self.addCleanup(self.clear_keys)
+        self.clear_keys()
+        self.user = User.objects.create_user(
+            username="limits_user", email="limits@example.com", password="pass"
+        )
+        self.media = create_public_media(self.user, "Limited film", duration=60)
+
+    def clear_keys(self):
+        for pattern in ["rate_limit", "cooldown"]:
+            for key in self.client_redis.scan_iter(f"{CACHE_KEY_PREFIX}:{pattern}:*"):
+                self.client_redis.delete(key)
+
+    def test_watches_in_cooldown_do_not_query_the_database(self):
+        with self.assertNumQueries(1):
+            self.assertTrue(pre_save_action(self.media, self.user, None, "watch", "10.0.0.1"))
+        with self.assertNumQueries(0):
+            self.assertFalse(pre_save_action(self.media, self.user, None, "watch", "10.0.0.1"))
+
+    def test_lost_cooldown_is_restored_from_the_database(self):
+        MediaAction.objects.create(
+            user=self.user, media=self.media, action="watch", remote_ip="10.0.0.1"
+        )
+        # eg after a Redis flush, no cooldown is left
+        self.assertFalse(rate_limits.check_watch(self.media, self.user.id, None, "10.0.0.1"))
+        key = rate_limits.COOLDOWN_KEY_TEMPLATE.format(
+            action="watch", viewer=f"user:{self.user.id}", media_id=self.media.id
+        )
+        self.assertTrue(self.client_redis.exists(key))
+        MediaAction.objects.update(action_date=timezone.now() - timedelta(seconds=61))
+        self.client_redis.delete(key)
+        self.assertTrue(rate_limits.check_watch(self.media, self.user.id, None, "10.0.0.1"))
+
+    def test_cooldown_lasts_the_media_duration(self):
+        self.assertTrue(rate_limits.check_watch(self.media, None, "s1", "10.0.0.1"))
+        self.assertFalse(rate_limits.check_watch(self.media, None, "s1", "10.0.0.1"))
+        key = rate_limits.COOLDOWN_KEY_TEMPLATE.format(
+            action="watch", viewer="session:s1", media_id=self.media.id
+        )
+        self.assertLessEqual(self.client_redis.ttl(key), 60)
+        self.client_redis.delete(key)
+        self.assertTrue(rate_limits.check_watch(self.media, None, "s1", "10.0.0.1"))
+
+    def test_anonymous_views_are_limited_per_ip(self):
+        allowed = [
+            rate_limits.check_watch(self.media, None, f"s{i}", "10.0.0.1") for i in range(5)
+        ]
+        self.assertEqual(allowed, [True, True, True, False, False])
+        self.assertTrue(rate_limits.check_watch(self.media, None, "s9", "10.0.0.2"))
+        # logged in users are not limited per IP
+        self.assertTrue(rate_limits.check_watch(self.media, self.user.id, None, "10.0.0.1"))
+
+    def test_rejected_hits_are_not_counted(self):
+        hits = [
+            rate_limits.hit_rate_limit(self.client_redis, "test", "ip", 2, 60) for _ in range(4)
+        ]
+        self.assertEqual(hits, [True, True, False, False])
+        key = rate_limits.RATE_LIMIT_KEY_TEMPLATE.format(scope="test", ident="ip")
+        self.assertEqual(self.client_redis.zcard(key), 2)
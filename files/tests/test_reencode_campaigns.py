@@ -0,0 +1,195 @@
+"""
+Tests for throttled re-encode campaigns.
+
+Tests cover:
+1. A campaign sends media to encode in id order, no more than its
+   concurrency in flight, and waits while other encodes are pending
+2. Paused campaigns keep their place, and are done once all media are
+   encoded
+3. Filters, and the estimate from the encoding telemetry
+4. The reencode_campaign command, with --dry-run
+"""
+from io import StringIO
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
+
+from files import reencode_campaigns
+from files.models import EncodeProfile, Encoding, Media, ReencodeCampaign
+
+User = get_user_model()
+
+
+@override_settings(REENCODE_CAMPAIGN_MAX_BACKLOG=2, MINIMUM_RESOLUTIONS_TO_ENCODE=[240])
+class ReencodeCampaignTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="campaign_user", email="campaign@example.com", password="pass"
+        )
+        self.h720 = EncodeProfile.objects.create(
+            name="h264-720", extension="mp4", resolution=720, codec="h264"
+        )
+        self.h1080 = EncodeProfile.objects.create(
+            name="h264-1080", extension="mp4", resolution=1080, codec="h264"
+        )
+        self.videos = [self.create_video(f"Video {i}") for i in range(5)]
+
+    def create_video(self, title, height=1080, user=None):
+        with patch.object(Media, "media_init", return_value=None):
+            media = Media.objects.create(title=title, user=user or self.user)
+        Media.objects.filter(id=media.id).update(
+            media_type="video", video_height=height, duration=600
+        )
+        media.refresh_from_db()
+        return media
+
+    def create_campaign(self, concurrency=2, profiles=None, **filters):
+        campaign = ReencodeCampaign.objects.create(
+            name="preset", filters=filters, concurrency=concurrency
+        )
+        campaign.profiles.set(profiles or [self.h1080])
+        return campaign
+
+    def advance(self, campaign):
+        """Media ids the campaign sends to encode, with pending encodings"""
+
+        def encode(media, profiles=None, force=True):
+            Encoding.objects.bulk_create(
+                [Encoding(media=media, profile=profile, status="pending") for profile in profiles]
+            )
+
+        with patch.object(Media, "encode", autospec=True, side_effect=encode) as mocked:
+            reencode_campaigns.advance(campaign)
+        for c in mocked.call_args_list:
+            self.assertTrue(c.kwargs["force"])
+        campaign.refresh_from_db()
+        return [c.args[0].id for c in mocked.call_args_list]
+
+    def finish(self, media):
+        Encoding.objects.filter(media=media).update(status="success")
+
+    def test_concurrency(self):
+        campaign = self.create_campaign()
+        first, second, third = self.videos[:3]
+        self.assertEqual(self.advance(campaign), [first.id, second.id])
+        self.assertEqual(self.advance(campaign), [])
+
+        self.finish(first)
+        self.assertEqual(self.advance(campaign), [third.id])
+        self.assertEqual((campaign.last_media_id, campaign.queued), (third.id, 3))
+
+        progress = reencode_campaigns.get_progress(campaign)
+        self.assertEqual(
+            (progress["total"], progress["queued"], progress["in_flight"], progress["failed"]),
+            (5, 3, 2, 0),
+        )
+        Encoding.objects.filter(media=second).update(status="fail")
+        self.assertEqual(reencode_campaigns.get_progress(campaign)["failed"], 1)
+
+    def test_waits_for_backlog(self):
+        campaign = self.create_campaign()
+        upload = self.create_video("Upload", height=480)
+        Encoding.objects.bulk_create(
+            [Encoding(media=upload, profile=self.h720, status="pending") for _ in range(3)]
+        )
+        self.assertEqual(self.advance(campaign), [])
+        self.assertEqual(campaign.status, "running")
+
+        Encoding.objects.filter(media=upload).first().delete()
+        # its own encodes don't count
+        self.assertEqual(len(self.advance(campaign)), 2)
+
+    def test_pause_and_done(self):
+        campaign = self.create_campaign(concurrency=3)
+        self.assertEqual(self.advance(campaign), [v.id for v in self.videos[:3]])
+
+        ReencodeCampaign.objects.filter(id=campaign.id).update(status="paused")
+        for video in self.videos:
+            self.finish(video)
+        campaign.refresh_from_db()
+        self.assertEqual(self.advance(campaign), [])
+        self.assertEqual(reencode_campaigns.advance_campaigns(), 0)
+
+        # resumes from where it stopped
+        campaign.status = "running"
+        campaign.save()
+        self.assertEqual(self.advance(campaign), [v.id for v in self.videos[3:]])
+        self.assertEqual(campaign.status, "running")
+        for video in self.videos:
+            self.finish(video)
+        self.assertEqual(self.advance(campaign), [])
+        self.assertEqual(campaign.status, "done")
+
+    def test_filters(self):
+        other = User.objects.create_user(username="other", email="o@example.com", password="p")
+        small = self.create_video("Small", height=360, user=other)
+        Encoding.objects.bulk_create(
+            [Encoding(media=self.videos[1], profile=self.h720, status="success")]
+        )
+        media = reencode_campaigns.get_campaign_media
+        self.assertEqual(list(media({"user": "other"})), [small])
+        self.assertEqual(list(media({"max_height": 480})), [small])
+        self.assertEqual(list(media({"with_profile": "h264-720"})), [self.videos[1]])
+        self.assertEqual(media({"max_id": self.videos[2].id}).count(), 3)
+        self.assertEqual(media({"since": "2000-01-01", "until": "2000-02-01"}).count(), 0)
+
+        # too small for 1080p
+        cost = reencode_campaigns.estimate({}, [self.h720, self.h1080])
+        self.assertEqual(cost["media"], 6)
+        self.assertEqual(
+            [(row["renditions"], row["video_hours"]) for row in cost["profiles"]],
+            [(5, 0.83), (5, 0.83)],
+        )
+        self.assertIsNone(cost["profiles"][0]["encode_hours"])
+
+        Encoding.objects.bulk_create(
+            [
+                Encoding(
+                    media=self.videos[0],
+                    profile=self.h1080,
+                    status="success",
+                    wall_time=300,
+                    cpu_time=1200,
+                    speed=2.0,
+                )
+            ]
+        )
+        cost = reencode_campaigns.estimate({}, [self.h1080])
+        # at twice realtime, with 2 CPU seconds per second encoded
+        self.assertEqual((cost["encode_hours"], cost["cpu_hours"]), (0.42, 1.67))
+
+    def test_command(self):
+        out = StringIO()
+        call_command(
+            "reencode_campaign", "start", "preset", "--profile", "h264-1080", "--dry-run", stdout=out
+        )
+        self.assertIn("5 media", out.getvalue())
+        self.assertFalse(ReencodeCampaign.objects.exists())
+
+        with self.assertRaises(CommandError):
+            call_command("reencode_campaign", "start", "preset", "--profile", "h265-1080")
+        with self.assertRaises(CommandError):
+            call_command("reencode_campaign", "start", "preset", "--since", "yesterday")
+
+        call_command(
+            "reencode_campaign", "start", "preset", "--profile", "h264-1080", "--concurrency",
+            "3", stdout=StringIO(),
+        )
+        # uploads after the start are not re-encoded
+        self.create_video("Later")
+        campaign = ReencodeCampaign.objects.get(name="preset")
+        self.assertEqual(list(campaign.profiles.all()), [self.h1080])
+        self.assertEqual(campaign.filters["max_id"], self.videos[-1].id)
+        self.assertEqual(reencode_campaigns.get_progress(campaign)["total"], 5)
+
+        call_command("reencode_campaign", "pause", "preset", stdout=StringIO())
+        campaign.refresh_from_db()
+        self.assertEqual(campaign.status, "paused")
+        out = StringIO()
+        call_command("reencode_campaign", "status", stdout=out)
+        self.assertIn("preset (paused, h264-1080): 0/5", out.getvalue())
+        with self.assertRaises(CommandError):
+            call_command("reencode_campaign", "resume", "missing")
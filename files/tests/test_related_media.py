@@ -0,0 +1,116 @@
+"""
+Tests for the "calculated" related media strategy.
+
+Tests cover:
+1. Media sharing more and rarer tags, topics and categories rank higher
+2. Media watched by the same viewers are related
+3. Same author media fill the list when there are few candidates
+4. Stored related media are served in order with a single query
+5. Media without calculated related media fall back to the content strategy
+6. Candidates are limited per media, rarest groups first, and stored in
+   batches
+"""
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+
+from actions.models import MediaAction
+from files import methods
+from files.methods import calculate_related_media, show_related_media
+from files.models import Category, Media, Tag, Topic
+from files.tasks import update_related_media
+from files.tests.helpers import create_public_media
+
+User = get_user_model()
+
+
+@override_settings(RELATED_MEDIA_STRATEGY="calculated", RELATED_MEDIA_CALCULATED_COUNT=3)
+class CalculatedRelatedMediaTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="related_user", email="related@example.com", password="pass"
+        )
+        self.other = User.objects.create_user(
+            username="related_other", email="other@example.com", password="pass"
+        )
+        self.media = create_public_media(self.user, "Source film")
+        self.close = create_public_media(self.other, "Close film")
+        self.far = create_public_media(self.other, "Far film")
+        self.unrelated = create_public_media(self.other, "Unrelated film")
+        self.own = create_public_media(self.user, "Own film")
+
+        documentary = Category.objects.create(title="Documentary")
+        topic = Topic.objects.create(title="Environment")
+        rare = Tag.objects.create(title="mangroves", user=self.user)
+        self.media.category.add(documentary)
+        self.media.topics.add(topic)
+        self.media.tags.add(rare)
+        self.close.category.add(documentary)
+        self.close.topics.add(topic)
+        self.close.tags.add(rare)
+        self.far.category.add(documentary)
+
+    def test_shared_taxonomy_ranks_higher(self):
+        self.assertEqual(calculate_related_media(), 5)
+        self.media.refresh_from_db()
+        # the own media of the author fill the list
+        self.assertEqual(
+            self.media.related_media_ids, [self.close.id, self.far.id, self.own.id]
+        )
+
+    def test_co_watched_media_are_related(self):
+        for i in range(3):
+            viewer = User.objects.create_user(
+                username=f"viewer{i}", email=f"viewer{i}@example.com"
+            )
+            MediaAction.objects.create(user=viewer, media=self.media, action="watch")
+            MediaAction.objects.create(user=viewer, media=self.unrelated, action="watch")
+        MediaAction.objects.create(
+            session_key="anonymous", media=self.unrelated, action="watch"
+        )
+
+        calculate_related_media([self.unrelated.id])
+        self.unrelated.refresh_from_db()
+        self.assertEqual(self.unrelated.related_media_ids[0], self.media.id)
+
+    def test_candidates_come_from_the_rarest_groups(self):
+        with patch.object(methods, "RELATED_MEDIA_MAX_CANDIDATES", 1), patch.object(
+            methods, "RELATED_MEDIA_BATCH_SIZE", 2
+        ):
+            self.assertEqual(calculate_related_media(), 5)
+        self.media.refresh_from_db()
+        # the category shared with far is the largest group, not searched
+        self.assertEqual(self.media.related_media_ids, [self.close.id, self.own.id])
+        # every batch was stored
+        self.assertFalse(Media.objects.filter(related_media_ids=[]).exists())
+
+    def test_media_ids_limit_the_calculation(self):
+        self.assertEqual(calculate_related_media([self.media.id]), 1)
+        self.close.refresh_from_db()
+        self.assertEqual(self.close.related_media_ids, [])
+
+    def test_served_in_order_with_one_query(self):
+        update_related_media()
+        media = Media.objects.get(pk=self.media.pk)
+        with self.assertNumQueries(1):
+            related = show_related_media(media, limit=2)
+            [m.user.username for m in related]
+        self.assertEqual(related, [self.close, self.far])
+
+    def test_unlisted_media_are_not_served(self):
+        update_related_media()
+        Media.objects.filter(pk=self.close.pk).update(state="private")
+        media = Media.objects.get(pk=self.media.pk)
+        self.assertEqual(show_related_media(media), [self.far, self.own])
+
+    def test_falls_back_to_content_strategy(self):
+        related = show_related_media(self.media)
+        self.assertIn(self.own, related)
+        self.assertNotIn(self.media, related)
+
+    @override_settings(RELATED_MEDIA_STRATEGY="content")
+    def test_task_skipped_for_other_strategies(self):
+        self.assertFalse(update_related_media())
+        self.media.refresh_from_db()
+        self.assertEqual(self.media.related_media_ids, [])
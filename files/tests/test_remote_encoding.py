@@ -0,0 +1,343 @@
+"""
+Tests for remote encoding workers: leases, resumable uploads and the agent.
+
+Tests cover:
+1. Workers lease the oldest pending encodings, and expired leases
+2. Only the worker holding a lease updates its encoding, and renews it
+3. encode_media leaves leased encodings alone, and claims the others
+   atomically
+4. Outputs are uploaded in ranges, resumed, and checked against md5sum
+5. The agent encodes an encoding end to end against a live server,
+   resuming its download with Range
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+from datetime import timedelta
+from unittest.mock import patch
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.http import HttpResponse
+from django.test import LiveServerTestCase, TestCase, override_settings
+from django.urls import include, path, re_path
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from files import encode_agent, remote_encoding
+from files.models import EncodeProfile, Encoding, Media
+from files.tasks import encode_media
+
+User = get_user_model()
+
+SOURCE = b"source video " * 1000
+SOURCE_MD5SUM = hashlib.md5(SOURCE).hexdigest()
+
+# ranges asked to serve_media
+served_ranges = []
+
+
+def serve_media(request, path):
+    """Media files with Range support, like nginx"""
+    with open(os.path.join(settings.MEDIA_ROOT, path), "rb") as f:
+        data = f.read()
+    match = re.match(r"bytes=(\d+)-$", request.headers.get("Range", ""))
+    served_ranges.append(request.headers.get("Range"))
+    if not match:
+        return HttpResponse(data, content_type="application/octet-stream")
+    start = int(match.group(1))
+    if start >= len(data):
+        return HttpResponse(status=416)
+    response = HttpResponse(data[start:], status=206, content_type="application/octet-stream")
+    response["Content-Range"] = f"bytes {start}-{len(data) - 1}/{len(data)}"
+    return response
+
+
+urlpatterns = [
+    re_path(r"^ranged-media/(?P<path>.*)$", serve_media),
+    path("", include("cms.urls")),
+]
+
+# stands in for ffmpeg: prints stats, and writes the source with a prefix
+FAKE_FFMPEG = """#!{python}
+import sys
+args = sys.argv[1:]
+source, output = args[args.index("-i") + 1], args[-1]
+sys.stderr.write("frame=1 time=00:00:05.00 bitrate=1\\r")
+with open(source, "rb") as f, open(output, "wb") as out:
+    out.write(b"encoded " + f.read())
+sys.stderr.write("frame=2 time=00:00:10.00 bitrate=1\\r\\n")
+"""
+
+
+class RemoteEncodingMixin:
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir, ignore_errors=True)
+        media_root = os.path.join(self.temp_dir, "media") + "/"
+        overrides = override_settings(
+            MEDIA_ROOT=media_root, TEMP_DIRECTORY=os.path.join(self.temp_dir, "tmp")
+        )
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        os.makedirs(os.path.join(media_root, "original"))
+        os.makedirs(os.path.join(self.temp_dir, "tmp"))
+        with open(os.path.join(media_root, "original", "source.mp4"), "wb") as f:
+            f.write(SOURCE)
+
+        self.admin = User.objects.create_superuser(
+            username="remote_admin", email="remote@example.com", password="pass"
+        )
+        with patch.object(Media, "media_init", return_value=None):
+            self.media = Media.objects.create(title="Remote film", user=self.admin)
+        Media.objects.filter(id=self.media.id).update(
+            media_file="original/source.mp4",
+            media_type="video",
+            duration=10,
+            md5sum=SOURCE_MD5SUM,
+            media_info=json.dumps(
+                {
+                    "video_frame_rate": 25,
+                    "video_height": 1080,
+                    "video_duration": 10,
+                    "has_audio": False,
+                }
+            ),
+        )
+        self.media.refresh_from_db()
+        # vp9 encodes don't create HLS
+        self.profile = EncodeProfile.objects.create(
+            name="vp9-240", extension="webm", resolution=240, codec="vp9"
+        )
+
+    def encoding(self, **kwargs):
+        kwargs.setdefault("status", "pending")
+        # without the post_save actions of encodings
+        return Encoding.objects.bulk_create(
+            [Encoding(media=self.media, profile=self.profile, **kwargs)]
+        )[0]
+
+
+class LeaseTest(RemoteEncodingMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client.force_login(self.admin)
+
+    def lease(self, worker="w1"):
+        return self.client.post(
+            "/api/v1/encodings/lease", {"worker": worker}, content_type="application/json"
+        )
+
+    def update(self, encoding, **data):
+        data["action"] = "update_fields"
+        return self.client.post(
+            f"/api/v1/media/encoding/{encoding.id}", data, content_type="application/json"
+        )
+
+    def test_lease(self):
+        gif = EncodeProfile.objects.create(name="gif", extension="gif", codec="gif")
+        Encoding.objects.bulk_create([Encoding(media=self.media, profile=gif, status="pending")])
+        first = self.encoding()
+        second = self.encoding()
+        self.encoding(status="running")
+
+        response = self.lease()
+        self.assertEqual(response.status_code, 201)
+        job = response.json()
+        self.assertEqual(job["encoding_id"], first.id)
+        self.assertEqual(job["source_url"], f"/media/original/source.mp4?v={self.media.media_version}")
+        self.assertEqual(job["original_media_md5sum"], SOURCE_MD5SUM)
+        self.assertIn(remote_encoding.TEMP_FILE, job["ffmpeg_commands"][-1])
+        first.refresh_from_db()
+        self.assertEqual((first.status, first.worker), ("running", "w1"))
+        self.assertGreater(first.lease_expires, timezone.now())
+
+        self.assertEqual(self.lease("w2").json()["encoding_id"], second.id)
+        # gifs are encoded locally
+        self.assertEqual(self.lease("w3").status_code, 204)
+
+        # the lease of a dead worker expires
+        Encoding.objects.filter(id=first.id).update(
+            lease_expires=timezone.now() - timedelta(seconds=1)
+        )
+        self.assertEqual(self.lease("w3").json()["encoding_id"], first.id)
+
+    def test_lease_skips_fair_share_queues(self):
+        queued = self.encoding()
+        released = self.encoding()
+        with patch(
+            "files.fair_share.get_queued_encodings", return_value={queued.id}
+        ) as get_queued:
+            self.assertEqual(self.lease().json()["encoding_id"], released.id)
+            self.assertEqual(self.lease("w2").status_code, 204)
+        get_queued.assert_called_with(released=False)
+
+    def test_lease_holder_updates(self):
+        encoding = self.encoding()
+        self.lease()
+        Encoding.objects.filter(id=encoding.id).update(
+            lease_expires=timezone.now() + timedelta(seconds=5)
+        )
+        self.assertEqual(self.update(encoding, worker="w2", progress=50).status_code, 409)
+
+        response = self.update(encoding, worker="w1", progress=50)
+        self.assertEqual(response.status_code, 201)
+        encoding.refresh_from_db()
+        self.assertEqual(encoding.progress, 50)
+        self.assertGreater(encoding.lease_expires, timezone.now() + timedelta(seconds=60))
+
+        response = self.update(
+            encoding, worker="w1", status="fail", wall_time=12.5, cpu_time=40, preset="speed=2"
+        )
+        self.assertEqual(response.status_code, 201)
+        encoding.refresh_from_db()
+        self.assertEqual((encoding.status, encoding.wall_time, encoding.preset), ("fail", 12.5, "speed=2"))
+        self.assertEqual(self.update(encoding, worker="w1", crf="high").status_code, 400)
+
+    def test_encode_media_skips_leased(self):
+        encoding = self.encoding(
+            status="running", worker="w1", lease_expires=timezone.now() + timedelta(minutes=5)
+        )
+        self.assertFalse(encode_media(self.media.friendly_token, self.profile.id, encoding.id, ""))
+        encoding.refresh_from_db()
+        self.assertEqual((encoding.status, encoding.worker), ("running", "w1"))
+
+        self.assertFalse(remote_encoding.is_leased(self.encoding()))
+        expired = self.encoding(status="running", lease_expires=timezone.now())
+        self.assertFalse(remote_encoding.is_leased(expired))
+        done = self.encoding(status="success", lease_expires=timezone.now())
+        self.assertTrue(remote_encoding.is_leased(done))
+
+    def test_encode_media_claims(self):
+        # a task running it already
+        running = self.encoding(status="running", worker="local")
+        self.assertFalse(encode_media(self.media.friendly_token, self.profile.id, running.id, ""))
+        running.refresh_from_db()
+        self.assertEqual(running.worker, "local")
+
+        pending = self.encoding()
+        self.assertTrue(remote_encoding.claim_encoding(pending.id))
+        self.assertFalse(remote_encoding.claim_encoding(pending.id))
+        # a remote worker can't lease it anymore
+        self.assertEqual(self.lease().status_code, 204)
+
+        expired = self.encoding(
+            status="running", worker="w1", lease_expires=timezone.now() - timedelta(seconds=1)
+        )
+        self.assertTrue(remote_encoding.claim_encoding(expired.id))
+        expired.refresh_from_db()
+        self.assertEqual((expired.status, expired.lease_expires), ("running", None))
+
+    def test_finished_encodings_are_not_claimed(self):
+        # a task delivered again after its encode finished
+        for status in ("success", "fail"):
+            done = self.encoding(status=status, worker="local", progress=100)
+            self.assertFalse(remote_encoding.claim_encoding(done.id))
+            self.assertFalse(
+                encode_media(self.media.friendly_token, self.profile.id, done.id, "")
+            )
+            done.refresh_from_db()
+            self.assertEqual((done.status, done.worker), (status, "local"))
+
+    def put_range(self, encoding, data, start, total, worker="w1", md5sum=""):
+        headers = {"HTTP_CONTENT_RANGE": f"bytes {start}-{start + len(data) - 1}/{total}"}
+        if md5sum:
+            headers["HTTP_X_MD5SUM"] = md5sum
+        return self.client.put(
+            f"/api/v1/media/encoding/{encoding.id}?worker={worker}",
+            data,
+            content_type="application/octet-stream",
+            **headers,
+        )
+
+    def uploaded(self, encoding, worker="w1"):
+        response = self.client.get(f"/api/v1/media/encoding/{encoding.id}", {"worker": worker})
+        return response.json()["uploaded"]
+
+    def test_upload_ranges(self):
+        encoding = self.encoding()
+        self.lease()
+        output = b"encoded video" * 100
+        md5sum = hashlib.md5(output).hexdigest()
+        total = len(output)
+
+        self.assertEqual(self.put_range(encoding, output[:500], 0, total).json(), {"uploaded": 500})
+        # out of order, and other workers, are refused
+        response = self.put_range(encoding, output[800:], 800, total)
+        self.assertEqual((response.status_code, response.json()), (409, {"uploaded": 500}))
+        self.assertEqual(self.put_range(encoding, output[500:], 500, total, worker="w2").status_code, 409)
+        self.assertEqual(self.uploaded(encoding), 500)
+
+        # the last range is checked against the md5sum
+        response = self.put_range(encoding, output[500:], 500, total, md5sum="0" * 32)
+        self.assertEqual((response.status_code, response.json()), (409, {"uploaded": 0}))
+        self.put_range(encoding, output[:500], 0, total)
+        response = self.put_range(encoding, output[500:], 500, total, md5sum=md5sum)
+        self.assertEqual(response.json(), {"uploaded": total})
+
+        encoding.refresh_from_db()
+        self.assertEqual(encoding.media_file.read(), output)
+        self.assertTrue(encoding.media_file.name.endswith(".webm"))
+        self.assertEqual(self.uploaded(encoding), 0)
+
+
+@override_settings(ROOT_URLCONF=__name__)
+class EncodeAgentTest(RemoteEncodingMixin, LiveServerTestCase):
+    def setUp(self):
+        super().setUp()
+        # the live server serves the MEDIA_URL it started with itself,
+        # without Range support
+        media_url = override_settings(MEDIA_URL="/ranged-media/")
+        media_url.enable()
+        self.addCleanup(media_url.disable)
+        served_ranges.clear()
+        self.ffmpeg = os.path.join(self.temp_dir, "ffmpeg")
+        with open(self.ffmpeg, "w") as f:
+            f.write(FAKE_FFMPEG.format(python=sys.executable))
+        os.chmod(self.ffmpeg, 0o755)
+        token = Token.objects.create(user=self.admin)
+        self.agent = encode_agent.EncodeAgent(
+            self.live_server_url,
+            token.key,
+            name="spare-1",
+            work_dir=os.path.join(self.temp_dir, "agent"),
+            ffmpeg=self.ffmpeg,
+        )
+        self.addCleanup(self.agent.session.close)
+
+    @patch.object(encode_agent, "PROGRESS_INTERVAL", 0)
+    @patch.object(encode_agent, "UPLOAD_CHUNK", 5000)
+    def test_encode(self):
+        encoding = self.encoding()
+        # an interrupted download
+        part = os.path.join(self.agent.work_dir, "sources", SOURCE_MD5SUM + ".mp4.part")
+        with open(part, "wb") as f:
+            f.write(SOURCE[:4000])
+
+        self.assertTrue(self.agent.run_once())
+        self.assertIn("bytes=4000-", served_ranges)
+
+        encoding.refresh_from_db()
+        self.assertEqual(encoding.status, "success")
+        self.assertEqual(encoding.worker, "spare-1")
+        self.assertEqual(encoding.media_file.read(), b"encoded " + SOURCE)
+        self.assertEqual(encoding.output_size, len(SOURCE) + 8)
+        self.assertEqual(encoding.pass_mode, "crf")
+        self.assertGreater(encoding.wall_time, 0)
+        self.assertEqual(
+            Media.objects.values_list("encoding_status", flat=True).get(id=self.media.id), "pending"
+        )
+        # nothing left to lease
+        self.assertFalse(self.agent.run_once())
+
+    def test_failed_encode(self):
+        encoding = self.encoding()
+        Media.objects.filter(id=self.media.id).update(md5sum="0" * 32)
+        self.assertTrue(self.agent.run_once())
+        encoding.refresh_from_db()
+        self.assertEqual(encoding.status, "fail")
+        self.assertIn("md5sum", encoding.logs)
@@ -0,0 +1,161 @@
+"""
+Tests for scratch space of encode intermediates.
+
+Tests cover:
+1. Expected encode sizes, from the target bitrates or the original
+2. Reservations count for what they haven't written, and are refused
+   when the volume is full
+3. encode_media waits for scratch space, published again with a delay
+   through the fair-share queues
+4. Reservations of dead processes are dropped (needs Redis)
+"""
+import os
+import shutil
+import tempfile
+from collections import namedtuple
+from unittest import skipUnless
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+
+from files import scratch
+from files.models import EncodeProfile, Encoding, Media
+from files.tasks import encode_media
+from files.tests.helpers import redis_available
+
+User = get_user_model()
+
+DiskUsage = namedtuple("DiskUsage", ["total", "used", "free"])
+
+
+class ScratchMixin:
+    def setUp(self):
+        self.scratch_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.scratch_dir, ignore_errors=True)
+        patcher = override_settings(SCRATCH_DIRECTORY=self.scratch_dir, SCRATCH_MIN_FREE=100)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+        patcher = patch.object(
+            scratch.shutil, "disk_usage", return_value=DiskUsage(2000, 1000, 1000)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def write(self, directory, nbytes):
+        with open(os.path.join(directory, "out.mp4"), "wb") as f:
+            f.write(b"0" * nbytes)
+
+
+@override_settings(SCRATCH_CHUNKS=False)
+class ScratchTest(ScratchMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user(
+            username="scratch_user", email="scratch@example.com", password="pass"
+        )
+        self.profile = EncodeProfile.objects.create(
+            name="h264-720", extension="mp4", resolution=720, codec="h264"
+        )
+        with patch.object(Media, "media_init", return_value=None):
+            self.media = Media.objects.create(title="Feature", user=self.user)
+        Media.objects.filter(id=self.media.id).update(
+            media_type="video",
+            video_height=1080,
+            duration=3600,
+            media_file="original/user/scratch_user/feature.mp4",
+        )
+        self.media.refresh_from_db()
+
+    def test_estimate(self):
+        size = scratch.estimate_encode_size(self.media, self.profile)
+        # 720p h264 at up to 4000 kbit/s, with audio
+        self.assertGreater(size, 3600 * 2500 * 1000 / 8)
+        with override_settings(VIDEO_CHUNKS_DURATION=240):
+            self.assertEqual(
+                scratch.estimate_encode_size(self.media, self.profile, chunk=True),
+                size * 240 // 3600,
+            )
+
+        # the original, without a target bitrate
+        gif = EncodeProfile.objects.create(name="preview-gif", extension="gif", codec="gif")
+        with patch.object(scratch.os.path, "getsize", return_value=1234):
+            self.assertEqual(scratch.estimate_encode_size(self.media, gif), 1234)
+
+    def test_reservations(self):
+        first = scratch.reserve(400)
+        self.assertTrue(os.path.isdir(first.directory))
+        self.assertEqual(scratch.get_available(), 500)
+        with self.assertRaises(scratch.ScratchFull):
+            scratch.reserve(600)
+
+        # written bytes are gone from the free space already
+        self.write(first.directory, 300)
+        self.assertEqual(scratch.get_reserved(), 100)
+        with scratch.reserve(600, encoding_id=1) as directory:
+            self.assertTrue(directory.startswith(self.scratch_dir))
+            self.assertEqual(scratch.get_available(), 200)
+            self.assertFalse(scratch.has_space(201))
+        self.assertFalse(os.path.exists(directory))
+
+        first.release()
+        self.assertEqual(scratch.get_reserved(), 0)
+        # larger than the volume, waits until it is empty
+        with self.assertRaises(scratch.ScratchFull):
+            scratch.reserve(5000)
+        with patch.object(scratch.shutil, "disk_usage", return_value=DiskUsage(2000, 0, 2000)):
+            scratch.reserve(5000).release()
+
+    def test_chunks_directory(self):
+        self.assertEqual(scratch.get_chunks_directory("/media/original"), "/media/original")
+        with override_settings(SCRATCH_CHUNKS=True):
+            directory = scratch.get_chunks_directory("/media/original")
+        self.assertEqual(directory, os.path.join(self.scratch_dir, "chunks"))
+        self.assertTrue(os.path.isdir(directory))
+
+    def test_encode_waits(self):
+        encoding = Encoding.objects.bulk_create(
+            [Encoding(media=self.media, profile=self.profile)]
+        )[0]
+        args = [self.media.friendly_token, self.profile.id, encoding.id, "url"]
+        with patch.object(scratch, "reserve", side_effect=scratch.ScratchFull("full")), patch(
+            "files.tasks.encode_media.apply_async"
+        ) as apply_async, override_settings(SCRATCH_DELAY=30):
+            self.assertFalse(encode_media.apply(args=args, kwargs={"force": True}).get())
+        encoding.refresh_from_db()
+        self.assertEqual(encoding.status, "pending")
+        self.assertEqual(apply_async.call_args.kwargs["args"], args)
+        self.assertEqual(apply_async.call_args.kwargs["kwargs"], {"force": True})
+        self.assertEqual(apply_async.call_args.kwargs["countdown"], 30)
+
+    def test_encode_waits_in_the_fair_share_queues(self):
+        encoding = Encoding.objects.bulk_create(
+            [Encoding(media=self.media, profile=self.profile)]
+        )[0]
+        args = [self.media.friendly_token, self.profile.id, encoding.id, "url"]
+        with patch.object(scratch, "reserve", side_effect=scratch.ScratchFull("full")), patch(
+            "files.fair_share.publish_encode"
+        ) as publish_encode, override_settings(SCRATCH_DELAY=30):
+            self.assertFalse(encode_media.apply(args=args).get())
+        self.assertEqual(publish_encode.call_args.args[1], args)
+        self.assertEqual(publish_encode.call_args.kwargs["countdown"], 30)
+
+
+@skipUnless(redis_available(), "needs the django-redis cache")
+class ScratchRedisTest(ScratchMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.redis = scratch.get_redis()
+        self.addCleanup(self.redis.delete, scratch.get_reservations_key())
+
+    def test_dead_reservations(self):
+        reservation = scratch.reserve(300)
+        # a reservation of another worker process, that died
+        dead = scratch.Reservation(tempfile.mkdtemp(dir=self.scratch_dir), 500)
+        with patch.object(scratch.os, "getpid", return_value=2 ** 22 + 1):
+            dead.register()
+        scratch._local.pop(dead.directory)
+        self.assertEqual(scratch.get_reserved(), 300)
+        self.assertEqual(list(scratch.get_reservations()), [reservation.directory])
+        reservation.release()
+        self.assertEqual(scratch.get_reservations(), {})
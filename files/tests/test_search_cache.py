@@ -0,0 +1,74 @@
+"""
+Tests for the search result cache.
+
+Tests cover:
+1. Identical searches are served from cache without touching the database
+2. Equivalent parameter sets share a cache entry
+3. Changes to listable media invalidate cached results (catalog generation),
+   saves of fields the listings don't depend on don't
+"""
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+
+from files.cache_utils import bump_catalog_generation, get_catalog_generation
+from files.models import Tag
+from files.tests.helpers import create_public_media
+
+User = get_user_model()
+
+
+@override_settings(ENABLE_SEARCH_CACHE=True)
+class SearchCacheTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.user = User.objects.create_user(
+            username="search_cache_user", email="search@example.com", password="pass"
+        )
+        self.tag = Tag.objects.create(title="documentary")
+        self.media = create_public_media(self.user, "First film")
+        self.media.tags.add(self.tag)
+
+    def test_identical_search_is_served_from_cache(self):
+        response = self.client.get("/api/v1/search", {"t": "documentary"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()["count"], 1)
+
+        with self.assertNumQueries(0):
+            cached = self.client.get("/api/v1/search", {"t": "documentary"})
+        self.assertEqual(cached.json(), response.json())
+
+    def test_equivalent_parameters_share_cache_entry(self):
+        self.client.get("/api/v1/search", {"t": "documentary"})
+        with self.assertNumQueries(0):
+            # explicit default ordering and sorting normalize to the same key
+            self.client.get(
+                "/api/v1/search",
+                {"t": "documentary", "ordering": "desc", "sort_by": "add_date"},
+            )
+
+    def test_media_change_invalidates_cached_results(self):
+        generation = get_catalog_generation()
+        self.client.get("/api/v1/search", {"t": "documentary"})
+
+        second = create_public_media(self.user, "Second film")
+        second.tags.add(self.tag)
+        self.assertNotEqual(get_catalog_generation(), generation)
+
+        response = self.client.get("/api/v1/search", {"t": "documentary"})
+        self.assertEqual(response.json()["count"], 2)
+
+    def test_saves_of_other_fields_keep_cached_results(self):
+        generation = get_catalog_generation()
+        self.media.views = 10
+        self.media.save(update_fields=["views"])
+        self.assertEqual(get_catalog_generation(), generation)
+
+        self.media.featured = True
+        self.media.save(update_fields=["featured"])
+        self.assertNotEqual(get_catalog_generation(), generation)
+
+    def test_bump_catalog_generation(self):
+        generation = get_catalog_generation()
+        self.assertTrue(bump_catalog_generation())
+        self.assertGreater(get_catalog_generation(), generation)
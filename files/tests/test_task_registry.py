@@ -0,0 +1,117 @@
+"""
+Tests for the Redis task registry behind list_tasks.
+
+Tests cover:
+1. Without Redis, list_tasks inspects the workers
+2. Tasks move from reserved or scheduled to active, and leave when done
+   (needs Redis)
+3. list_tasks reads encodes with one query, and drops expired tasks
+   (needs Redis)
+"""
+from types import SimpleNamespace
+from unittest import skipUnless
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from files import methods, task_registry
+from files.cache_utils import CACHE_KEY_PREFIX
+from files.models import EncodeProfile, Encoding, Media
+from files.tests.helpers import redis_available
+
+User = get_user_model()
+
+
+def publish(task_id, name, args, queue="long_tasks", eta=None):
+    task_registry.task_published_handler(
+        sender=name,
+        headers={"id": task_id, "task": name, "eta": eta},
+        body=(args, {}, {}),
+        routing_key=queue,
+    )
+
+
+def fake_task(name, queue="long_tasks"):
+    return SimpleNamespace(
+        name=name,
+        request=SimpleNamespace(hostname="worker@encoder", delivery_info={"routing_key": queue}),
+    )
+
+
+class TaskRegistryFallbackTest(TestCase):
+    def test_inspects_workers_without_redis(self):
+        with patch.object(task_registry, "get_redis", return_value=None), patch.object(
+            methods, "inspect_tasks", return_value={"task_ids": []}
+        ) as inspect_tasks:
+            self.assertEqual(methods.list_tasks(), {"task_ids": []})
+        inspect_tasks.assert_called_once()
+
+
+@skipUnless(redis_available(), "needs the django-redis cache")
+class TaskRegistryTest(TestCase):
+    def setUp(self):
+        self.client_redis = task_registry.get_redis()
+        self.addCleanup(self.clear_keys)
+        self.clear_keys()
+        user = User.objects.create_user(
+            username="registry_user", email="registry@example.com", password="pass"
+        )
+        with patch.object(Media, "media_init", return_value=None):
+            self.media = Media.objects.create(title="Encoded film", user=user)
+        self.profile = EncodeProfile.objects.create(
+            name="h264-720", extension="mp4", resolution=720, codec="h264"
+        )
+        self.encoding = Encoding.objects.bulk_create(
+            [Encoding(media=self.media, profile=self.profile, status="running", progress=40)]
+        )[0]
+
+    def clear_keys(self):
+        for key in self.client_redis.scan_iter(f"{CACHE_KEY_PREFIX}:task_registry:*"):
+            self.client_redis.delete(key)
+
+    def encode_args(self):
+        return [self.media.friendly_token, self.profile.id, self.encoding.id, "url"]
+
+    def states(self):
+        registered = task_registry.get_registered_tasks()
+        return {state: [t["task_id"] for t in tasks] for state, tasks in registered.items()}
+
+    def test_task_lifecycle(self):
+        publish("t1", "encode_media", self.encode_args())
+        publish("t2", "create_hls", [self.media.friendly_token], eta="2030-01-01T00:00:00")
+        publish("t3", "save_user_action", [{}], queue="short_tasks")
+        self.assertEqual(self.states(), {"active": [], "reserved": ["t1"], "scheduled": ["t2"]})
+
+        task = fake_task("encode_media")
+        task_registry.task_started_handler(task_id="t1", task=task, args=self.encode_args())
+        self.assertEqual(self.states(), {"active": ["t1"], "reserved": [], "scheduled": ["t2"]})
+
+        task_registry.task_finished_handler(task_id="t1", task=task)
+        task_registry.unregister_task("t2")
+        self.assertEqual(self.states(), {"active": [], "reserved": [], "scheduled": []})
+
+    def test_list_tasks(self):
+        publish("t1", "encode_media", self.encode_args())
+        task_registry.task_started_handler(
+            task_id="t1", task=fake_task("encode_media"), args=self.encode_args()
+        )
+        publish("t2", "produce_sprite_from_video", [self.media.friendly_token])
+        with self.assertNumQueries(1):
+            ret = methods.list_tasks()
+        self.assertEqual(ret["task_ids"], ["t1", "t2"])
+        self.assertEqual(ret["media_profile_pairs"], [(self.media.friendly_token, self.profile.id)])
+        active = ret["active"]["tasks"][0]
+        self.assertEqual(active["worker"], "worker@encoder")
+        self.assertEqual(
+            active["info"],
+            {"profile name": "h264-720", "media title": "Encoded film", "encoding progress": 40},
+        )
+        self.assertEqual(ret["reserved"]["tasks"][0]["name"], "produce_sprite_from_video")
+
+    def test_expired_tasks_are_dropped(self):
+        publish("t1", "create_hls", [self.media.friendly_token])
+        self.client_redis.delete(task_registry.TASK_KEY_TEMPLATE.format(task_id="t1"))
+        self.assertEqual(self.states()["reserved"], [])
+        key = task_registry.STATE_KEY_TEMPLATE.format(queue="long_tasks", state="reserved")
+        self.assertEqual(self.client_redis.zcard(key), 0)
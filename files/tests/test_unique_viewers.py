@@ -0,0 +1,130 @@
+"""
+Tests for the approximate unique viewers of media.
+
+Tests cover:
+1. Viewers are identified by user, session, then IP
+2. Without Redis nothing is counted and the stats endpoint says so
+3. Viewers are counted once per window, across days (needs Redis)
+4. Day sketches are persisted in the watch rollups and counted from
+   there once expired (needs Redis)
+"""
+from datetime import timedelta
+from unittest import skipUnless
+from unittest.mock import patch
+
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+from django.utils import timezone
+
+from actions.models import MediaActionDaily
+from files import unique_viewers
+from files.action_buffer import apply_user_actions
+from files.action_rollups import day_bounds, rollup_day
+from files.cache_utils import CACHE_KEY_PREFIX
+from files.tests.helpers import create_public_media, redis_available
+
+User = get_user_model()
+
+
+class UniqueViewersFallbackTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="audience_user", email="audience@example.com", password="pass"
+        )
+        self.viewer = User.objects.create_user(
+            username="audience_viewer", email="viewer@example.com", password="pass"
+        )
+        self.media = create_public_media(self.user, "Seen film")
+
+    def test_viewer_id(self):
+        self.assertEqual(unique_viewers.get_viewer_id(3, "s1", "10.0.0.1"), "user:3")
+        self.assertEqual(unique_viewers.get_viewer_id(None, "s1", "10.0.0.1"), "session:s1")
+        self.assertEqual(unique_viewers.get_viewer_id(None, None, "10.0.0.1"), "ip:10.0.0.1")
+
+    def test_no_redis(self):
+        with patch.object(unique_viewers, "get_redis", return_value=None):
+            self.assertFalse(unique_viewers.add_viewers([(self.media.id, "user:1", None)]))
+            self.assertIsNone(
+                unique_viewers.count_unique_viewers(self.media.id, timezone.localdate())
+            )
+            self.client.force_login(self.user)
+            data = self.client.get(f"/api/v1/media/{self.media.friendly_token}/stats").json()
+        self.assertIsNone(data["unique_viewers"])
+        self.assertEqual(data["views"], self.media.views)
+
+    def test_stats_permissions(self):
+        url = f"/api/v1/media/{self.media.friendly_token}/stats"
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_login(self.viewer)
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get("/api/v1/media/missing/stats").status_code, 404)
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get(url, {"days": "many"}).status_code, 400)
+
+
+@skipUnless(redis_available(), "needs the django-redis cache")
+class RedisUniqueViewersTest(TestCase):
+    def setUp(self):
+        self.client_redis = unique_viewers.get_redis()
+        self.addCleanup(self.clear_keys)
+        self.clear_keys()
+        self.user = User.objects.create_user(
+            username="audience_user", email="audience@example.com", password="pass"
+        )
+        self.media = create_public_media(self.user, "Seen film")
+        self.today = timezone.localdate()
+
+    def clear_keys(self):
+        for key in self.client_redis.scan_iter(f"{CACHE_KEY_PREFIX}:unique_viewers:*"):
+            self.client_redis.delete(key)
+
+    def at(self, days):
+        return day_bounds(self.today - timedelta(days=days))[0] + timedelta(hours=12)
+
+    def test_viewers_counted_once_across_days(self):
+        unique_viewers.add_viewers(
+            [
+                (self.media.id, "user:1", self.at(2)),
+                (self.media.id, "user:1", self.at(0)),
+                (self.media.id, "session:s1", self.at(1)),
+                (self.media.id, "session:s1", self.at(1)),
+                (self.media.id, "ip:10.0.0.1", self.at(0)),
+            ]
+        )
+        count = unique_viewers.count_unique_viewers
+        self.assertEqual(count(self.media.id, self.today - timedelta(days=2)), 3)
+        self.assertEqual(count(self.media.id, self.today), 2)
+        self.assertEqual(
+            count(self.media.id, self.today - timedelta(days=5), self.today - timedelta(days=3)), 0
+        )
+
+    def test_buffered_watches_are_counted(self):
+        entries = [
+            {
+                "user_id": None,
+                "session_key": f"s{i}",
+                "remote_ip": f"10.0.0.{i}",
+                "friendly_token": self.media.friendly_token,
+                "action": "watch",
+                "ts": timezone.now().timestamp(),
+            }
+            for i in range(3)
+        ]
+        apply_user_actions(entries)
+        self.assertEqual(unique_viewers.count_unique_viewers(self.media.id, self.today), 3)
+
+    def test_sketches_persisted_by_rollups(self):
+        day = self.today - timedelta(days=1)
+        unique_viewers.add_viewers(
+            [(self.media.id, f"session:s{i}", self.at(1)) for i in range(5)]
+        )
+        rollup_day(day)
+        rollup = MediaActionDaily.objects.get(media=self.media, day=day, action="watch")
+        # no watch rows, the sketch still counts its viewers
+        self.assertEqual((rollup.count, rollup.unique_viewers), (0, 5))
+        self.assertIsNotNone(rollup.viewers_sketch)
+
+        # expired from Redis, rolling up again keeps the sketch
+        self.clear_keys()
+        rollup_day(day)
+        self.assertEqual(unique_viewers.count_unique_viewers(self.media.id, day), 5)
@@ -0,0 +1,90 @@
+"""
+Tests for the signed viewer id cookie of anonymous viewers.
+
+Tests cover:
+1. Anonymous actions get a viewer id cookie instead of a session
+2. The cookie identifies the viewer on later requests, tampered ones don't
+3. Viewers with a session get a new id, their history moves to it
+4. Anonymous history is read with the cookie
+"""
+from unittest.mock import patch
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import TestCase
+
+from actions.models import MediaAction
+from files.tests.helpers import create_public_media
+
+User = get_user_model()
+
+
+@patch("files.views.buffer_user_action")
+class ViewerIdTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username="viewer_id_user", email="viewerid@example.com", password="pass"
+        )
+        self.media = create_public_media(self.user, "Anonymous film")
+        self.url = f"/api/v1/media/{self.media.friendly_token}/actions"
+
+    def like(self):
+        return self.client.post(self.url, {"type": "like"}, content_type="application/json")
+
+    def test_anonymous_action_sets_cookie_not_session(self, buffer_user_action):
+        response = self.like()
+        self.assertEqual(response.status_code, 201)
+        self.assertIn(settings.VIEWER_ID_COOKIE_NAME, response.cookies)
+        self.assertNotIn(settings.SESSION_COOKIE_NAME, response.cookies)
+        viewer_id = buffer_user_action.call_args[0][0]["user_session"]
+        self.assertEqual(len(viewer_id), 32)
+
+        # known on the next request, no new cookie
+        response = self.like()
+        self.assertNotIn(settings.VIEWER_ID_COOKIE_NAME, response.cookies)
+        self.assertEqual(buffer_user_action.call_args[0][0]["user_session"], viewer_id)
+
+    def test_tampered_cookie_is_replaced(self, buffer_user_action):
+        self.client.cookies[settings.VIEWER_ID_COOKIE_NAME] = "forged"
+        response = self.like()
+        self.assertIn(settings.VIEWER_ID_COOKIE_NAME, response.cookies)
+        self.assertNotEqual(buffer_user_action.call_args[0][0]["user_session"], "forged")
+
+    def test_session_history_is_carried_over(self, buffer_user_action):
+        session = self.client.session
+        session["seen"] = True
+        session.save()
+        self.client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+        watch = MediaAction.objects.create(
+            media=self.media, action="watch", session_key=session.session_key
+        )
+        history = "/api/v1/user/action/watch"
+        self.assertEqual(len(self.client.get(history).json()["results"]), 1)
+
+        response = self.like()
+        self.assertIn(settings.VIEWER_ID_COOKIE_NAME, response.cookies)
+        viewer_id = buffer_user_action.call_args[0][0]["user_session"]
+        # a new id, the session key stays out of the cookie
+        self.assertNotEqual(viewer_id, session.session_key)
+        cookie = response.cookies[settings.VIEWER_ID_COOKIE_NAME].value
+        self.assertNotIn(session.session_key, cookie)
+        watch.refresh_from_db()
+        self.assertEqual(watch.session_key, viewer_id)
+        self.assertEqual(len(self.client.get(history).json()["results"]), 1)
+
+    def test_logged_in_users_get_no_cookie(self, buffer_user_action):
+        self.client.force_login(self.user)
+        response = self.like()
+        self.assertNotIn(settings.VIEWER_ID_COOKIE_NAME, response.cookies)
+        self.assertEqual(buffer_user_action.call_args[0][0]["user_id"], self.user.id)
+
+    def test_anonymous_history(self, buffer_user_action):
+        history = "/api/v1/user/action/watch"
+        self.assertEqual(self.client.get(history).json()["results"], [])
+        self.like()
+        viewer_id = buffer_user_action.call_args[0][0]["user_session"]
+        MediaAction.objects.create(media=self.media, action="watch", session_key=viewer_id)
+        results = self.client.get(history).json()["results"]
+        self.assertEqual(
+            [m["friendly_token"] for m in results], [self.media.friendly_token]
+        )
@@ -0,0 +1,139 @@
+"""
+Tests for segmented whisper.cpp transcription.
+
+Tests cover:
+1. Silences are read from silencedetect, and windows cut at the silence
+   closest to each cut
+2. The VTT of windows are merged with their offsets
+3. Windows are split in one ffmpeg pass and transcribed by a pool of
+   whisper.cpp processes
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+from types import SimpleNamespace
+from unittest.mock import patch
+
+from django.test import SimpleTestCase, override_settings
+
+from files import whisper_segments
+
+SILENCEDETECT_OUTPUT = b"""
+[silencedetect @ 0x1] silence_start: 290.5
+[silencedetect @ 0x1] silence_end: 291.5 | silence_duration: 1
+[silencedetect @ 0x1] silence_start: 330
+[silencedetect @ 0x1] silence_end: 332 | silence_duration: 2
+[silencedetect @ 0x1] silence_start: 605.2
+[silencedetect @ 0x1] silence_end: 606.8 | silence_duration: 1.6
+"""
+
+
+def completed(cmd, returncode=0, stderr=b""):
+    return subprocess.CompletedProcess(cmd, returncode, b"", stderr)
+
+
+def write_vtt(path, cues):
+    with open(path, "w") as f:
+        f.write("WEBVTT\n\n")
+        for start, end, text in cues:
+            f.write(f"{start} --> {end}\n{text}\n\n")
+
+
+@override_settings(
+    FFMPEG_COMMAND="ffmpeg",
+    WHISPER_SEGMENTED_DURATION=1800,
+    WHISPER_SEGMENT_SECONDS=300,
+    WHISPER_SEGMENT_THREADS=4,
+    WHISPER_SEGMENT_PROCESSES=0,
+)
+class WhisperSegmentsTest(SimpleTestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.temp_dir)
+
+    def test_windows(self):
+        self.assertFalse(whisper_segments.is_segmented(SimpleNamespace(duration=1800)))
+        self.assertTrue(whisper_segments.is_segmented(SimpleNamespace(duration=7200)))
+        with override_settings(WHISPER_SEGMENTED_DURATION=0):
+            self.assertFalse(whisper_segments.is_segmented(SimpleNamespace(duration=7200)))
+
+        ret = completed([], stderr=SILENCEDETECT_OUTPUT)
+        with patch.object(whisper_segments.processes, "run", return_value=ret):
+            silences = whisper_segments.detect_silences("audio.wav")
+        self.assertEqual(silences, [(290.5, 291.5), (330.0, 332.0), (605.2, 606.8)])
+
+        windows = whisper_segments.plan_windows(950, silences, 300)
+        # the closest silences, a hard cut without one
+        self.assertEqual(windows, [(0.0, 291.0), (291.0, 606.0), (606.0, None)])
+        self.assertEqual(
+            whisper_segments.plan_windows(500, [], 300), [(0.0, 300.0), (300.0, None)]
+        )
+        self.assertEqual(whisper_segments.plan_windows(360, [], 300), [(0.0, None)])
+
+    def test_merge(self):
+        first = os.path.join(self.temp_dir, "first.vtt")
+        second = os.path.join(self.temp_dir, "second.vtt")
+        write_vtt(
+            first,
+            [("00:00:00.000", "00:00:04.500", " Hello."), ("00:04:50.000", "00:04:51.000", " ")],
+        )
+        write_vtt(second, [("00:00:01.250", "00:00:03.000", " Two\n lines")])
+        output = os.path.join(self.temp_dir, "merged.vtt")
+
+        self.assertEqual(whisper_segments.merge_vtt([(0, first), (3599.5, second)], output), 2)
+        with open(output) as f:
+            self.assertEqual(
+                f.read(),
+                "WEBVTT\n\n"
+                "00:00:00.000 --> 00:00:04.500\n Hello.\n\n"
+                "01:00:00.750 --> 01:00:02.500\n Two\n lines\n\n",
+            )
+
+    def test_transcribe(self):
+        audio = os.path.join(self.temp_dir, "film.wav")
+        commands = []
+
+        def run(cmd, **kwargs):
+            commands.append(cmd)
+            if "silencedetect" in " ".join(cmd):
+                return completed(cmd, stderr=SILENCEDETECT_OUTPUT)
+            if "segment" in cmd:
+                for i in range(3):
+                    open(cmd[-1] % i, "wb").close()
+                return completed(cmd)
+            # whisper.cpp, a cue at the start of each window
+            output = cmd[cmd.index("--output-file") + 1]
+            cue = ("00:00:00.500", "00:00:02.000", os.path.basename(output))
+            write_vtt(f"{output}.vtt", [cue])
+            return completed(cmd)
+
+        output = os.path.join(self.temp_dir, "film.vtt")
+        with patch.object(whisper_segments.processes, "run", side_effect=run), patch.object(
+            whisper_segments.os, "cpu_count", return_value=8
+        ), patch.object(
+            whisper_segments, "ThreadPoolExecutor", wraps=whisper_segments.ThreadPoolExecutor
+        ) as pool:
+            cues = whisper_segments.transcribe(
+                audio, 950, ["whisper", "-m", "model"], output, self.temp_dir
+            )
+        self.assertEqual(cues, 3)
+        pool.assert_called_once_with(max_workers=2)
+
+        split = commands[1]
+        self.assertEqual(split[split.index("-segment_times") + 1], "291.000,606.000")
+        whisper = [cmd for cmd in commands if cmd[0] == "whisper"]
+        self.assertEqual(len(whisper), 3)
+        self.assertEqual(whisper[0][:5], ["whisper", "-m", "model", "--threads", "4"])
+        with open(output) as f:
+            self.assertIn("00:10:06.500 --> 00:10:08.000\nwindow_0002", f.read())
+
+        # a failed window fails the transcription
+        def fail_whisper(cmd, **kwargs):
+            if cmd[0] == "whisper":
+                return completed(cmd, returncode=1, stderr=b"out of memory")
+            return run(cmd)
+
+        with patch.object(whisper_segments.processes, "run", side_effect=fail_whisper):
+            with self.assertRaises(RuntimeError):
+                whisper_segments.transcribe(audio, 950, ["whisper"], output, self.temp_dir)
@@ -61,6 +61,11 @@ urlpatterns = [
         views.MediaDetail.as_view(),
         name="api_get_media",
     ),
+    re_path(
+        r"^api/v1/encodings/lease$",
+        views.EncodingLease.as_view(),
+        name="api_lease_encoding",
+    ),
     re_path(
         r"^api/v1/media/encoding/(?P<encoding_id>[\w]*)$",
         views.EncodingDetail.as_view(),
@@ -71,6 +76,11 @@ urlpatterns = [
         r"^api/v1/media/(?P<friendly_token>[\w]+(-[\w]+)*)/actions$",
         views.MediaActions.as_view(),
     ),
+    re_path(
+        r"^api/v1/media/(?P<friendly_token>[\w]+(-[\w]+)*)/stats$",
+        views.MediaStats.as_view(),
+        name="api_media_stats",
+    ),
     #    url(r'^api/v1/media/(?P<friendly_token>[\w]*)/subtitless$',
     #        views.MediaSubtitles.as_view()),
     re_path("^api/v1/categories$", views.CategoryList.as_view()),
@@ -106,6 +116,8 @@ urlpatterns = [
     re_path("^manage/comments$", views.manage_comments, name="manage_comments"),
     re_path("^manage/users/export$", views.export_users, name="export_users"),
     re_path("^api/v1/encode_profiles/$", views.EncodeProfileList.as_view()),
+    re_path("^api/v1/encode_stats$", views.EncodeStats.as_view(), name="api_encode_stats"),
+    re_path("^api/v1/encode_queue$", views.EncodeQueue.as_view(), name="api_encode_queue"),
     re_path("^api/v1/tasks$", views.TasksList.as_view()),
     re_path("^api/v1/tasks/$", views.TasksList.as_view()),
     re_path("^api/v1/tasks/(?P<friendly_token>[\w|\W]*)$", views.TaskDetail.as_view()),
@@ -2,6 +2,7 @@ import csv
 import json
 import logging
 import os
+import re
 import shutil
 from pathlib import Path
 
@@ -14,7 +15,7 @@ from django.contrib.auth.decorators import login_required
 from django.contrib.postgres.search import SearchQuery
 from django.core.mail import EmailMessage, send_mail
 from django.db import transaction
-from django.db.models import Q
+from django.db.models import Count, F, OuterRef, Prefetch, Q, Subquery
 from django.http import HttpResponse, HttpResponseRedirect
 from django.shortcuts import get_object_or_404, render
 from django.template.defaultfilters import slugify
@@ -32,7 +33,7 @@ from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
 from actions.models import USER_MEDIA_ACTIONS, MediaAction
-from cms.custom_pagination import FastPaginationWithoutCount
+from cms.custom_pagination import FastPaginationWithoutCount, KeysetPagination
 from cms.permissions import (
     IsAuthorizedToAdd,
     IsUserOrEditor,
@@ -42,7 +43,16 @@ from cms.permissions import (
 from users.models import User
 from allauth.mfa.utils import is_mfa_enabled
 
-from . import lists
+from . import fair_share, lists, remote_encoding
+from .action_buffer import buffer_user_action
+from .action_rollups import stats_window_start
+from .cache_utils import (
+    get_cached_listing_count,
+    get_cached_search,
+    get_search_cache_key,
+    set_cached_search,
+)
+from .encode_telemetry import GROUPS as ENCODE_REPORT_GROUPS, get_throughput
 from .forms import ContactForm, EditSubtitleForm, MediaForm, SubtitleForm
 from .helpers import (
     clean_friendly_token,
@@ -50,18 +60,20 @@ from .helpers import (
     cleanup_temp_upload_files,
     create_temp_file,
     get_allowed_video_extensions,
-    produce_ffmpeg_commands,
     rm_file,
 )
 from .methods import (
     can_upload_media,
+    get_anonymous_viewer_id,
     get_user_or_session,
     is_media_allowed_type,
     is_mediacms_editor,
     is_mediacms_manager,
     list_tasks,
     notify_user_on_comment,
+    set_thumbnail_media,
     show_recommended_media,
+    show_trending_media,
     show_related_media,
 )
 from .models import (
@@ -80,6 +92,7 @@ from .models import (
     Page,
     Playlist,
     PlaylistMedia,
+    RatingCategory,
     Subtitle,
     Tag,
     Topic,
@@ -101,11 +114,16 @@ from .serializers import (
     TagSerializer,
     TopicSerializer,
     TopMessageSerializer,
+    get_media_card_rows,
+    get_media_card_values,
+    serialize_media_cards,
 )
 from .stop_words import STOP_WORDS
-from .tasks import save_user_action
+from .unique_viewers import count_unique_viewers
 
 VALID_USER_ACTIONS = [action for action, name in USER_MEDIA_ACTIONS]
+# country title -> code, used by search filters
+VIDEO_COUNTRY_CODES = {value: key for key, value in lists.video_countries}
 
 logger = logging.getLogger(__name__)
 
@@ -373,8 +391,8 @@ def view_media(request):
         return render(request, "cms/media.html", context)
         # return HttpResponseRedirect('/')
     user_or_session = get_user_or_session(request)
-    save_user_action.delay(
-        user_or_session, friendly_token=friendly_token, action="watch"
+    buffer_user_action(
+        user_or_session, friendly_token=friendly_token, action="watch", media=media
     )
     context = {}
     context["media"] = friendly_token
@@ -428,8 +446,8 @@ def view_old_media(request, user, video):
     else:
         return HttpResponseRedirect("/")
     user_or_session = get_user_or_session(request)
-    save_user_action.delay(
-        user_or_session, friendly_token=friendly_token, action="watch"
+    buffer_user_action(
+        user_or_session, friendly_token=friendly_token, action="watch", media=media
     )
     context = {}
     context["media"] = friendly_token
@@ -462,7 +480,6 @@ def embed_old_media(request, user, video):
         friendly_token = media["friendly_token"]
     else:
         return HttpResponseRedirect("/")
-    user_or_session = get_user_or_session(request)
     # save_user_action.delay(
     #     user_or_session, friendly_token=friendly_token, action='watch')
     context = {}
@@ -704,6 +721,7 @@ def edit_media(request):
                             # Reset encoding-related fields and save the new media_file
                             media.encoding_status = "pending"
                             media.hls_file = ""
+                            media.hls_manifest = {}
                             media.preview_file_path = ""
                             # Bump edit_date to invalidate caches/CDNs
                             media.edit_date = timezone.now()
@@ -712,6 +730,7 @@ def edit_media(request):
                                     "media_file",  # Save the new media file
                                     "encoding_status",
                                     "hls_file",
+                                    "hls_manifest",
                                     "preview_file_path",
                                     "edit_date",
                                 ]
@@ -903,7 +922,6 @@ def embed_media(request):
     media = Media.objects.values("title").filter(friendly_token=friendly_token).first()
     if not media:
         return HttpResponseRedirect("/")
-    user_or_session = get_user_or_session(request)
     # save_user_action.delay(
     #     user_or_session, friendly_token=friendly_token, action='watch')
     context = {}
@@ -939,13 +957,22 @@ class MediaList(APIView):
             user_queryset = User.objects.all()
             user = get_object_or_404(user_queryset, username=author_param)
         if show_param == "recommended":
-            pagination_class = FastPaginationWithoutCount
-            media = show_recommended_media(request, limit=50)
+            paginator = FastPaginationWithoutCount()
+            media = show_recommended_media(
+                request, limit=50, values=get_media_card_values(MediaSerializer)
+            )
+        elif show_param == "trending":
+            paginator = FastPaginationWithoutCount()
+            media = show_trending_media(
+                request, limit=50, values=get_media_card_values(MediaSerializer)
+            )
         else:
-            pagination_class = api_settings.DEFAULT_PAGINATION_CLASS
+            count_function = get_cached_listing_count
             if author_param:
                 if self.request.user == user:  # SHOW ALL VIDEOS
                     basic_query = Q(user=user)
+                    # non public media don't bump the catalog generation
+                    count_function = None
                 else:
                     basic_query = Q(state="public", is_reviewed=True, user=user)
             else:
@@ -959,15 +986,21 @@ class MediaList(APIView):
                 media = Media.objects.filter(basic_query, featured=True)
             else:
                 media = Media.objects.filter(basic_query).order_by("-add_date")
-        paginator = pagination_class()
-        if offset_param:
-            media = media[int(offset_param) :]
-        if show_param != "recommended":
-            media = media.prefetch_related("user")
+            media = media.values(*get_media_card_values(MediaSerializer))
+
+            if offset_param:
+                # legacy clients, an offset can only be combined with page numbers
+                paginator = api_settings.DEFAULT_PAGINATION_CLASS()
+                media = media[int(offset_param) :]
+            else:
+                # keyset pagination, served as page numbers when a page is given
+                paginator = KeysetPagination(
+                    ordering=("-add_date", "-id"), count_function=count_function
+                )
         page = paginator.paginate_queryset(media, request)
 
-        serializer = MediaSerializer(page, many=True, context={"request": request})
-        return paginator.get_paginated_response(serializer.data)
+        data = serialize_media_cards(page, request, MediaSerializer)
+        return paginator.get_paginated_response(data)
 
     def post(self, request, format=None):
         # Add new media
@@ -987,12 +1020,36 @@ class MediaDetail(APIView):
     permission_classes = (permissions.IsAuthenticatedOrReadOnly, IsUserOrEditor)
     parser_classes = (JSONParser, MultiPartParser, FormParser, FileUploadParser)
 
+    def get_prefetches(self):
+        # everything SingleMediaSerializer walks, so that the media detail
+        # runs a fixed number of queries whatever the taxonomy size
+        prefetches = [
+            "encodings__profile",
+            "category",
+            "topics",
+            "tags",
+            Prefetch(
+                "subtitles",
+                queryset=Subtitle.objects.select_related("language").order_by(
+                    "language__title", "id"
+                ),
+            ),
+        ]
+        if settings.ALLOW_RATINGS:
+            prefetches.append(
+                Prefetch(
+                    "category__ratingcategory_set",
+                    queryset=RatingCategory.objects.filter(enabled=True).order_by("id"),
+                )
+            )
+        return prefetches
+
     def get_object(self, friendly_token, password=None):
         friendly_tone = clean_friendly_token(friendly_token)
         try:
             media = (
-                Media.objects.select_related("user")
-                .prefetch_related("encodings__profile")
+                Media.objects.select_related("user", "license")
+                .prefetch_related(*self.get_prefetches())
                 .get(friendly_token=friendly_token)
             )
             # this need be explicitly called, and will call
@@ -1043,10 +1100,11 @@ class MediaDetail(APIView):
             related_media = []
         else:
             related_media = show_related_media(media, request=request, limit=100)
-            related_media_serializer = MediaSerializer(
-                related_media, many=True, context={"request": request}
+            related_media = serialize_media_cards(
+                get_media_card_rows(related_media, MediaSerializer),
+                request,
+                MediaSerializer,
             )
-            related_media = related_media_serializer.data
         ret = serializer.data
         ret["related_media"] = related_media
         return Response(ret)
@@ -1198,11 +1256,12 @@ class MediaActions(APIView):
                 )
         if action:
             user_or_session = get_user_or_session(request)
-            save_user_action.delay(
+            buffer_user_action(
                 user_or_session,
                 friendly_token=media.friendly_token,
                 action=action,
                 extra_info=extra,
+                media=media,
             )
 
             return Response(
@@ -1268,6 +1327,46 @@ class MediaActions(APIView):
         )
 
 
+# longest period of MediaStats, in days
+MEDIA_STATS_MAX_DAYS = 366
+
+
+class MediaStats(APIView):
+    """Audience of a media, for its owner and editors/managers"""
+
+    def get(self, request, friendly_token, format=None):
+        media = Media.objects.filter(friendly_token=friendly_token).first()
+        if not media:
+            return Response(
+                {"detail": "media file does not exist"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        if not (
+            request.user == media.user
+            or is_mediacms_editor(request.user)
+            or is_mediacms_manager(request.user)
+        ):
+            return Response(
+                {"detail": "not allowed"}, status=status.HTTP_403_FORBIDDEN
+            )
+        try:
+            days = min(max(int(request.GET.get("days", 30)), 1), MEDIA_STATS_MAX_DAYS)
+        except ValueError:
+            return Response(
+                {"detail": "days must be a number"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        since = stats_window_start(days)
+        ret = {
+            "views": media.views,
+            "likes": media.likes,
+            "dislikes": media.dislikes,
+            "since": since,
+            # approximate, None without Redis
+            "unique_viewers": count_unique_viewers(media.id, since),
+        }
+        return Response(ret, status=status.HTTP_200_OK)
+
+
 class MediaSearch(APIView):
     parser_classes = (JSONParser,)
 
@@ -1307,8 +1406,7 @@ class MediaSearch(APIView):
             ret = {}
             return Response(ret, status=status.HTTP_200_OK)
 
-        media = Media.objects.filter(state="public", is_reviewed=True)
-
+        q_parts = []
         if query:
             query = clean_query(query)
             q_parts = [
@@ -1316,13 +1414,41 @@ class MediaSearch(APIView):
                 for q_part in query.split()
                 if q_part not in STOP_WORDS
             ]
-            if q_parts:
-                query = SearchQuery(q_parts[0] + ":*", search_type="raw")
-                for part in q_parts[1:]:
-                    query &= SearchQuery(part + ":*", search_type="raw")
-            else:
-                query = None
-        if query:
+        show_titles = show_param == "titles"
+
+        # identical searches (eg tag and category landing pages) are served
+        # from cache, keyed on the normalized parameters
+        cache_key = None
+        if getattr(settings, "ENABLE_SEARCH_CACHE", True):
+            cache_key = get_search_cache_key(
+                {
+                    "host": request.build_absolute_uri("/"),
+                    "q": sorted(set(q_parts)),
+                    "c": category,
+                    "t": tag,
+                    "language": language,
+                    "country": country,
+                    "topic": topic,
+                    "media_type": media_type,
+                    "author": author,
+                    "license": license,
+                    "upload_date": upload_date,
+                    "sort": f"{ordering}{sort_by}",
+                    "titles": show_titles,
+                    "page": "" if show_titles else params.get("page", "").strip(),
+                    "cursor": "" if show_titles else params.get("cursor", "").strip(),
+                }
+            )
+            ret = get_cached_search(cache_key)
+            if ret is not None:
+                return Response(ret, status=status.HTTP_200_OK)
+
+        media = Media.objects.filter(state="public", is_reviewed=True)
+
+        if q_parts:
+            query = SearchQuery(q_parts[0] + ":*", search_type="raw")
+            for part in q_parts[1:]:
+                query &= SearchQuery(part + ":*", search_type="raw")
             media = media.filter(search=query)
 
         if tag:
@@ -1335,18 +1461,18 @@ class MediaSearch(APIView):
             media = media.filter(topics__title__contains=topic)
 
         if language:
-            language = {
-                value: key
-                for key, value in Language.objects.exclude(
+            language = (
+                Language.objects.exclude(
                     code__in=["automatic", "automatic-translation"]
-                ).values_list("code", "title")
-            }.get(language)
+                )
+                .filter(title=language)
+                .values_list("code", flat=True)
+                .first()
+            )
             media = media.filter(media_language=language)
 
         if country:
-            country = {
-                value: key for key, value in dict(lists.video_countries).items()
-            }.get(country)
+            country = VIDEO_COUNTRY_CODES.get(country)
             media = media.filter(media_country=country)
 
         if media_type:
@@ -1385,22 +1511,21 @@ class MediaSearch(APIView):
 
         media = media.order_by(f"{ordering}{sort_by}")
 
-        if self.request.query_params.get("show", "").strip() == "titles":
-            media = media.values("title")[:40]
-            return Response(media, status=status.HTTP_200_OK)
+        if show_titles:
+            ret = list(media.values("title")[:40])
         else:
-            media = media.prefetch_related("user")
-            if category or tag:
-                pagination_class = api_settings.DEFAULT_PAGINATION_CLASS
-            else:
-                # pagination_class = FastPaginationWithoutCount
-                pagination_class = api_settings.DEFAULT_PAGINATION_CLASS
-            paginator = pagination_class()
-            page = paginator.paginate_queryset(media, request)
-            serializer = MediaSearchSerializer(
-                page, many=True, context={"request": request}
+            media = media.values(*get_media_card_values(MediaSearchSerializer))
+            paginator = KeysetPagination(
+                ordering=(f"{ordering}{sort_by}", f"{ordering}id"),
+                count_function=get_cached_listing_count,
             )
-            return paginator.get_paginated_response(serializer.data)
+            page = paginator.paginate_queryset(media, request)
+            data = serialize_media_cards(page, request, MediaSearchSerializer)
+            ret = paginator.get_paginated_response(data).data
+
+        if cache_key:
+            set_cached_search(cache_key, ret)
+        return Response(ret, status=status.HTTP_200_OK)
 
 
 class EncodeProfileList(APIView):
@@ -1421,6 +1546,42 @@ class TasksList(APIView):
         return Response(ret)
 
 
+class EncodeStats(APIView):
+    """Encoding throughput over the last days, grouped"""
+
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request, format=None):
+        try:
+            days = min(max(int(request.GET.get("days", 7)), 1), MEDIA_STATS_MAX_DAYS)
+        except ValueError:
+            return Response(
+                {"detail": "days must be a number"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        group_by = [g for g in request.GET.get("by", "profile").split(",") if g]
+        if not group_by or any(g not in ENCODE_REPORT_GROUPS for g in group_by):
+            return Response(
+                {"detail": f"by must be some of {', '.join(ENCODE_REPORT_GROUPS)}"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        since = timezone.now() - timedelta(days=days)
+        ret = {
+            "since": since,
+            "group_by": group_by,
+            "results": get_throughput(since, group_by=group_by),
+        }
+        return Response(ret, status=status.HTTP_200_OK)
+
+
+class EncodeQueue(APIView):
+    """Encodes queued and released per uploader, see files/fair_share.py"""
+
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request, format=None):
+        return Response(fair_share.get_queue_stats(), status=status.HTTP_200_OK)
+
+
 class TaskDetail(APIView):
     """
     Cancel a task
@@ -1440,13 +1601,24 @@ class PlaylistList(APIView):
     def get(self, request, format=None):
         pagination_class = api_settings.DEFAULT_PAGINATION_CLASS
         paginator = pagination_class()
-        playlists = Playlist.objects.filter().prefetch_related("user")
+        playlists = (
+            Playlist.objects.filter()
+            .prefetch_related("user")
+            .annotate(
+                annotated_media_count=Count("media"),
+                thumbnail_media_id=Subquery(
+                    PlaylistMedia.objects.filter(playlist=OuterRef("pk")).values(
+                        "media_id"
+                    )[:1]
+                ),
+            )
+        )
 
         if "author" in self.request.query_params:
             author = self.request.query_params["author"].strip()
             playlists = playlists.filter(user__username=author)
 
-        page = paginator.paginate_queryset(playlists, request)
+        page = set_thumbnail_media(paginator.paginate_queryset(playlists, request))
 
         serializer = PlaylistSerializer(page, many=True, context={"request": request})
         return paginator.get_paginated_response(serializer.data)
@@ -1637,10 +1809,69 @@ class PlaylistDetail(APIView):
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+class EncodingLease(APIView):
+    """
+    Lease the oldest pending encoding to a remote worker, see
+    files/remote_encoding.py
+    """
+
+    permission_classes = (permissions.IsAdminUser,)
+
+    def post(self, request, format=None):
+        worker = request.data.get("worker", "")
+        if not worker:
+            return Response(
+                {"detail": "worker is required"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        while True:
+            encoding = remote_encoding.lease_encoding(worker)
+            if encoding is None:
+                return Response(status=status.HTTP_204_NO_CONTENT)
+            ret = remote_encoding.get_start_info(encoding)
+            if ret:
+                return Response(ret, status=status.HTTP_201_CREATED)
+            # no commands for this profile, like encode_media
+            encoding.status = "fail"
+            encoding.save(update_fields=["status"])
+
+
+# telemetry remote workers report, see files/encode_telemetry.py
+REMOTE_TELEMETRY_FIELDS = {
+    "wall_time": float,
+    "cpu_time": float,
+    "max_rss": int,
+    "speed": float,
+    "bitrate": int,
+    "output_size": int,
+    "preset": str,
+    "crf": int,
+    "pass_mode": str,
+}
+RE_CONTENT_RANGE = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+
+
 class EncodingDetail(APIView):
     permission_classes = (permissions.IsAdminUser,)
     parser_classes = (JSONParser, MultiPartParser, FormParser, FileUploadParser)
 
+    def get(self, request, encoding_id, format=None):
+        # state of a lease, and bytes uploaded so far by a worker
+        encoding = Encoding.objects.filter(id=encoding_id).first()
+        if not encoding:
+            return Response(
+                {"detail": "encoding does not exist"},
+                status=status.HTTP_404_NOT_FOUND,
+            )
+        worker = request.GET.get("worker", "")
+        upload_path = remote_encoding.get_upload_path(encoding.id, worker)
+        ret = {
+            "status": encoding.status,
+            "worker": encoding.worker,
+            "lease_expires": encoding.lease_expires,
+            "uploaded": os.path.getsize(upload_path) if os.path.exists(upload_path) else 0,
+        }
+        return Response(ret, status=status.HTTP_200_OK)
+
     def post(self, request, encoding_id):
         ret = {}
         force = request.data.get("force", False)
@@ -1691,50 +1922,26 @@ class EncodingDetail(APIView):
                 encoding.task_id = task_id
 
             encoding.save()
-            if chunk:
-                original_media_path = chunk_file_path
-                original_media_md5sum = encoding.md5sum
-                original_media_url = (
-                    settings.SSL_FRONTEND_HOST + encoding.media_chunk_url
-                )
-            else:
-                original_media_path = media.media_file.path
-                original_media_md5sum = media.md5sum
-                original_media_url = (
-                    settings.SSL_FRONTEND_HOST + media.original_media_url
-                )
-
-            ret["original_media_url"] = original_media_url
-            ret["original_media_path"] = original_media_path
-            ret["original_media_md5sum"] = original_media_md5sum
-
-            # generating the commands here, and will replace these with temporary
-            # files created on the remote server
-            tf = "TEMP_FILE_REPLACE"
-            tfpass = "TEMP_FPASS_FILE_REPLACE"
-            ffmpeg_commands = produce_ffmpeg_commands(
-                original_media_path,
-                media.media_info,
-                resolution=profile.resolution,
-                codec=profile.codec,
-                output_filename=tf,
-                pass_file=tfpass,
-                chunk=chunk,
-            )
-            if not ffmpeg_commands:
+            # generating the commands here, with placeholders for the
+            # temporary files created on the remote server
+            ret = remote_encoding.get_start_info(encoding)
+            if not ret:
                 encoding.delete()
                 return Response({"status": "fail"}, status=status.HTTP_400_BAD_REQUEST)
-
-            ret["duration"] = media.duration
-            ret["ffmpeg_commands"] = ffmpeg_commands
-            ret["profile_extension"] = profile.extension
             return Response(ret, status=status.HTTP_201_CREATED)
         elif action == "update_fields":
             try:
                 encoding = Encoding.objects.get(id=encoding_id)
             except:
                 return Response({"status": "fail"}, status=status.HTTP_400_BAD_REQUEST)
+            if not remote_encoding.holds_lease(encoding, worker):
+                return Response(
+                    {"detail": "lease lost"}, status=status.HTTP_409_CONFLICT
+                )
             to_update = ["size", "update_date"]
+            if encoding.lease_expires is not None and encoding_status not in ("success", "fail"):
+                remote_encoding.renew_lease(encoding)
+                to_update.append("lease_expires")
             if encoding_status:
                 encoding.status = encoding_status
                 to_update.append("status")
@@ -1764,13 +1971,26 @@ class EncodingDetail(APIView):
                 encoding.retries = retries
                 to_update.append("retries")
 
+            for field, cast in REMOTE_TELEMETRY_FIELDS.items():
+                if request.data.get(field) not in (None, ""):
+                    try:
+                        setattr(encoding, field, cast(request.data[field]))
+                    except (TypeError, ValueError):
+                        return Response(
+                            {"detail": f"bad {field}"}, status=status.HTTP_400_BAD_REQUEST
+                        )
+                    to_update.append(field)
+
             try:
                 encoding.save(update_fields=to_update)
             except:
                 return Response({"status": "fail"}, status=status.HTTP_400_BAD_REQUEST)
-            return Response({"status": "success"}, status=status.HTTP_201_CREATED)
+            ret = {"status": "success", "lease_expires": encoding.lease_expires}
+            return Response(ret, status=status.HTTP_201_CREATED)
 
     def put(self, request, encoding_id, format=None):
+        if "HTTP_CONTENT_RANGE" in request.META:
+            return self.put_range(request, encoding_id)
         encoding_file = request.data["file"]
         encoding = Encoding.objects.filter(id=encoding_id).first()
         if not encoding:
@@ -1782,6 +2002,37 @@ class EncodingDetail(APIView):
         encoding.save()
         return Response({"detail": "ok"}, status=status.HTTP_201_CREATED)
 
+    def put_range(self, request, encoding_id):
+        # resumable upload of the output, one range per request, with
+        # Content-Range: bytes start-end/total and the raw bytes as body
+        match = RE_CONTENT_RANGE.match(request.META["HTTP_CONTENT_RANGE"])
+        if not match:
+            return Response(
+                {"detail": "bad Content-Range"}, status=status.HTTP_400_BAD_REQUEST
+            )
+        start, end, total = (int(n) for n in match.groups())
+        data = request.body
+        if end - start + 1 != len(data):
+            return Response(
+                {"detail": "Content-Range does not match the body"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        encoding = Encoding.objects.filter(id=encoding_id).first()
+        if not encoding:
+            return Response(
+                {"detail": "encoding does not exist"},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        worker = request.GET.get("worker", "")
+        if not remote_encoding.holds_lease(encoding, worker):
+            return Response({"detail": "lease lost"}, status=status.HTTP_409_CONFLICT)
+        taken, uploaded = remote_encoding.append_upload(
+            encoding, worker, data, start, total, md5sum=request.META.get("HTTP_X_MD5SUM", "")
+        )
+        if not taken:
+            return Response({"uploaded": uploaded}, status=status.HTTP_409_CONFLICT)
+        return Response({"uploaded": uploaded}, status=status.HTTP_200_OK)
+
 
 class CommentList(APIView):
     permission_classes = (permissions.IsAuthenticated, IsAuthorizedToAdd)
@@ -1896,7 +2147,10 @@ class UserActions(APIView):
     parser_classes = (JSONParser,)
 
     def get(self, request, action):
-        media = []
+        media = Media.objects.none()
+        viewer_id = None
+        if not request.user.is_authenticated:
+            viewer_id = get_anonymous_viewer_id(request, create=False)
         if action in VALID_USER_ACTIONS:
             if request.user.is_authenticated:
                 media = (
@@ -1906,26 +2160,43 @@ class UserActions(APIView):
                     )
                     .order_by("-mediaactions__action_date")
                 )
-            elif request.session.session_key:
+            elif viewer_id:
                 media = (
                     Media.objects.select_related("user")
                     .filter(
-                        mediaactions__session_key=request.session.session_key,
+                        mediaactions__session_key=viewer_id,
                         mediaactions__action=action,
                     )
                     .order_by("-mediaactions__action_date")
                 )
 
-        pagination_class = api_settings.DEFAULT_PAGINATION_CLASS
-        paginator = pagination_class()
+        # history is paged on the action, not on the media
+        media = media.annotate(
+            action_date=F("mediaactions__action_date"),
+            action_id=F("mediaactions__id"),
+        ).values(*get_media_card_values(MediaSerializer, "action_date", "action_id"))
+        paginator = KeysetPagination(ordering=("-action_date", "-action_id"))
         page = paginator.paginate_queryset(media, request)
-        serializer = MediaSerializer(page, many=True, context={"request": request})
-        return paginator.get_paginated_response(serializer.data)
+        data = serialize_media_cards(page, request, MediaSerializer)
+        return paginator.get_paginated_response(data)
 
 
 class CategoryList(APIView):
     def get(self, request, format=None):
-        categories = Category.objects.filter().order_by("title")
+        categories = (
+            Category.objects.filter()
+            .select_related("user")
+            .annotate(
+                # thumbnail for categories without one
+                thumbnail_media_id=Subquery(
+                    Media.objects.filter(category=OuterRef("pk"), state="public")
+                    .order_by("-views")
+                    .values("id")[:1]
+                )
+            )
+            .order_by("title")
+        )
+        categories = set_thumbnail_media(categories)
         serializer = CategorySerializer(
             categories, many=True, context={"request": request}
         )
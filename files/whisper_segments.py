@@ -0,0 +1,232 @@
+"""
+Segmented whisper.cpp transcription of long media.
+
+whisper_transcribe ran one whisper.cpp process over the whole audio of a
+media, so a two hour film kept a whisper worker busy for hours, on the few
+threads of one process. Media longer than WHISPER_SEGMENTED_DURATION are
+now cut into windows of about WHISPER_SEGMENT_SECONDS, at the silence
+(ffmpeg silencedetect) closest to each cut, so no word is split. The
+windows are transcribed concurrently, by whisper.cpp processes of
+WHISPER_SEGMENT_THREADS threads each, as many as the cores of the host
+hold (or WHISPER_SEGMENT_PROCESSES), and their VTT cues merged into one
+VTT with the offsets of the windows added.
+
+whisper.cpp runs with --max-context 0, so windows lose no context the
+single process would have carried over.
+
+Functions:
+    - is_segmented: Whether a media is transcribed in windows
+    - detect_silences: Silences of an audio file
+    - plan_windows: Windows of an audio file, cut at silences
+    - split_audio: Cut an audio file into windows
+    - merge_vtt: Merge the VTT of windows into one
+    - transcribe: Transcribe an audio file in windows, concurrently
+"""
+
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+
+from . import processes
+
+logger = logging.getLogger(__name__)
+
+# silencedetect noise floor and shortest silence, in seconds
+SILENCE_NOISE = "-30dB"
+SILENCE_DURATION = 0.5
+# how far from a cut a silence may be, as a part of the window length
+CUT_TOLERANCE = 0.25
+SILENCE_RE = re.compile(r"silence_(start|end): (-?[\d.]+)")
+TIMESTAMP_RE = re.compile(r"(?:(\d+):)?(\d+):(\d+)[.,](\d+)")
+
+
+def is_segmented(media) -> bool:
+    return bool(
+        settings.WHISPER_SEGMENTED_DURATION
+        and media.duration
+        and media.duration > settings.WHISPER_SEGMENTED_DURATION
+    )
+
+
+def get_pool_size() -> int:
+    """whisper.cpp processes run at once, by the cores of the host"""
+    if settings.WHISPER_SEGMENT_PROCESSES:
+        return settings.WHISPER_SEGMENT_PROCESSES
+    return max(1, (os.cpu_count() or 1) // settings.WHISPER_SEGMENT_THREADS)
+
+
+def detect_silences(audio_file: str) -> List[Tuple[float, float]]:
+    """(start, end) of the silences of an audio file, in seconds"""
+    cmd = [
+        settings.FFMPEG_COMMAND,
+        "-i",
+        audio_file,
+        "-af",
+        f"silencedetect=noise={SILENCE_NOISE}:d={SILENCE_DURATION}",
+        "-f",
+        "null",
+        "-",
+    ]
+    ret = processes.run(cmd)
+    silences, start = [], None
+    for kind, value in SILENCE_RE.findall(ret.stderr.decode("utf-8", "ignore")):
+        if kind == "start":
+            start = max(float(value), 0)
+        elif start is not None:
+            silences.append((start, float(value)))
+            start = None
+    return silences
+
+
+def plan_windows(
+    duration: float, silences: List[Tuple[float, float]], length: float
+) -> List[Tuple[float, Optional[float]]]:
+    """
+    (start, end) of windows of about length seconds, cut in the middle of
+    the silence closest to each cut, or at the cut without one nearby.
+    The last window ends with the audio, its end is None.
+    """
+    middles = [(start + end) / 2 for start, end in silences]
+    windows = []
+    start = 0.0
+    while duration - start > length * (1 + CUT_TOLERANCE):
+        target = start + length
+        nearby = [m for m in middles if abs(m - target) <= length * CUT_TOLERANCE]
+        cut = min(nearby, key=lambda m: abs(m - target)) if nearby else target
+        windows.append((start, cut))
+        start = cut
+    windows.append((start, None))
+    return windows
+
+
+def split_audio(audio_file: str, windows, directory: str) -> List[str]:
+    """Cut an audio file into windows, in one pass. Returns their files"""
+    cuts = [end for _, end in windows if end is not None]
+    if not cuts:
+        return [audio_file]
+    pattern = os.path.join(directory, "window_%04d.wav")
+    cmd = [
+        settings.FFMPEG_COMMAND,
+        "-y",
+        "-i",
+        audio_file,
+        "-c",
+        "copy",
+        "-f",
+        "segment",
+        "-segment_times",
+        ",".join(f"{cut:.3f}" for cut in cuts),
+        "-reset_timestamps",
+        "1",
+        pattern,
+    ]
+    ret = processes.run(cmd)
+    if ret.returncode != 0:
+        stderr = ret.stderr.decode("utf-8", "ignore")
+        raise RuntimeError(f"ffmpeg failed to split audio: {stderr[-2000:]}")
+    files = [pattern % i for i in range(len(windows))]
+    missing = [f for f in files if not os.path.exists(f)]
+    if missing:
+        raise RuntimeError(f"ffmpeg did not write windows {missing}")
+    return files
+
+
+def parse_timestamp(value: str) -> float:
+    hours, minutes, seconds, millis = TIMESTAMP_RE.match(value.strip()).groups()
+    return int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds) + int(millis) / 1000
+
+
+def format_timestamp(seconds: float) -> str:
+    millis = int(round(seconds * 1000))
+    hours, millis = divmod(millis, 3600 * 1000)
+    minutes, millis = divmod(millis, 60 * 1000)
+    seconds, millis = divmod(millis, 1000)
+    return f"{hours:02d}:{minutes:02d}:{seconds:02d}.{millis:03d}"
+
+
+def read_cues(vtt_file: str) -> List[Tuple[float, float, str]]:
+    """(start, end, text) of the cues of a VTT file"""
+    with open(vtt_file, encoding="utf-8") as f:
+        blocks = re.split(r"\n\s*\n", f.read().replace("\r\n", "\n"))
+    cues = []
+    for block in blocks:
+        lines = block.strip("\n").split("\n")
+        for i, line in enumerate(lines):
+            if "-->" in line:
+                start, end = line.split("-->")
+                end = end.strip().split()[0]
+                text = "\n".join(lines[i + 1 :])
+                if text.strip():
+                    cues.append((parse_timestamp(start), parse_timestamp(end), text))
+                break
+    return cues
+
+
+def merge_vtt(parts: List[Tuple[float, str]], output_file: str) -> int:
+    """
+    Merge the VTT files of windows, as (offset, file), into one VTT with
+    the offsets added to the cues. Returns the number of cues.
+    """
+    cues = []
+    for offset, vtt_file in parts:
+        for start, end, text in read_cues(vtt_file):
+            cues.append((start + offset, end + offset, text))
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write("WEBVTT\n\n")
+        for start, end, text in cues:
+            f.write(f"{format_timestamp(start)} --> {format_timestamp(end)}\n{text}\n\n")
+    return len(cues)
+
+
+def transcribe_window(whisper_cmd: List[str], audio_file: str) -> str:
+    """Run whisper.cpp on a window, returns its VTT file"""
+    output_name = os.path.splitext(audio_file)[0]
+    cmd = [
+        *whisper_cmd,
+        "--threads",
+        str(settings.WHISPER_SEGMENT_THREADS),
+        "-f",
+        audio_file,
+        "--output-vtt",
+        "--output-file",
+        output_name,
+    ]
+    ret = processes.run(cmd)
+    if ret.returncode != 0:
+        raise RuntimeError(
+            f"whisper.cpp failed on {audio_file} with return code {ret.returncode}: "
+            f"{ret.stderr.decode('utf-8', 'ignore')[-2000:]}"
+        )
+    vtt_file = f"{output_name}.vtt"
+    if not os.path.exists(vtt_file):
+        raise RuntimeError(f"whisper.cpp did not write {vtt_file}")
+    return vtt_file
+
+
+def transcribe(
+    audio_file: str, duration: float, whisper_cmd: List[str], output_file: str, directory: str
+) -> int:
+    """
+    Transcribe an audio file in windows, concurrently, into the VTT
+    output_file. whisper_cmd is the whisper.cpp command without its input
+    and output options.
+
+    Returns:
+        int: Number of cues
+
+    Raises:
+        RuntimeError: if ffmpeg or whisper.cpp fails on a window
+    """
+    silences = detect_silences(audio_file)
+    windows = plan_windows(duration, silences, settings.WHISPER_SEGMENT_SECONDS)
+    files = split_audio(audio_file, windows, directory)
+    pool_size = min(get_pool_size(), len(files))
+    logger.info(f"Transcribing {audio_file} in {len(files)} windows, {pool_size} at a time")
+    # the pool threads wait on whisper.cpp processes, that run in parallel
+    with ThreadPoolExecutor(max_workers=pool_size) as pool:
+        vtt_files = list(pool.map(lambda f: transcribe_window(whisper_cmd, f), files))
+    return merge_vtt([(start, vtt) for (start, _), vtt in zip(windows, vtt_files)], output_file)
@@ -95,9 +95,10 @@ class User(AbstractUser):
 
     @property
     def email_is_verified(self):
-        if self.emailaddress_set.first():
-            if self.emailaddress_set.first().verified:
-                return True
+        # emailaddress_set may be prefetched, eg on user listings
+        email_address = next(iter(self.emailaddress_set.all()), None)
+        if email_address and email_address.verified:
+            return True
         return False
 
     def get_absolute_url(self, api=False):
@@ -237,6 +238,18 @@ Visit user profile page at %s
             email.send(fail_silently=True)
 
 
+@receiver(post_save, sender=User)
+def update_author_listing_cards(sender, instance, created, update_fields=None, **kwargs):
+    # media listing cards carry the author name, profile url and logo
+    if created:
+        return
+    if update_fields is not None and not {"name", "username", "logo"}.intersection(
+        update_fields
+    ):
+        return
+    Media.update_author_listing_cards(instance)
+
+
 NOTIFICATION_METHODS = (("email", "Email"),)
 
 
@@ -39,6 +39,11 @@ urlpatterns = [
         views.UserDetail.as_view(),
         name="api_get_user",
     ),
+    re_path(
+        r"^api/v1/users/(?P<username>[\w@._-]*)/stats$",
+        views.user_stats,
+        name="api_user_stats",
+    ),
     re_path(
         r"^api/v1/users/(?P<username>[\w@._-]*)/contact",
         views.contact_user,
@@ -18,6 +18,7 @@ from rest_framework.settings import api_settings
 from rest_framework.views import APIView
 
 from cms.permissions import IsUserOrManager
+from files.action_rollups import get_user_stats, stats_window_start
 from files.lists import video_countries
 from files.methods import is_mediacms_editor, is_mediacms_manager
 
@@ -210,6 +211,39 @@ Sender email: %s\n
     return Response(status=status.HTTP_204_NO_CONTENT)
 
 
+# longest period of user_stats, in days
+USER_STATS_MAX_DAYS = 366
+
+
+@api_view(["GET"])
+def user_stats(request, username):
+    # daily watch/like/dislike/report counts on the media of a user, from
+    # the daily rollups, for the user and editors/managers
+    user = User.objects.filter(username=username).first()
+    if not user:
+        return Response(
+            {"detail": "user does not exist"}, status=status.HTTP_404_NOT_FOUND
+        )
+    if not (
+        request.user == user
+        or is_mediacms_editor(request.user)
+        or is_mediacms_manager(request.user)
+    ):
+        return Response(
+            {"detail": "not enough permissions"}, status=status.HTTP_403_FORBIDDEN
+        )
+    try:
+        days = min(max(int(request.GET.get("days", 30)), 1), USER_STATS_MAX_DAYS)
+    except ValueError:
+        return Response(
+            {"detail": "days must be a number"}, status=status.HTTP_400_BAD_REQUEST
+        )
+    since = stats_window_start(days)
+    stats = get_user_stats(user, since)
+    stats["since"] = since
+    return Response(stats)
+
+
 class UserList(APIView):
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
     parser_classes = (JSONParser, MultiPartParser, FormParser, FileUploadParser)
@@ -219,6 +253,7 @@ class UserList(APIView):
         paginator = pagination_class()
         users = (
             User.objects.filter()
+            .prefetch_related("emailaddress_set")
             .exclude(username="emnews")
             .order_by("-advancedUser", "-last_published_video_datetime")
         )